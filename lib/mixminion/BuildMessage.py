@@ -592,8 +592,15 @@ def _buildHeader(path,secrets,exitType,exitInfo,paddingPRNG):
         raise MixError("Path cannot fit in header")
 
     # headerKey[i]==the AES key object node i will use to decrypt the header
-    headerKeys = [ Crypto.Keyset(secret).get(Crypto.HEADER_SECRET_MODE)
-                       for secret in secrets ]
+    # junkKeys[i]==the AES key object node i will use to generate padding
+    headerKeys = []
+    junkKeys = []
+    for secret in secrets:
+        hk, jk = Crypto.Keyset(secret).getKeys(
+            ((Crypto.HEADER_SECRET_MODE, 'aes'),
+             (Crypto.RANDOM_JUNK_MODE, 'aes')))
+        headerKeys.append(hk)
+        junkKeys.append(jk)
 
     # Length of padding needed for the header
     paddingLen = HEADER_LEN - totalSize
@@ -603,14 +610,12 @@ def _buildHeader(path,secrets,exitType,exitInfo,paddingPRNG):
     #                encryption.   Note that junkSeen[0]=="", because node 0
     #                sees no junk.
     junkSeen = [""]
-    for secret, headerKey, size in zip(secrets, headerKeys, sizes):
+    for headerKey, prngKey, size in zip(headerKeys, junkKeys, sizes):
         # Here we're calculating the junk that node i+1 will see.
         #
         # Node i+1 sees the junk that node i saw, plus the junk that i appends,
         # all encrypted by i.
 
-        prngKey = Crypto.Keyset(secret).get(Crypto.RANDOM_JUNK_MODE)
-
         # newJunk is the junk that node i will append. (It's as long as
         #   the data that i removes.)
         newJunk = Crypto.prng(prngKey,size)
@@ -709,9 +714,9 @@ def _constructMessage(secrets1, secrets2, header1, header2, payload):
     # Now, encrypt header2 and the payload for each node in path1, reversed.
     secrets1.reverse()
     for secret in secrets1:
-        ks = Crypto.Keyset(secret)
-        hkey = ks.getLionessKeys(Crypto.HEADER_ENCRYPT_MODE)
-        pkey = ks.getLionessKeys(Crypto.PAYLOAD_ENCRYPT_MODE)
+        hkey, pkey = Crypto.Keyset(secret).getKeys(
+            ((Crypto.HEADER_ENCRYPT_MODE, 'lioness'),
+             (Crypto.PAYLOAD_ENCRYPT_MODE, 'lioness')))
         header2 = Crypto.lioness_encrypt(header2,hkey)
         payload = Crypto.lioness_encrypt(payload,pkey)
 
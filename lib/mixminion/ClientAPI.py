@@ -317,11 +317,21 @@ class ClientEnv:
             raise KeyError(name)
         return Mix(name, servers)
 
-    def updateDirectory(self, force=0):
+    def updateDirectory(self, force=0, background=0, onDone=None):
         """If the directory is stale, or if 'force' is true, download
            a fresh directory.
+
+           If 'background' is true and we already have a directory, return
+           at once, and keep using the old directory until the new one
+           has been downloaded and validated in another thread.  When
+           that thread is done, it calls onDone(None) on success, or
+           onDone(exception) on failure.
         """
-        self._getClientDirectory().update(force=force)
+        if background:
+            self._getClientDirectory().updateInBackground(force=force,
+                                                          onDone=onDone)
+        else:
+            self._getClientDirectory().update(force=force)
 
     def _getPathDuration(self, messageDest):
         if messageDest.isSURB():
@@ -18,6 +18,7 @@ import os
 import re
 import socket
 import stat
+import sys
 import threading
 import time
 import types
@@ -33,8 +34,8 @@ import mixminion.ServerInfo
 
 from mixminion.Common import LOG, MixError, MixFatalError, UIError, \
      ceilDiv, createPrivateDir, formatDate, formatFnameTime, openUnique, \
-     previousMidnight, readPickled, readPossiblyGzippedFile, \
-     replaceFile, tryUnlink, writePickled, floorDiv, isSMTPMailbox
+     previousMidnight, readFile, readPickled, readPossiblyGzippedFile, \
+     replaceFile, tryUnlink, writeFile, writePickled, floorDiv, isSMTPMailbox
 from mixminion.Packet import MBOX_TYPE, SMTP_TYPE, DROP_TYPE, FRAGMENT_TYPE, \
      parseMBOXInfo, parseRelayInfoByType, parseSMTPInfo, ParseError, \
      ServerSideFragmentedMessage
@@ -328,13 +329,17 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
     """
     ## Fields:
     # fnameBase: The name of the file where we'll store a cached directory.
-    #   We may append '.gz' or '_new' or '_new.gz' as appropriate.
+    #   We may append '.gz' or '_new' or '_new.gz' as appropriate.  We keep
+    #   the URL and entity tag of the cached directory in fnameBase+".etag",
+    #   so that we can ask the server not to resend an unchanged one.
     # serverDir: An instance of mixminion.ServerInfo.ServerDirectory, or
     #   None.
     # lastDownload: When did we last download the directory?
     # __downloading: Boolean: are we currently downloading a new directory?
     # timeout: How long do we wait when trying to download?  A number
     #   of seconds, or None.
+    # url: The URL to download directories from, or None to use
+    #   MIXMINION_DIRECTORY_URL.
     MAGIC = "BDBS-0.1"
     def __init__(self, state):
         """Create a new DirectoryBackedDescriptorSource"""
@@ -346,6 +351,7 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
         self._changed = 1
         self.__downloading = 0
         self.timeout = None
+        self.url = None
 
     def getServerList(self):
         if self.serverDir is None:
@@ -353,6 +359,10 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
         else:
             return self.serverDir.getAllServers()
 
+    def hasDirectory(self):
+        """Return true iff we have a directory, even a stale one."""
+        return self.serverDir is not None
+
     def getRecommendedNicknames(self):
         if self.serverDir is None:
             return []
@@ -376,6 +386,11 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
             self.timeout = int(timeout)
         else:
             self.timeout = None
+        urls = config.get('DirectoryServers',{}).get('ServerURL',None)
+        if urls:
+            self.url = urls[0]
+        else:
+            self.url = None
 
     def rescan(self, force=0):
         if not self.fnameBase:
@@ -414,7 +429,7 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
         if now is None:
             now = time.time()
         if url is None:
-            url = MIXMINION_DIRECTORY_URL
+            url = self.url or MIXMINION_DIRECTORY_URL
 
         if (self.serverDir is None or forceDownload or
             self.lastDownload < previousMidnight(now)):
@@ -466,11 +481,21 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
                 # Tell HTTP proxies and their ilk not to cache the directory.
                 # Really, the directory server should set an Expires header
                 # in its response, but that's harder.
-                request = urllib2.Request(url,
-                          headers={ 'Pragma' : 'no-cache',
-                                    'Cache-Control' : 'no-cache', })
+                headers = { 'Pragma' : 'no-cache',
+                            'Cache-Control' : 'no-cache', }
+                # If we have this URL's directory, let the server tell us
+                # it's unchanged rather than resending it.
+                etag = self._getCachedETag(url)
+                if etag:
+                    headers['If-None-Match'] = etag
+                request = urllib2.Request(url, headers=headers)
                 startTime = time.time()
                 infile = urllib2.urlopen(request)
+            except urllib2.HTTPError, e:
+                if e.code != 304 or not etag:
+                    raise DirectoryDownloadError(
+                        "Couldn't download directory: %s"%e)
+                infile = None
             except IOError, e:
                 #XXXX008 the "-D no" note makes no sense for servers.
                 raise DirectoryDownloadError(
@@ -490,6 +515,11 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
             if self.timeout:
                 mixminion.NetUtils.unsetGlobalTimeout()
 
+        if infile is None:
+            LOG.info("Directory is unchanged")
+            self._markDirectoryFresh(lock)
+            return
+
         if url.endswith(".gz"):
             isGzipped = 1
             tmpname = self.fnameBase + "_new.gz"
@@ -543,6 +573,12 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
             replaceFile(tmpname, self.fnameBase)
             tryUnlink(self.fnameBase+".gz")
 
+        etag = infile.info().get("ETag")
+        if etag:
+            writeFile(self.fnameBase+".etag", "%s\n%s\n"%(url,etag))
+        else:
+            tryUnlink(self.fnameBase+".etag")
+
         lock.write_in()
         try:
             self.serverDir = directory
@@ -553,6 +589,33 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
         finally:
             lock.write_out()
 
+    def _getCachedETag(self, url):
+        """Helper: if we have a cached directory that we downloaded from
+           'url', and the server gave it an entity tag, return the tag.
+           Else return None."""
+        if self.serverDir is None:
+            return None
+        try:
+            lines = readFile(self.fnameBase+".etag").split("\n")
+        except (IOError, OSError):
+            return None
+        if len(lines) < 2 or lines[0] != url or not lines[1]:
+            return None
+        return lines[1]
+
+    def _markDirectoryFresh(self, lock):
+        """Helper: the server told us our cached directory is still
+           current: treat it as if we had just downloaded it."""
+        for ext in "", ".gz":
+            if os.path.exists(self.fnameBase+ext):
+                os.utime(self.fnameBase+ext, None)
+        lock.write_in()
+        try:
+            self.lastDownload = time.time()
+            self._changed = 1
+        finally:
+            lock.write_out()
+
     def __getstate__(self):
         return self.MAGIC, self.lastDownload, self.serverDir
 
@@ -569,6 +632,7 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
         self.__downloading = 0
         self.fnameBase = None
         self.timeout = None
+        self.url = None
 
 class CachingDescriptorSource(DescriptorSource):
     """A CachingDescriptorSource aggregates several base DescriptorSources,
@@ -731,8 +795,14 @@ class ClientDirectory:
     # blockedNicknames: a map from lowercase nickname to a list of the purposes
     #   ('entry', 'exit', or '*') for which the corresponding server shouldn't
     #   be selected in automatic path generation.  Set by configure.
+    ## Fields for background updates:
+    # _refreshThread: The thread running our current background update, or
+    #    None.
+    # _refreshLock: A lock to protect _refreshThread.
     def __init__(self, config=None, store=None, diskLock=None):
         self._lock = RWLock()
+        self._refreshThread = None
+        self._refreshLock = threading.Lock()
         if diskLock is None:
             self._diskLock = DummyLock()
         else:
@@ -754,23 +824,31 @@ class ClientDirectory:
 
            Must hold write lock if other threads can reach this object.
         """
-        self.allServers = self.store.getServerList()
-        self.clientVersions, self.serverVersions = \
-                             self.store.getRecommendedVersions()
-        self.goodNicknames = {}
-        self.goodServers = []
-        self.byNickname = {}
-        self.byKeyID = {}
+        # We build every field before we install any of them, so that
+        # callers who don't take the lock still see a consistent view.
+        allServers = self.store.getServerList()
+        versions = self.store.getRecommendedVersions()
+        goodNicknames = {}
+        goodServers = []
+        byNickname = {}
+        byKeyID = {}
         for n in self.store.getRecommendedNicknames():
             assert n == n.lower()
-            self.goodNicknames[n]=1
-        for s in self.allServers:
+            goodNicknames[n]=1
+        for s in allServers:
             lcnickname = s.getNickname().lower()
             keydigest = s.getKeyDigest()
-            self.byKeyID.setdefault(keydigest,[]).append(s)
-            self.byNickname.setdefault(lcnickname,[]).append(s)
-            if self.goodNicknames.has_key(lcnickname):
-                self.goodServers.append(s)
+            byKeyID.setdefault(keydigest,[]).append(s)
+            byNickname.setdefault(lcnickname,[]).append(s)
+            if goodNicknames.has_key(lcnickname):
+                goodServers.append(s)
+
+        self.allServers = allServers
+        self.clientVersions, self.serverVersions = versions
+        self.goodNicknames = goodNicknames
+        self.goodServers = goodServers
+        self.byNickname = byNickname
+        self.byKeyID = byKeyID
 
     def flush(self):
         """Save any pending changes to disk, and update all derivative
@@ -855,6 +933,74 @@ class ClientDirectory:
             self._diskLock.release()
         self.__scanAsNeeded()
 
+    def updateInBackground(self, force=0, now=None, onDone=None):
+        """As update, but do not make the caller wait for the download if
+           we already have a directory: instead, keep serving the directory
+           we have while a new one is fetched and validated in a separate
+           thread, and swap the new one in under our lock once it is ready.
+
+           If we have no directory at all, there's nothing to serve, so
+           we update in the calling thread and let any exceptions
+           propagate.  Return true iff we started a background update, or
+           one was already running.
+
+           When a background update finishes, we call onDone(None) from
+           the updating thread on success, or onDone(exception) on
+           failure.
+        """
+        if not self._hasDirectory():
+            self.update(force=force, now=now)
+            return 0
+
+        self._refreshLock.acquire()
+        try:
+            if (self._refreshThread is not None and
+                self._refreshThread.isAlive()):
+                LOG.debug("Directory update already in progress")
+                return 1
+            t = threading.Thread(None, self.__updateInBackgroundImpl,
+                                 args=(force, now, onDone))
+            t.setDaemon(1)
+            self._refreshThread = t
+            t.start()
+        finally:
+            self._refreshLock.release()
+        return 1
+
+    def __updateInBackgroundImpl(self, force, now, onDone):
+        """Helper: body of the thread started by updateInBackground."""
+        err = None
+        try:
+            self.update(force=force, now=now)
+        except MixError, err:
+            LOG.warn("Couldn't update directory: %s", err)
+            LOG.warn("   (I'll use the old directory until I have a new one.)")
+        except:
+            err = sys.exc_info()[1]
+            LOG.error_exc(sys.exc_info(),
+                          "Unexpected error while updating directory")
+        self._refreshLock.acquire()
+        try:
+            self._refreshThread = None
+        finally:
+            self._refreshLock.release()
+        if onDone is not None:
+            onDone(err)
+
+    def isUpdating(self):
+        """Return true iff a background update is in progress."""
+        self._refreshLock.acquire()
+        try:
+            return self._refreshThread is not None
+        finally:
+            self._refreshLock.release()
+
+    def _hasDirectory(self):
+        """Helper: return true iff our store holds a directory that we
+           could use while fetching a new one."""
+        fn = getattr(self.store, "hasDirectory", None)
+        return fn is not None and fn()
+
     def clean(self, now=None):
         """Remove expired and superseded descriptors."""
         self._diskLock.acquire()
@@ -670,26 +670,43 @@ def tryUnlink(fname):
 _SHRED_CMD = "---"
 # Tuple of options to be passed to the 'shred' command
 _SHRED_OPTS = None
+# How many passes of random data does our internal implementation write
+# before it zeroes a file?
+_SHRED_PASSES = 0
+# Does our internal implementation release a file's blocks before
+# unlinking it?
+_SHRED_PUNCH = 0
+# The _minionlib function our internal implementation uses to overwrite and
+# unlink a batch of files, or None if we don't have one.
+_SHRED_FN = None
+# How many files do we hand to _SHRED_FN at once?  (It holds all of them
+# open at the same time.)
+_SHRED_BATCH = 128
 
 def configureShredCommand(conf):
     """Initialize the secure delete command from a given Config object.
        If no object is provided, try some sane defaults."""
-    global _SHRED_CMD
-    global _SHRED_OPTS
+    global _SHRED_CMD, _SHRED_OPTS, _SHRED_PASSES, _SHRED_PUNCH, _SHRED_FN
     cmd, opts = None, None
+    passes, punch = 0, 0
     if conf is not None:
         val = conf['Host'].get('ShredCommand')
         if val is not None:
             cmd, opts = val
+        passes = conf['Host'].get('ShredPasses', 0)
+        punch = conf['Host'].get('ShredPunchHoles', 0)
 
-    if cmd is None:
-        if os.path.exists("/usr/bin/shred"):
-            cmd, opts = "/usr/bin/shred", ["-uz", "-n0"]
-        else:
-            # Use built-in _overwriteFile
-            cmd, opts = None, None
+    # If no command is configured, we overwrite files ourself: it's a lot
+    # cheaper than forking a shred process for every batch.
+    try:
+        import mixminion._minionlib
+        _SHRED_FN = mixminion._minionlib.shred_files
+    except (ImportError, AttributeError):
+        # Use built-in _overwriteFile
+        _SHRED_FN = None
 
     _SHRED_CMD, _SHRED_OPTS = cmd, opts
+    _SHRED_PASSES, _SHRED_PUNCH = passes, punch
 
 
 # Map from parent directory to blocksize.  We only overwrite files in a few
@@ -755,11 +772,16 @@ def secureDelete(fnames, blocking=0):
        against a well-funded adversary with access to your hard drive
        and a bunch of sensitive magnetic equipment.
 
-       XXXX Currently, we use shred from GNU fileutils.  Shred's 'unlink'
-       XXXX operation has the regrettable property that two shred commands
-       XXXX running in the same directory can sometimes get into a race.
-       XXXX The source to shred.c seems to imply that this is harmless, but
-       XXXX let's try to avoid that, to be on the safe side.
+       Unless a ShredCommand is configured, we overwrite the files
+       in-process, in batches; this blocks the calling thread even if
+       blocking=0, so callers that care should call us from a
+       CleaningThread.
+
+       XXXX Shred's 'unlink' operation has the regrettable property that
+       XXXX two shred commands running in the same directory can sometimes
+       XXXX get into a race.  The source to shred.c seems to imply that
+       XXXX this is harmless, but let's try to avoid that, to be on the
+       XXXX safe side.
     """
     if _SHRED_CMD == "---":
         configureShredCommand(None)
@@ -771,9 +793,18 @@ def secureDelete(fnames, blocking=0):
         fnames = [fnames]
 
     if not _SHRED_CMD:
-        for f in fnames:
-            _overwriteFile(f)
-            os.unlink(f)
+        if _SHRED_FN is None:
+            for f in fnames:
+                _overwriteFile(f)
+                os.unlink(f)
+            return None
+        for i in xrange(0, len(fnames), _SHRED_BATCH):
+            failed = _SHRED_FN(fnames[i:i+_SHRED_BATCH],
+                               _SHRED_PASSES, _SHRED_PUNCH)
+            for f, err in failed:
+                if err != errno.ENOENT:
+                    LOG.warn("Error while shredding %s: %s", f,
+                             os.strerror(err))
         return None
 
     # Some systems are unhappy when you call them with too many options.
@@ -807,10 +838,12 @@ def secureDelete(fnames, blocking=0):
 
 # This weirdness is used to memoize lookups in the 'time' module's namespace.
 # "LOG.log" can get called a lot, so this matters.
-def _logtime(_time=time.time,_strftime=time.strftime,
+def _logtime(t=None,_time=time.time,_strftime=time.strftime,
              _localtime=time.localtime,_tzadj=[None],_dst=[None]):
-    'Helper function.  Returns current local time formatted for log.'
-    t = _time()
+    """Helper function.  Returns the time 't' (default: the current time)
+       formatted for log."""
+    if t is None:
+        t = _time()
     lt = _localtime(t)
 
     # We use the '_dst[0]' variable to check whether our DST setting
@@ -862,9 +895,14 @@ class _FileLogHandler:
         self.file.close()
     def write(self, severity, message):
         """(Used by Log: write a message to this log handler.)"""
+        self.writeRecords([(None, severity, message)])
+    def writeRecords(self, records):
+        """(Used by Log: write a list of (time, severity, message) tuples to
+           this log handler, and flush it once.)"""
         if self.file is None:
             return
-        print >> self.file, "%s [%s] %s" % (_logtime(), severity, message)
+        self.file.write("".join(["%s [%s] %s\n" % (_logtime(t), sev, m)
+                                 for t, sev, m in records ]))
         self.file.flush()
 
 class _ConsoleLogHandler:
@@ -878,6 +916,11 @@ class _ConsoleLogHandler:
     def write(self, severity, message):
         """(Used by Log: write a message to this log handler.)"""
         print >> self.file, "%s [%s] %s" % (_logtime(), severity, message)
+    def writeRecords(self, records):
+        """(Used by Log: write a list of (time, severity, message) tuples to
+           this log handler.)"""
+        self.file.write("".join(["%s [%s] %s\n" % (_logtime(t), sev, m)
+                                 for t, sev, m in records ]))
 
 # Map from log severity name to numeric values
 _SEVERITIES = { 'TRACE' : -2,
@@ -888,6 +931,9 @@ _SEVERITIES = { 'TRACE' : -2,
                 'FATAL' : 3,
                 'NEVER' : 100}
 
+# How often does the log writer thread flush queued messages?  (Seconds.)
+LOG_FLUSH_INTERVAL = 0.1
+
 class Log:
     """A Log is a set of destinations for system messages, along with the
        means to filter them to a desired verbosity.
@@ -903,6 +949,14 @@ class Log:
                  message or a connection.
               FATAL: nonrecoverable errors that affect the entire system.
 
+       Ordinarily, we write each message to every handler before returning.
+       A server's log can instead be made asynchronous: messages are
+       appended to a queue, and a separate thread writes them out in
+       batches.  (ERROR and FATAL messages are still written before we
+       return.)  Additionally, TRACE and DEBUG messages can be rate-limited
+       per format string, so that a single busy call site can't flood the
+       log.
+
        In practice, we instantiate only a single instance of this class,
        accessed as mixminion.Common.LOG."""
     ## Fields:
@@ -910,13 +964,27 @@ class Log:
     # severity: a severity below which log messages are ignored.
     # silenceNoted: true iff we have printed a message about silencing the
     #     console long.
+    # rateLimit: the largest number of TRACE or DEBUG messages we write
+    #     per second for any single format string, or 0 for no limit.
+    # _rateState: map from format string to a list of [second, number of
+    #     messages logged this second, number of messages suppressed].
+    # _queue: a list of (time, severity, message) tuples waiting for the
+    #     writer thread, or None if we're writing synchronously.  Producers
+    #     only append to this list, and the writer only removes items from
+    #     its front, so no lock is needed.  It's replaced only while
+    #     holding __lock.
+    # _writer: the writer thread, or None.
+    # _stopWriter: true iff the writer thread should exit.
+    # __lock: a lock held while writing to the handlers.
     def __init__(self, minSeverity):
         """Create a new Log object that ignores all message less severe than
            minSeverity, and sends its output to stderr."""
+        self.__lock = threading.Lock()
+        self._queue = self._writer = None
+        self._stopWriter = 0
         self.configure(None)
         self.setMinSeverity(minSeverity)
         self.silenceNoted = 0
-        self.__lock = threading.Lock()
 
     def configure(self, config, keepStderr=0):
         """Set up this Log object based on a ServerConfig or ClientConfig
@@ -925,7 +993,10 @@ class Log:
            If keepStderr is true, do not silence the console log, regardless
            of the value of 'Daemon' or 'EchoMessages'.
            """
+        self.setAsync(0)
         self.handlers = []
+        self.rateLimit = 0
+        self._rateState = {}
         if config == None or not config.has_section("Server"):
             # We're configuring a client.
             self.setMinSeverity("WARN")
@@ -935,7 +1006,16 @@ class Log:
         # We're configuring the log on a server.  Stuff will get complicated
         # now.  First, we set the severity as specified in the configuration...
         self.setMinSeverity(config['Server'].get('LogLevel', "WARN"))
-        # ...find out what logfile we're supposed to use ...
+        self.rateLimit = config['Server'].get('LogRateLimit', 0)
+        self._configureServerHandlers(config, keepStderr)
+        # Only once the handlers are in place do we start queueing messages
+        # for them.
+        self.setAsync(config['Server'].get('AsyncLog', 0))
+
+    def _configureServerHandlers(self, config, keepStderr):
+        """Helper for configure: add the handlers that a server's
+           configuration asks for."""
+        # Find out what logfile we're supposed to use ...
         logfile = config.getLogFile()
         # ...and add a handler to log any messages to stderr.
         self.addHandler(_ConsoleLogHandler(sys.stderr))
@@ -979,19 +1059,86 @@ class Log:
            messages from this log."""
         self.handlers.append(handler)
 
+    def setAsync(self, enable):
+        """If 'enable' is true, start a thread to write messages in the
+           background.  Otherwise, write any queued messages and stop the
+           writer thread, if any."""
+        if self._writer is not None:
+            self._stopWriter = 1
+            self._writer.join()
+            self._writer = None
+        if not enable:
+            # Stop queueing before we drain the queue, so that nothing
+            # appended in between gets left behind.  (_write catches any
+            # producer that picked up the old queue just before we swapped
+            # it out.)
+            self.__lock.acquire()
+            try:
+                q = self._queue
+                self._queue = None
+            finally:
+                self.__lock.release()
+            self._drain(q)
+            return
+        self.__lock.acquire()
+        try:
+            if self._queue is None:
+                self._queue = []
+        finally:
+            self.__lock.release()
+        self._stopWriter = 0
+        self._writer = threading.Thread(target=self._writerLoop)
+        self._writer.setDaemon(1)
+        self._writer.start()
+
+    def _writerLoop(self):
+        """Helper: main loop for the writer thread."""
+        while not self._stopWriter:
+            time.sleep(LOG_FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        """Write all queued messages to the handlers."""
+        self._drain(self._queue)
+
+    def _drain(self, q):
+        """Helper: write all the messages in the queue 'q' (which may be
+           None) to the handlers."""
+        if not q:
+            return
+        self.__lock.acquire()
+        try:
+            n = len(q)
+            records = q[:n]
+            del q[:n]
+            if records:
+                for h in self.handlers:
+                    h.writeRecords(records)
+        finally:
+            self.__lock.release()
+
     def reset(self):
         """Flush and re-open all logs."""
-        for h in self.handlers:
-            try:
-                h.reset()
-            except MixError, e:
-                if len(self.handlers) > 1:
-                    self.error(str(e))
-                else:
-                    print >>sys.stderr, "Unable to reset log system"
+        self.flush()
+        errors = []
+        self.__lock.acquire()
+        try:
+            for h in self.handlers:
+                try:
+                    h.reset()
+                except MixError, e:
+                    errors.append(str(e))
+        finally:
+            self.__lock.release()
+        for e in errors:
+            if len(self.handlers) > 1:
+                self.error(e)
+            else:
+                print >>sys.stderr, "Unable to reset log system"
 
     def close(self):
         """Close all logs"""
+        self.setAsync(0)
         for h in self.handlers:
             h.close()
 
@@ -1000,22 +1147,48 @@ class Log:
            arguments are provided, write 'message % args'. """
         self._log(severity, message, args)
 
-    def _log(self, severity, message, args):
+    def _log(self, severity, message, args, _time=time.time):
         """Helper method: If we aren't ignoring messages of level 'severity',
            then send message%args to all the underlying log handlers."""
+        sev = _SEVERITIES.get(severity, 100)
+        if sev < self.severity:
+            return
+        now = _time()
+        if sev < 0 and self.rateLimit:
+            # Rate-limit TRACE and DEBUG messages.
+            st = self._rateState.get(message)
+            sec = int(now)
+            if st is None or st[0] != sec:
+                if st is not None and st[2]:
+                    self._write(now, severity,
+                       "(Suppressed %s more messages like %r)"%(st[2],message))
+                self._rateState[message] = [sec, 1, 0]
+            elif st[1] >= self.rateLimit:
+                st[2] += 1
+                return
+            else:
+                st[1] += 1
 
-        # Enable this block to bail early in production versions
-        #if _SEVERITIES.get(severity, 100) < self.severity:
-        #    return
         if args is None:
             m = message
         else:
             m = message % args
-
-        # Enable this block to debug message formats.
-        if _SEVERITIES.get(severity, 100) < self.severity:
+        self._write(now, severity, m)
+        if sev >= 2 and self._queue is not None:
+            # Don't let an ERROR or FATAL message linger in the queue: we
+            # might be about to exit.
+            self.flush()
+
+    def _write(self, now, severity, m):
+        """Helper method: queue or write a single formatted message."""
+        q = self._queue
+        if q is not None:
+            q.append((now, severity, m))
+            if self._queue is not q:
+                # setAsync(0) swapped out the queue under us, and may
+                # already have drained it.
+                self._drain(q)
             return
-
         self.__lock.acquire()
         try:
             for h in self.handlers:
@@ -1571,6 +1744,17 @@ def installSIGCHLDHandler():
         return
     signal.signal(signal.SIGCHLD, _sigChldHandler)
 
+def getCPUCount():
+    """Return the number of processors currently online, or 1 if we can't
+       tell."""
+    try:
+        n = os.sysconf("SC_NPROCESSORS_ONLN")
+    except (AttributeError, ValueError, OSError):
+        return 1
+    if n < 1:
+        return 1
+    return n
+
 #----------------------------------------------------------------------
 # File helpers.
 
@@ -365,6 +365,25 @@ def _parsePublicKey(s):
         raise ConfigError("Invalid exponent on public key")
     return key
 
+def _memoizeParser(parseFn, maxEntries=1024):
+    """Given a validation function whose results are never modified by
+       its callers, return a version of it that remembers the results for
+       the last few distinct input strings.  Failed inputs are not
+       remembered."""
+    cache = {}
+    def memoizedParseFn(s, parseFn=parseFn, cache=cache,
+                        maxEntries=maxEntries):
+        try:
+            return cache[s]
+        except KeyError:
+            pass
+        v = parseFn(s)
+        if len(cache) >= maxEntries:
+            cache.clear()
+        cache[s] = v
+        return v
+    return memoizedParseFn
+
 # FFFF008 stop accepting YYYY/MM/DD.  We've generated the right thing
 # FFFF008 since 0.0.6.
 # Regular expression to match YYYY/MM/DD or YYYY-MM-DD
@@ -522,6 +541,14 @@ def _readConfigFile(contents):
 
     return sections
 
+# Regular expression to match a single line of a restricted-format file:
+# either a section header (group 1), or a 'key: value' entry (groups 2, 3).
+# Surrounding whitespace is not included in any group.
+_restricted_line_re = re.compile(r'''[ \t\v]*(?:
+          \[[ \t\v]*([^\s\]]+)[ \t\v]*\][^\n]*
+        | ([^\s:\[\#][^:\n]*?)[ \t\v]*:[ \t\v]*([^\n]*?)
+        )[ \t\v]*(?:\n|\Z)''', re.X)
+
 def _readRestrictedConfigFile(contents):
     """Same interface as _readConfigFile, but only supports the restrictd
        file format as used by directories and descriptors."""
@@ -536,37 +563,57 @@ def _readRestrictedConfigFile(contents):
     if not isPrintingAscii(contents):
         raise ConfigError("Invalid characters in file")
 
-    fileLines = contents.split("\n")
-    if fileLines[-1] == '':
-        del fileLines[-1]
-
-    if len(fileLines) == 1 and fileLines[0].strip() == '':
+    if contents and not contents.strip():
         raise ConfigError("File is empty")
 
-    for line in fileLines:
+    # We tokenize the whole file in one pass of _restricted_line_re: every
+    # successful match consumes exactly one line.
+    match = _restricted_line_re.match
+    pos = 0
+    end = len(contents)
+    while pos < end:
         lineno += 1
-        line = line.strip()
-        if line == '' or line[0] == '#':
-            raise ConfigError("Empty line not allowed at line %s"%lineno)
-        elif line[0] == '[':
-            m = _section_re.match(line)
-            if not m:
+        m = match(contents, pos)
+        if m is None:
+            line = contents[pos:].split("\n",1)[0].strip()
+            if line == '' or line[0] == '#':
+                raise ConfigError("Empty line not allowed at line %s"%lineno)
+            elif line[0] == '[':
                 raise ConfigError("Bad section declaration at line %s"%lineno)
-            curSection = [ ]
-            sections.append( (m.group(1), curSection) )
-        else:
-            colonIdx = line.find(':')
-            if colonIdx >= 1:
-                try:
-                    curSection.append( (line[:colonIdx].strip(),
-                                        line[colonIdx+1:].strip(), lineno) )
-                except AttributeError:
-                    raise ConfigError("Unknown section at line %s" % lineno)
             else:
                 raise ConfigError("Bad Entry at line %s" % lineno)
+        pos = m.end()
+        secName, key, val = m.groups()
+        if secName is not None:
+            curSection = [ ]
+            sections.append( (secName, curSection) )
+        else:
+            try:
+                curSection.append( (key, val, lineno) )
+            except AttributeError:
+                raise ConfigError("Unknown section at line %s" % lineno)
 
     return sections
 
+def _compileSection(secConfig, codingFns):
+    """Helper function.  Given a section's entry from a _syntax table and a
+       map of coding functions, returns a tuple of (entries, missing),
+       where entries maps each key to a (rule, parseFn) tuple, and missing
+       is a list of (key, rule, parseFn, default) for every key that must
+       be checked when it is absent from the section."""
+    entries = {}
+    missing = []
+    for k, (rule, parseType, default) in secConfig.items():
+        parseFn = codingFns.get(parseType, (None,None))[0]
+        entries[k] = (rule, parseFn)
+        if k != '__SECTION__' and rule != 'IGNORE':
+            missing.append((k, rule, parseFn, default))
+    return entries, missing
+
+# Map from _ConfigFile subclass to a tuple of (_syntax, CODING_FNS,
+# {secname: compiled section}), for classes whose syntax is fixed.
+_compiledSyntaxCache = {}
+
 def _formatEntry(key,val,w=79,ind=4,strict=0):
     """Helper function.  Given a key/value pair, returns a NL-terminated
        entry for inclusion in a configuration file, such that no line is
@@ -722,8 +769,9 @@ class _ConfigFile:
         "command" : (_parseCommand, lambda c,o: " ".join([c," ".join(o)])),
         "base64" : (_parseBase64, mixminion.Common.formatBase64),
         "hex" : (_parseHex, binascii.b2a_hex),
-        "publicKey" : (_parsePublicKey, lambda r: "<public key>"),
-        "date" : (_parseDate, mixminion.Common.formatDate),
+        "publicKey" : (_memoizeParser(_parsePublicKey),
+                       lambda r: "<public key>"),
+        "date" : (_memoizeParser(_parseDate), mixminion.Common.formatDate),
         "time" : (_parseTime, mixminion.Common.formatTime),
         "nickname" : (_parseNickname, str),
         "filename" : (_parseFilename, str),
@@ -803,11 +851,14 @@ class _ConfigFile:
                     LOG.warn("Skipping unrecognized section %s", secName)
                     continue
 
+            compiledEntries, missingEntries = self._getCompiledSection(
+                secName, secConfig)
+
             # Set entries from the section, searching for bad entries
             # as we go.
             for k,v,line in secEntries:
                 try:
-                    rule, parseType, default = secConfig[k]
+                    rule, parseFn = compiledEntries[k]
                 except KeyError:
                     msg = "Unrecognized key %s on line %s"%(k,line)
                     acceptedIn = [ sn for sn,sc in self._syntax.items()
@@ -823,8 +874,6 @@ class _ConfigFile:
                         LOG.warn(msg)
                         continue
 
-                parseFn, _ = self.CODING_FNS.get(parseType,(None,None))
-
                 # Parse and validate the value of this entry.
                 if parseFn is not None:
                     try:
@@ -854,15 +903,12 @@ class _ConfigFile:
 
             # Check for missing entries, setting defaults and detecting
             # missing requirements as we go.
-            for k, (rule, parseType, default) in secConfig.items():
-                if k == '__SECTION__' or rule == 'IGNORE':
-                    continue
-                elif not section.has_key(k):
+            for k, rule, parseFn, default in missingEntries:
+                if not section.has_key(k):
                     if rule in ('REQUIRE', 'REQUIRE*'):
                         raise ConfigError("Missing entry %s from section %s"
                                           % (k, secName))
                     else:
-                        parseFn, _ = self.CODING_FNS.get(parseType,(None,None))
                         if parseFn is None or default is None:
                             if rule == 'ALLOW*':
                                 section[k] = []
@@ -893,6 +939,28 @@ class _ConfigFile:
             # Call our validation hook.
             self.validate(sectionEntryLines, fileContents)
 
+    def _getCompiledSection(self, secName, secConfig):
+        """Return the (entries, missing) tuple for the section secName, as
+           generated by _compileSection.  If this object uses the _syntax
+           and CODING_FNS of its class, the result is computed only once
+           per class; otherwise (as when a subclass edits its syntax
+           while loading), we recompute it every time."""
+        klass = self.__class__
+        syntax, codingFns = self._syntax, self.CODING_FNS
+        if (getattr(klass, '_syntax') is not syntax or
+            getattr(klass, 'CODING_FNS') is not codingFns):
+            return _compileSection(secConfig, codingFns)
+
+        cached = _compiledSyntaxCache.get(klass)
+        if cached is None or cached[0] is not syntax or \
+               cached[1] is not codingFns:
+            cached = _compiledSyntaxCache[klass] = (syntax, codingFns, {})
+        try:
+            return cached[2][secName]
+        except KeyError:
+            c = cached[2][secName] = _compileSection(secConfig, codingFns)
+            return c
+
     def _addCallback(self, section, cb):
         """For use by subclasses.  Adds a callback for a section"""
         if not hasattr(self, '_callbacks'):
@@ -977,6 +1045,8 @@ class ClientConfig(_ConfigFile):
     _syntax = {
         'Host' : { '__SECTION__' : ('ALLOW', None, None),
                    'ShredCommand': ('ALLOW', "command", None),
+                   'ShredPasses': ('ALLOW', "int", "0"),
+                   'ShredPunchHoles': ('ALLOW', "boolean", "no"),
                    'EntropySource': ('ALLOW', "filename", "/dev/urandom"),
                    'TrustedUser': ('ALLOW*', "user", None),
                    'FileParanoia': ('ALLOW', "boolean", "yes"),
@@ -1071,8 +1141,10 @@ class ClientConfig(_ConfigFile):
 def _validateHostSection(sec):
     """Helper function: Makes sure that the shared [Host] section is correct;
        raise ConfigError if it isn't"""
-    # For now, we do nothing here.  EntropySource and ShredCommand are checked
-    # in configure_trng and configureShredCommand, respectively.
+    # EntropySource and ShredCommand are checked in configure_trng and
+    # configureShredCommand, respectively.
+    if sec.get('ShredPasses', 0) < 0:
+        raise ConfigError("ShredPasses must be nonnegative")
 
     # Host is checked in setupTrustedUIDs.
 
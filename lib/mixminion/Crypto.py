@@ -18,12 +18,15 @@ import threading
 from types import StringType
 
 import mixminion._minionlib as _ml
-from mixminion.Common import MixError, MixFatalError, floorDiv, ceilDiv, LOG
+from mixminion.Common import MixError, MixFatalError, floorDiv, ceilDiv, \
+     getCPUCount, LOG
 
 __all__ = [ 'AESCounterPRNG', 'CryptoError', 'Keyset', 'bear_decrypt',
             'bear_encrypt', 'ctr_crypt', 'getCommonPRNG', 'init_crypto',
-            'lioness_decrypt', 'lioness_encrypt', 'openssl_seed',
-            'pk_check_signature', 'pk_decode_private_key',
+            'lioness_decrypt', 'lioness_decrypt_inplace', 'lioness_encrypt',
+            'openssl_seed',
+            'pk_check_signature', 'pk_check_signatures',
+            'pk_decode_private_key',
             'pk_decode_public_key', 'pk_decrypt', 'pk_encode_private_key',
             'pk_encode_public_key', 'pk_encrypt', 'pk_fingerprint',
             'pk_from_modulus', 'pk_generate', 'pk_get_modulus',
@@ -88,99 +91,54 @@ def lioness_encrypt(s,(key1,key2,key3,key4)):
     """Given four 20-byte keys, encrypts s using the LIONESS
        super-pseudorandom permutation.
     """
-
-    assert len(key1) == len(key3) == DIGEST_LEN
-    assert len(key2) == len(key4) == DIGEST_LEN
-    assert len(s) > DIGEST_LEN
-
-    # Split the message.
-    left = s[:DIGEST_LEN]
-    right = s[DIGEST_LEN:]
-    del s
-    # Performance note: This business with sha1("".join((key,right,key)))
-    # may look slow, but it contributes only .7% to the total time for
-    # LIONESS.
-    right = _ml.aes_ctr128_crypt(
-        _ml.aes_key(_ml.sha1("".join((key1,left,key1)))[:AES_KEY_LEN]),
-        right, 0)
-    left = _ml.strxor(left,  _ml.sha1("".join((key2,right,key2))))
-    right = _ml.aes_ctr128_crypt(
-        _ml.aes_key(_ml.sha1("".join((key3,left,key3)))[:AES_KEY_LEN]),
-        right, 0)
-    left = _ml.strxor(left,  _ml.sha1("".join((key4,right,key4))))
-
-    # You could write the above as:
-    #   right = ctr_crypt(right, "".join((key1,left,key1))[:AES_KEY_LEN])
+    # The four rounds are, in order:
+    #   right = ctr_crypt(right, sha1("".join((key1,left,key1)))[:AES_KEY_LEN])
     #   left = strxor(left, sha1("".join((key2,right,key2))))
-    #   right = ctr_crypt(right, "".join((key3,left,key3))[:AES_KEY_LEN])
+    #   right = ctr_crypt(right, sha1("".join((key3,left,key3)))[:AES_KEY_LEN])
     #   left = strxor(left, sha1("".join((key4,right,key4))))
-    # but that would be slower by about 10%.  (Since LIONESS is in the
-    # critical path, we care.)
-
-    return left + right
+    # where left is the first DIGEST_LEN bytes of s, and right is the rest.
+    # _minionlib does them all in place on a single copy of s, without
+    # holding the interpreter lock.  (Since LIONESS is in the critical
+    # path, we care.)
+    return _ml.lioness_encrypt(s,(key1,key2,key3,key4))
 
 def lioness_decrypt(s,(key1,key2,key3,key4)):
     """Given a 16-byte key2 and key4, and a 20-byte key1 and key3, decrypts
        s using the LIONESS super-pseudorandom permutation.
     """
-
-    assert len(key1)==len(key3)==DIGEST_LEN
-    assert len(key2)==len(key4)==DIGEST_LEN
-    assert len(s) > DIGEST_LEN
-
-    left = s[:DIGEST_LEN]
-    right = s[DIGEST_LEN:]
-    del s
-
-    # Slow, comprehensible version:
-    #left = strxor(left,  sha1("".join([key4,right,key4])))
-    #right = ctr_crypt(right, sha1("".join([key3,left,key3]))[:AES_KEY_LEN])
-    #left = strxor(left,  sha1("".join([key2,right,key2])))
-    #right = ctr_crypt(right, sha1("".join([key1,left,key1]))[:AES_KEY_LEN])
-
-    # Equivalent-but-faster version:
-    left = _ml.strxor(left, _ml.sha1("".join((key4,right,key4))))
-    right = _ml.aes_ctr128_crypt(
-        _ml.aes_key(_ml.sha1("".join((key3,left, key3)))[:AES_KEY_LEN]),
-        right, 0)
-    left = _ml.strxor(left, _ml.sha1("".join((key2,right,key2))))
-    right = _ml.aes_ctr128_crypt(
-        _ml.aes_key(_ml.sha1("".join((key1,left, key1)))[:AES_KEY_LEN]),
-        right, 0)
-
-    return left + right
+    # The rounds of lioness_encrypt, backwards:
+    #   left = strxor(left, sha1("".join((key4,right,key4))))
+    #   right = ctr_crypt(right, sha1("".join((key3,left,key3)))[:AES_KEY_LEN])
+    #   left = strxor(left, sha1("".join((key2,right,key2))))
+    #   right = ctr_crypt(right, sha1("".join((key1,left,key1)))[:AES_KEY_LEN])
+    return _ml.lioness_decrypt(s,(key1,key2,key3,key4))
+
+if hasattr(_ml, 'lioness_decrypt_inplace'):
+    def lioness_decrypt_inplace(buf,(key1,key2,key3,key4)):
+        """As lioness_decrypt, but decrypts the writable buffer 'buf'
+           (such as a bytearray, or a memoryview of one) in place."""
+        _ml.lioness_decrypt_inplace(buf,(key1,key2,key3,key4))
+else:
+    # Before Python 2.6, _minionlib can't write into a buffer; callers
+    # must use lioness_decrypt instead.
+    lioness_decrypt_inplace = None
 
 def bear_encrypt(s,(key1,key2)):
     """Given four 20-byte keys, encrypts s using the BEAR
        pseudorandom permutation.
     """
-
-    assert len(key1) == len(key2) == DIGEST_LEN
-    assert len(s) > DIGEST_LEN
-
-    left = s[:DIGEST_LEN]
-    right = s[DIGEST_LEN:]
-    del s
-    left = _ml.strxor(left, _ml.sha1("".join((key1,right,key1))))
-    right = ctr_crypt(right, _ml.sha1(left)[:AES_KEY_LEN])
-    left = _ml.strxor(left, _ml.sha1("".join((key2,right,key2))))
-    return left + right
+    # The three rounds are, in order:
+    #   left = strxor(left, sha1("".join((key1,right,key1))))
+    #   right = ctr_crypt(right, sha1(left)[:AES_KEY_LEN])
+    #   left = strxor(left, sha1("".join((key2,right,key2))))
+    return _ml.bear_encrypt(s,(key1,key2))
 
 def bear_decrypt(s,(key1,key2)):
     """Given four 20-byte keys, decrypts s using the BEAR
        pseudorandom permutation.
     """
-
-    assert len(key1) == len(key2) == DIGEST_LEN
-    assert len(s) > DIGEST_LEN
-
-    left = s[:DIGEST_LEN]
-    right = s[DIGEST_LEN:]
-    del s
-    left = _ml.strxor(left, _ml.sha1("".join((key2,right,key2))))
-    right = ctr_crypt(right, _ml.sha1(left)[:AES_KEY_LEN])
-    left = _ml.strxor(left, _ml.sha1("".join((key1,right,key1))))
-    return left + right
+    # As bear_encrypt, with key1 and key2 exchanged.
+    return _ml.bear_decrypt(s,(key1,key2))
 
 def whiten(s):
     """Return a whitened version of a string 's', using the whitening
@@ -247,6 +205,48 @@ def pk_check_signature(data, key):
     data = key.crypt(data, 1, 0)
     return check_oaep(data,OAEP_PARAMETER,bytes)
 
+# Smallest number of signatures worth handing to a separate thread in
+# pk_check_signatures.
+MIN_SIGNATURES_PER_THREAD = 8
+
+def pk_check_signatures(items, nThreads=None):
+    """Given a list of (data, key) tuples, check each signature as in
+       pk_check_signature.  Return a list holding the original data for
+       each valid signature, and None for each invalid one.
+
+       Because our RSA operations release the interpreter lock, we divide
+       large batches among up to nThreads threads (by default, one per
+       online processor)."""
+    if nThreads is None:
+        nThreads = getCPUCount()
+    nThreads = min(nThreads, floorDiv(len(items), MIN_SIGNATURES_PER_THREAD))
+    results = [None] * len(items)
+    if nThreads <= 1:
+        _checkSignatureSlice(items, results, 0, 1)
+        return results
+
+    threads = []
+    for i in range(1, nThreads):
+        t = threading.Thread(None, _checkSignatureSlice,
+                             args=(items, results, i, nThreads))
+        t.start()
+        threads.append(t)
+    _checkSignatureSlice(items, results, 0, nThreads)
+    for t in threads:
+        t.join()
+    return results
+
+def _checkSignatureSlice(items, results, start, step):
+    """Helper for pk_check_signatures: check every step'th signature in
+       items, beginning at index start, and store the outcomes in
+       results."""
+    for idx in xrange(start, len(items), step):
+        data, key = items[idx]
+        try:
+            results[idx] = pk_check_signature(data, key)
+        except CryptoError:
+            pass
+
 def pk_generate(bits=1024,e=65537):
     """Generate a new RSA keypair with 'bits' bits and exponent 'e'.  It is
        safe to use the default value of 'e'.
@@ -471,17 +471,26 @@ class Keyset:
         key2 = _ml.strxor(key1, z19+"\x01")
         return (key1, key2)
 
+    def getKeys(self, modes):
+        """Derives several keys from the master secret in a single call to
+           _minionlib.  'modes' is a sequence of (mode, kind) tuples; for
+           each one, the result list holds:
+               get(mode, n)            if kind is an integer n;
+               aes_key(get(mode))      if kind is 'aes';
+               getLionessKeys(mode)    if kind is 'lioness';
+               getBearKeys(mode)       if kind is 'bear'.
+        """
+        return _ml.derive_keys(self.master, modes)
+
 def lioness_keys_from_payload(payload):
     '''Given a payload, returns the LIONESS keys to encrypt the off-header
        at the swap point.'''
-    digest = sha1(payload)
-    return Keyset(digest).getLionessKeys(HIDE_HEADER_MODE)
+    return _ml.derive_keys(sha1(payload), ((HIDE_HEADER_MODE,'lioness'),))[0]
 
 def lioness_keys_from_header(header2):
     '''Given the off-header, returns the LIONESS keys to encrypt the payload
        at the swap point.'''
-    digest = sha1(header2)
-    return Keyset(digest).getLionessKeys(HIDE_PAYLOAD_MODE)
+    return _ml.derive_keys(sha1(header2), ((HIDE_PAYLOAD_MODE,'lioness'),))[0]
 
 #---------------------------------------------------------------------
 # Random number generators
@@ -17,20 +17,23 @@ import binascii
 import cPickle
 import dumbdbm
 import errno
+import mmap
 import os
 import stat
+import struct
 import threading
 import time
 import types
 import whichdb
 
 from mixminion.Common import MixError, MixFatalError, secureDelete, LOG, \
-     createPrivateDir, readFile, replaceFile, tryUnlink, writePickled
+     createPrivateDir, readFile, replaceFile, tryUnlink, writeFile, \
+     writePickled
 from mixminion.Crypto import getCommonPRNG
 
 __all__ = [ "StringStore", "StringMetadataStore",
             "ObjectStore", "ObjectMetadataStore",
-            "MixedStore", "MixedMetadataStore",
+            "MixedStore", "MixedMetadataStore", "RingStore",
             "DBBase", "JournaledDBBase", "BooleanJournaledDBBase",
             "CorruptedFile",
             ]
@@ -232,6 +235,39 @@ class BaseStore:
         else:
             self._changeState(handle, "inp", "rmv")
 
+    def moveMessageTo(self, handle, store, metadata=None):
+        """Move the message 'handle' out of this filestore and into the
+           filestore 'store', without reading or rewriting it, and return
+           its handle in 'store'.  If 'store' keeps metadata, 'metadata'
+           becomes the message's metadata there.  Any metadata the message
+           had here is removed, not moved.
+
+           Both filestores must be on the same filesystem; if the message
+           can't be renamed, raises OSError and leaves it here."""
+        f, newHandle = store.openNewMessage()
+        f.close()
+        try:
+            self._lock.acquire()
+            try:
+                replaceFile(os.path.join(self.dir, "msg_"+handle),
+                            os.path.join(store.dir, "inp_"+newHandle))
+            except OSError:
+                store._changeState(newHandle, "inp", "rmv")
+                raise
+            self._forgetMoved(handle)
+        finally:
+            self._lock.release()
+        if isinstance(store, BaseMetadataStore):
+            store.setMetadata(newHandle, metadata)
+        store._changeState(newHandle, "inp", "msg")
+        return newHandle
+
+    def _forgetMoved(self, handle):
+        """Helper: called with the lock held after the message 'handle' has
+           been moved to another filestore."""
+        if self.n_entries >= 0:
+            self.n_entries -= 1
+
     def cleanQueue(self, secureDeleteFn=None):
         """Removes all timed-out or trash messages from the filestore.
 
@@ -445,6 +481,15 @@ class BaseMetadataStore(BaseStore):
         finally:
             self._lock.release()
 
+    def _forgetMoved(self, handle):
+        BaseStore._forgetMoved(self, handle)
+        if os.path.exists(os.path.join(self.dir, "meta_"+handle)):
+            self._changeState(handle, "meta", "rmvm")
+        try:
+            del self._metadata_cache[handle]
+        except KeyError:
+            pass
+
     def _doRemove(self, handle, newState):
         try:
             self._lock.acquire()
@@ -524,6 +569,184 @@ class MixedMetadataStore(BaseMetadataStore, StringMetadataStoreMixin,
         StringMetadataStoreMixin.__init__(self)
         ObjectMetadataStoreMixin.__init__(self)
 
+# ======================================================================
+# Ring stores.
+
+# First bytes of every ring file.
+RING_MAGIC = "MMRING1\n"
+# Format of the ring file header: magic, slot length, number of slots.
+_RING_HEADER_FMT = "!8sLL"
+_RING_HEADER_LEN = struct.calcsize(_RING_HEADER_FMT)
+# We align the first slot to this boundary.
+_RING_ALIGN = 4096
+# Slot states, one byte per slot.
+_SLOT_FREE = "\0"
+_SLOT_FULL = "\1"
+
+class RingStore:
+    """A RingStore is a fixed number of fixed-length 'slots' in a single
+       preallocated, memory-mapped file.  It holds strings of exactly the
+       slot length, like a StringStore, but storing or removing one costs
+       a memory copy rather than a file creation, a rename, and a
+       deletion.
+
+       Layout: a header giving the slot length and count; a state map with
+       one byte per slot; and, starting at the next page boundary, the
+       slots themselves.  We write a slot's contents before marking it
+       full, and zero them before marking it free, so that if the process
+       crashes, every slot marked full holds a complete string.  (We don't
+       sync the file on every change, so after an OS crash or power loss
+       the kernel may have saved a slot's state byte but not its contents,
+       just as a StringStore may lose the contents of its newest files.
+       We use a byte per slot rather than a bit so that marking one slot
+       never rewrites the state of another.)
+
+       Handles are slot indices.  Like BaseStore, a RingStore is
+       threadsafe, and expects one producer and one consumer.
+       """
+    ## Fields:
+    # fname: the name of the ring file.
+    # slotLen: the length of each slot.
+    # nSlots: the number of slots.
+    # _offset: the position of the first slot in the file.
+    # _file: the open ring file.
+    # _map: an mmap object for the whole of _file.
+    # _free: a list of the indices of all free slots.
+    # _zero: a string of slotLen zero bytes.
+    # _lock: a lock that must be held while modifying _free or the state
+    #     map.
+    def __init__(self, fname, slotLen, nSlots):
+        """Open the ring file 'fname', creating it with 'nSlots' slots of
+           'slotLen' bytes each if it doesn't exist.  If the file exists
+           with a different geometry, we recreate it when it is empty, and
+           keep using it as it is otherwise."""
+        if slotLen < 1 or nSlots < 1:
+            raise MixError("Ring must have at least one nonempty slot")
+        self.fname = fname
+        self._lock = threading.RLock()
+        if os.path.exists(fname):
+            geometry = self._readHeader()
+            if geometry != (slotLen, nSlots):
+                if self._countFull(geometry) == 0:
+                    LOG.info("Resizing empty ring file %s", fname)
+                    self._create(slotLen, nSlots)
+                else:
+                    LOG.warn("Not resizing nonempty ring file %s", fname)
+        else:
+            self._create(slotLen, nSlots)
+        self.slotLen, self.nSlots = self._readHeader()
+        self._offset = _ringDataOffset(self.nSlots)
+        self._file = open(fname, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(),
+                              self._offset+self.slotLen*self.nSlots)
+        self._zero = "\0"*self.slotLen
+        states = self._map[_RING_HEADER_LEN:_RING_HEADER_LEN+self.nSlots]
+        self._free = [ i for i in xrange(self.nSlots-1, -1, -1)
+                       if states[i] != _SLOT_FULL ]
+
+    def _create(self, slotLen, nSlots):
+        """Helper: write a new, empty ring file."""
+        offset = _ringDataOffset(nSlots)
+        header = struct.pack(_RING_HEADER_FMT, RING_MAGIC, slotLen, nSlots)
+        # We write out every byte, rather than making a sparse file, so
+        # that we can't run out of disk when we store into a slot later.
+        writeFile(self.fname, header+"\0"*(offset-len(header)+
+                                           slotLen*nSlots),
+                  mode=0600, binary=1)
+
+    def _readHeader(self):
+        """Helper: return the (slotLen, nSlots) of the ring file."""
+        f = open(self.fname, 'rb')
+        try:
+            header = f.read(_RING_HEADER_LEN)
+        finally:
+            f.close()
+        if len(header) != _RING_HEADER_LEN:
+            raise MixFatalError("Truncated ring file %s" % self.fname)
+        magic, slotLen, nSlots = struct.unpack(_RING_HEADER_FMT, header)
+        if magic != RING_MAGIC:
+            raise MixFatalError("%s is not a ring file" % self.fname)
+        return slotLen, nSlots
+
+    def _countFull(self, (slotLen, nSlots)):
+        """Helper: return the number of full slots in the ring file,
+           whose geometry is (slotLen, nSlots)."""
+        f = open(self.fname, 'rb')
+        try:
+            f.seek(_RING_HEADER_LEN)
+            return f.read(nSlots).count(_SLOT_FULL)
+        finally:
+            f.close()
+
+    def count(self):
+        """Return the number of full slots."""
+        return self.nSlots - len(self._free)
+
+    def getAllMessages(self):
+        """Return handles for all full slots."""
+        try:
+            self._lock.acquire()
+            states = self._map[_RING_HEADER_LEN:_RING_HEADER_LEN+self.nSlots]
+        finally:
+            self._lock.release()
+        return [ i for i in xrange(self.nSlots) if states[i] == _SLOT_FULL ]
+
+    def queueMessage(self, contents):
+        """Store 'contents', which must be exactly slotLen bytes long, in
+           a free slot, and return the slot's handle.  Returns None if every
+           slot is full."""
+        if len(contents) != self.slotLen:
+            raise MixError("Wrong length for ring slot")
+        try:
+            self._lock.acquire()
+            if not self._free:
+                return None
+            handle = self._free.pop()
+        finally:
+            self._lock.release()
+        pos = self._offset+handle*self.slotLen
+        self._map[pos:pos+self.slotLen] = contents
+        self._map[_RING_HEADER_LEN+handle] = _SLOT_FULL
+        return handle
+
+    def messageContents(self, handle):
+        """Return a read-only buffer of the contents of slot 'handle'.
+           The buffer refers to the ring itself, and is only valid until
+           the slot is removed."""
+        return buffer(self._map, self._offset+handle*self.slotLen,
+                      self.slotLen)
+
+    def removeMessage(self, handle):
+        """Zero the slot 'handle', and mark it free."""
+        try:
+            self._lock.acquire()
+            if self._map[_RING_HEADER_LEN+handle] != _SLOT_FULL:
+                LOG.error("Tried to remove empty slot %s from ring %s",
+                          handle, self.fname)
+                return
+            pos = self._offset+handle*self.slotLen
+            self._map[pos:pos+self.slotLen] = self._zero
+            self._map[_RING_HEADER_LEN+handle] = _SLOT_FREE
+            self._free.append(handle)
+        finally:
+            self._lock.release()
+
+    def sync(self):
+        """Flush the ring file to disk."""
+        self._map.flush()
+
+    def close(self):
+        """Flush and close the ring file."""
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+def _ringDataOffset(nSlots):
+    """Helper: return the position of the first slot in a ring file with
+       'nSlots' slots."""
+    n = _RING_HEADER_LEN + nSlots + _RING_ALIGN - 1
+    return n - (n % _RING_ALIGN)
+
 # ======================================================================
 # Database wrappers
 
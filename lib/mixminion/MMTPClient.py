@@ -27,6 +27,32 @@ from mixminion.Common import MixProtocolError, MixProtocolReject, \
      TimeoutError
 from mixminion.Packet import IPV4Info, MMTPHostInfo
 
+# The MMTP version in which sender and receiver agree on how many packets
+# may be unacknowledged at once.  (Otherwise, it's the same as 0.3.)  The
+# sender offers a version string like "0.4;window=64", and the receiver
+# answers with the window it will allow, which is never larger.
+WINDOWED_PROTOCOL = "0.4"
+
+def formatProtocol(version, window=None):
+    """Return the element of an MMTP protocol string that names 'version'
+       and, if 'window' is provided, the window we want to use."""
+    if window is None:
+        return version
+    return "%s;window=%d" % (version, window)
+
+def parseProtocol(s):
+    """Given one element of an MMTP protocol string, return a 2-tuple of
+       the version it names, and the window it names (or None if it names
+       no valid window).  Unrecognized parameters are ignored."""
+    parts = s.split(";")
+    window = None
+    for param in parts[1:]:
+        if param.startswith("window="):
+            w = param[len("window="):]
+            if w.isdigit() and 0 < int(w) < 65536:
+                window = int(w)
+    return parts[0], window
+
 def _noop(*k,**v): pass
 class EventStatsDummy:
     def __getattr__(self,a):
@@ -54,10 +80,14 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
     """A nonblocking MMTP connection sending packets and padding to a single
        server."""
     # Which MMTP versions do we understand?
-    PROTOCOL_VERSIONS = ['0.3']
+    PROTOCOL_VERSIONS = ['0.4', '0.3']
     # If we've written WRITEAHEAD packets without receiving any acks, we wait
-    # for an ack before sending any more.
+    # for an ack before sending any more.  (This is the default window, for
+    # servers that don't negotiate one.)
     WRITEAHEAD = 6
+    # How many unacknowledged packets do we ask to have in flight, when the
+    # server supports windowed MMTP?
+    WINDOW = 64
     # Length of a single transmission unit (control string, packet, checksum)
     MESSAGE_LEN = 6 + (1<<15) + 20
     # Length of a single acknowledgment (control string, digest)
@@ -75,6 +105,7 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
     # nPacketsTotal: total number of packets we've ever been asked to send.
     # nPacketsSent: total number of packets sent across the TLS connection
     # nPacketsAcked: total number of acks received from the TLS connection
+    # window: how many packets may we have sent without receiving acks?
     # expectedAcks: list of acceptAck,rejectAck tuples for the packets
     #   that we've sent but haven't gotten acks for.
     # _isConnected: flag: true if the TLS connection been completed,
@@ -126,6 +157,7 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         self.pendingPackets = []
         self.expectedAcks = []
         self.nPacketsSent = self.nPacketsAcked = self.nPacketsTotal =0
+        self.window = self.WRITEAHEAD
         self._isConnected = 0
         self._isFailed = 0
         self._isAlive = 1
@@ -169,24 +201,24 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
             # Renegotiate has been removed from the spec.
             return
 
-        data = "".join([control, m, sha1(m+hashExtra)])
-        assert len(data) == self.MESSAGE_LEN
+        digest = sha1(m+hashExtra)
+        assert len(control)+len(m)+len(digest) == self.MESSAGE_LEN
         acceptedAck = serverControl + sha1(m+serverHashExtra)
         rejectedAck = "REJECTED\r\n" + sha1(m+"REJECTED")
         assert len(acceptedAck) == len(rejectedAck) == self.ACK_LEN
         self.expectedAcks.append( (acceptedAck, rejectedAck) )
         self.pendingPackets.append(pkt)
-        self.beginWriting(data)
+        self.beginWriting([control, m, digest])
         self.nPacketsSent += 1
 
     def _updateRWState(self):
         """Helper: if we have any queued packets that haven't been sent yet,
-           and we aren't waiting for WRITEAHEAD acks, and we're connected,
-           start sending the pending packets.
+           and we aren't waiting for a full window of acks, and we're
+           connected, start sending the pending packets.
         """
         if not self._isConnected: return
 
-        while self.nPacketsSent < self.nPacketsAcked + self.WRITEAHEAD:
+        while self.nPacketsSent < self.nPacketsAcked + self.window:
             if not self.packets:
                 break
             LOG.trace("Queueing new packet for %s",self.address)
@@ -231,7 +263,13 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         EventStats.log.successfulConnect()
 
         # The certificate is fine; start protocol negotiation.
-        self.beginWriting("MMTP %s\r\n" % ",".join(self.PROTOCOL_VERSIONS))
+        offer = []
+        for p in self.PROTOCOL_VERSIONS:
+            if p == WINDOWED_PROTOCOL:
+                offer.append(formatProtocol(p, self.WINDOW))
+            else:
+                offer.append(p)
+        self.beginWriting("MMTP %s\r\n" % ",".join(offer))
         self.onWrite = self.onProtocolWritten
 
     def onProtocolWritten(self,n):
@@ -259,18 +297,20 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
 
         # Find which protocol the server chose.
         self.protocol = None
-        for p in self.PROTOCOL_VERSIONS:
-            if s == "MMTP %s\r\n"%p:
-                self.protocol = p
-                break
+        if s.startswith("MMTP ") and s.endswith("\r\n"):
+            version, window = parseProtocol(s[5:-2])
+            if version in self.PROTOCOL_VERSIONS:
+                self.protocol = version
         if not self.protocol:
             LOG.warn("Protocol negotiation failed with %s", self.address)
             self._failPendingPackets()
             self.startShutdown()
             return
+        if self.protocol == WINDOWED_PROTOCOL and window:
+            self.window = min(window, self.WINDOW)
 
-        LOG.debug("MMTP protocol negotiated with %s: version %s",
-                  self.address, self.protocol)
+        LOG.debug("MMTP protocol negotiated with %s: version %s, window %s",
+                  self.address, self.protocol, self.window)
 
         # Now that we're connected, optimize for throughput.
         mixminion.NetUtils.optimizeThroughput(self.sock)
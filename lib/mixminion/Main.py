@@ -114,6 +114,7 @@ _COMMANDS = {
     "version" :        ( 'mixminion.Main',       'printVersion' ),
     "unittests" :      ( 'mixminion.test',       'testAll' ),
     "benchmarks" :     ( 'mixminion.benchmark',  'timeAll' ),
+    "loadtest" :       ( 'mixminion.loadtest',   'runLoadTest' ),
     "testvectors" :    ( 'mixminion.testSupport', 'testVectors' ),
     "send" :           ( 'mixminion.ClientMain', 'runClient' ),
     "queue" :          ( 'mixminion.ClientMain', 'runClient' ),
@@ -179,6 +180,7 @@ _USAGE = (
   "       dir            [Administration for server directories]\n"+
   "       unittests      [Run the mixminion unit tests]\n"+
   "       benchmarks     [Time underlying cryptographic operations]\n"+
+  "       loadtest       [Measure throughput of a mixnet on localhost]\n"+
   "\n"+
   "For help on sending a message, run 'mixminion send --help'"
 )
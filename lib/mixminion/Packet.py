@@ -16,7 +16,7 @@ __all__ = [ 'compressData', 'CompressedDataTooLong', 'DROP_TYPE',
             'FRAGMENT_MESSAGEID_LEN', 'FRAGMENT_TYPE',
             'HEADER_LEN', 'IPV4Info', 'MAJOR_NO', 'MBOXInfo',
             'MBOX_TYPE', 'MINOR_NO', 'MIN_EXIT_TYPE',
-            'MIN_SUBHEADER_LEN', 'MMTPHostInfo', 'Packet',
+            'MIN_SUBHEADER_LEN', 'MMTPHostInfo', 'Packet', 'PacketBuffer',
             'OAEP_OVERHEAD', 'PAYLOAD_LEN', 'ParseError', 'ReplyBlock',
             'ReplyBlock', 'SECRET_LEN', 'SINGLETON_PAYLOAD_OVERHEAD',
             'SMTPInfo', 'SMTP_TYPE', 'SWAP_FWD_IPV4_TYPE',
@@ -130,6 +130,65 @@ class Packet:
         """Return the 32K string value of this packet."""
         return "".join([self.header1,self.header2,self.payload])
 
+# True iff this Python has the bytearray and memoryview types that
+# PacketBuffer needs.  (They appeared in Python 2.7.)
+try:
+    memoryview
+    HAVE_PACKET_BUFFER = 1
+except NameError:
+    HAVE_PACKET_BUFFER = 0
+
+class PacketBuffer:
+    """Represents a complete Mixminion packet as a single mutable 32K
+       buffer, so that a server can decrypt and rearrange it in place
+       rather than building a new string at every step.  Only usable if
+       HAVE_PACKET_BUFFER is true.
+
+       Fields: buf (a bytearray); header1, header2, payload (writable
+       memoryviews into buf)"""
+    def __init__(self, s):
+        """Create a new PacketBuffer holding a copy of the 32K string
+           's'."""
+        if len(s) != PACKET_LEN:
+            raise ParseError("Bad packet length")
+        self.buf = bytearray(s)
+        v = memoryview(self.buf)
+        self.header1 = v[:HEADER_LEN]
+        self.header2 = v[HEADER_LEN:HEADER_LEN*2]
+        self.payload = v[HEADER_LEN*2:]
+
+    def getHeader1(self):
+        """Return the first header as a string."""
+        return self.header1.tobytes()
+
+    def getPayload(self):
+        """Return the payload as a string."""
+        return self.payload.tobytes()
+
+    def getHeader2Buffer(self):
+        """Return a read-only buffer of the second header, suitable for
+           hashing without a copy."""
+        return buffer(self.buf, HEADER_LEN, HEADER_LEN)
+
+    def getPayloadBuffer(self):
+        """Return a read-only buffer of the payload, suitable for hashing
+           without a copy."""
+        return buffer(self.buf, HEADER_LEN*2)
+
+    def setHeader1(self, s):
+        """Replace the first header with the 2K string 's'."""
+        self.header1[:] = s
+
+    def swapHeaders(self):
+        """Exchange the first and second headers."""
+        h = self.header1.tobytes()
+        self.header1[:] = self.header2
+        self.header2[:] = h
+
+    def pack(self):
+        """Return the 32K string value of this packet."""
+        return str(self.buf)
+
 def parseHeader(s):
     """Convert a 2K string into a Header object"""
     if len(s) != HEADER_LEN:
@@ -168,7 +168,7 @@ class Scheduler:
         try:
             self.scheduledEvents.append(event)
         finally:
-            self.schedLock.acquire()
+            self.schedLock.release()
 
     #XXXX008 -- these are only used for testing.
     def scheduleOnce(self, when, name, cb):
@@ -8,7 +8,8 @@
    """
 
 __all__ = [ 'ServerInfo', 'ServerDirectory', 'displayServerByRouting',
-            'getNicknameByKeyID', 'SignedDirectory', 'parseDirectory' ]
+            'getNicknameByKeyID', 'SignedDirectory', 'parseDirectory',
+            'checkServerInfoSignatures' ]
 
 import re
 import time
@@ -21,7 +22,7 @@ from mixminion.Common import IntervalSet, LOG, MixError, createPrivateDir, \
      formatBase64, formatDate, formatTime, readPossiblyGzippedFile
 from mixminion.Config import ConfigError
 from mixminion.Crypto import CryptoError, DIGEST_LEN, pk_check_signature, \
-     pk_encode_public_key, pk_fingerprint, pk_sign, sha1
+     pk_check_signatures, pk_encode_public_key, pk_fingerprint, pk_sign, sha1
 
 # Longest allowed Contact email
 MAX_CONTACT = 256
@@ -108,6 +109,9 @@ class ServerInfo(mixminion.Config._ConfigFile):
     # _isValidated: flag.  Has this serverInfo been fully validated?
     # _validatedDigests: a dict whose keys are already-validated server
     #    digests.  Optional.  Only valid while 'validate' is being called.
+    # _signatureChecks: a list to which we append our signature, rather
+    #    than checking it.  Optional.  Only valid while 'validate' is being
+    #    called.
 
     """A ServerInfo object holds a parsed server descriptor."""
     _restrictFormat = 1
@@ -185,7 +189,8 @@ class ServerInfo(mixminion.Config._ConfigFile):
          }
 
     def __init__(self, fname=None, string=None, assumeValid=0,
-                 validatedDigests=None, _keepContents=0): #DOCDOC
+                 validatedDigests=None, _keepContents=0,
+                 _signatureChecks=None): #DOCDOC
         """Read a server descriptor from a file named <fname>, or from
              <string>.
 
@@ -194,12 +199,19 @@ class ServerInfo(mixminion.Config._ConfigFile):
            If the (computed) digest of this descriptor is a key of the dict
               validatedDigests, assume we have already validated it, and
               pass it along.
+
+           If _signatureChecks is a list, don't check the signature on
+              this descriptor: instead, append it to the list, and leave
+              this descriptor unvalidated until the list is passed to
+              checkServerInfoSignatures.
         """
         self._isValidated = 0
         self._validatedDigests = validatedDigests
+        self._signatureChecks = _signatureChecks
         mixminion.Config._ConfigFile.__init__(self, fname, string, assumeValid,
                                               keep=_keepContents)
         del self._validatedDigests
+        del self._signatureChecks
 
     def prevalidate(self, contents):
         for name, ents in contents:
@@ -270,14 +282,16 @@ class ServerInfo(mixminion.Config._ConfigFile):
             raise ConfigError("Invalid length on packet key")
 
         ####
-        # Check signature
-        try:
-            signedDigest = pk_check_signature(server['Signature'], identityKey)
-        except CryptoError:
-            raise ConfigError("Invalid signature")
+        # Check signature, unless our caller wants to check it later.
+        if self._signatureChecks is None:
+            try:
+                signedDigest = pk_check_signature(server['Signature'],
+                                                  identityKey)
+            except CryptoError:
+                raise ConfigError("Invalid signature")
 
-        if digest != signedDigest:
-            raise ConfigError("Signed digest is incorrect")
+            if digest != signedDigest:
+                raise ConfigError("Signed digest is incorrect")
 
         ## Incoming/MMTP section
         inMMTP = self['Incoming/MMTP']
@@ -296,7 +310,11 @@ class ServerInfo(mixminion.Config._ConfigFile):
         # FFFF When a better client module system exists, check the
         # FFFF module descriptors.
 
-        self._isValidated = 1
+        if self._signatureChecks is None:
+            self._isValidated = 1
+        else:
+            self._signatureChecks.append((self, server['Signature'],
+                                          identityKey, digest))
 
     def getNickname(self):
         """Returns this server's nickname"""
@@ -527,6 +545,40 @@ class ServerInfo(mixminion.Config._ConfigFile):
 
 # Regex used to split a big directory along '[Server]' lines.
 _server_header_re = re.compile(r'^\[\s*Server\s*\]\s*\n', re.M)
+def checkServerInfoSignatures(checks, nThreads=None):
+    """Given a list of signatures deferred by passing _signatureChecks to
+       the ServerInfo constructor, check them all at once, using up to
+       nThreads threads.  Mark every ServerInfo with a good signature as
+       validated, and return a list of (ServerInfo, error message) tuples
+       for the rest."""
+    signed = pk_check_signatures([ (sig, key) for _, sig, key, _ in checks ],
+                                 nThreads)
+    bad = []
+    for idx in xrange(len(checks)):
+        info, digest = checks[idx][0], checks[idx][3]
+        if signed[idx] is None:
+            bad.append((info, "Invalid signature"))
+        elif signed[idx] != digest:
+            bad.append((info, "Signed digest is incorrect"))
+        else:
+            info._isValidated = 1
+    return bad
+
+def _parseServerInfos(strings, validatedDigests=None, _keepContents=0):
+    """Helper: parse and validate every server descriptor in the list
+       'strings', checking their signatures together.  Return a list of
+       ServerInfo.  Raise ConfigError if any descriptor is invalid."""
+    checks = []
+    servers = [ ServerInfo(string=s, validatedDigests=validatedDigests,
+                           _keepContents=_keepContents,
+                           _signatureChecks=checks)
+                for s in strings ]
+    bad = checkServerInfoSignatures(checks)
+    if bad:
+        info, msg = bad[0]
+        raise ConfigError("%s on descriptor for %s" % (msg,info.getNickname()))
+    return servers
+
 class ServerDirectory:
     """Minimal client-side implementation of directory parsing.  This will
        become very inefficient when directories get big, but we won't have
@@ -570,9 +622,7 @@ class ServerDirectory:
         self.header = _DirectoryHeader(headercontents, digest)
         self.goodServerNames = [name.lower() for name in
                    self.header['Directory']['Recommended-Servers'] ]
-        servers = [ ServerInfo(string=s,
-                               validatedDigests=validatedDigests)
-                    for s in servercontents ]
+        servers = _parseServerInfos(servercontents, validatedDigests)
         self.allServers = servers[:]
         goodServers = [ s for s in servers
                         if s.getNickname().lower() in self.goodServerNames ]
@@ -639,11 +689,8 @@ class SignedDirectory:
         # Parse the DirectoryInfo
         self.dirInfo = _DirectoryInfo(info)
         # Parse the Server descriptors.
-        self.servers = [ ]
-        for s in servers:
-            si = ServerInfo(string=s, validatedDigests=validatedDigests,
-                            _keepContents=_keepServerContents)
-            self.servers.append(si)
+        self.servers = _parseServerInfos(servers, validatedDigests,
+                                         _keepServerContents)
         self.goodServerNames = [ name.lower()
              for name in self.dirInfo['Directory-Info']['Recommended-Servers'] ]
 
@@ -967,7 +1014,7 @@ def _getMultisignedDirectoryDigest(directory):
             idx = 0
         else:
             idx = directory.index("\n[Directory-Info]\n")+1
-    except IndexError:
+    except ValueError:
         raise ConfigError("No [Directory-Info] found.")
     digest = sha1(directory[idx:])
     return digest
@@ -7,12 +7,16 @@
 #XXXX implement renegotiate
 import sys
 import time
+from types import StringType
 
 import mixminion._minionlib as _ml
 from mixminion.Common import LOG, stringContains
 
 # Number of bytes to try reading at once.
 _READLEN = 1024
+# Number of bytes we try to gather into a single write when the output
+# buffer holds small strings.  (This is the largest TLS record.)
+_WRITELEN = 16384
 
 class _Closing(Exception):
     """Helper class: exception raised by state functions that want the
@@ -46,7 +50,10 @@ class TLSConnection:
     # inbuf -- a list of strings received from self.tls
     # inbuflen -- the total length of the strings in self.inbuf
     # outbuf -- a list of strings to write to self.tls
-    # outbuflen -- the total length of the strings in self.outbuf
+    # outbuflen -- the number of bytes in self.outbuf that we haven't
+    #   written yet.
+    # __outbufOffset -- how many bytes of self.outbuf[0] have we already
+    #   written?
     #
     # __setup -- have we finished the TLS handshake.
     # __stateFn -- a function that should be invoked when this connection
@@ -81,6 +88,7 @@ class TLSConnection:
         self.inbuflen = 0
         self.outbuf = []
         self.outbuflen = 0
+        self.__outbufOffset = 0
 
         self.__awaitingShutdown = 0
         self.__bytesReadOnShutdown = 0
@@ -120,6 +128,10 @@ class TLSConnection:
         if not self.__readBlockedOnWrite:
             self.wantRead = 1
 
+    def isReading(self):
+        """Return true iff we are currently reading bytes from self.tls."""
+        return self.__reading
+
     def stopReading(self):
         """Stop reading bytes from self.tls."""
         assert self.__stateFn == self.__dataFn
@@ -129,11 +141,17 @@ class TLSConnection:
         self.__reading = 0
 
     def beginWriting(self, data):
-        """Queue 'data' to be written to self.tls.  When any is written,
-           onWrite is invoked."""
+        """Queue 'data' to be written to self.tls.  'data' may be a string,
+           or a list of strings to be written one after another; we keep
+           references to the strings rather than copying them.  When any
+           data is written, onWrite is invoked."""
         self.__stateFn = self.__dataFn
-        self.outbuf.append(data)
-        self.outbuflen += len(data)
+        if type(data) == StringType:
+            data = [ data ]
+        for s in data:
+            if s:
+                self.outbuf.append(s)
+                self.outbuflen += len(s)
         if not self.__writeBlockedOnRead:
             self.wantWrite = 1
 
@@ -142,6 +160,7 @@ class TLSConnection:
         self.__stateFn = self.__dataFn
         self.outbuf = []
         self.outbuflen = 0
+        self.__outbufOffset = self.__blockedWriteLen = 0
         self.__writeBlockedOnRead = 0
         if not self.__readBlockedOnWrite:
             self.wantWrite = 0
@@ -153,6 +172,7 @@ class TLSConnection:
         self.__stateFn = self.__shutdownFn
         self.outbuf = []
         self.outbuflen = 0
+        self.__outbufOffset = self.__blockedWriteLen = 0
         self.__reading = 0
         self.__writeBlockedOnRead = self.__readBlockedOnWrite = 0
         self.wantRead = self.wantWrite = 1
@@ -348,16 +368,21 @@ class TLSConnection:
         "Helper function: write as much data from self.outbuf as we can."
         self.__writeBlockedOnRead = 0
         while self.outbuf and cap > 0:
+            avail = len(self.outbuf[0]) - self.__outbufOffset
             if self.__blockedWriteLen:
                 # If the last write blocked, we must retry the exact same
                 # length, or else OpenSSL will give an error.
                 span = self.__blockedWriteLen
-            else:
+            elif avail >= _WRITELEN:
                 # Otherwise, we try to write as much of the first string on
-                # the output buffer as our bandwidth cap will allow.
-                span = min(len(self.outbuf[0]),cap)
+                # the output buffer as our bandwidth cap will allow...
+                span = min(avail,cap)
+            else:
+                # ...unless it's short, in which case we gather it with
+                # the strings after it into a single TLS record.
+                span = min(self.outbuflen,cap,_WRITELEN)
             try:
-                n = self.tls.write(self.outbuf[0][:span])
+                n = self.tls.write(self.__getOutbufChunk(span))
             except _ml.TLSWantRead:
                 self.__blockedWriteLen = span
                 self.__writeBlockedOnRead = 1
@@ -373,11 +398,7 @@ class TLSConnection:
                 assert n >= 0
                 self.__blockedWriteLen = 0
                 LOG.trace("Wrote %s bytes to %s", n, self.address)
-                if n == len(self.outbuf[0]):
-                    del self.outbuf[0]
-                else:
-                    self.outbuf[0] = self.outbuf[0][n:]
-                self.outbuflen -= n
+                self.__dropOutbuf(n)
                 cap -= n
                 self.onWrite(n)
         if not self.outbuf:
@@ -387,6 +408,36 @@ class TLSConnection:
             self.doneWriting()
         return cap
 
+    def __getOutbufChunk(self, span):
+        """Helper function: return the next 'span' bytes of self.outbuf,
+           copying as little as we can."""
+        s = self.outbuf[0]
+        off = self.__outbufOffset
+        if off+span <= len(s):
+            if off == 0 and span == len(s):
+                return s
+            return buffer(s, off, span)
+        pieces = [ s[off:] ]
+        n = len(s) - off
+        idx = 1
+        while n < span:
+            s = self.outbuf[idx]
+            if n+len(s) > span:
+                s = s[:span-n]
+            pieces.append(s)
+            n += len(s)
+            idx += 1
+        return "".join(pieces)
+
+    def __dropOutbuf(self, n):
+        """Helper function: remove the first 'n' bytes from self.outbuf."""
+        self.outbuflen -= n
+        n += self.__outbufOffset
+        while n and n >= len(self.outbuf[0]):
+            n -= len(self.outbuf[0])
+            del self.outbuf[0]
+        self.__outbufOffset = n
+
     def __doRead(self, cap):
         "Helper function: read as much data as we can."
         self.__readBlockedOnWrite = 0
@@ -487,6 +538,10 @@ class TLSConnection:
                 self.onTLSError()
                 self.__close()
 
+        # (The state functions don't tell us when they've moved data, so
+        # we count again before reporting the bandwidth we used.)
+        if self.tls is not None:
+            bytesNow = self.tls.get_num_bytes_raw()
         return (self.wantRead, self.wantWrite, (self.sock is not None),
                 bytesNow-bytesAtStart)
 
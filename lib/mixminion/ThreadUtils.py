@@ -7,12 +7,14 @@
    """
 
 __all__ = [ 'MessageQueue', 'QueueEmpty', 'ClearableQueue', 'TimeoutQueue',
-            'RWLock', 'ProcessingThread', 'BackgroundingDecorator' ]
+            'RWLock', 'ProcessingThread', 'BackgroundingDecorator',
+            'Future', 'CancelledError', 'FutureTimeout', 'CallbackQueue',
+            'WorkerPool' ]
 
 import sys
 import threading
 import time
-from mixminion.Common import LOG
+from mixminion.Common import LOG, MixError, floorDiv
 
 import thread
 _get_ident = thread.get_ident
@@ -294,6 +296,10 @@ class ProcessingThread(threading.Thread):
     # Fields:
     #   mqueue: a ClearableQueue of callable objects.
     #   threadName: the name of this thread (used in log msgs)
+    #   highWater, lowWater: the queue lengths at which we start and stop
+    #      reporting congestion, or None if we never report congestion.
+    #   _congested: flag: have we reached highWater since we last drained
+    #      to lowWater?
     class _Shutdown:
         """Callable that raises itself when called.  Inserted into the
            queue when it's time to shut down."""
@@ -305,6 +311,42 @@ class ProcessingThread(threading.Thread):
         threading.Thread.__init__(self)
         self.mqueue = ClearableQueue()
         self.threadName = name
+        self.highWater = self.lowWater = None
+        self._congested = 0
+
+    def setWatermarks(self, high, low=None):
+        """Report this thread as congested (see isCongested) once 'high'
+           jobs are waiting, until no more than 'low' jobs are waiting.
+           'low' defaults to half of 'high'.  If 'high' is None, never
+           report congestion."""
+        if high is None:
+            low = None
+        elif low is None:
+            low = floorDiv(high, 2)
+        assert high is None or 0 <= low < high
+        self.highWater = high
+        self.lowWater = low
+        self._congested = 0
+
+    def getQueueLength(self):
+        """Return the number of jobs waiting to be run."""
+        return self.mqueue.qsize()
+
+    def isCongested(self):
+        """Return true iff the job queue has reached its high watermark,
+           and has not since drained to its low watermark.  Callers should
+           stop adding work while this is true.
+
+           This method is not threadsafe; only one thread should call it."""
+        if self.highWater is None:
+            return 0
+        n = self.mqueue.qsize()
+        if self._congested:
+            if n <= self.lowWater:
+                self._congested = 0
+        elif n >= self.highWater:
+            self._congested = 1
+        return self._congested
 
     def shutdown(self,flush=1):
         """Tells this thread to shut down once the current job is done."""
@@ -319,6 +361,18 @@ class ProcessingThread(threading.Thread):
            ProcessingThread._Shutdown, the processing thread stops running."""
         self.mqueue.put(job)
 
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) in this thread, after all the jobs
+           already queued.  Return a Future for its result.  Unlike a job
+           added with addJob, an exception in fn is recorded in the
+           Future, and doesn't stop the thread."""
+        future = Future()
+        def job(future=future, fn=fn, args=args, kwargs=kwargs,
+                name=self.threadName):
+            future._run(fn, args, kwargs, name)
+        self.addJob(job)
+        return future
+
     def run(self):
         """Internal: main body of processing thread."""
         try:
@@ -335,29 +389,26 @@ class ProcessingThread(threading.Thread):
 
 class BackgroundingDecorator:
     """Wraps an underlying object, and makes all method calls to the wrapped
-       object happen in a processing thread.
+       object happen in a processing thread or a worker pool.
 
-       Return values from wrapped methods are lost.
+       Wrapped methods return a Future for the underlying method's return
+       value.
 
        Methods and attributes starting with _ are not wrapped;
        otherwise, attribute access is not available.
     """
-    #FFFF We could retain return values by adding some kind of a thunk
-    #FFFF system, or some kind of callback system.  But neither is needed
-    #FFFF right now.
     class _AddJob:
         "Helper: A wrapped function for the underlying object."
         def __init__(self, processingThread, fn):
             self.thread = processingThread
             self.fn = fn
         def __call__(self, *args, **kwargs):
-            def callback(self=self, args=args, kwargs=kwargs):
-                self.fn(*args, **kwargs)
-            self.thread.addJob(callback)
+            return self.thread.submit(self.fn, *args, **kwargs)
 
     def __init__(self, processingThread, obj):
         """Create a new BackgroundingDecorator to redirect calls to the
-           methods of obj to processingThread."""
+           methods of obj to processingThread, which may be a
+           ProcessingThread or a WorkerPool."""
         self._thread = processingThread
         self._baseObject = obj
 
@@ -365,3 +416,398 @@ class BackgroundingDecorator:
         if attr[0]=='_': return getattr(self._baseObject,attr)#XXXX
         fn = getattr(self._baseObject,attr)
         return self._AddJob(self._thread,fn)
+
+#----------------------------------------------------------------------
+# Futures and worker pools
+
+class CancelledError(MixError):
+    """Raised by Future.result when the job was cancelled."""
+    pass
+
+class FutureTimeout(MixError):
+    """Raised by Future.result when the job isn't done in time."""
+    pass
+
+class Future:
+    """The eventual result of a job running in the background.  Returned by
+       WorkerPool.submit, by ProcessingThread.submit, and by the methods
+       of a BackgroundingDecorator."""
+    ## Fields:
+    # _cond: a threading.Condition protecting the other fields.
+    # _state: one of PENDING, RUNNING, CANCELLED, or FINISHED.
+    # _result: the job's return value, if it finished without raising.
+    # _excInfo: the sys.exc_info() triple for the exception the job raised,
+    #    or None.
+    # _callbacks: a list of (fn, callbackQueue) tuples to invoke once this
+    #    future is done.
+    PENDING = "PENDING"
+    RUNNING = "RUNNING"
+    CANCELLED = "CANCELLED"
+    FINISHED = "FINISHED"
+
+    def __init__(self):
+        """Create a new pending Future."""
+        self._cond = threading.Condition(threading.Lock())
+        self._state = Future.PENDING
+        self._result = None
+        self._excInfo = None
+        self._callbacks = []
+
+    def cancel(self):
+        """Keep the job from running, if it hasn't started yet.  Return
+           true iff the job is now cancelled."""
+        self._cond.acquire()
+        try:
+            if self._state == Future.CANCELLED:
+                return 1
+            elif self._state != Future.PENDING:
+                return 0
+            self._state = Future.CANCELLED
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        self._invokeCallbacks()
+        return 1
+
+    def cancelled(self):
+        """Return true iff the job was cancelled."""
+        return self._state == Future.CANCELLED
+
+    def done(self):
+        """Return true iff the job has finished or been cancelled."""
+        return self._state in (Future.FINISHED, Future.CANCELLED)
+
+    def result(self, timeout=None):
+        """Wait until the job is done, and return its return value.  If it
+           raised an exception, raise the same exception.  If it was
+           cancelled, raise CancelledError.  If 'timeout' is provided and
+           the job isn't done within 'timeout' seconds, raise
+           FutureTimeout."""
+        self._wait(timeout)
+        if self._state == Future.CANCELLED:
+            raise CancelledError("Job was cancelled")
+        if self._excInfo is not None:
+            raise self._excInfo[0], self._excInfo[1], self._excInfo[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Wait until the job is done, as for result(), and return the
+           exception it raised, or None if it raised no exception."""
+        self._wait(timeout)
+        if self._state == Future.CANCELLED:
+            raise CancelledError("Job was cancelled")
+        if self._excInfo is None:
+            return None
+        return self._excInfo[1]
+
+    def addDoneCallback(self, fn, callbackQueue=None):
+        """Arrange for fn(future) to be invoked once this future is done.
+           If 'callbackQueue' is a CallbackQueue, fn is invoked from
+           whichever thread runs the queue; otherwise, it's invoked from
+           the worker thread that finished the job (or at once, if the job
+           is already done)."""
+        self._cond.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append((fn, callbackQueue))
+                return
+        finally:
+            self._cond.release()
+        self._invokeCallback(fn, callbackQueue)
+
+    def _wait(self, timeout):
+        """Helper: block until this future is done, or until 'timeout'
+           seconds have passed."""
+        self._cond.acquire()
+        try:
+            if timeout is None:
+                while not self.done():
+                    self._cond.wait()
+            else:
+                deadline = time.time() + timeout
+                while not self.done():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise FutureTimeout("Job not done after %s seconds"
+                                            % timeout)
+                    self._cond.wait(remaining)
+        finally:
+            self._cond.release()
+
+    def _run(self, fn, args, kwargs, name):
+        """Helper: invoke fn(*args, **kwargs) and record the outcome,
+           unless this future was cancelled.  Called from the worker
+           thread.  'name' is the name of the worker, for log messages.
+           Returns true iff the job ran and raised no exception."""
+        self._cond.acquire()
+        try:
+            if self._state != Future.PENDING:
+                return 0
+            self._state = Future.RUNNING
+        finally:
+            self._cond.release()
+        try:
+            result = fn(*args, **kwargs)
+            excInfo = None
+        except:
+            result = None
+            excInfo = sys.exc_info()
+            LOG.error_exc(excInfo, "Exception in %s", name)
+        self._cond.acquire()
+        try:
+            self._result = result
+            self._excInfo = excInfo
+            self._state = Future.FINISHED
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        self._invokeCallbacks()
+        return excInfo is None
+
+    def _invokeCallbacks(self):
+        """Helper: invoke all the done-callbacks, once."""
+        self._cond.acquire()
+        try:
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._cond.release()
+        for fn, callbackQueue in callbacks:
+            self._invokeCallback(fn, callbackQueue)
+
+    def _invokeCallback(self, fn, callbackQueue):
+        """Helper: invoke or queue a single done-callback."""
+        if callbackQueue is not None:
+            callbackQueue.put(fn, self)
+            return
+        try:
+            fn(self)
+        except:
+            LOG.error_exc(sys.exc_info(), "Exception in job callback")
+
+class CallbackQueue:
+    """A queue of functions to be invoked by a single thread -- usually the
+       main loop -- no matter which thread added them.  Worker threads use
+       this to hand results back to code that isn't threadsafe."""
+    ## Fields:
+    # queue: a MessageQueue of (fn, args) tuples.
+    def __init__(self):
+        """Create a new empty CallbackQueue."""
+        self.queue = MessageQueue()
+
+    def put(self, fn, *args):
+        """Arrange for fn(*args) to be invoked by the next call to run().
+           Safe to call from any thread."""
+        self.queue.put((fn, args))
+
+    def run(self):
+        """Invoke every queued function, without blocking.  Return the
+           number of functions invoked."""
+        n = 0
+        while 1:
+            try:
+                fn, args = self.queue.get(block=0)
+            except QueueEmpty:
+                return n
+            n += 1
+            try:
+                fn(*args)
+            except:
+                LOG.error_exc(sys.exc_info(), "Exception in queued callback")
+
+class WorkerPool:
+    """A pool of threads to run jobs in the background.  The pool starts a
+       new thread whenever a job arrives and no thread is free, up to
+       maxThreads; threads that are idle for more than maxIdle seconds
+       exit, down to minThreads.
+
+       Unlike a ProcessingThread, a pool with more than one thread can run
+       jobs in any order.
+    """
+    ## Fields:
+    # name: the name of this pool (used in log messages).
+    # minThreads, maxThreads: bounds on the number of threads we keep.
+    # maxIdle: how long a thread may wait for a job before exiting, or
+    #    None to wait forever.
+    # daemon: flag: should our threads be daemon threads?
+    # queue: a TimeoutQueue of (future, fn, args, kwargs, timeSubmitted)
+    #    tuples, or None to tell a thread to exit.
+    # lock: a lock protecting the fields below.
+    # threads: a list of threading.Thread objects, some of which may
+    #    be dead.
+    # nLive: the number of threads that are running.
+    # nBusy: the number of threads that are running a job.
+    # nPending: the number of jobs that no thread has taken yet.
+    # isShutdown: flag: have we been told to shut down?
+    # stats: a map from statistic name to value.  See getStats.
+    def __init__(self, name, minThreads=0, maxThreads=1, maxIdle=5*60,
+                 daemon=0):
+        """Create a new WorkerPool named 'name'."""
+        assert 0 <= minThreads <= maxThreads and maxThreads >= 1
+        self.name = name
+        self.minThreads = minThreads
+        self.maxThreads = maxThreads
+        self.maxIdle = maxIdle
+        self.daemon = daemon
+        self.queue = TimeoutQueue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.nLive = self.nBusy = self.nPending = 0
+        self.isShutdown = 0
+        self.stats = { 'submitted' : 0, 'completed' : 0, 'failed' : 0,
+                       'cancelled' : 0, 'waitTime' : 0.0, 'runTime' : 0.0,
+                       'maxWaitTime' : 0.0 }
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) in one of this pool's threads.  Return a
+           Future for its result."""
+        future = Future()
+        self.lock.acquire()
+        try:
+            if self.isShutdown:
+                raise MixError("Tried to submit a job to %s after shutdown"
+                               % self.name)
+            self.stats['submitted'] += 1
+            self.nPending += 1
+            self.queue.put((future, fn, args, kwargs, time.time()))
+            # If every thread already has a job, add a thread.
+            if (self.nLive - self.nBusy < self.nPending and
+                self.nLive < self.maxThreads):
+                self._startThread()
+        finally:
+            self.lock.release()
+        return future
+
+    def addJob(self, job):
+        """Run the callable 'job' in one of this pool's threads.  (Same
+           interface as ProcessingThread.addJob.)"""
+        self.submit(job)
+
+    def setMaxThreads(self, maxThreads):
+        """Change the largest number of threads this pool may run at once.
+           We never stop a running thread: if we have too many, the extras
+           exit once they have been idle for maxIdle seconds."""
+        self.lock.acquire()
+        try:
+            assert maxThreads >= max(1, self.minThreads)
+            self.maxThreads = maxThreads
+            while (self.nLive - self.nBusy < self.nPending and
+                   self.nLive < self.maxThreads):
+                self._startThread()
+        finally:
+            self.lock.release()
+
+    def shutdown(self, flush=1, wait=0):
+        """Tell all of this pool's threads to exit once they're done with
+           their current jobs.  If 'flush' is true, cancel all jobs that
+           haven't started yet; otherwise, run them first.  If 'wait' is
+           true, block until the threads have exited."""
+        LOG.info("Telling %s to shut down.", self.name)
+        self.lock.acquire()
+        try:
+            self.isShutdown = 1
+            if flush:
+                while 1:
+                    try:
+                        job = self.queue.get(block=0)
+                    except QueueEmpty:
+                        break
+                    if job is not None:
+                        self.nPending -= 1
+                        if job[0].cancel():
+                            self.stats['cancelled'] += 1
+            for _ in xrange(self.nLive):
+                self.queue.put(None)
+            threads = self.threads[:]
+        finally:
+            self.lock.release()
+        if wait:
+            for thr in threads:
+                thr.join()
+
+    def getStats(self):
+        """Return a map of statistics about this pool: the number of jobs
+           'submitted', 'completed', 'failed' (raised an exception), and
+           'cancelled'; the number 'queued' and 'running' now; the number
+           of live 'threads'; and the total and maximum number of seconds
+           jobs have spent waiting for a thread ('waitTime',
+           'maxWaitTime') and running ('runTime')."""
+        self.lock.acquire()
+        try:
+            stats = self.stats.copy()
+            stats['queued'] = self.nPending
+            stats['running'] = self.nBusy
+            stats['threads'] = self.nLive
+        finally:
+            self.lock.release()
+        return stats
+
+    def _startThread(self):
+        """Helper: start a new worker thread.  Caller must hold self.lock."""
+        thread = threading.Thread(target=self._workerBody,
+                                  name="%s worker"%self.name)
+        thread.setDaemon(self.daemon)
+        self.nLive += 1
+        self.threads = [ t for t in self.threads if t.isAlive() ]
+        self.threads.append(thread)
+        thread.start()
+
+    def _workerBody(self):
+        """Helper: main body of each worker thread."""
+        try:
+            while 1:
+                try:
+                    job = self.queue.get(timeout=self.maxIdle)
+                except QueueEmpty:
+                    # Don't exit if we'd leave too few threads, or if a
+                    # job arrived after our get() timed out: submit() saw
+                    # us as idle, and won't have started anybody else.
+                    self.lock.acquire()
+                    try:
+                        if (self.nLive > self.minThreads and
+                            self.nPending <= self.nLive-1-self.nBusy):
+                            LOG.debug("%s worker exiting: idle for %s seconds",
+                                      self.name, self.maxIdle)
+                            self.nLive -= 1
+                            return
+                    finally:
+                        self.lock.release()
+                    continue
+                if job is None:
+                    self.lock.acquire()
+                    self.nLive -= 1
+                    self.lock.release()
+                    return
+                future, fn, args, kwargs, submitted = job
+                started = time.time()
+                self.lock.acquire()
+                self.nPending -= 1
+                self.nBusy += 1
+                self.lock.release()
+
+                ok = future._run(fn, args, kwargs, self.name)
+
+                finished = time.time()
+                self.lock.acquire()
+                try:
+                    self.nBusy -= 1
+                    stats = self.stats
+                    if future.cancelled():
+                        stats['cancelled'] += 1
+                        continue
+                    if ok:
+                        stats['completed'] += 1
+                    else:
+                        stats['failed'] += 1
+                    wait = started - submitted
+                    stats['waitTime'] += wait
+                    stats['maxWaitTime'] = max(stats['maxWaitTime'], wait)
+                    stats['runTime'] += finished - started
+                finally:
+                    self.lock.release()
+        except:
+            self.lock.acquire()
+            self.nLive -= 1
+            self.lock.release()
+            LOG.error_exc(sys.exc_info(), "Exception in %s worker; exiting.",
+                          self.name)
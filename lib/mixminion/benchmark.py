@@ -147,6 +147,24 @@ def cryptoTiming():
     print "aes (32K,pre-key,unoptimized)", timeit(
         (lambda key=key: _ml.strxor(prng(key,32768),s32K)), 100)
 
+    # Compare our own counter mode with OpenSSL's EVP one, if we have it.
+    backend = _ml.aes_ctr_backend()
+    lkey = Keyset("keymaterial foo bar baz").getLionessKeys("T")
+    for b in "builtin", "evp":
+        try:
+            _ml.aes_ctr_backend(b)
+        except CryptoError:
+            print "aes (%s): not available" % b
+            continue
+        for name, s in ("1K", s1K), ("28K", s28K), ("32K", s32K):
+            print "aes (%s,pre-key,%s)"%(name,b), \
+                  timeit((lambda key=key,s=s: ctr_crypt(s,key)), 1000)
+        print "prng (28K,%s)"%b, \
+              timeit((lambda key=key: prng(key,28678)), 1000)
+        print "lioness E (28K,%s)"%b, timeit((
+            lambda lkey=lkey: lioness_encrypt(s28K, lkey)), 1000)
+    _ml.aes_ctr_backend(backend)
+
     print "prng (short)", timeit((lambda key=key: prng(key,8)), 100000)
     print "prng (128b)", timeit((
         lambda key=key: prng(key,18)), 10000)
@@ -412,6 +430,58 @@ IP: 1.1.1.1
     print "Unpickle text-pickled descriptor (%s/%s)"%(len(dtxt),len(desc)), \
           timeit(lambda dtxt=dtxt: cPickle.loads(dtxt), 400)
 
+def consensusTiming():
+    print "#================= CONSENSUS DIRECTORIES ================="
+    import mixminion.directory.DirFormats as DF
+    from mixminion.Common import previousMidnight, readFile
+    from mixminion.server.ServerKeys import generateServerDescriptorAndKeys
+    from mixminion.test import EX_SERVER_CONF_TEMPLATE, getRSAKey, \
+         overrideDNS
+    from mixminion.testSupport import undoReplacedAttributes
+
+    # Make a set of synthetic servers, each with its own identity.
+    nServers = 40
+    now = time()
+    va = previousMidnight(now)
+    keydir = mix_mktemp()
+    descs = []
+    for i in xrange(nServers):
+        nickname = "Server%d"%i
+        lifetime = "10 days"
+        ip = "10.0.%d.%d" % (i/250, i%250+1)
+        homedir = mix_mktemp()
+        conf = ServerConfig(string=EX_SERVER_CONF_TEMPLATE % locals())
+        try:
+            overrideDNS({nickname: ip})
+            generateServerDescriptorAndKeys(
+                config=conf, identityKey=getRSAKey(100+i,2048),
+                keyname="k%d"%i, keydir=keydir, hashdir=keydir,
+                validAt=va, now=now)
+        finally:
+            undoReplacedAttributes()
+        descs.append(readFile(os.path.join(keydir,"key_k%d"%i,"ServerDesc")))
+
+    # Each voter lists a random 90% of the servers.
+    prng = getCommonPRNG()
+    for nVoters in 3, 5, 9:
+        keys = [ getRSAKey(200+j,2048) for j in xrange(nVoters) ]
+        voters = [ (pk_fingerprint(k), "http://dir%d/"%j)
+                   for j, k in zip(range(nVoters), keys) ]
+        voters.sort()
+        for n in 10, nServers:
+            votes = []
+            for k in keys:
+                servers = prng.shuffle(descs[:n], (n*9)/10)
+                names = [ ServerInfo(string=s,assumeValid=1).getNickname()
+                          for s in servers ]
+                votes.append(("voter", DF.generateVoteDirectory(
+                    k, servers, names, voters, va, ["0.0.8"], ["0.0.8"])))
+            t = timeit_(lambda keys=keys,voters=voters,va=va,votes=votes:
+                        DF.generateConsensusDirectory(keys[0], voters, va,
+                                                      votes), 3)
+            print "Consensus (%d voters, %d servers)"%(nVoters, n), \
+                  timestr(t), "(%s per listing)"%timestr(t/(nVoters*n))
+
 #----------------------------------------------------------------------
 
 def buildMessageTiming():
@@ -539,6 +609,37 @@ def serverQueueTiming():
             os.unlink(os.path.join(d1,p))
 
 
+def _unlinkAll(fnames):
+    for fn in fnames:
+        os.unlink(fn)
+
+def mixPoolTiming():
+    print "#================= MIX POOLS ====================="
+    ServerQueue = mixminion.server.ServerQueue
+    for size in 1000, 10000, 50000:
+        d = mix_mktemp()
+        pool = ServerQueue.CottrellMixPool(d, 600, 6, sendRate=.01)
+        t = time()
+        for i in xrange(size):
+            pool.queueObject(i)
+        print "Pool of %s: queue each message: %s" %(
+            size, timestr((time()-t)/size))
+        t = time()
+        pool = ServerQueue.CottrellMixPool(d, 600, 6, sendRate=.01)
+        print "Pool of %s: open: %s" %(size, timestr(time()-t))
+        bpool = ServerQueue.BinomialCottrellMixPool(d, 600, 6, sendRate=.01)
+        n = pool._getBatchSize()
+        print "Pool of %s: listdir and shuffle %s (old):"%(size,n), timeit(
+            lambda pool=pool,n=n: getCommonPRNG().shuffle(
+                pool.getAllMessages(), n), 10)
+        print "Pool of %s: Cottrell batch of %s:"%(size,n), timeit(
+            pool.getBatch, 100)
+        print "Pool of %s: binomial batch of ~%s:"%(size,n), timeit(
+            bpool.getBatch, 100)
+        print "Pool of %s: remove one message:"%size, timeit(
+            lambda pool=pool: pool.removeMessage(pool.pickRandom(1)[0]), 100)
+        pool.removeAll(_unlinkAll)
+
 #----------------------------------------------------------------------
 class DummyLog:
     def seenHash(self,h): return 0
@@ -1017,9 +1118,11 @@ def timeAll(name, args):
     rsaTiming()
     buildMessageTiming()
     directoryTiming()
+    consensusTiming()
     fileOpsTiming()
     encodingTiming()
     serverQueueTiming()
+    mixPoolTiming()
     serverProcessTiming()
     hashlogTiming()
     timeEfficiency()
@@ -2,18 +2,23 @@
 
 """mixminion.directory.DirCGI
 
-   Backend for directory-publish CGI.
+   Backend for directory-publish CGI, and for the CGI that serves
+   published directories.
    """
 
 __all__ = [ ]
 
 # Edit this to the configured value "Homedir" in .mixminion_dir.cf
 DIRECTORY_BASE = "/home/nickm/src/MixminionDirectory"
+# Edit this to the configured value "ArtifactDir" in .mixminion_dir.cf,
+# if you set one.
+ARTIFACT_DIR = DIRECTORY_BASE + "/published"
 
 import cgi
 import os
 import sys
 from mixminion.directory.Directory import Directory
+from mixminion.directory.DirCache import DirectoryArtifactCache
 from mixminion.directory.ServerInbox import ServerQueuedException
 from mixminion.Common import UIError
 
@@ -54,3 +59,17 @@ def run():
         print "Status: 0\nMessage: %s"%e
     except ServerQueuedException, e:
         print "Status: 1\nMessage: %s"%e
+
+def runFetch():
+    """Serve the current directory (or a published artifact, by digest)
+       named by PATH_INFO, honoring If-None-Match."""
+    path = os.environ.get("PATH_INFO") or "Directory.gz"
+    cache = DirectoryArtifactCache(ARTIFACT_DIR)
+    status, headers, body = cache.respond(
+        path.split("/")[-1], os.environ.get("HTTP_IF_NONE_MATCH"))
+    sys.stdout.write("Status: %s\r\n"%status)
+    for h, v in headers:
+        sys.stdout.write("%s: %s\r\n"%(h,v))
+    sys.stdout.write("\r\n")
+    if os.environ.get("REQUEST_METHOD") != "HEAD":
+        sys.stdout.write(body)
@@ -0,0 +1,243 @@
+# Copyright 2003-2011 Nick Mathewson.  See LICENSE for licensing information.
+
+"""mixminion.directory.DirCache
+
+   Content-addressed store of published directories.
+
+   Every directory we publish is written exactly once, both raw and
+   gzipped, under the hex SHA1 digest of its raw contents.  A small
+   pointer file names the current one.  Because published files never
+   change, a server can answer any request -- including "send me the
+   directory only if it isn't the one with digest X" -- by looking at
+   the pointer file, without reading, compressing, or hashing anything.
+
+   Layout:
+       ARTIFACTDIR/<digest>      [A published directory]
+       ARTIFACTDIR/<digest>.gz   [The same directory, gzipped]
+       ARTIFACTDIR/current       [The digest of the current directory]
+   """
+
+__all__ = [ 'DirectoryArtifactCache', 'publishDirectory', 'serveDirectory' ]
+
+import BaseHTTPServer
+import binascii
+import cStringIO
+import gzip
+import os
+import re
+import stat
+
+import mixminion.Crypto
+from mixminion.Common import LOG, MixError, readFile, tryUnlink, writeFile
+
+# Name of the pointer file within an artifact directory.
+POINTER_FNAME = "current"
+# How many old directories do we keep around, so that clients who just
+# saw the pointer can still fetch the artifact it named?
+KEEP_ARTIFACTS = 4
+# How long may a cache hold an immutable artifact?  (One year.)
+IMMUTABLE_MAX_AGE = 365*24*60*60
+
+# Regex to match the name of a published artifact.
+_ARTIFACT_RE = re.compile(r'^([0-9a-f]{40})(\.gz)?$')
+
+def getDirectoryDigest(contents):
+    """Return the name under which we publish the directory 'contents':
+       the hex-encoded SHA1 digest of its raw bytes."""
+    return binascii.b2a_hex(mixminion.Crypto.sha1(contents))
+
+def _gzipString(s):
+    """Helper: return the gzipped form of the string 's'."""
+    out = cStringIO.StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(s)
+    f.close()
+    return out.getvalue()
+
+def publishDirectory(contents, artifactDir, keep=KEEP_ARTIFACTS):
+    """Publish the raw directory 'contents' into 'artifactDir': write its
+       raw and gzipped artifacts if they don't already exist, point the
+       pointer file at them, and remove all but the 'keep' most recently
+       published directories.  Returns the new directory's digest."""
+    if not os.path.exists(artifactDir):
+        os.makedirs(artifactDir, 0755)
+    digest = getDirectoryDigest(contents)
+    fname = os.path.join(artifactDir, digest)
+    # Since artifacts are named by their contents, an existing one is
+    # already correct; we never rewrite it.
+    if not os.path.exists(fname):
+        writeFile(fname, contents, mode=0644, binary=1)
+    if not os.path.exists(fname+".gz"):
+        writeFile(fname+".gz", _gzipString(contents), mode=0644, binary=1)
+    os.utime(fname, None)
+    writeFile(os.path.join(artifactDir, POINTER_FNAME), digest+"\n",
+              mode=0644)
+
+    # Remove the old artifacts, oldest first.
+    published = []
+    for fn in os.listdir(artifactDir):
+        m = _ARTIFACT_RE.match(fn)
+        if m and not m.group(2) and fn != digest:
+            mtime = os.stat(os.path.join(artifactDir, fn))[stat.ST_MTIME]
+            published.append((mtime, fn))
+    published.sort()
+    published.reverse()
+    for _, fn in published[max(keep-1,0):]:
+        LOG.debug("Removing old published directory %s", fn)
+        tryUnlink(os.path.join(artifactDir, fn))
+        tryUnlink(os.path.join(artifactDir, fn+".gz"))
+
+    return digest
+
+class DirectoryArtifactCache:
+    """Answers requests for the directories published in an artifact
+       directory, keeping the current directory's artifacts in memory.
+
+       A request names either an artifact ('<digest>' or '<digest>.gz'),
+       which never changes, or any other file ('Directory',
+       'Directory.gz'), which means 'the current directory', gzipped iff
+       the name ends with '.gz'.  Either way, the entity tag is the
+       directory's digest, so a client that sends back the last tag it
+       saw gets '304 Not Modified' until a new directory is published.
+    """
+    ## Fields:
+    # artifactDir: the directory we serve from.
+    # pointerFname: the name of the pointer file.
+    # _pointerStat: (mtime, size, inode) of the pointer file when we last
+    #    read it, or None.
+    # _current: the digest of the current directory, or None.
+    # _bodies: map from artifact filename to contents, for the current
+    #    directory only.
+    def __init__(self, artifactDir):
+        """Create a new cache serving the directories in 'artifactDir'."""
+        self.artifactDir = artifactDir
+        self.pointerFname = os.path.join(artifactDir, POINTER_FNAME)
+        self._pointerStat = None
+        self._current = None
+        self._bodies = {}
+
+    def getCurrentDigest(self):
+        """Return the digest of the current directory, or None if nothing
+           has been published.  Re-reads the pointer file only when it has
+           been replaced."""
+        try:
+            st = os.stat(self.pointerFname)
+        except OSError:
+            self._pointerStat = self._current = None
+            self._bodies = {}
+            return None
+        key = (st[stat.ST_MTIME], st[stat.ST_SIZE], st[stat.ST_INO])
+        if key != self._pointerStat:
+            digest = readFile(self.pointerFname).strip()
+            if not _ARTIFACT_RE.match(digest) or digest.endswith(".gz"):
+                raise MixError("Corrupt pointer file %s"%self.pointerFname)
+            if digest != self._current:
+                self._bodies = {}
+            self._current = digest
+            self._pointerStat = key
+        return self._current
+
+    def getArtifact(self, name):
+        """Return the contents of the published artifact 'name', or None if
+           there is no such artifact."""
+        m = _ARTIFACT_RE.match(name)
+        if not m:
+            return None
+        if m.group(1) == self._current and self._bodies.has_key(name):
+            return self._bodies[name]
+        try:
+            body = readFile(os.path.join(self.artifactDir, name), 1)
+        except (IOError, OSError):
+            return None
+        if m.group(1) == self._current:
+            self._bodies[name] = body
+        return body
+
+    def respond(self, name, ifNoneMatch=None):
+        """Answer a request for the file 'name'.  'ifNoneMatch' is the
+           value of the request's If-None-Match header, if any.  Returns
+           a 3-tuple of (HTTP status code, list of (header, value),
+           body)."""
+        m = _ARTIFACT_RE.match(name)
+        if m:
+            digest, gzipped = m.group(1), m.group(2)
+            cacheControl = "public, max-age=%d" % IMMUTABLE_MAX_AGE
+        else:
+            digest = self.getCurrentDigest()
+            gzipped = name.endswith(".gz")
+            # Caches may keep the current directory, but must check with
+            # us before each use.
+            cacheControl = "no-cache"
+            if digest is None:
+                return 404, [("Content-Type", "text/plain")], \
+                       "No directory has been published.\n"
+        etag = '"%s"' % digest
+        if gzipped:
+            artifact = digest+".gz"
+            ctype = "application/x-gzip"
+        else:
+            artifact = digest
+            ctype = "text/plain"
+        headers = [ ("ETag", etag), ("Cache-Control", cacheControl) ]
+
+        if ifNoneMatch and _etagMatches(etag, ifNoneMatch):
+            return 304, headers, ""
+        body = self.getArtifact(artifact)
+        if body is None:
+            return 404, [("Content-Type", "text/plain")], \
+                   "No such directory.\n"
+        headers.extend([("Content-Type", ctype),
+                        ("Content-Length", str(len(body)))])
+        return 200, headers, body
+
+def _etagMatches(etag, ifNoneMatch):
+    """Helper: return true iff the If-None-Match header value 'ifNoneMatch'
+       matches the entity tag 'etag'."""
+    for tag in ifNoneMatch.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag or tag == "*":
+            return 1
+    return 0
+
+class DirectoryRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Minimal HTTP front-end for a DirectoryArtifactCache: suitable for
+       testing, or for a small directory server without a real web
+       server.  The server must have a 'dirCache' attribute."""
+    def do_GET(self):
+        self._respond(sendBody=1)
+
+    def do_HEAD(self):
+        self._respond(sendBody=0)
+
+    def _respond(self, sendBody):
+        """Helper: answer a GET or HEAD request."""
+        name = self.path.split("?")[0].split("/")[-1]
+        try:
+            status, headers, body = self.server.dirCache.respond(
+                name, self.headers.get("If-None-Match"))
+        except MixError, e:
+            LOG.error("Error serving directory: %s", e)
+            status, headers, body = 500, [], ""
+        self.send_response(status)
+        for h, v in headers:
+            self.send_header(h, v)
+        self.end_headers()
+        if sendBody:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug("%s: %s", self.address_string(), format%args)
+
+def serveDirectory(artifactDir, address=("127.0.0.1", 8080), serve=1):
+    """Serve the directories published in 'artifactDir' over HTTP on
+       'address'.  If 'serve' is true, loop forever; otherwise, return the
+       server object without handling any requests."""
+    server = BaseHTTPServer.HTTPServer(address, DirectoryRequestHandler)
+    server.dirCache = DirectoryArtifactCache(artifactDir)
+    if not serve:
+        return server
+    LOG.info("Serving directory from %s on %s:%s", artifactDir,
+             address[0], address[1])
+    server.serve_forever()
@@ -91,69 +91,67 @@ def generateConsensusDirectory(identity, voters, validAfter, directories,
                                validatedDigests=None):
     # directories is (source, stringable) list
 
-    # First -- whom shall we vote with?
-    goodDirectories = {} # {fingerprint: (src,SignedDirectory)}
+    # We handle the votes one at a time, and keep only what we need from
+    # each: every descriptor once, indexed by digest, and a running count
+    # of how many voters listed each version, recommended server, and
+    # identity.  A descriptor that appears in one accepted vote is valid,
+    # so we don't check its signature again when it appears in another.
+    if validatedDigests is None:
+        knownDigests = {}
+    else:
+        knownDigests = validatedDigests.copy()
+    voterSources = {} # fingerprint->src for each accepted vote
     serverMap = {} # digest->server info
-    serversByDir = {} # keyid->list of digest
+    digestsByIdent = {} # identity digest->{server digest: 1}
+    identNickname = {} # identity digest->first nickname we saw
+    badIdents = {} # identity digests with more than one nickname
+    clientVersionCounts = {}
+    serverVersionCounts = {}
+    recommendedCounts = {}
+    identCounts = {}
     for src, val in directories:
         LOG.debug("Checking vote directory from %s",src)
         val = str(val)
         try:
             directory = mixminion.ServerInfo.SignedDirectory(string=val,
-                                  validatedDigests=validatedDigests,
+                                  validatedDigests=knownDigests,
                                   _keepServerContents=1)
         except ConfigError,e:
             LOG.warn("Rejecting malformed vote directory from %s: %s",src,e)
             continue
+        del val
         try:
             checkVoteDirectory(voters, validAfter, directory)
         except BadVote, e:
             LOG.warn("Rejecting vote directory from %s: %s", src, e)
             continue
-        LOG.info("Accepting vote directory from %s",src)
 
-        # Remember server descs minimally to save room.
         sig = directory.getSignatures()[0]
         fp = pk_fingerprint(sig['Signed-Directory']['Directory-Identity'])
-        serversByDir[fp] = []
-        for s in directory.getAllServers():
-            d = s.getDigest()
-            serversByDir[fp].append(d)
-            if not serverMap.has_key(d):
-                serverMap[d] = s
-
-        del directory.servers[:] # Save RAM
-        if goodDirectories.has_key(fp):
+        if voterSources.has_key(fp):
             LOG.warn("Multiple directories with fingerprint %s; ignoring one from %s",
-                     fp, goodDirectories[fp][0])
-        goodDirectories[fp] = (src, directory)
+                     fp, src)
+            continue
+        LOG.info("Accepting vote directory from %s",src)
+        voterSources[fp] = src
 
-    goodVotes = [ v for _,v in goodDirectories.values() ]
+        _countDistinct(clientVersionCounts,
+                       directory['Recommended-Software']['MixminionClient'])
+        _countDistinct(serverVersionCounts,
+                       directory['Recommended-Software']['MixminionServer'])
+        _countDistinct(recommendedCounts,
+                       directory['Directory-Info']['Recommended-Servers'])
 
-    # Next -- what is the result of the vote? (easy cases)
-    threshold = floorDiv(len(voters)+1, 2)
-    includedClientVersions = commonElements(
-        [ d['Recommended-Software']['MixminionClient'] for d in goodVotes ],
-        threshold)
-    includedServerVersions = commonElements(
-        [ d['Recommended-Software']['MixminionServer'] for d in goodVotes ],
-        threshold)
-    includedRecommended = commonElements(
-        [ d['Directory-Info']['Recommended-Servers'] for d in goodVotes ],
-        threshold)
-
-    # Hard part -- what servers go in?
-
-    # Identities go in if they have a consistant nickname, and most voters
-    # include them.
-    identNickname = {}
-    badIdents = {}
-    identsByVoter = []
-    digestsByIdent = {}
-    for digestList in serversByDir.values():
+        # Identities go in if they have a consistant nickname, and most
+        # voters include them.
         idents = {}
-        for digest in digestList:
-            s = serverMap[digest]
+        for s in directory.getAllServers():
+            d = s.getDigest()
+            if serverMap.has_key(d):
+                s = serverMap[d]
+            else:
+                serverMap[d] = s
+                knownDigests[d] = 1
             n = s.getNickname()
             ident = s.getIdentityDigest()
             try:
@@ -164,10 +162,17 @@ def generateConsensusDirectory(identity, voters, validAfter, directories,
                 identNickname[ident]=n
 
             idents[ident] = 1
-            digestsByIdent.setdefault(ident,{})[digest]=1
-        identsByVoter.append(idents.keys())
+            digestsByIdent.setdefault(ident,{})[d]=1
+        _countDistinct(identCounts, idents.keys())
+
+        del directory # Save RAM
 
-    includedIdentities = [ i for i in commonElements(identsByVoter, threshold)
+    # Next -- what is the result of the vote?
+    threshold = floorDiv(len(voters)+1, 2)
+    includedClientVersions = _atThreshold(clientVersionCounts, threshold)
+    includedServerVersions = _atThreshold(serverVersionCounts, threshold)
+    includedRecommended = _atThreshold(recommendedCounts, threshold)
+    includedIdentities = [ i for i in _atThreshold(identCounts, threshold)
                            if not badIdents.has_key(i) ]
 
     # okay -- for each identity, what servers do we include?
@@ -190,7 +195,7 @@ def generateConsensusDirectory(identity, voters, validAfter, directories,
                              includedClientVersions, includedServerVersions)
     try:
         directory = mixminion.ServerInfo.SignedDirectory(
-            string=val, validatedDigests=validatedDigests)
+            string=val, validatedDigests=knownDigests)
     except ConfigError,e:
         raise MixError("Generated a consensus directory we cannot parse: %s"%e)
 
@@ -216,11 +221,11 @@ def checkVoteDirectory(voters, validAfter, directory):
     ident = sig['Signed-Directory']['Directory-Identity']
     keyid = mixminion.Crypto.pk_fingerprint(ident)
 
+    mykeys = {}
+    for k,u in voters: mykeys[k]=u
+
     # Do we recognize the signing key?
-    for k,_ in voters:
-        if k == keyid:
-            break
-    else:
+    if not mykeys.has_key(keyid):
         raise BadVote("Unknown identity key (%s)"%keyid)
 
     # Is the signature valid?
@@ -243,8 +248,6 @@ def checkVoteDirectory(voters, validAfter, directory):
     vkeys = {}
     for k,u in directory.dirInfo.voters:
         vkeys[k]=u
-    mykeys = {}
-    for k,u in voters: mykeys[k]=u
 
     for k,u in directory.dirInfo.voters:
         try:
@@ -293,8 +296,9 @@ def _versionOrdering(v):
         return (sys.maxint, sys.maxint)
 
 def _serverOrdering(s):
-    return ( s.getNickname().lower(), s['Server']['Valid-After'],
-             s.getDigest() )
+    server = s['Server']
+    return ( server['Nickname'].lower(), server['Valid-After'],
+             server['Digest'] )
 
 def sortServerList(servers):
     return _sortedBy(servers, _serverOrdering)
@@ -312,31 +316,42 @@ def versionListIsSorted(versions):
     return _listIsSorted(versions, _versionOrdering)
 
 def _sortedBy(lst, keyFn):
-    lst2 = [ (keyFn(item), item) for item in lst ]
+    # We compute each key once, and break ties by position so that we never
+    # fall back to comparing the items themselves.
+    lst2 = map(None, map(keyFn, lst), range(len(lst)), lst)
     lst2.sort()
-    return [ item for _, item in lst2 ]
+    return [ item for _, _, item in lst2 ]
 
 def _listIsSorted(lst, keyFn=None):
+    # A list is sorted iff no adjacent pair is out of order; we don't need
+    # to sort a copy to find out.
     if keyFn is None:
-        lst2 = lst[:]
-        lst2.sort()
+        keys = lst
     else:
-        lst2 = _sortedBy(lst, keyFn)
-    for a,b in zip(lst,lst2):
-        if a is not b:
+        keys = map(keyFn, lst)
+    for i in xrange(len(keys)-1):
+        if keys[i] > keys[i+1]:
             return 0
     return 1
 
+def _countDistinct(counts, lst):
+    """Helper: increment counts[item] once for every distinct item in lst."""
+    m = {}
+    for item in lst:
+        m[item]=1
+    for item in m.keys():
+        try:
+            counts[item] += 1
+        except KeyError:
+            counts[item] = 1
+
+def _atThreshold(counts, threshold):
+    """Helper: return every key in 'counts' whose count is at least
+       'threshold'."""
+    return [ k for k,c in counts.items() if c >= threshold ]
+
 def commonElements(lists, threshold):
     counts = {}
     for lst in lists:
-        m = {}
-        for item in lst:
-            m[item]=1
-        for item in m.keys():
-            try:
-                counts[item] += 1
-            except KeyError:
-                counts[item] = 1
-
-    return [ k for k,c in counts.items() if c >= threshold ]
+        _countDistinct(counts, lst)
+    return _atThreshold(counts, threshold)
@@ -13,11 +13,12 @@ import shutil
 import sys
 import time
 from mixminion.Common import createPrivateDir, formatTime, iterFileLines, LOG, \
-     UIError
+     readFile, UIError
 from mixminion.Config import ConfigError
 from mixminion.Crypto import init_crypto, pk_fingerprint, pk_generate, \
      pk_PEM_load, pk_PEM_save
 from mixminion.directory.Directory import Directory, DirectoryConfig
+from mixminion.directory.DirCache import publishDirectory, serveDirectory
 
 USAGE = """\
 Usage: mixminion dir <command>
@@ -29,6 +30,7 @@ Usage: mixminion dir <command>
       generate                 [Generate and sign a new directory]
       fingerprint              [Return the fingerprint of this directory's pk]
       rebuildcache             [Rebuild a corrupted or removed identity cache]
+      serve [host:]port        [Serve published directories over HTTP]
 """.strip()
 
 def getDirectory():
@@ -178,7 +180,27 @@ def cmd_generate(args):
     else:
         shutil.copy(fname, location)
 
-    print "Published."
+    digest = publishDirectory(readFile(fname, 1), d.getArtifactDir())
+
+    print "Published (digest %s)."%digest
+
+def cmd_serve(args):
+    """[Entry point] Serve the published directories over HTTP, answering
+       conditional requests from the published artifacts.  Meant for
+       testing, or for sites without a real web server."""
+    if len(args) != 1:
+        raise UIError("mixminion dir serve takes one argument")
+    if ':' in args[0]:
+        host, port = args[0].split(":",1)
+    else:
+        host, port = "127.0.0.1", args[0]
+    try:
+        port = int(port)
+    except ValueError:
+        raise UIError("Invalid port %r"%port)
+
+    d = getDirectory()
+    serveDirectory(d.getArtifactDir(), (host, port))
 
 def cmd_fingerprint(args):
     """[Entry point] Print the fingerprint for this directory's key."""
@@ -195,7 +217,8 @@ SUBCOMMANDS = { 'initialize' : cmd_init,
                 'import-new' : cmd_import,
                 'generate' : cmd_generate,
                 'fingerprint' : cmd_fingerprint,
-                'rebuildcache' : cmd_rebuildcache
+                'rebuildcache' : cmd_rebuildcache,
+                'serve' : cmd_serve,
                 }
 
 def main(cmd, args):
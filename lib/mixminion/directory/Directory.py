@@ -38,6 +38,8 @@ class Directory:
        Layout:
           BASEDIR/dir            [Base for ServerList.]
           BASEDIR/inbox          [Base for ServerInbox.]
+          BASEDIR/published      [Default location for published
+                                  directories; see DirCache.]
 
        DOCDOC
     """
@@ -139,6 +141,14 @@ class Directory:
             self.inbox = ServerInbox(self.inboxBase, self.getIDCache())
         return self.inbox
 
+    def getArtifactDir(self):
+        """Return the directory where we publish content-addressed copies
+           of each directory we generate."""
+        d = None
+        if self.config:
+            d = self.config['Publishing'].get('ArtifactDir')
+        return d or os.path.join(self.location, "published")
+
     def getIdentity(self):
         """Return the identity key for this directory."""
         _ = self.getServerList()
@@ -170,7 +180,8 @@ class DirectoryConfig(mixminion.Config._ConfigFile):
         },
         'Publishing' : {
            "__SECTION__": ('REQUIRE', None, None),
-           "Location" : ('REQUIRE', "filename", None)
+           "Location" : ('REQUIRE', "filename", None),
+           "ArtifactDir" : ('ALLOW', "filename", None),
         } }
     def __init__(self, filename=None, string=None):
         mixminion.Config._ConfigFile.__init__(self, filename, string)
@@ -33,7 +33,7 @@ from mixminion.Common import IntervalSet, LOG, MixError, MixFatalError, \
      writePickled
 from mixminion.Config import ConfigError
 from mixminion.ServerInfo import ServerDirectory, ServerInfo, \
-     _getDirectoryDigestImpl
+     checkServerInfoSignatures, _getDirectoryDigestImpl
 
 """
 Redesign notes:
@@ -298,19 +298,33 @@ class LiveServerList:
     def addServersFromInbox(self, inbox):
         self.inbox.moveEntriesToStore(self)
 
-    def _addOneFromRawDirLines(self, lines):
-        s = "".join(lines)
-        #XXXX digest-cache
-        si = ServerInfo(s,assumeValid=0,keepContents=1)
-        if not self.store.hasServer(si):
-            self.store.addServer(si)
-
     def addServersFromRawDirectoryFile(self, file):
+        """Add every valid server descriptor in a raw directory file to the
+           store.  Signatures are checked as a single batch, so that they
+           can be spread across processors."""
+        descriptors = []
         curLines = []
         for line in iterFileLines(file):
             if line == '[Server]\n' and curLines:
-                self._addOneFromRawLines(curLines)
+                descriptors.append("".join(curLines))
                 del curLines[:]
+            curLines.append(line)
         if curLines:
-            self._addOneFromRawLines(curLines)
+            descriptors.append("".join(curLines))
 
+        checks = []
+        servers = []
+        for s in descriptors:
+            #XXXX digest-cache
+            try:
+                servers.append(ServerInfo(string=s, _keepContents=1,
+                                          _signatureChecks=checks))
+            except ConfigError, e:
+                LOG.warn("Skipping invalid server descriptor: %s", e)
+        for si, msg in checkServerInfoSignatures(checks):
+            LOG.warn("Skipping server descriptor for %s: %s",
+                     si.getNickname(), msg)
+
+        for si in servers:
+            if si.isValidated() and not self.store.hasServer(si):
+                self.store.addServer(si)
@@ -0,0 +1,558 @@
+# Copyright 2002-2011 Nick Mathewson.  See LICENSE for licensing information.
+
+"""mixminion.loadtest
+
+   End-to-end throughput test for a small mixnet running on localhost.
+
+   We generate keys and a directory for N servers, start each one as a
+   separate 'mixminiond start' process, and push packets through all of
+   them at a fixed rate.  The last hop of every path is a sink inside this
+   process, which records when each packet arrives.  When the run is done,
+   we report throughput, latency percentiles, and the CPU time and disk
+   I/O that the servers spent per packet, as 'Key: value' lines.
+
+   Usage:
+      mixminion loadtest [-n servers] [-r rate] [-d duration] [-o file]
+   """
+
+__all__ = [ 'LocalMixnet', 'runLoadTest' ]
+
+import getopt
+import os
+import shutil
+import signal
+import socket
+import sys
+import threading
+import time
+
+import mixminion
+import mixminion.BuildMessage
+import mixminion.Crypto
+import mixminion.MMTPClient
+import mixminion.directory.DirCache
+import mixminion.directory.DirFormats
+import mixminion.server.MMTPServer
+import mixminion.server.PacketHandler
+from mixminion.Common import LOG, MixError, UIError, createPrivateDir, \
+     floorDiv, previousMidnight, readFile, writeFile
+from mixminion.Crypto import CryptoError, pk_fingerprint, pk_generate
+from mixminion.ServerInfo import ServerInfo
+from mixminion.server.ServerConfig import ServerConfig
+from mixminion.server.ServerKeys import ServerKeyring
+from mixminion.server.ServerMain import SERVER_HOMEDIR_VERSION
+
+# Exit type for the packets we send.  It's in the exit range, so the last
+# hop hands it to us whole, but no real server would ever deliver it.
+LOADTEST_EXIT_TYPE = 0xFFF0
+
+# How long do we wait for a server to start listening?
+STARTUP_TIMEOUT = 120
+# By default, what percentage of packets may we lose before the test fails?
+DEFAULT_MAX_LOSS = 5.0
+
+_SERVER_CONF_TEMPLATE = """\
+[Host]
+[Server]
+Homedir: %(homedir)s
+Nickname: %(nickname)s
+Contact-Email: loadtest@localhost
+Mode: relay
+EncryptIdentityKey: no
+EncryptPrivateKey: no
+IdentityKeyBits: 2048
+MixAlgorithm: Timed
+MixInterval: %(mixInterval)s sec
+LogLevel: WARN
+LogStats: no
+Daemon: no
+[Pinging]
+Enabled: no
+[DirectoryServers]
+ServerURL: %(dirURL)s
+[Incoming/MMTP]
+Enabled: yes
+Hostname: localhost
+IP: 127.0.0.1
+ListenIP: 127.0.0.1
+Port: %(port)s
+[Outgoing/MMTP]
+Enabled: yes
+"""
+
+class LocalMixnet:
+    """A set of mixminion servers on localhost, a directory listing them,
+       and a sink that receives the packets they deliver.
+
+       Call setUp to generate keys and start everything, run to send
+       packets through the network, and tearDown to stop the servers.
+    """
+    ## Fields:
+    # workdir: directory holding one home directory per server.
+    # nServers: number of servers to run, not counting the sink.
+    # basePort: the first server listens on basePort, the next on
+    #    basePort+1, and so on.  The sink listens on basePort+nServers, and
+    #    the directory on basePort+nServers+1.
+    # mixInterval: how often, in seconds, each server flushes its pool.
+    # configFiles: list of configuration filenames, one per server.
+    # descriptors: list of ServerInfo, one per server, then one for the sink.
+    # pids: list of process IDs for the running servers.
+    # asyncServer: an AsyncServer for the sink and the client connection.
+    # packetHandler: PacketHandler that decrypts packets for the sink.
+    # sinkListener: ListenConnection for the sink.
+    # dirServer: HTTPServer serving the directory.
+    # arrivals: map from packet sequence number to arrival time.
+    # sent: map from packet sequence number to the time we queued it.
+    # nAcked: number of packets the first server has acknowledged.
+    # nBad: number of packets the sink couldn't process.
+    def __init__(self, workdir, nServers=3, basePort=48300, mixInterval=2):
+        """Create a new LocalMixnet in 'workdir'."""
+        if nServers < 2:
+            raise UIError("Need at least 2 servers for a load test.")
+        self.workdir = workdir
+        self.nServers = nServers
+        self.basePort = basePort
+        self.mixInterval = mixInterval
+        self.configFiles = []
+        self.descriptors = []
+        self.pids = []
+        self.asyncServer = None
+        self.packetHandler = None
+        self.sinkListener = None
+        self.dirServer = None
+        self.arrivals = {}
+        self.sent = {}
+        self.nAcked = 0
+        self.nBad = 0
+
+    def setUp(self):
+        """Generate keys, descriptors, and a directory for every server,
+           start the sink and the directory server, launch the servers,
+           and wait for them all to listen."""
+        createPrivateDir(self.workdir)
+        dirURL = "http://127.0.0.1:%s/Directory" % (
+            self.basePort+self.nServers+1)
+        keyrings = []
+        for i in xrange(self.nServers+1):
+            homedir = os.path.join(self.workdir, "server%d"%i)
+            createPrivateDir(homedir)
+            writeFile(os.path.join(homedir, "version"),
+                      SERVER_HOMEDIR_VERSION, 0644)
+            fname = os.path.join(homedir, "mixminiond.conf")
+            if i == self.nServers:
+                nickname = "LoadTestSink"
+            else:
+                nickname = "LoadTest%d"%i
+            writeFile(fname, getServerConfigString(
+                homedir, nickname, self.mixInterval, dirURL,
+                self.basePort+i))
+            LOG.info("Generating keys for %s", nickname)
+            keyring = ServerKeyring(ServerConfig(fname=fname))
+            keyring.createKeysAsNeeded()
+            keyset = keyring.getServerKeysets()[0]
+            self.descriptors.append(ServerInfo(
+                fname=keyset.getDescriptorFileName(), _keepContents=1))
+            keyrings.append(keyring)
+            if i < self.nServers:
+                self.configFiles.append(fname)
+
+        # Generating Diffie-Hellman parameters is slow; do it once, for the
+        # sink, and let every server share the result.
+        sinkKeyring = keyrings[-1]
+        dhFile = sinkKeyring._getDHFile()
+        for keyring in keyrings[:-1]:
+            createPrivateDir(os.path.split(keyring.dhFile)[0])
+            shutil.copyfile(dhFile, keyring.dhFile)
+
+        self._startSink(sinkKeyring)
+        self._startDirectory()
+        for fname in self.configFiles:
+            self.pids.append(_spawnServer(fname))
+        for i in xrange(self.nServers):
+            _waitForPort(self.basePort+i, self.pids[i])
+
+    def _startSink(self, keyring):
+        """Helper: listen for packets as the last hop of every path, and
+           note when each one arrives."""
+        keyset = keyring.getServerKeysets()[0]
+        handler = self.packetHandler = \
+                  mixminion.server.PacketHandler.PacketHandler(
+                      [keyset.getPacketKey()], [keyset.getHashLog()])
+        self.asyncServer = mixminion.server.MMTPServer.AsyncServer()
+        def onPacket(pkt, self=self, handler=handler):
+            try:
+                res = handler.processPacket(pkt)
+                seq = int(res.getAddress())
+            except (MixError, CryptoError, AttributeError, ValueError):
+                self.nBad += 1
+                return
+            if not self.arrivals.has_key(seq):
+                self.arrivals[seq] = time.time()
+        def conFactory(sock, context=keyring._getTLSContext(),
+                       onPacket=onPacket, server=self.asyncServer):
+            tls = context.sock(sock, serverMode=1)
+            sock.setblocking(0)
+            con = mixminion.server.MMTPServer.MMTPServerConnection(
+                sock, tls, onPacket)
+            con.junkCallback = lambda : None
+            server.register(con)
+        self.sinkListener = mixminion.server.MMTPServer.ListenConnection(
+            socket.AF_INET, "127.0.0.1", self.basePort+self.nServers, 16,
+            conFactory)
+        self.asyncServer.register(self.sinkListener)
+
+    def _startDirectory(self):
+        """Helper: generate a consensus directory listing all of our servers,
+           and serve it over HTTP from a background thread."""
+        DF = mixminion.directory.DirFormats
+        identity = pk_generate(2048)
+        voters = [ (pk_fingerprint(identity),
+                    "http://127.0.0.1:%s/"%(self.basePort+self.nServers+1)) ]
+        validAfter = previousMidnight(time.time())
+        descs = [ d._originalContents for d in self.descriptors ]
+        names = [ d.getNickname() for d in self.descriptors ]
+        vote = DF.generateVoteDirectory(identity, descs, names, voters,
+                                        validAfter, [mixminion.__version__],
+                                        [mixminion.__version__])
+        consensus = DF.generateConsensusDirectory(identity, voters,
+                                                  validAfter, [("me", vote)])
+        artifactDir = os.path.join(self.workdir, "published")
+        mixminion.directory.DirCache.publishDirectory(consensus, artifactDir)
+        self.dirServer = mixminion.directory.DirCache.serveDirectory(
+            artifactDir, ("127.0.0.1", self.basePort+self.nServers+1),
+            serve=0)
+        t = threading.Thread(target=self.dirServer.serve_forever)
+        t.setDaemon(1)
+        t.start()
+
+    def run(self, rate, duration, drainTimeout=None):
+        """Send packets into the network at 'rate' packets per second for
+           'duration' seconds, then wait up to 'drainTimeout' seconds for
+           the stragglers.  Returns a map of results, as described in
+           formatResults."""
+        nPackets = max(int(rate*duration), 1)
+        if drainTimeout is None:
+            drainTimeout = self.mixInterval*(self.nServers+1) + 30
+
+        # Build all the packets before we start the clock, so that the
+        # client's own cost doesn't limit the rate we can offer.
+        LOG.info("Building %s packets", nPackets)
+        payload = mixminion.BuildMessage.encodeMessage("Load test", 0)[0]
+        mid = floorDiv(self.nServers+1, 2)
+        path = self.descriptors
+        packets = []
+        for seq in xrange(nPackets):
+            packets.append(mixminion.BuildMessage.buildForwardPacket(
+                payload, LOADTEST_EXIT_TYPE, str(seq), path[:mid],
+                path[mid:], suppressTag=1))
+
+        before = [ _getProcessUsage(pid) for pid in self.pids ]
+        con = None
+        start = time.time()
+        interval = 1.0/rate
+        seq = 0
+        deadline = start + duration + drainTimeout
+        def succeeded(self=self): self.nAcked += 1
+        while time.time() < deadline and len(self.arrivals) < nPackets:
+            now = time.time()
+            while seq < nPackets and start+seq*interval <= now:
+                if con is None or not con.isActive():
+                    con = self._connect()
+                con.addPacket(mixminion.MMTPClient.DeliverableString(
+                    s=packets[seq], callback=succeeded))
+                packets[seq] = None
+                self.sent[seq] = now
+                seq += 1
+            self.asyncServer.process(0.05)
+        after = [ _getProcessUsage(pid) for pid in self.pids ]
+
+        return self._summarize(start, duration, before, after)
+
+    def _connect(self):
+        """Helper: open a new client connection to the first server."""
+        first = self.descriptors[0]
+        con = mixminion.MMTPClient.MMTPClientConnection(
+            socket.AF_INET, "127.0.0.1", self.basePort, first.getKeyDigest(),
+            serverName=first.getNickname())
+        self.asyncServer.register(con)
+        return con
+
+    def _summarize(self, start, duration, before, after):
+        """Helper: compute the results of a run."""
+        latencies = []
+        lastArrival = start
+        for seq, when in self.arrivals.items():
+            latencies.append(when - self.sent[seq])
+            lastArrival = max(lastArrival, when)
+        latencies.sort()
+        nReceived = len(latencies)
+        nHops = self.nServers+1
+        res = { 'Servers' : self.nServers,
+                'OfferedRate' : len(self.sent) / duration,
+                'Hops' : nHops,
+                'MixInterval' : self.mixInterval,
+                'PacketsSent' : len(self.sent),
+                'PacketsAcked' : self.nAcked,
+                'PacketsReceived' : nReceived,
+                'PacketsBad' : self.nBad,
+                'PacketsLost' : len(self.sent)-nReceived }
+        if nReceived and lastArrival > start:
+            res['Throughput'] = nReceived / (lastArrival-start)
+        for name, p in (("P50", .5), ("P90", .9), ("P99", .99)):
+            if latencies:
+                res['Latency'+name] = percentile(latencies, p)
+                res['HopLatency'+name] = percentile(latencies, p) / nHops
+        if latencies:
+            res['LatencyMax'] = latencies[-1]
+
+        cpu = disk = 0
+        for b, a in zip(before, after):
+            if a[0] is None or b[0] is None:
+                cpu = None
+            elif cpu is not None:
+                cpu += a[0]-b[0]
+            if a[1] is None or b[1] is None:
+                disk = None
+            elif disk is not None:
+                disk += a[1]-b[1]
+        if nReceived and cpu is not None:
+            res['CPUPerPacket'] = cpu / nReceived
+        if nReceived and disk is not None:
+            res['DiskBytesPerPacket'] = disk / nReceived
+        return res
+
+    def tearDown(self):
+        """Stop the servers, the sink, and the directory server."""
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.pids = []
+        if self.sinkListener is not None:
+            self.sinkListener.shutdown()
+            self.sinkListener = None
+        if self.packetHandler is not None:
+            self.packetHandler.close()
+            self.packetHandler = None
+        if self.dirServer is not None:
+            self.dirServer.socket.close()
+            self.dirServer = None
+
+def getServerConfigString(homedir, nickname, mixInterval, dirURL, port):
+    """Return the contents of a configuration file for a load test server
+       named 'nickname', with its home in 'homedir', listening on 'port',
+       mixing every 'mixInterval' seconds, and using the directory at
+       'dirURL'."""
+    return _SERVER_CONF_TEMPLATE % {
+        'homedir' : homedir, 'nickname' : nickname,
+        'mixInterval' : mixInterval, 'dirURL' : dirURL, 'port' : port }
+
+def checkResults(res, maxLoss=DEFAULT_MAX_LOSS):
+    """Given a map of results as returned by LocalMixnet.run, return None
+       if the run succeeded, or a string explaining why it failed: because
+       no packets arrived, or because we lost more than 'maxLoss' percent
+       of them."""
+    sent = res.get('PacketsSent', 0)
+    if not sent:
+        return "No packets were sent."
+    if not res.get('PacketsReceived'):
+        return "No packets were delivered."
+    loss = 100.0 * res.get('PacketsLost', 0) / sent
+    if loss > maxLoss:
+        return "Lost %.1f%% of packets; at most %s%% allowed." % (
+            loss, maxLoss)
+    return None
+
+def percentile(values, p):
+    """Given a sorted nonempty list of numbers 'values', return the
+       smallest element that is at least as large as the fraction 'p' of
+       them."""
+    idx = int(p*len(values)+0.999999) - 1
+    return values[min(max(idx, 0), len(values)-1)]
+
+# Order in which we report results, and units for each.
+_RESULT_FIELDS = [
+    ('Servers', None), ('Hops', None), ('MixInterval', 'sec'),
+    ('OfferedRate', 'packets/sec'), ('PacketsSent', None), ('PacketsAcked', None),
+    ('PacketsReceived', None), ('PacketsLost', None), ('PacketsBad', None),
+    ('Throughput', 'packets/sec'),
+    ('LatencyP50', 'sec'), ('LatencyP90', 'sec'), ('LatencyP99', 'sec'),
+    ('LatencyMax', 'sec'),
+    ('HopLatencyP50', 'sec'), ('HopLatencyP90', 'sec'),
+    ('HopLatencyP99', 'sec'),
+    ('CPUPerPacket', 'sec'), ('DiskBytesPerPacket', 'bytes') ]
+
+def formatResults(res):
+    """Given a map of results as returned by LocalMixnet.run, return a
+       string with one 'Key: value' line for each result.  Results we
+       couldn't measure are listed as 'unknown'.
+
+       Latencies are end-to-end, from when we queued a packet to when the
+       sink received it.  We can't see when a packet leaves each server,
+       so the per-hop latencies are the end-to-end ones divided by the
+       number of hops."""
+    lines = []
+    for key, unit in _RESULT_FIELDS:
+        v = res.get(key)
+        if v is None:
+            v = "unknown"
+        elif type(v) == type(0.0):
+            v = "%.4f"%v
+        else:
+            v = str(v)
+        if unit and v != "unknown":
+            v = "%s %s"%(v, unit)
+        lines.append("%s: %s\n"%(key, v))
+    return "".join(lines)
+
+def _getProcessUsage(pid):
+    """Return a 2-tuple of the CPU seconds used by the process 'pid', and
+       the number of bytes it has read from and written to disk.  Either
+       is None if we can't tell on this platform."""
+    cpu = disk = None
+    try:
+        stat = readFile("/proc/%s/stat"%pid)
+        # The second field is the command name, which may contain spaces.
+        fields = stat[stat.rindex(")")+2:].split()
+        cpu = (int(fields[11])+int(fields[12])) / \
+              float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, ValueError, IndexError, KeyError):
+        pass
+    try:
+        io = {}
+        for line in readFile("/proc/%s/io"%pid).split("\n"):
+            if ":" in line:
+                k, v = line.split(":", 1)
+                io[k.strip()] = int(v)
+        disk = io['read_bytes'] + io['write_bytes']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return cpu, disk
+
+def _spawnServer(configFile):
+    """Helper: start a mixminion server in a new process, using the
+       configuration in 'configFile'.  Return its process ID."""
+    libDir = os.path.split(os.path.split(
+        os.path.abspath(mixminion.__file__))[0])[0]
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+        [libDir] + filter(None, [os.environ.get('PYTHONPATH')]))
+    script = os.path.join(libDir, "mixminion", "Main.py")
+    return os.spawnve(os.P_NOWAIT, sys.executable,
+                      [sys.executable, script, "server-start", "-f",
+                       configFile, "--nodaemon", "-Q"], env)
+
+def _waitForPort(port, pid, timeout=STARTUP_TIMEOUT):
+    """Helper: wait until a server is listening on 'port' on localhost.
+       Raise UIError if it takes more than 'timeout' seconds, or if the
+       process 'pid' exits first."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            try:
+                s.connect(("127.0.0.1", port))
+                return
+            except socket.error:
+                pass
+        finally:
+            s.close()
+        if os.waitpid(pid, os.WNOHANG)[0]:
+            raise UIError("Server on port %s exited while starting."%port)
+        time.sleep(0.5)
+    raise UIError("Server on port %s didn't start within %s seconds"%(
+        port, timeout))
+
+_LOADTEST_USAGE = """\
+Usage: %(cmd)s [options]
+Start a mixnet on localhost, send packets through it, and report on how
+the servers performed.
+Options:
+  -h, --help                 Print this usage message and exit.
+  -n <n>, --servers=<n>      Number of servers to run. (Default: 3)
+  -r <n>, --rate=<n>         Packets per second to send. (Default: 10)
+  -d <sec>, --duration=<sec> How long to send packets. (Default: 30)
+  -i <sec>, --mix-interval=<sec>
+                             Servers' mix interval. (Default: 2)
+  -p <port>, --base-port=<port>
+                             First port to use. (Default: 48300)
+  -w <dir>, --workdir=<dir>  Directory for server homes. (Default: a new
+                             temporary directory.)
+  -o <file>, --output=<file> Write results to <file> instead of stdout.
+  -l <pct>, --max-loss=<pct> Fail if more than <pct> percent of packets are
+                             lost. (Default: 5)
+
+Exits with status 1 if no packets are delivered, or too many are lost.
+""".strip()
+
+def runLoadTest(cmd, args):
+    """[Entry point] Run a load test on a local mixnet."""
+    options, args = getopt.getopt(args, "hn:r:d:i:p:w:o:l:",
+          ["help", "servers=", "rate=", "duration=", "mix-interval=",
+           "base-port=", "workdir=", "output=", "max-loss="])
+    if args:
+        print >>sys.stderr, "Unexpected arguments"
+        print _LOADTEST_USAGE % { 'cmd' : cmd }
+        sys.exit(1)
+    nServers, rate, duration, mixInterval, basePort = 3, 10.0, 30.0, 2, 48300
+    workdir = outFile = None
+    maxLoss = DEFAULT_MAX_LOSS
+    try:
+        for o, v in options:
+            if o in ('-h', '--help'):
+                print _LOADTEST_USAGE % { 'cmd' : cmd }
+                sys.exit(0)
+            elif o in ('-n', '--servers'):
+                nServers = int(v)
+            elif o in ('-r', '--rate'):
+                rate = float(v)
+            elif o in ('-d', '--duration'):
+                duration = float(v)
+            elif o in ('-i', '--mix-interval'):
+                mixInterval = int(v)
+            elif o in ('-p', '--base-port'):
+                basePort = int(v)
+            elif o in ('-w', '--workdir'):
+                workdir = v
+            elif o in ('-o', '--output'):
+                outFile = v
+            elif o in ('-l', '--max-loss'):
+                maxLoss = float(v)
+    except ValueError, e:
+        raise UIError("Bad argument: %s"%e)
+    if rate <= 0 or duration <= 0:
+        raise UIError("Rate and duration must be positive")
+
+    removeWorkdir = 0
+    if workdir is None:
+        from mixminion.testSupport import mix_mktemp
+        workdir = mix_mktemp(".loadtest")
+        removeWorkdir = 1
+
+    LOG.setMinSeverity("WARN")
+    mixminion.Crypto.init_crypto()
+    net = LocalMixnet(workdir, nServers, basePort, mixInterval)
+    try:
+        net.setUp()
+        res = net.run(rate, duration)
+    finally:
+        net.tearDown()
+        if removeWorkdir:
+            shutil.rmtree(workdir, 1)
+
+    out = formatResults(res)
+    if outFile:
+        writeFile(outFile, out, mode=0644)
+    else:
+        sys.stdout.write(out)
+
+    problem = checkResults(res, maxLoss)
+    if problem:
+        print >>sys.stderr, "Load test failed: %s" % problem
+        sys.exit(1)
@@ -1,17 +1,23 @@
 # Copyright 2003-2011 Nick Mathewson.  See LICENSE for licensing information.
 
-"""mixminion.server.DNSFarm: code to implement asynchronous DNS resolves with
-   background threads and cachhe the results.
+"""mixminion.server.DNSFarm: code to implement asynchronous DNS resolves,
+   either by speaking DNS over UDP from the server's main loop, or with
+   background threads, and cache the results.
    """
 
+import errno
+import socket
+import struct
+import sys
 import threading
 import time
-import sys
+import mixminion.Crypto
 import mixminion.NetUtils
 from mixminion.Common import LOG
-from mixminion.ThreadUtils import TimeoutQueue, QueueEmpty
+from mixminion.ThreadUtils import WorkerPool
+from mixminion.server.MMTPServer import Connection, TRAFFIC_CONTROL
 
-__all__ = [ 'DNSCache' ]
+__all__ = [ 'DNSCache', 'AsyncResolver', 'readResolvConf' ]
 
 class _Pending:
     """Class to represent resolves that we're waiting for an answer on."""
@@ -21,45 +27,64 @@ PENDING = _Pending()
 
 # We never shutdown threads if doing so would leave fewer than MIN_THREADS.
 MIN_THREADS = 2
-# We never shutdown threads if doing so would leave fewer than MIN_FREE_THREADS
-# idle threads.
-MIN_FREE_THREADS = 1
 # We never start a new thread if doing so would make more than MAX_THREADS.
 MAX_THREADS = 8
 # Subject to MIN_THREADS and MIN_FREE_THREADS, we shutdown threads when
 # they're idele for more than MAX_THREAD_IDLE seconds.
 MAX_THREAD_IDLE = 5*60
 # We clear entries from the DNS cache when they're more than MAX_ENTRY_TTL
-# seconds old...
+# seconds old, unless the resolver told us how long to keep them...
 MAX_ENTRY_TTL = 30*60
 # ...and entries from the reverse cache after MAX_RENTRY_TTL seconds.
 MAX_RENTRY_TTL = 24*60*60
+# How often do we look for prefetched names whose answers are about to
+# expire?  We refresh any that will expire within two intervals.
+REFRESH_INTERVAL = 60
 
 class DNSCache:
-    """Class to cache answers to DNS requests and manager DNS threads."""
+    """Class to cache answers to DNS requests, and resolve names either with
+       an AsyncResolver or in a pool of background threads."""
     ## Fields:
     # _isShutdown: boolean: are the threads shutting down?  (While the
     #     threads are shutting down, we don't answer any requests.)
-    # cache: map from name to PENDING or getIP result.
+    # cache: map from lowercase name to PENDING or getIP result.  (Since
+    #     hostnames are case-insensitive, we lowercase every name we're
+    #     given before we look at any of our maps.)
+    # ttls: map from name to the number of seconds we may keep its answer
+    #     in 'cache'.  Names not listed here are kept for MAX_ENTRY_TTL.
     # rCache: map from (family,lowercase IP) to (hostname, time).
     # callbacks: map from name to list of callback functions. (See lookup
     #     for definition of callback.)
     # lock: Lock to control access to this class's shared state.
-    # nBusyThreads: Number of threads that are currently handling requests.
-    # nLiveThreads: Number of threads that are currently running.
-    # queue: Instance of TimeoutQueue that holds either names to resolve,
-    #     or instances of None to shutdown threads.
-    # threads: List of DNSThreads, some of which may be dead.
-    def __init__(self):
-        """Create a new DNSCache"""
+    # pool: the WorkerPool that resolves names, or None if we're using
+    #     a resolver.
+    # resolver: the AsyncResolver that resolves names, or None.
+    # prefetchNames: a set of the names we were last asked to prefetch;
+    #     we refresh their answers before they expire.
+    # refreshing: a set of the names we're refreshing.  (While we refresh
+    #     a name, we keep answering lookups with its old answer.  If the
+    #     refresh fails, we keep the old answer until it expires.)
+    # stats: a map from statistic name to value.  See getStats.
+    def __init__(self, pool=None, resolver=None):
+        """Create a new DNSCache.  If 'resolver' is provided, resolve names
+           with that AsyncResolver.  Otherwise, if 'pool' is provided,
+           resolve names in that WorkerPool; otherwise, start a pool of
+           our own."""
         self.cache = {}
+        self.ttls = {}
         self.rCache = {}
         self.callbacks = {}
         self.lock = threading.RLock()
-        self.queue = TimeoutQueue()
-        self.threads = []
-        self.nLiveThreads = 0
-        self.nBusyThreads = 0
+        if pool is None and resolver is None:
+            pool = WorkerPool("DNS pool", minThreads=MIN_THREADS,
+                              maxThreads=MAX_THREADS,
+                              maxIdle=MAX_THREAD_IDLE, daemon=1)
+        self.pool = pool
+        self.resolver = resolver
+        self.prefetchNames = {}
+        self.refreshing = {}
+        self.stats = { 'lookups' : 0, 'hits' : 0, 'waits' : 0, 'misses' : 0,
+                       'prefetched' : 0, 'refreshed' : 0 }
         self._isShutdown = 0
         self.cleanCache()
     def getNonblocking(self, name):
@@ -67,6 +92,7 @@ class DNSCache:
            waiting for an answer, return PENDING.  If there is no cached
            result, return None.
         """
+        name = name.lower()
         try:
             self.lock.acquire()
             return self.cache.get(name)
@@ -100,8 +126,9 @@ class DNSCache:
            (Family, Address, Time) or ('NOENT', Reason, Time).
 
            Note: The callback may be invoked from a different thread.  Either
-           this thread or a DNS thread will block until the callback finishes,
-           so it shouldn't be especially time-consuming.
+           this thread, a DNS thread, or the thread running the resolver's
+           main loop will block until the callback finishes, so it
+           shouldn't be especially time-consuming.
         """
         # Check for a static IP first; no need to resolve that.
         v = mixminion.NetUtils.nameIsStaticIP(name)
@@ -109,16 +136,31 @@ class DNSCache:
             cb(name,v)
             return
 
+        name = name.lower()
         try:
             self.lock.acquire()
             v = self.cache.get(name)
+            # If the answer has expired, forget it.
+            if v is not None and v is not PENDING and self._isExpired(name):
+                v = None
             # If we don't have a cached answer, add cb to self.callbacks
             if v is None or v is PENDING:
                 self.callbacks.setdefault(name, []).append(cb)
             # If we aren't looking up the answer, start looking it up.
+            stats = self.stats
+            stats['lookups'] += 1
             if v is None:
-                LOG.trace("DNS cache starting lookup of %r", name)
-                self._beginLookup(name)
+                stats['misses'] += 1
+                if self.refreshing.has_key(name):
+                    # We're already looking it up again; wait for that.
+                    self.cache[name] = PENDING
+                else:
+                    LOG.trace("DNS cache starting lookup of %r", name)
+                    self._beginLookup(name)
+            elif v is PENDING:
+                stats['waits'] += 1
+            else:
+                stats['hits'] += 1
         finally:
             self.lock.release()
         # If we _did_ have an answer, invoke the callback now.
@@ -127,21 +169,98 @@ class DNSCache:
                       v,name)
             cb(name,v)
 
+    def prefetch(self, names, now=None):
+        """Begin looking up every name in 'names' that we don't already have
+           a fresh answer for, without waiting for the answers.  From now
+           until the next call to prefetch, refreshExpiring will keep these
+           names' answers from expiring.  Returns the number of lookups we
+           started."""
+        if now is None:
+            now = time.time()
+        n = 0
+        try:
+            self.lock.acquire()
+            self.prefetchNames = {}
+            for name in names:
+                if mixminion.NetUtils.nameIsStaticIP(name) is not None:
+                    continue
+                name = name.lower()
+                self.prefetchNames[name] = 1
+                v = self.cache.get(name)
+                if v is PENDING or self.refreshing.has_key(name):
+                    continue
+                if v is None:
+                    self._beginLookup(name)
+                elif self._isExpired(name, now+2*REFRESH_INTERVAL):
+                    self._beginLookup(name, refresh=1)
+                else:
+                    continue
+                n += 1
+            self.stats['prefetched'] += n
+        finally:
+            self.lock.release()
+        return n
+
+    def refreshExpiring(self, now=None):
+        """Begin looking up again every prefetched name whose answer will
+           expire within 2*REFRESH_INTERVAL seconds, so that nobody has to
+           wait for it.  Should be called every REFRESH_INTERVAL seconds.
+           Returns the number of lookups we started."""
+        if now is None:
+            now = time.time()
+        n = 0
+        try:
+            self.lock.acquire()
+            for name in self.prefetchNames.keys():
+                v = self.cache.get(name)
+                if v is PENDING or self.refreshing.has_key(name):
+                    continue
+                if v is None:
+                    # Someone cleaned it; look it up again.
+                    self._beginLookup(name)
+                elif self._isExpired(name, now+2*REFRESH_INTERVAL):
+                    self._beginLookup(name, refresh=1)
+                else:
+                    continue
+                n += 1
+            self.stats['refreshed'] += n
+        finally:
+            self.lock.release()
+        return n
+
+    def getStats(self):
+        """Return a map of statistics about this cache: the number of
+           'lookups' of names that weren't static IPs; how many of them
+           we answered at once from the cache ('hits'), how many had to
+           wait for a lookup that was already running ('waits'), and how
+           many had to start a new lookup ('misses'); the fraction of
+           lookups that were hits ('hitRate'); the number of lookups started
+           by 'prefetch' and by 'refreshExpiring' ('prefetched',
+           'refreshed'); and the number of names in the cache ('size')."""
+        try:
+            self.lock.acquire()
+            stats = self.stats.copy()
+            stats['size'] = len(self.cache)
+        finally:
+            self.lock.release()
+        if stats['lookups']:
+            stats['hitRate'] = float(stats['hits']) / stats['lookups']
+        else:
+            stats['hitRate'] = 0.0
+        return stats
+
     def shutdown(self, wait=0):
         """Tell all the DNS threads to shut down.  If 'wait' is true,
-           don't wait until all the theads have completed."""
+           wait until all the threads have completed."""
         try:
             self.lock.acquire()
             self._isShutdown = 1
-            self.queue.clear()
-            for _ in xrange(self.nLiveThreads*2):
-                self.queue.put(None)
         finally:
             self.lock.release()
-
-        if wait:
-            for thr in self.threads:
-                thr.join()
+        if self.pool is not None:
+            self.pool.shutdown(flush=1, wait=wait)
+        if self.resolver is not None:
+            self.resolver.close()
 
     def cleanCache(self,now=None):
         """Remove all expired entries from the cache."""
@@ -152,56 +271,79 @@ class DNSCache:
 
             # Purge old entries from the caches.
             cache = self.cache
+            ttls = self.ttls
             for name in cache.keys():
                 v = cache[name]
                 if v is PENDING: continue
-                if now-v[2] > MAX_ENTRY_TTL:
+                if now-v[2] > ttls.get(name, MAX_ENTRY_TTL):
                     del cache[name]
+                    if ttls.has_key(name):
+                        del ttls[name]
             rCache = self.rCache
             for name in rCache.keys():
                 v=rCache[name]
                 if now-v[1] > MAX_RENTRY_TTL:
                     del rCache[name]
-
-            # Remove dead threads from self.threads.
-            liveThreads = [ thr for thr in self.threads if thr.isAlive() ]
-            self.threads = liveThreads
-
-            # Make sure we have enough threads.
-            if len(self.threads) < MIN_THREADS:
-                for _ in xrange(len(self.threads)-MIN_THREADS):
-                    self.threads.append(DNSThread(self))
-                    self.threads[-1].start()
         finally:
             self.lock.release()
 
-    def _beginLookup(self,name):
-        """Helper function: Begin looking up 'name'.
+    def _isExpired(self, name, now=None):
+        """Helper function: return true iff the cached answer for 'name'
+           will have expired by 'now'.  Caller must hold self.lock."""
+        if now is None:
+            now = time.time()
+        return now-self.cache[name][2] > self.ttls.get(name, MAX_ENTRY_TTL)
+
+    def _beginLookup(self,name,refresh=0):
+        """Helper function: Begin looking up 'name'.  If 'refresh' is true,
+           keep answering lookups with the old answer until we get a new
+           one.
 
            Caller must hold self.lock
         """
-        self.cache[name] = PENDING
+        if refresh:
+            self.refreshing[name] = 1
+        else:
+            self.cache[name] = PENDING
         if self._isShutdown:
             # If we've shut down the threads, don't queue the request at
             # all; it'll stay pending indefinitely.
             return
         # Queue the request.
-        self.queue.put(name)
-        # If there aren't enough idle threads, and if we haven't maxed
-        # out the threads, start a new one.
-        if (self.nLiveThreads < self.nBusyThreads + MIN_FREE_THREADS
-            and self.nLiveThreads < MAX_THREADS):
-            thread = DNSThread(self)
-            thread.start()
-            self.threads.append(thread)
-    def _lookupDone(self,name,val):
+        if self.resolver is not None:
+            self.resolver.resolve(name, self._lookupDone)
+        else:
+            self.pool.submit(self._resolve, name)
+    def _resolve(self,name):
+        """Helper function: resolve 'name' and record the answer.  Runs in
+           a worker thread."""
+        self._lookupDone(name, mixminion.NetUtils.getIP(name))
+    def _lookupDone(self,name,val,ttl=None):
         """Helper function: invoked when we get the answer 'val' for
-           a lookup of 'name'.
+           a lookup of 'name'.  If 'ttl' is provided, we keep the answer
+           for that many seconds; otherwise, for MAX_ENTRY_TTL.
            """
         try:
             self.lock.acquire()
+            old = self.cache.get(name)
+            if self.refreshing.has_key(name):
+                del self.refreshing[name]
+                if (val[0] == 'NOENT' and old is not None and
+                    old is not PENDING and old[0] != 'NOENT' and
+                    not self._isExpired(name)):
+                    # Don't let a failed refresh hide an answer that's
+                    # still good; refreshExpiring will try again.
+                    LOG.debug("Couldn't refresh DNS answer for %r (%s); "
+                              "keeping the old one until it expires.",
+                              name, val[1])
+                    return
             # Insert the value in the cache.
             self.cache[name]=val
+            if ttl is None:
+                if self.ttls.has_key(name):
+                    del self.ttls[name]
+            else:
+                self.ttls[name] = ttl
             # Insert the value in the reverse cache.
             if val[0] != 'NOENT':
                 self.rCache[(val[0], val[1].lower())] = (name.lower(),val[2])
@@ -216,54 +358,530 @@ class DNSCache:
         # Now that we've released the lock, invoke the callbacks.
         for cb in cbs:
             cb(name,val)
-    def _adjLiveThreads(self,n):
-        """Helper: adjust the number of live threads by n"""
-        self.lock.acquire()
-        self.nLiveThreads += n
-        self.lock.release()
-    def _adjBusyThreads(self,n):
-        """Helper: adjust the number of busy threads by n"""
-        self.lock.acquire()
-        self.nBusyThreads += n
-        self.lock.release()
 
-class DNSThread(threading.Thread):
-    """Helper class: used by DNSCache to implement name resolution."""
+#----------------------------------------------------------------------
+# Asynchronous resolution over UDP.
+
+# How long do we wait for a nameserver to answer before trying again?
+RESOLVER_TIMEOUT = 5
+# How many times do we send each query (rotating among our nameservers)
+# before giving up?
+RESOLVER_TRIES = 3
+# We keep answers for at least MIN_ENTRY_TTL seconds, and at most
+# MAX_ANSWER_TTL seconds, no matter what TTL the nameserver gives us.
+MIN_ENTRY_TTL = 60
+MAX_ANSWER_TTL = 24*60*60
+# How long do we remember that a name doesn't exist, if the nameserver
+# doesn't tell us?  And at most how long, if it does?
+NEGATIVE_TTL = 5*60
+MAX_NEGATIVE_TTL = 60*60
+# How long do we remember that we couldn't get any answer at all?
+FAILURE_TTL = MIN_ENTRY_TTL
+# How many UDP sockets do we send queries from at once?  Each query goes
+# out from a randomly chosen one...
+RESOLVER_SOCKETS = 4
+# ...and we replace each socket with a new one, on a new port, once it has
+# sent this many queries, so that nobody can learn which ports to aim
+# forged answers at.
+RESOLVER_SOCKET_QUERIES = 16
+
+# DNS record types and response codes that we care about.
+_TYPE_A = 1
+_TYPE_SOA = 6
+_TYPE_AAAA = 28
+_CLASS_IN = 1
+_RCODE_NXDOMAIN = 3
+
+class DNSError(Exception):
+    """Raised when we can't encode a DNS query, or can't parse a DNS
+       answer."""
+
+def _encodeName(name):
+    """Helper: return the DNS wire encoding of the hostname 'name'.  Raise
+       DNSError if 'name' isn't a valid hostname."""
+    labels = name.rstrip(".").split(".")
+    out = []
+    for label in labels:
+        if not 0 < len(label) < 64:
+            raise DNSError("Invalid hostname %r" % name)
+        out.append(chr(len(label)))
+        out.append(label)
+    out.append("\0")
+    r = "".join(out)
+    if len(r) > 255:
+        raise DNSError("Hostname %r is too long" % name)
+    return r
+
+def _buildQuery(qid, name, qtype):
+    """Helper: return a recursive DNS query with ID 'qid' for records of
+       type 'qtype' about 'name'."""
+    # ID, flags (just 'recursion desired'), 1 question, no other records.
+    return (struct.pack("!HHHHHH", qid, 0x0100, 1, 0, 0, 0) +
+            _encodeName(name) + struct.pack("!HH", qtype, _CLASS_IN))
+
+def _readName(msg, off):
+    """Helper: read a (possibly compressed) domain name from the DNS message
+       'msg' at offset 'off'.  Return a tuple of the name and the offset
+       just after it."""
+    labels = []
+    end = None
+    jumps = 0
+    while 1:
+        if off >= len(msg):
+            raise DNSError("Truncated name")
+        n = ord(msg[off])
+        if n & 0xC0 == 0xC0:
+            if off+2 > len(msg):
+                raise DNSError("Truncated name")
+            if end is None:
+                end = off+2
+            jumps += 1
+            if jumps > 64:
+                raise DNSError("Compression loop")
+            off = struct.unpack("!H", msg[off:off+2])[0] & 0x3FFF
+        elif n & 0xC0:
+            raise DNSError("Bad label type")
+        elif n == 0:
+            off += 1
+            break
+        else:
+            if off+1+n > len(msg):
+                raise DNSError("Truncated label")
+            labels.append(msg[off+1:off+1+n])
+            off += 1+n
+    if end is None:
+        end = off
+    return ".".join(labels), end
+
+def _formatIP6(b):
+    """Helper: return the text form of the 16-byte IPv6 address 'b'."""
+    return ":".join([ "%x"%w for w in struct.unpack("!8H", b) ])
+
+def _parseResponse(msg):
+    """Helper: parse the DNS response 'msg'.  Return a 5-tuple of (ID,
+       response code, lowercase question name, list of (type, ttl, address)
+       for every A and AAAA record in the answer section, negative-caching
+       TTL from the authority section or None).  Raise DNSError if the
+       message is malformed."""
+    if len(msg) < 12:
+        raise DNSError("Truncated header")
+    qid, flags, qdcount, ancount, nscount, _ = struct.unpack("!HHHHHH",
+                                                             msg[:12])
+    if not flags & 0x8000:
+        raise DNSError("Not a response")
+    if qdcount != 1:
+        raise DNSError("Expected one question; got %s"%qdcount)
+    qname, off = _readName(msg, 12)
+    off += 4
+    answers = []
+    negTTL = None
+    for section in xrange(2):
+        if section == 0:
+            count = ancount
+        else:
+            count = nscount
+        for _ in xrange(count):
+            _, off = _readName(msg, off)
+            if off+10 > len(msg):
+                raise DNSError("Truncated record")
+            rtype, rclass, ttl, rdlen = struct.unpack("!HHIH",
+                                                      msg[off:off+10])
+            off += 10
+            rdata = msg[off:off+rdlen]
+            if len(rdata) != rdlen:
+                raise DNSError("Truncated record")
+            if section == 0 and rclass == _CLASS_IN:
+                if rtype == _TYPE_A and rdlen == 4:
+                    answers.append((_TYPE_A, ttl, socket.inet_ntoa(rdata)))
+                elif rtype == _TYPE_AAAA and rdlen == 16:
+                    answers.append((_TYPE_AAAA, ttl, _formatIP6(rdata)))
+            elif section == 1 and rtype == _TYPE_SOA:
+                # The SOA's 'minimum' field is the negative-caching TTL.
+                _, o = _readName(msg, off)
+                _, o = _readName(msg, o)
+                if o+20 <= off+rdlen:
+                    minimum = struct.unpack("!I", msg[o+16:o+20])[0]
+                    negTTL = min(ttl, minimum)
+            off += rdlen
+    return qid, flags & 0x000F, qname.lower(), answers, negTTL
+
+def readResolvConf(fname="/etc/resolv.conf"):
+    """Return a list of the IPv4 nameservers listed in the resolver
+       configuration file 'fname', or an empty list if there are none.
+
+       We ignore 'search' and 'domain' lines: the names we look up come
+       from server descriptors, and should already be fully qualified."""
+    try:
+        f = open(fname, 'r')
+        try:
+            lines = f.readlines()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return []
+    result = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 2 and fields[0] == 'nameserver':
+            v = mixminion.NetUtils.nameIsStaticIP(fields[1])
+            if v is not None and v[0] == mixminion.NetUtils.AF_INET:
+                result.append(v[1])
+    return result
+
+def _readHostsFile(fname="/etc/hosts"):
+    """Helper: return a map from lowercase hostname to a list of getIP-style
+       (family, address) tuples, from the hosts file 'fname'."""
+    try:
+        f = open(fname, 'r')
+        try:
+            lines = f.readlines()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return {}
+    result = {}
+    for line in lines:
+        fields = line.split("#")[0].split()
+        if len(fields) < 2:
+            continue
+        v = mixminion.NetUtils.nameIsStaticIP(fields[0])
+        if v is None:
+            continue
+        for name in fields[1:]:
+            result.setdefault(name.lower(), []).append(v[:2])
+    return result
+
+class _Query:
+    """Helper class: an outstanding query sent by an AsyncResolver."""
+    ## Fields:
+    # name: the hostname we're looking up.
+    # qtype: _TYPE_A or _TYPE_AAAA.
+    # qid: the 16-bit ID of the query.
+    # callback: the function to invoke with the answer.
+    # tries: how many times we've sent the query.
+    # deadline: when we give up waiting for the current try.
+    # sock: the _ResolverSocket we sent the current try from.
+    def __init__(self, name, qtype, callback):
+        self.name = name
+        self.qtype = qtype
+        self.callback = callback
+        self.qid = None
+        self.tries = 0
+        self.deadline = None
+        self.sock = None
+
+class _ResolverSocket(Connection):
+    """Helper class: one of the UDP sockets that an AsyncResolver sends
+       its queries from.  We pass every datagram that arrives on it to
+       the resolver."""
     ## Fields:
-    # dnscache: The DNSCache object that should receive our answers
-    def __init__(self, dnscache):
-        """Create a new DNSThread"""
-        threading.Thread.__init__(self)
-        self.dnscache = dnscache
-        self.setDaemon(1) # When the process exits, don't wait for this thread.
-    def run(self):
-        """Thread body: pull questions from the DNS thread queue and
-           answer them."""
-        queue = self.dnscache.queue
-        _lookupDone = self.dnscache._lookupDone
-        _adjBusyThreads = self.dnscache._adjBusyThreads
-        _adjLiveThreads = self.dnscache._adjLiveThreads
+    # resolver: the AsyncResolver that owns this socket.
+    # sock: a nonblocking UDP socket, bound to an ephemeral port.
+    # nSent: how many queries we've sent from this socket.
+    # isOpen: flag: are we still reading from this socket?
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+        self.sock.bind(("0.0.0.0", 0))
+        self.nSent = 0
+        self.isOpen = 1
+
+    def close(self):
+        if self.isOpen:
+            self.isOpen = 0
+            self.sock.close()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def getStatus(self):
+        return self.isOpen, 0, self.isOpen
+
+    def getTrafficClasses(self):
+        return TRAFFIC_CONTROL, TRAFFIC_CONTROL
+
+    def process(self, r, w, x, cap):
+        now = time.time()
+        while self.isOpen:
+            try:
+                msg, addr = self.sock.recvfrom(4096)
+            except socket.error, e:
+                if e[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR,
+                                errno.ECONNREFUSED):
+                    LOG.warn("Error reading DNS answer: %s", e)
+                break
+            self.resolver._handleResponse(msg, addr, now, self)
+        return self.isOpen, 0, self.isOpen, 0
+
+class AsyncResolver:
+    """Resolves hostnames by sending DNS queries over UDP to a list of
+       recursive nameservers, without blocking and without threads.  To
+       use it, pass an AsyncServer to its connectServer method, and call
+       its poll method every time through the server's loop; callbacks are
+       invoked from the thread that runs the loop.
+
+       We send each query from one of RESOLVER_SOCKETS sockets, chosen at
+       random, and move each socket to a new port after
+       RESOLVER_SOCKET_QUERIES queries.
+
+       Like NetUtils.getIP, we prefer IPv4 answers, and only ask for IPv6
+       addresses if a name has no IPv4 addresses and this host supports
+       IPv6.  Names listed in the hosts file are answered without any
+       queries.
+    """
+    ## Fields:
+    # nameservers: a list of nameserver IPs.
+    # server: the AsyncServer that reads from our sockets, or None.
+    # socks: a list of the _ResolverSockets we send new queries from.
+    # retired: a list of _ResolverSockets that have sent their share of
+    #    queries.  We close each one once its queries are answered.
+    # unregistered: a list of _ResolverSockets that we haven't yet told
+    #    'server' about.
+    # hosts: a map from lowercase hostname to list of (family, address),
+    #    from the hosts file.
+    # queries: a map from query ID to _Query object.
+    # ready: a list of (callback, name, value, ttl) for answers we have
+    #    but haven't delivered yet.
+    # lock: a lock protecting 'queries', 'ready', and the lists of sockets.
+    # isOpen: flag: are we still running?
+    def __init__(self, nameservers, hostsFile="/etc/hosts"):
+        """Create a new AsyncResolver that sends its queries to the IPv4
+           addresses in 'nameservers' (port 53 unless given as
+           (addr,port) tuples)."""
+        assert nameservers
+        self.nameservers = []
+        for ns in nameservers:
+            if type(ns) == type(()):
+                self.nameservers.append(ns)
+            else:
+                self.nameservers.append((ns, 53))
+        self.server = None
+        self.socks = [ _ResolverSocket(self)
+                       for _ in xrange(RESOLVER_SOCKETS) ]
+        self.retired = []
+        self.unregistered = self.socks[:]
+        if hostsFile:
+            self.hosts = _readHostsFile(hostsFile)
+        else:
+            self.hosts = {}
+        self.queries = {}
+        self.ready = []
+        self.lock = threading.Lock()
+        self.isOpen = 1
+
+    def connectServer(self, server):
+        """Read answers to our queries from the AsyncServer 'server'.
+           Must be called from the thread that runs the AsyncServer."""
+        self.server = server
+        self._registerSockets()
+
+    def resolve(self, name, callback):
+        """Begin looking up 'name'.  When we're done, invoke
+           callback(name, value, ttl), where 'value' is as for
+           NetUtils.getIP, and 'ttl' is the number of seconds the answer
+           is good for.  May be called from any thread."""
+        now = time.time()
+        addrs = self.hosts.get(name.lower())
+        if addrs:
+            self._answer(callback, name, addrs, MAX_ENTRY_TTL, now)
+            return
+        self.lock.acquire()
+        try:
+            self._send(_Query(name, _TYPE_A, callback), now)
+        finally:
+            self.lock.release()
+
+    def poll(self, now=None):
+        """Retry or give up on every query that has gone unanswered for
+           too long, and invoke the callbacks for every answer we've
+           received.  Must be called from the thread that runs the
+           AsyncServer."""
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
         try:
-            _adjLiveThreads(1)
+            for q in self.queries.values():
+                if q.deadline > now:
+                    continue
+                del self.queries[q.qid]
+                if q.tries >= RESOLVER_TRIES:
+                    LOG.debug("No answer for DNS query about %r", q.name)
+                    self._fail(q, "No answer from nameserver", FAILURE_TTL,
+                               now)
+                else:
+                    self._send(q, now)
+            ready = self.ready
+            self.ready = []
+            # Close every retired socket that no query is waiting on.
+            busy = {}
+            for q in self.queries.values():
+                busy[id(q.sock)] = 1
+            done = [ s for s in self.retired if not busy.has_key(id(s)) ]
+            for s in done:
+                self.retired.remove(s)
+        finally:
+            self.lock.release()
+        for s in done:
+            if self.server is not None and s not in self.unregistered:
+                self.server.remove(s)
+            s.close()
+        self._registerSockets()
+        for callback, name, val, ttl in ready:
             try:
-                while 1:
-                    # Get a question from the queue, but don't wait more than
-                    # MAX_THREAD_IDLE seconds
-                    hostname = queue.get(timeout=MAX_THREAD_IDLE)
-                    # If the question is None, shutdown.
-                    if hostname is None:
-                        return
-                    # Else, resolve the IP and send the answer to the dnscache
-                    _adjBusyThreads(1)
-                    result = mixminion.NetUtils.getIP(hostname)
-                    _lookupDone(hostname, result)
-                    _adjBusyThreads(-1)
-            except QueueEmpty:
-                LOG.debug("DNS thread shutting down: idle for %s seconds.",
-                         MAX_THREAD_IDLE)
+                callback(name, val, ttl)
             except:
-                LOG.error_exc(sys.exc_info(),
-                              "Exception in DNS thread; shutting down.")
+                LOG.error_exc(sys.exc_info(), "Error in DNS callback")
+
+    def close(self):
+        """Stop resolving names.  Queries in progress are never answered.
+           Must be called from the thread that runs the AsyncServer."""
+        self.lock.acquire()
+        try:
+            if not self.isOpen:
+                return
+            self.isOpen = 0
+            socks = self.socks + self.retired
+            self.socks = []
+            self.retired = []
+        finally:
+            self.lock.release()
+        for s in socks:
+            if self.server is not None and s not in self.unregistered:
+                self.server.remove(s)
+            s.close()
+
+    def _registerSockets(self):
+        """Helper: tell our AsyncServer (if any) about every socket it
+           doesn't know about yet."""
+        if self.server is None:
+            return
+        self.lock.acquire()
+        try:
+            socks = [ s for s in self.unregistered if s.isOpen ]
+            self.unregistered = []
+        finally:
+            self.lock.release()
+        for s in socks:
+            self.server.register(s)
+
+    def _handleResponse(self, msg, addr, now, sock):
+        """Helper: handle a single UDP datagram 'msg' from 'addr', which
+           arrived on the _ResolverSocket 'sock'."""
+        try:
+            qid, rcode, qname, answers, negTTL = _parseResponse(msg)
+        except DNSError, e:
+            LOG.debug("Dropping malformed DNS answer from %s: %s", addr, e)
+            return
+        self.lock.acquire()
+        try:
+            q = self.queries.get(qid)
+            # Make sure this is really the answer to our question, from the
+            # server we asked, to the port we asked from.
+            if (q is None or qname != q.name.lower().rstrip(".") or
+                q.sock is not sock or
+                addr != self.nameservers[(q.tries-1)%len(self.nameservers)]):
+                LOG.debug("Dropping unexpected DNS answer from %s", addr)
+                return
+            del self.queries[qid]
+            if rcode == _RCODE_NXDOMAIN:
+                self._fail(q, "No such host", negTTL, now)
+            elif rcode != 0:
+                # The server failed; ask another one.
+                if q.tries >= RESOLVER_TRIES:
+                    self._fail(q, "Nameserver error %s"%rcode, FAILURE_TTL,
+                               now)
+                else:
+                    self._send(q, now)
+            else:
+                found = [ a for a in answers if a[0] == q.qtype ]
+                if found:
+                    if q.qtype == _TYPE_A:
+                        family = mixminion.NetUtils.AF_INET
+                    else:
+                        family = mixminion.NetUtils.AF_INET6
+                    ttl = min([ a[1] for a in found ])
+                    self._answer(q.callback, q.name,
+                                 [ (family, a[2]) for a in found ],
+                                 max(MIN_ENTRY_TTL, min(ttl, MAX_ANSWER_TTL)),
+                                 now, lock=0)
+                elif (q.qtype == _TYPE_A and
+                      mixminion.NetUtils.getProtocolSupport()[1]):
+                    # No IPv4 addresses; try IPv6.
+                    self._send(_Query(q.name, _TYPE_AAAA, q.callback), now)
+                else:
+                    self._fail(q, "No inet addresses returned", negTTL, now)
+        finally:
+            self.lock.release()
+
+    def _send(self, q, now):
+        """Helper: send (or resend) the query 'q' to the next nameserver.
+           Caller must hold self.lock."""
+        if q.qid is None:
+            try:
+                _encodeName(q.name)
+            except DNSError, e:
+                self._fail(q, str(e), NEGATIVE_TTL, now)
+                return
+        prng = mixminion.Crypto.getCommonPRNG()
+        # Use a new ID for every try, so that a late answer to an old try
+        # can't be mistaken for an answer to this one.
+        while 1:
+            q.qid = prng.getInt(65536)
+            if not self.queries.has_key(q.qid):
+                break
+        if not self.isOpen:
+            return
+        sock = self.socks[prng.getInt(len(self.socks))]
+        sock.nSent += 1
+        if sock.nSent >= RESOLVER_SOCKET_QUERIES:
+            # Replace it; we'll close it once its queries are done.  (The
+            # new socket's answers wait in its buffer until poll registers
+            # it.)
+            self.socks.remove(sock)
+            self.retired.append(sock)
+            fresh = _ResolverSocket(self)
+            self.socks.append(fresh)
+            self.unregistered.append(fresh)
+        ns = self.nameservers[q.tries % len(self.nameservers)]
+        q.tries += 1
+        q.deadline = now + RESOLVER_TIMEOUT
+        q.sock = sock
+        self.queries[q.qid] = q
+        try:
+            sock.sock.sendto(_buildQuery(q.qid, q.name, q.qtype), ns)
+        except socket.error, e:
+            # We'll try again when the query times out.
+            LOG.debug("Error sending DNS query to %s: %s", ns[0], e)
+
+    def _answer(self, callback, name, addrs, ttl, now, lock=1):
+        """Helper: arrange to tell 'callback' that 'name' resolves to the
+           best of the (family, address) tuples in 'addrs'."""
+        haveIP6 = mixminion.NetUtils.getProtocolSupport()[1]
+        inet4 = [ a for a in addrs if a[0] == mixminion.NetUtils.AF_INET ]
+        inet6 = [ a for a in addrs if a[0] == mixminion.NetUtils.AF_INET6 ]
+        if inet4:
+            val = inet4[0] + (now,)
+        elif inet6 and haveIP6:
+            val = inet6[0] + (now,)
+        else:
+            val = ("NOENT",
+                 "All addresses were IPv6, and this host has no IPv6 support",
+                 now)
+        LOG.trace("Result for DNS query about %r: %s (ttl %s)", name,
+                  val[1], ttl)
+        if lock: self.lock.acquire()
+        try:
+            self.ready.append((callback, name, val, ttl))
         finally:
-            _adjLiveThreads(-1)
+            if lock: self.lock.release()
 
+    def _fail(self, q, reason, ttl, now):
+        """Helper: arrange to tell q's callback that we couldn't resolve its
+           name.  If 'ttl' is None, use NEGATIVE_TTL.  Caller must hold
+           self.lock."""
+        if ttl is None:
+            ttl = NEGATIVE_TTL
+        ttl = max(MIN_ENTRY_TTL, min(ttl, MAX_NEGATIVE_TTL))
+        LOG.trace("Result for DNS query about %r: error: %s", q.name, reason)
+        self.ready.append((q.callback, q.name, ("NOENT", reason, now), ttl))
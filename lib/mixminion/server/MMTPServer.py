@@ -34,13 +34,81 @@ from mixminion.Common import MixError, MixFatalError, MixProtocolError, \
      LOG, stringContains, floorDiv, UIError
 from mixminion.Crypto import sha1, getCommonPRNG
 from mixminion.Packet import PACKET_LEN, DIGEST_LEN, IPV4Info, MMTPHostInfo
-from mixminion.MMTPClient import PeerCertificateCache, MMTPClientConnection
+from mixminion.MMTPClient import PeerCertificateCache, MMTPClientConnection, \
+     WINDOWED_PROTOCOL, formatProtocol, parseProtocol
 from mixminion.NetUtils import getProtocolSupport, AF_INET, AF_INET6
 import mixminion.server.EventStats as EventStats
 from mixminion.Filestore import CorruptedFile
-from mixminion.ThreadUtils import MessageQueue, QueueEmpty
+from mixminion.ThreadUtils import CallbackQueue
 
-__all__ = [ 'AsyncServer', 'ListenConnection', 'MMTPServerConnection' ]
+__all__ = [ 'AsyncServer', 'ListenConnection', 'MMTPServerConnection',
+            'TokenBucket' ]
+
+class TokenBucket:
+    """A token bucket for bandwidth limiting.  The bucket refills
+       continuously at 'rate' bytes per second, up to 'burst' bytes.
+       Spending more than the bucket holds is allowed: the bucket goes
+       negative, and the debt is repaid from later refills."""
+    ## Fields:
+    # rate: bytes per second added to the bucket.
+    # burst: the most bytes the bucket may hold.
+    # tokens: the number of bytes currently in the bucket.  May be
+    #    negative.
+    # lastRefill: the time at which we last refilled the bucket.
+    def __init__(self, rate, burst=None, now=None):
+        """Create a new full TokenBucket.  'burst' defaults to 5
+           seconds' worth of 'rate'."""
+        if burst is None:
+            burst = rate*5
+        if now is None:
+            now = time.time()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.lastRefill = now
+
+    def refill(self, now):
+        """Add the tokens that have accumulated since the last refill."""
+        elapsed = now - self.lastRefill
+        if elapsed <= 0:
+            # Don't let a clock that jumps backwards drain the bucket.
+            self.lastRefill = now
+            return
+        self.lastRefill = now
+        self.tokens = min(self.burst, self.tokens + elapsed*self.rate)
+
+    def spend(self, n):
+        """Remove 'n' bytes' worth of tokens from the bucket."""
+        self.tokens -= n
+
+    def getAvailable(self):
+        """Return the number of whole bytes we may spend right now."""
+        if self.tokens <= 0:
+            return 0
+        return int(self.tokens)
+
+    def getDelay(self, level=1):
+        """Return the number of seconds until the bucket holds at least
+           'level' bytes."""
+        if self.tokens >= level:
+            return 0.0
+        return (level - self.tokens) / float(self.rate)
+
+# Traffic classes for bandwidth shaping.  Control traffic (handshakes,
+# acknowledgments) is never held back for lack of tokens, though it is
+# still counted against the limits; real packets wait until there are
+# tokens; and link padding only uses bandwidth left over once the buckets
+# are at least PADDING_RESERVE full.
+TRAFFIC_CONTROL = 0
+TRAFFIC_PACKET = 1
+TRAFFIC_PADDING = 2
+# Fraction of each bucket that padding must leave for real packets.
+PADDING_RESERVE = 0.5
+# How many bytes may control traffic use in a single call to 'process',
+# regardless of the bandwidth limits?
+CONTROL_ALLOWANCE = 4096
+# Shortest time to wait for tokens before checking the buckets again.
+MIN_SHAPING_DELAY = 0.01
 
 class SelectAsyncServer:
     """AsyncServer is the core of a general-purpose asynchronous
@@ -54,17 +122,20 @@ class SelectAsyncServer:
     # self.state: a map from fd to the latest wantRead,wantWrite tuples
     #    returned by the connection objects' process or getStatus methods.
 
-    # self.bandwidthPerTick: How many bytes of bandwidth do we use per tick,
-    #    on average?
-    # self.maxBucket: How many bytes of bandwidth are we willing to use in
-    #    a single 1-tick burst?
-    # self.bucket: How many bytes are we willing to use in the next tick?
-    #
-    #   (NOTE: if no bandwidth limitation is used, the 3 fields above are
-    #   set to None.)
-
-    # How many seconds pass between the 'ticks' at which we increment
-    # our bandwidth bucket?
+    # self.totalBucket: A TokenBucket limiting the bytes we read and
+    #    write, or None.
+    # self.inBucket, self.outBucket: TokenBuckets limiting the bytes we
+    #    read and write respectively, or None.
+    # self.peerRate: How many bytes per second may a single connection
+    #    use, on average?  None if there is no per-connection limit.
+    # self.peerBuckets: A map from fd to a TokenBucket for each
+    #    connection, if peerRate is set.
+    # self._shaping: flag: are any of the limits above in use?
+    # self._wakeDelay: While processing, the shortest time until a
+    #    connection we've held back might get tokens, or None.
+
+    # How often does the main loop call 'tick'?  (The buckets refill
+    # continuously; 'tick' just keeps them fresh when we're idle.)
     TICK_INTERVAL = 1.0
 
     def __init__(self):
@@ -72,7 +143,11 @@ class SelectAsyncServer:
         self._timeout = None
         self.connections = {}
         self.state = {}
-        self.bandwidthPerTick = self.bucket = self.maxBucket = None
+        self.totalBucket = self.inBucket = self.outBucket = None
+        self.peerRate = None
+        self.peerBuckets = {}
+        self._shaping = 0
+        self._wakeDelay = None
 
     def process(self,timeout):
         """If any relevant file descriptors become available within
@@ -82,11 +157,16 @@ class SelectAsyncServer:
 
            If we receive an unblocked signal, return immediately.
            """
+        if self._shaping:
+            self._beginShaping()
         readfds = []; writefds = []; exfds = []
         for fd,(wr,ww) in self.state.items():
+            if self._shaping:
+                wr, ww = self._getAllowedInterest(fd, wr, ww)
             if wr: readfds.append(fd)
             if ww==2: exfds.append(fd)
             if ww: writefds.append(fd)
+        timeout = self._getShapedTimeout(timeout)
 
         if not (readfds or writefds or exfds):
             # Windows 'select' doesn't timeout properly when we aren't
@@ -95,10 +175,6 @@ class SelectAsyncServer:
             time.sleep(timeout)
             return
 
-        if self.bucket is not None and self.bucket <= 0:
-            time.sleep(timeout)
-            return
-
         try:
             readfds,writefds,exfds = select.select(readfds,writefds,exfds,
                                                    timeout)
@@ -120,17 +196,18 @@ class SelectAsyncServer:
             active.append((c,r,w,fd))
 
         if not active: return
-        if self.bucket is None:
-            cap = None
-        else:
-            cap = floorDiv(self.bucket, len(active))
         for c,r,w,fd in active:
+            if self._shaping:
+                cap = self._getCap(fd, c, r, w, len(active))
+            else:
+                cap = None
             wr, ww, isopen, nbytes = c.process(r,w,0,cap)
-            if cap is not None:
-                self.bucket -= nbytes
+            if self._shaping:
+                self._spend(fd, r, w, nbytes)
             if not isopen:
                 del self.connections[fd]
                 del self.state[fd]
+                self._forgetPeer(fd)
                 continue
             self.state[fd] = (wr,ww)
 
@@ -148,6 +225,7 @@ class SelectAsyncServer:
             fd = c.fileno()
         del self.connections[fd]
         del self.state[fd]
+        self._forgetPeer(fd)
 
     def tryTimeout(self, now=None):
         """Timeout any connection that is too old."""
@@ -171,28 +249,178 @@ class SelectAsyncServer:
 
            Setting n to None removes bandwidth limiting."""
         if n is None:
-            self.bandwidthPerTick = None
-            self.maxBucket = None
+            self.totalBucket = None
         else:
-            self.bandwidthPerTick = int(n * self.TICK_INTERVAL)
-            if maxBucket is None:
-                self.maxBucket = self.bandwidthPerTick*5
-            else:
-                self.maxBucket = maxBucket
-
-    def tick(self):
-        """Tell the server that one unit of time has passed, and the bandwidth
-           limitations can be readjusted.  This method must be called once
-           every TICK_INTERVAL seconds."""
-        bwpt = self.bandwidthPerTick
-        if bwpt is None:
-            self.bucket = None
+            self.totalBucket = TokenBucket(n, maxBucket)
+        self._updateShaping()
+
+    def setBandwidthLimits(self, inbound=None, outbound=None, perPeer=None):
+        """Set limits beyond the overall limit from setBandwidth:
+              inbound -- maximum bytes-per-second to read, on average.
+              outbound -- maximum bytes-per-second to write, on average.
+              perPeer -- maximum bytes-per-second to read and write on a
+                 single connection, on average.
+           Each limit allows bursts of 5 seconds' worth of bandwidth.
+           Setting a limit to None removes it."""
+        if inbound is None:
+            self.inBucket = None
+        else:
+            self.inBucket = TokenBucket(inbound)
+        if outbound is None:
+            self.outBucket = None
+        else:
+            self.outBucket = TokenBucket(outbound)
+        self.peerRate = perPeer
+        self.peerBuckets = {}
+        self._updateShaping()
+
+    def tick(self, now=None):
+        """Refill the bandwidth buckets.  The buckets refill by elapsed
+           time whenever we process events, so calling this is optional;
+           the main loop calls it every TICK_INTERVAL seconds."""
+        if now is None:
+            now = time.time()
+        for b in self._getBuckets():
+            b.refill(now)
+
+    def _getBuckets(self):
+        """Helper: return a list of all the TokenBuckets in use."""
+        return [ b for b in (self.totalBucket, self.inBucket, self.outBucket)
+                 if b is not None ] + self.peerBuckets.values()
+
+    def _updateShaping(self):
+        """Helper: recompute self._shaping after the limits change."""
+        self._shaping = (self.totalBucket is not None or
+                         self.inBucket is not None or
+                         self.outBucket is not None or
+                         self.peerRate is not None)
+
+    def _beginShaping(self):
+        """Helper: called at the start of each call to 'process' when we
+           have bandwidth limits."""
+        self.tick()
+        self._wakeDelay = None
+
+    def _getShapedTimeout(self, timeout):
+        """Helper: return how long we may wait for events, given that we
+           must wake up in time to service connections we've held back."""
+        d = self._wakeDelay
+        if d is None or d >= timeout:
+            return timeout
+        return max(d, MIN_SHAPING_DELAY)
+
+    def _getPeerBucket(self, fd):
+        """Helper: return the per-connection TokenBucket for 'fd', or None
+           if there is no per-connection limit."""
+        if self.peerRate is None:
+            return None
+        try:
+            return self.peerBuckets[fd]
+        except KeyError:
+            b = self.peerBuckets[fd] = TokenBucket(self.peerRate)
+            return b
+
+    def _forgetPeer(self, fd):
+        """Helper: discard the per-connection bucket for 'fd'."""
+        try:
+            del self.peerBuckets[fd]
+        except KeyError:
+            pass
+
+    def _getLimitingBuckets(self, fd, isWrite):
+        """Helper: return a list of the TokenBuckets that limit reading
+           (or writing, if 'isWrite') on 'fd'."""
+        if isWrite:
+            bs = [ self.totalBucket, self.outBucket, self._getPeerBucket(fd) ]
         else:
-            bucket = (self.bucket or 0) + bwpt
-            if bucket > self.maxBucket:
-                self.bucket = self.maxBucket
+            bs = [ self.totalBucket, self.inBucket, self._getPeerBucket(fd) ]
+        return [ b for b in bs if b is not None ]
+
+    def _mayUse(self, fd, isWrite, cls):
+        """Helper: return true iff traffic of class 'cls' may read (or
+           write, if 'isWrite') on 'fd' now.  If it may not, remember how
+           long to wait before checking again."""
+        if cls == TRAFFIC_CONTROL:
+            return 1
+        delay = 0
+        for b in self._getLimitingBuckets(fd, isWrite):
+            if cls == TRAFFIC_PADDING:
+                d = b.getDelay(b.burst*PADDING_RESERVE)
             else:
-                self.bucket = bucket
+                d = b.getDelay()
+            delay = max(delay, d)
+        if delay <= 0:
+            return 1
+        if self._wakeDelay is None or delay < self._wakeDelay:
+            self._wakeDelay = delay
+        return 0
+
+    def _getAllowedInterest(self, fd, wr, ww):
+        """Helper: given that the connection on 'fd' wants the events
+           'wr' and 'ww', return the events it may have given our
+           bandwidth limits."""
+        if not (wr or ww):
+            return wr, ww
+        inClass, outClass = _getTrafficClasses(self.connections[fd])
+        if wr and not self._mayUse(fd, 0, inClass):
+            wr = 0
+        # (We never hold back a connection that's waiting for 'connect'.)
+        if ww == 1 and not self._mayUse(fd, 1, outClass):
+            ww = 0
+        return wr, ww
+
+    def _getCap(self, fd, c, r, w, nActive):
+        """Helper: return how many bytes the connection 'c' on 'fd' may
+           use to handle the read and write events 'r' and 'w', when
+           'nActive' connections are sharing the bandwidth."""
+        inClass, outClass = _getTrafficClasses(c)
+        cap = 0
+        for isWrite, active, cls in ((0, r, inClass), (1, w, outClass)):
+            if not active:
+                continue
+            if cls == TRAFFIC_CONTROL:
+                cap += CONTROL_ALLOWANCE
+                continue
+            share = None
+            for b in self._getLimitingBuckets(fd, isWrite):
+                avail = b.getAvailable()
+                if b is self.peerBuckets.get(fd):
+                    n = avail
+                else:
+                    # Give everybody at least one byte: _mayUse lets us
+                    # poll a connection once there's a single token left,
+                    # and if its share rounded down to 0, we'd poll it
+                    # again at once without making progress.
+                    n = max(min(avail, 1), floorDiv(avail, nActive))
+                if share is None or n < share:
+                    share = n
+            if share is None:
+                return None
+            cap += share
+        return cap
+
+    def _spend(self, fd, r, w, nBytes):
+        """Helper: charge 'nBytes' used by the connection on 'fd' against
+           our bandwidth limits.  We can't tell how a connection that was
+           both readable and writable split its bytes, so we charge them
+           all to both directions."""
+        if not nBytes:
+            return
+        for b in (self.totalBucket, self._getPeerBucket(fd)):
+            if b is not None:
+                b.spend(nBytes)
+        if r and self.inBucket is not None:
+            self.inBucket.spend(nBytes)
+        if w and self.outBucket is not None:
+            self.outBucket.spend(nBytes)
+
+def _getTrafficClasses(c):
+    """Helper: return the traffic classes for the bytes the connection
+       'c' reads and writes."""
+    try:
+        return c.getTrafficClasses()
+    except AttributeError:
+        return TRAFFIC_PACKET, TRAFFIC_PACKET
 
 class PollAsyncServer(SelectAsyncServer):
     """Subclass of SelectAsyncServer that uses 'poll' where available.  This
@@ -206,10 +434,14 @@ class PollAsyncServer(SelectAsyncServer):
                            (0,2): select.POLLOUT+select.POLLERR,
                            (1,1): select.POLLIN+select.POLLOUT+select.POLLERR,
                            (1,2): select.POLLIN+select.POLLOUT+select.POLLERR }
+        # Map from fd to the mask we've registered with self.poll.
+        self.masks = {}
     def process(self,timeout):
-        if self.bucket is not None and self.bucket <= 0:
-            time.sleep(timeout)
-            return
+        if self._shaping:
+            self._beginShaping()
+            for fd, (wr,ww) in self.state.items():
+                self._setMask(fd, self._getAllowedInterest(fd, wr, ww))
+            timeout = self._getShapedTimeout(timeout)
         try:
             # (watch out: poll takes a timeout in msec, but select takes a
             #  timeout in sec.)
@@ -221,40 +453,52 @@ class PollAsyncServer(SelectAsyncServer):
                 raise e
         if not events:
             return
-        if self.bucket is None:
-            cap = None
-        else:
-            cap = floorDiv(self.bucket,len(events))
+        cap = None
         #print events, self.connections.keys()
         for fd, mask in events:
             c = self.connections[fd]
-            wr,ww,isopen,n = c.process(mask&select.POLLIN, mask&select.POLLOUT,
+            r = mask&select.POLLIN
+            w = mask&select.POLLOUT
+            if self._shaping:
+                cap = self._getCap(fd, c, r, w, len(events))
+            wr,ww,isopen,n = c.process(r, w,
                                        mask&(select.POLLERR|select.POLLHUP),
                                        cap)
-            if cap is not None:
-                self.bucket -= n
+            if self._shaping:
+                self._spend(fd, r, w, n)
             if not isopen:
                 #print "unregister",fd
-                self.poll.unregister(fd)
-                del self.connections[fd]
+                self.remove(c, fd)
                 continue
             #print "register",fd
-            self.poll.register(fd,self.EVENT_MASK[wr,ww])
+            self.state[fd] = (wr,ww)
+            self._setMask(fd, (wr,ww))
+
+    def _setMask(self, fd, interest):
+        """Helper: make sure we're polling 'fd' for the events in
+           'interest'."""
+        mask = self.EVENT_MASK[interest]
+        if self.masks.get(fd) != mask:
+            self.poll.register(fd, mask)
+            self.masks[fd] = mask
 
     def register(self,c):
         fd = c.fileno()
         wr, ww, isopen = c.getStatus()
         if not isopen: return
         self.connections[fd] = c
-        mask = self.EVENT_MASK[(wr,ww)]
+        self.state[fd] = (wr,ww)
         #print "register",fd
-        self.poll.register(fd, mask)
+        self._setMask(fd, (wr,ww))
     def remove(self,c,fd=None):
         if fd is None:
             fd = c.fileno()
         #print "unregister",fd
         self.poll.unregister(fd)
         del self.connections[fd]
+        del self.state[fd]
+        del self.masks[fd]
+        self._forgetPeer(fd)
 
 if hasattr(select,'poll') and not _ml.POLL_IS_EMULATED and sys.platform != 'cygwin':
     # Prefer 'poll' to 'select', except on MacOS and other platforms where
@@ -281,6 +525,10 @@ class Connection:
         """If this connection has seen no activity since 'cutoff', and it
            is subject to aging, shut it down."""
         pass
+    def getTrafficClasses(self):
+        """Return the traffic classes (TRAFFIC_*) of the bytes this
+           connection reads and writes, for bandwidth shaping."""
+        return TRAFFIC_PACKET, TRAFFIC_PACKET
 
 class ListenConnection(Connection):
     """A ListenConnection listens on a given port/ip combination, and calls
@@ -330,6 +578,10 @@ class ListenConnection(Connection):
     def getStatus(self):
         return self.isOpen,0,self.isOpen
 
+    def getTrafficClasses(self):
+        # Accepting a connection uses no bandwidth.
+        return TRAFFIC_CONTROL, TRAFFIC_CONTROL
+
     def shutdown(self):
         LOG.debug("Closing listener connection (fd %s)", self.sock.fileno())
         self.isOpen = 0
@@ -347,9 +599,17 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
     #   junkCallback -- a callback to invoke whenever we receive padding
     #   rejectCallback -- a callback to invoke whenever we've rejected a packet
     #   protocol -- the negotiated MMTP version
+    #   window -- how many unacknowledged packets have we told the client
+    #      it may send?
     #   rejectPackets -- flag: do we reject the packets we've received?
+    #   readingPaused -- flag: has the server told us to stop reading
+    #      packets?
+    #   _stalled -- flag: have we stopped reading because readingPaused
+    #      is set?
     MESSAGE_LEN = 6 + (1<<15) + 20
-    PROTOCOL_VERSIONS = ['0.3']
+    PROTOCOL_VERSIONS = ['0.4', '0.3']
+    # Largest window we allow a client to negotiate.
+    MAX_WINDOW = 64
     def __init__(self, sock, tls, consumer, rejectPackets=0, serverName=None):
         if serverName is None:
             addr,port = sock.getpeername()
@@ -363,9 +623,33 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
         self.junkCallback = lambda : None
         self.rejectCallback = lambda : None
         self.protocol = None
+        self.window = MMTPClientConnection.WRITEAHEAD
         self.rejectPackets = rejectPackets
+        self.readingPaused = self._stalled = 0
         self.beginAccepting()
 
+    def getTrafficClasses(self):
+        # We read packets, and write only acknowledgments.
+        return TRAFFIC_PACKET, TRAFFIC_CONTROL
+
+    def pauseReading(self):
+        """Stop reading packets from this connection until resumeReading is
+           called.  Since our peer can't send more than its TCP window
+           while we aren't reading, this pushes back on it without
+           dropping anything.  (We still finish protocol negotiation, and
+           still acknowledge packets we've already read.)"""
+        self.readingPaused = 1
+        if self.onRead == self.onDataRead and self.isReading():
+            self.stopReading()
+            self._stalled = 1
+
+    def resumeReading(self):
+        """Start reading packets again after a call to pauseReading."""
+        self.readingPaused = 0
+        if self._stalled:
+            self._stalled = 0
+            self.beginReading()
+
     def onConnected(self):
         self.onRead = self.readProtocol
         self.beginReading()
@@ -388,10 +672,16 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
             self.startShutdown()
             return
 
-        protocols = m.group(1).split(",")
+        offered = {}
+        for elt in m.group(1).split(","):
+            version, window = parseProtocol(elt)
+            offered[version] = window
         for p in self.PROTOCOL_VERSIONS:
-            if p in protocols:
+            if offered.has_key(p):
                 self.protocol = p
+                if p == WINDOWED_PROTOCOL and offered[p]:
+                    self.window = min(offered[p], self.MAX_WINDOW)
+                    p = formatProtocol(p, self.window)
                 self.onWrite = self.protocolWritten
                 self.beginWriting("MMTP %s\r\n"%p)
                 return
@@ -402,7 +692,14 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
     def protocolWritten(self,n):
         self.onRead = self.onDataRead
         self.onWrite = self.onDataWritten
-        self.beginReading()
+        if self.readingPaused:
+            self._stalled = 1
+        else:
+            self.beginReading()
+
+    def startShutdown(self):
+        self._stalled = 0
+        mixminion.TLSConnection.TLSConnection.startShutdown(self)
 
     def onDataRead(self):
         while self.inbuflen >= self.MESSAGE_LEN:
@@ -454,7 +751,7 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
                 self.packetConsumer(pkt)
 
             # Queue the ack.
-            self.beginWriting(replyControl+replyDigest)
+            self.beginWriting([replyControl, replyDigest])
 
     def onDataWritten(self, n): pass
     def onTLSError(self): pass
@@ -546,6 +843,104 @@ class _ClientCon(MMTPClientConnection):
         if not self._wasOnceConnected and self._pingLog:
             self._pingLog.connectFailed(self._identity)
         MMTPClientConnection._failPendingPackets(self)
+    def getTrafficClasses(self):
+        # We read only acknowledgments.  What we write is padding unless
+        # we have at least one real packet to send.
+        for p in self.pendingPackets:
+            if not p.isJunk():
+                return TRAFFIC_CONTROL, TRAFFIC_PACKET
+        for p in self.packets:
+            if not p.isJunk():
+                return TRAFFIC_CONTROL, TRAFFIC_PACKET
+        return TRAFFIC_CONTROL, TRAFFIC_PADDING
+
+# How many packets do we hand to a single destination at a time, when
+# other destinations are waiting for a connection?
+OUTBOUND_QUANTUM = 128
+
+class OutboundScheduler:
+    """Holds packets that are waiting for an outgoing connection because
+       we already have as many open as we're willing to.  Packets for the
+       same destination are kept together, so that they go out over a
+       single connection, and destinations take turns: each time a
+       connection is free, the destination that has waited longest gets
+       up to 'quantum' of its packets sent.  If it had more, it goes to
+       the back of the line.
+
+       All operations take constant amortized time.
+    """
+    ## Fields:
+    # quantum: the largest number of packets we hand out for a
+    #    destination at once.
+    # queues: a map from (ip, port, keyID) to a list of [family, ip, port,
+    #    keyID, list of DeliverableMessage, serverName, start].  Packets
+    #    before index 'start' in the list have already been handed out.
+    # order: a list of (ip, port, keyID) for destinations in the order
+    #    they get their turns.  Entries before 'head' have had their
+    #    turn, and are None.
+    # head: the index of the next destination in 'order'.
+    # nPackets: the total number of packets we're holding.
+    def __init__(self, quantum=OUTBOUND_QUANTUM):
+        """Create a new empty OutboundScheduler."""
+        assert quantum >= 1
+        self.quantum = quantum
+        self.queues = {}
+        self.order = []
+        self.head = 0
+        self.nPackets = 0
+
+    def __len__(self):
+        """Return the number of destinations waiting for a connection."""
+        return len(self.queues)
+
+    def getPacketCount(self):
+        """Return the number of packets we're holding."""
+        return self.nPackets
+
+    def add(self, family, ip, port, keyID, deliverable, serverName):
+        """Hold the packets in 'deliverable' until there's a connection
+           free to send them to the server at (ip, port, keyID).  Takes
+           the same arguments as MMTPAsyncServer._sendPackets."""
+        addr = (ip, port, keyID)
+        self.nPackets += len(deliverable)
+        try:
+            self.queues[addr][4].extend(deliverable)
+        except KeyError:
+            self.queues[addr] = [family, ip, port, keyID, list(deliverable),
+                                 serverName, 0]
+            self.order.append(addr)
+
+    def next(self):
+        """Return a tuple of arguments for MMTPAsyncServer._sendPackets, for
+           the destination whose turn it is, or None if there are no
+           packets waiting."""
+        if self.head >= len(self.order):
+            return None
+        addr = self.order[self.head]
+        self.order[self.head] = None
+        self.head += 1
+        if self.head >= 32 and self.head*2 >= len(self.order):
+            # Throw away the destinations that have had their turns, once
+            # they make up at least half the list.
+            del self.order[:self.head]
+            self.head = 0
+        entry = self.queues[addr]
+        family, ip, port, keyID, packets, serverName, start = entry
+        end = start + self.quantum
+        if len(packets) > end:
+            deliverable = packets[start:end]
+            if end*2 >= len(packets):
+                # As with 'order': throw away the packets we've handed
+                # out, once they make up at least half the list.
+                del packets[:end]
+                end = 0
+            entry[6] = end
+            self.order.append(addr)
+        else:
+            deliverable = packets[start:]
+            del self.queues[addr]
+        self.nPackets -= len(deliverable)
+        return (family, ip, port, keyID, deliverable, serverName)
 
 LISTEN_BACKLOG = 128
 class MMTPAsyncServer(AsyncServer):
@@ -562,14 +957,22 @@ class MMTPAsyncServer(AsyncServer):
     # _timeout: The number of seconds of inactivity to allow on a connection
     #     before formerly shutting it down.
     # dnsCache: An instance of mixminion.server.DNSFarm.DNSCache.
-    # msgQueue: An instance of MessageQueue to receive notification from DNS
-    #     DNS threads.  See _queueSendablePackets for more information.
+    # dnsResolver: The AsyncResolver used by dnsCache, or None if dnsCache
+    #     uses threads.
+    # callbackQueue: An instance of CallbackQueue to receive notification
+    #     from DNS threads.  See _queueSendablePackets for more information.
     # _lock: protects only serverContext.
     # maxClientConnections: Number of client connections we're willing
     #     to have outgoing at any time.  If we try to deliver packets
     #     to a new server, but we already have this many open outgoing
-    #     connections, we put the packets in pendingPackets.
-    # pendingPackets: A list of tuples to serve as arguments for _sendPackets.
+    #     connections, we put the packets in outboundScheduler.
+    # outboundScheduler: An OutboundScheduler holding packets that are
+    #     waiting for a free connection.
+    # overloaded: flag: are we holding off incoming packets because we
+    #     can't process them as fast as they arrive?
+    # overloadPolicy: What we do with incoming packets while we're
+    #     overloaded: 'stall' to stop reading them, or 'reject' to tell
+    #     the sender to retry later.
 
     def __init__(self, config, servercontext):
         AsyncServer.__init__(self)
@@ -582,6 +985,10 @@ class MMTPAsyncServer(AsyncServer):
         maxbw = config['Server'].get('MaxBandwidth', None)
         maxbwspike = config['Server'].get('MaxBandwidthSpike', None)
         self.setBandwidth(maxbw, maxbwspike)
+        self.setBandwidthLimits(
+            inbound=config['Server'].get('MaxBandwidthIn', None),
+            outbound=config['Server'].get('MaxBandwidthOut', None),
+            perPeer=config['Server'].get('MaxBandwidthPerPeer', None))
 
         # Don't always listen; don't always retransmit!
         # FFFF Support listening on multiple IPs
@@ -620,15 +1027,23 @@ class MMTPAsyncServer(AsyncServer):
         self.clientConByAddr = {}
         self.certificateCache = PeerCertificateCache()
         self.dnsCache = None
-        self.msgQueue = MessageQueue()
-        self.pendingPackets = []
+        self.dnsResolver = None
+        self.callbackQueue = CallbackQueue()
+        self.outboundScheduler = OutboundScheduler()
         self.pingLog = None
+        self.overloaded = 0
+        self.overloadPolicy = config['Incoming/MMTP'].get('OverloadPolicy',
+                                                          'stall')
 
     def connectDNSCache(self, dnsCache):
         """Use the DNSCache object 'DNSCache' to resolve DNS queries for
-           this server.
+           this server.  If the cache uses an AsyncResolver, we run it as
+           part of our loop.
         """
         self.dnsCache = dnsCache
+        self.dnsResolver = dnsCache.resolver
+        if self.dnsResolver is not None:
+            self.dnsResolver.connectServer(self)
 
     def connectPingLog(self, pingLog):
         """Report successful or failed connection attempts to 'pingLog'."""
@@ -666,9 +1081,43 @@ class MMTPAsyncServer(AsyncServer):
 
         con = MMTPServerConnection(sock, tls, self.onPacketReceived,
                                    serverName=name)
+        if self.overloaded:
+            self._holdOffPackets(con)
         self.register(con)
         return con
 
+    def setOverloaded(self, overloaded):
+        """Tell this server whether we're too far behind on processing
+           incoming packets to take any more.  While we're overloaded, we
+           stop reading packets from incoming connections or reject them,
+           depending on self.overloadPolicy."""
+        overloaded = not not overloaded
+        if overloaded == self.overloaded:
+            return
+        self.overloaded = overloaded
+        if overloaded:
+            LOG.warn("Too many packets waiting to be processed; %s incoming packets until we catch up.",
+                     {'stall':'delaying', 'reject':'rejecting'}[
+                         self.overloadPolicy])
+        else:
+            LOG.info("Caught up on processing; accepting incoming packets.")
+        for con in self.connections.values():
+            if isinstance(con, MMTPServerConnection):
+                self._holdOffPackets(con)
+                # Re-register, so that we notice any change in whether
+                # the connection wants to read.
+                self.register(con)
+
+    def _holdOffPackets(self, con):
+        """Helper: make the incoming connection 'con' stop or resume
+           taking packets, according to self.overloaded."""
+        if self.overloadPolicy == 'reject':
+            con.rejectPackets = self.overloaded
+        elif self.overloaded:
+            con.pauseReading()
+        else:
+            con.resumeReading()
+
     def stopListening(self):
         """Shut down all the listeners for this server.  Does not close open
            connections.
@@ -712,38 +1161,37 @@ class MMTPAsyncServer(AsyncServer):
             # Start looking up the hostname for the destination, and call
             # 'lookupDone' when we're done.  This is a little fiddly, since
             # 'lookupDone' might get invoked from this thread (if the result
-            # is in the cache) or from a DNS thread.
+            # is in the cache), from a DNS thread, or from our own loop.
             self.dnsCache.lookup(routing.hostname, lookupDone)
 
     def _queueSendablePackets(self, family, addr, port, keyID, deliverable,
                               serverName):
         """Helper function: insert the DNS lookup results and list of
-           deliverable packets onto self.msgQueue.  Subsequent invocations
-           of _sendQueuedPackets will begin sending those packets to their
-           destination.
+           deliverable packets onto self.callbackQueue.  Subsequent
+           invocations of _sendQueuedPackets will begin sending those
+           packets to their destination.
 
            It is safe to call this function from any thread.
            """
-        self.msgQueue.put((family,addr,port,keyID,deliverable,serverName))
+        self.callbackQueue.put(self._sendPackets, family, addr, port, keyID,
+                               deliverable, serverName)
 
     def _sendQueuedPackets(self):
         """Helper function: Find all DNS lookup results and packets in
-           self.msgQueue, and begin sending packets to the resulting servers.
+           self.callbackQueue, and begin sending packets to the resulting
+           servers.
 
            This function should only be called from the main thread.
         """
-        while len(self.clientConByAddr) < self.maxClientConnections and self.pendingPackets:
-            args = self.pendingPackets.pop(0)
-            LOG.debug("Sending %s delayed packets...",len(args[5]))
+        while len(self.clientConByAddr) < self.maxClientConnections:
+            args = self.outboundScheduler.next()
+            if args is None:
+                break
+            LOG.debug("Sending %s delayed packets to %s...",
+                      len(args[4]), args[5])
             self._sendPackets(*args)
 
-        while 1:
-            try:
-                family,addr,port,keyID,deliverable,serverName = \
-                                                self.msgQueue.get(block=0)
-            except QueueEmpty:
-                return
-            self._sendPackets(family,addr,port,keyID,deliverable,serverName)
+        self.callbackQueue.run()
 
     def _sendPackets(self, family, ip, port, keyID, deliverable, serverName):
         """Begin sending a set of packets to a given server.
@@ -769,7 +1217,8 @@ class MMTPAsyncServer(AsyncServer):
         if len(self.clientConByAddr) >= self.maxClientConnections:
             LOG.debug("We already have %s open client connections; delaying %s packets for %s",
                       len(self.clientConByAddr), len(deliverable), serverName)
-            self.pendingPackets.append((family,ip,port,keyID,deliverable,serverName))
+            self.outboundScheduler.add(family, ip, port, keyID, deliverable,
+                                       serverName)
             return
 
         try:
@@ -824,3 +1273,5 @@ class MMTPAsyncServer(AsyncServer):
         """
         self._sendQueuedPackets()
         AsyncServer.process(self, timeout)
+        if self.dnsResolver is not None:
+            self.dnsResolver.poll()
@@ -20,6 +20,7 @@ import smtplib
 import socket
 import threading
 import time
+from types import TupleType
 
 if sys.version_info[:2] >= (2,3):
     import textwrap
@@ -40,6 +41,7 @@ from mixminion.Common import LOG, MixError, ceilDiv, createPrivateDir, \
      encodeBase64, floorDiv, isPrintingAscii, isSMTPMailbox, previousMidnight,\
      readFile, waitForChildren
 from mixminion.Packet import ParseError, CompressedDataTooLong, uncompressData
+from mixminion.ThreadUtils import FutureTimeout, WorkerPool
 
 # Return values for processMessage
 DELIVER_OK = 1
@@ -76,6 +78,14 @@ class DeliveryModule:
            in ServerQueue.DeliveryQueue.setRetrySchedule."""
         return None
 
+    def getMaxConcurrency(self):
+        """Return the largest number of batches of messages that this
+           module's queue may deliver at once, or None to use the server's
+           DeliveryThreads setting.  By default, we deliver one batch at a
+           time; modules whose processMessage(s) methods are threadsafe
+           should override this."""
+        return 1
+
     def getConfigSyntax(self):
         """Return a map from section names to section syntax, as described
            in Config.py"""
@@ -133,6 +143,25 @@ class DeliveryModule:
             a nonstandard delivery queue, you don't need to implement this.)"""
         raise NotImplementedError("processMessage")
 
+    def processMessages(self, packets):
+        """Given a list of DeliveryPacket objects, try to deliver all of
+           them.  Return a list of results, one for each packet, as for
+           processMessage.
+
+           The default implementation calls processMessage for each packet
+           in turn; modules that can deliver a batch more cheaply than one
+           message at a time should override it.  (This method is only used
+           by SimpleModuleDeliveryQueue.)"""
+        results = []
+        for packet in packets:
+            try:
+                results.append(self.processMessage(packet))
+            except:
+                LOG.error_exc(sys.exc_info(),
+                              "Exception delivering message")
+                results.append(DELIVER_FAIL_NORETRY)
+        return results
+
     def sync(self):
         """Flush all pending data held by this module to disk."""
 
@@ -199,19 +228,31 @@ class SimpleModuleDeliveryQueue(mixminion.server.ServerQueue.DeliveryQueue):
         return 0
 
     def _deliverMessages(self, msgList):
+        # First, read all the packets, so that the module can deliver them
+        # as a single batch.
+        batch = []
         for handle in msgList:
             try:
-                dh = handle.getHandle() # display handle
                 EventStats.log.attemptedDelivery() #FFFF
                 try:
                     packet = handle.getMessage()
                 except mixminion.Filestore.CorruptedFile:
                     packet = None
                 if packet:
-                    result = self.module.processMessage(packet)
-                if not packet:
-                    pass # Python<2.1 doesn't allow 'continue' inside 'try'.
-                elif result == DELIVER_OK:
+                    batch.append((handle, packet))
+            except:
+                LOG.error_exc(sys.exc_info(),
+                                   "Exception delivering message")
+                handle.failed(0)
+                EventStats.log.unretriableDelivery() #FFFF
+        if not batch:
+            return
+
+        results = self.module.processMessages([p for _, p in batch])
+        for (handle, _), result in zip(batch, results):
+            try:
+                dh = handle.getHandle() # display handle
+                if result == DELIVER_OK:
                     LOG.debug("Successfully delivered message MOD:%s", dh)
                     handle.succeeded()
                     EventStats.log.successfulDelivery() #FFFF
@@ -232,9 +273,17 @@ class SimpleModuleDeliveryQueue(mixminion.server.ServerQueue.DeliveryQueue):
                 handle.failed(0)
                 EventStats.log.unretriableDelivery() #FFFF
 
+# Default number of batches each module may deliver at once.
+DEFAULT_DELIVERY_THREADS = 2
+# Default number of seconds we wait for a batch of messages to be
+# delivered before giving up on it and rescheduling its messages.
+DEFAULT_DELIVERY_TIMEOUT = 10*60
+
 class DeliveryThread(threading.Thread):
     """A thread object used by ModuleManager to send messages in the
-       background; delegates to ModuleManager._sendReadyMessages."""
+       background; delegates to ModuleManager._sendReadyMessages.  The
+       messages themselves are delivered by the ModuleManager's per-module
+       worker pools, so this thread never waits on a slow module."""
     ## Fields:
     # moduleManager -- a ModuleManager object.
     # event -- an Event that is set when we have messages to deliver, or
@@ -288,6 +337,16 @@ class ModuleManager:
 
        To send messages, call 'queueMessage' for each message to send, then
        call 'sendReadyMessages'.
+
+       When we're threading, every module whose queue supports
+       getReadyMessages gets its own WorkerPool, and may deliver up to
+       getMaxConcurrency() (or DeliveryThreads) batches at once.  On each
+       pass we visit the modules in order of priority, handing each one at
+       most as many batches as it has free threads, so that a slow module
+       only slows itself.  A batch that takes longer than DeliveryTimeout
+       stops counting against the module's limit, so the module can get
+       new work.  Since we can't interrupt a thread, the batch's messages
+       stay pending until it returns and reports how they went.
        """
     ##
     # Fields
@@ -303,6 +362,16 @@ class ModuleManager:
     #    _isConfigured: flag: has this modulemanager's configure method been
     #            called?
     #    thread: None, or a DeliveryThread object.
+    #    deliveryThreads: default number of batches each module may deliver
+    #            at once.
+    #    deliveryTimeout: number of seconds to wait for a batch before
+    #            giving up on it.
+    #    pools: a map from module name to the WorkerPool that delivers its
+    #            messages.
+    #    inFlight: a list of [deadline, module name, Future, list of
+    #            PendingMessage, timed-out flag] for every batch that
+    #            hasn't finished yet.
+    #    inFlightLock: a lock to protect 'inFlight'.
 
     def __init__(self):
         "Create a new ModuleManager"
@@ -325,6 +394,12 @@ class ModuleManager:
         self._isConfigured = 0
         self.thread = None
 
+        self.deliveryThreads = DEFAULT_DELIVERY_THREADS
+        self.deliveryTimeout = DEFAULT_DELIVERY_TIMEOUT
+        self.pools = {}
+        self.inFlight = []
+        self.inFlightLock = threading.Lock()
+
     def startThreading(self):
         """Begin delivering messages in a separate thread.  Should only
            be called once."""
@@ -398,6 +473,12 @@ class ModuleManager:
     def configure(self, config):
         self._setQueueRoot(os.path.join(config.getQueueDir(), 'deliver'))
         createPrivateDir(self.queueRoot)
+        server = config['Server']
+        self.deliveryThreads = server.get('DeliveryThreads',
+                                          DEFAULT_DELIVERY_THREADS)
+        t = server.get('DeliveryTimeout')
+        if t is not None:
+            self.deliveryTimeout = t.getSeconds()
         for m in self.modules:
             m.configure(config, self)
         self._isConfigured = 1
@@ -484,11 +565,107 @@ class ModuleManager:
         """Actual implementation of message delivery. Tells every module's
            queue to send pending messages.  This is called directly if
            we aren't threading, and from the delivery thread if we are."""
-        queuelist = [ (queue.getPriority(), queue)
-                      for queue in self.queues.values() ]
+        queuelist = [ (queue.getPriority(), name, queue)
+                      for name, queue in self.queues.items() ]
         queuelist.sort()
-        for _, queue in queuelist:
-            queue.sendReadyMessages()
+        if self.thread is None:
+            for _, _, queue in queuelist:
+                queue.sendReadyMessages()
+            return
+
+        now = time.time()
+        self._checkTimeouts(now)
+        for priority, name, queue in queuelist:
+            if priority < 0 or not hasattr(queue, 'getReadyMessages'):
+                # Queues with negative priority feed messages to other
+                # modules, so they must finish before we dispatch anything;
+                # queues without getReadyMessages deliver immediately.
+                queue.sendReadyMessages()
+            else:
+                self._dispatch(name, queue, now)
+
+    def _dispatch(self, name, queue, now):
+        """Helper: hand the ready messages in 'queue', which belongs to the
+           module called 'name', to the module's WorkerPool, split into as
+           many batches as the module has free threads.  Called from the
+           delivery thread."""
+        mod = self.nameToModule[name]
+        maxThreads = mod.getMaxConcurrency() or self.deliveryThreads
+        self.inFlightLock.acquire()
+        try:
+            nBusy = nStuck = 0
+            for b in self.inFlight:
+                if b[1] != name:
+                    continue
+                elif b[4]:
+                    nStuck += 1
+                else:
+                    nBusy += 1
+        finally:
+            self.inFlightLock.release()
+        free = maxThreads - nBusy
+        if free <= 0:
+            return
+        messages = queue.getReadyMessages(now)
+        if not messages:
+            return
+
+        # Batches that have timed out still hold their threads, so give
+        # the pool a thread for each of them.
+        pool = self.pools.get(name)
+        if pool is None:
+            pool = self.pools[name] = WorkerPool(
+                "%s delivery pool"%name, maxThreads=maxThreads+nStuck,
+                daemon=1)
+        else:
+            pool.setMaxThreads(maxThreads+nStuck)
+        nBatches = min(free, len(messages))
+        batchSize = ceilDiv(len(messages), nBatches)
+        for i in xrange(0, len(messages), batchSize):
+            batch = messages[i:i+batchSize]
+            entry = [ now+self.deliveryTimeout, name, None, batch, 0 ]
+            self.inFlightLock.acquire()
+            try:
+                self.inFlight.append(entry)
+            finally:
+                self.inFlightLock.release()
+            entry[2] = future = pool.submit(queue._deliverMessages, batch)
+            future.addDoneCallback(
+                lambda f, self=self, entry=entry: self._batchDone(entry))
+
+    def _batchDone(self, entry):
+        """Helper: called from a worker thread when the batch described by
+           'entry' (an element of inFlight) is finished."""
+        self.inFlightLock.acquire()
+        try:
+            if entry in self.inFlight:
+                self.inFlight.remove(entry)
+        finally:
+            self.inFlightLock.release()
+        if entry[4]:
+            LOG.info("Delayed batch of %s messages for module %s finished",
+                     len(entry[3]), entry[1])
+        # The module has a free thread now; see if there's more to do.
+        if self.thread is not None:
+            self.thread.beginSending()
+
+    def _checkTimeouts(self, now):
+        """Helper: stop counting every batch that has taken longer than
+           deliveryTimeout against its module's limit.  Its messages stay
+           pending until the batch returns, so that we never deliver a
+           message twice at once."""
+        self.inFlightLock.acquire()
+        try:
+            expired = [ b for b in self.inFlight
+                        if not b[4] and b[0] <= now ]
+            for b in expired:
+                b[4] = 1
+        finally:
+            self.inFlightLock.release()
+        for _, name, _, batch, _ in expired:
+            LOG.warn("Module %s has taken over %s seconds to deliver %s "
+                     "messages; no longer waiting for them.", name,
+                     self.deliveryTimeout, len(batch))
 
     def getServerInfoBlocks(self):
         """Return a list of strings that should be appended to the server
@@ -500,6 +677,25 @@ class ModuleManager:
 
     def close(self):
         """Release all resources held by all modules."""
+        self.inFlightLock.acquire()
+        try:
+            inFlight = self.inFlight[:]
+        finally:
+            self.inFlightLock.release()
+        if inFlight:
+            LOG.info("Waiting for %s batches of messages to be delivered",
+                     len(inFlight))
+        for deadline, name, future, batch, _ in inFlight:
+            try:
+                future.exception(max(deadline-time.time(), 0))
+            except FutureTimeout:
+                LOG.warn("Gave up waiting for module %s to deliver %s "
+                         "messages; will retry them on restart.",
+                         name, len(batch))
+        for pool in self.pools.values():
+            pool.shutdown(wait=0)
+        self.pools = {}
+
         for module in self.enabled.keys():
             mod = self.nameToModule[module]
             self.disableModule(mod)
@@ -1067,6 +1263,10 @@ class MBoxModule(DeliveryModule, MailBase):
     def getRetrySchedule(self):
         return self.retrySchedule
 
+    def getMaxConcurrency(self):
+        # Each delivery uses its own SMTP connection.
+        return None
+
     def getConfigSyntax(self):
         # FFFF There should be some way to say that fields are required
         # FFFF if the module is enabled.
@@ -1077,6 +1277,7 @@ class MBoxModule(DeliveryModule, MailBase):
                 'RemoveContact' : ('ALLOW', None, None),
                 'SMTPServer' : ('ALLOW', None, None),
                 'SendmailCommand' : ('ALLOW', "command", None),
+                'MaxConnections' : ('ALLOW', "int", "4"),
                 'Advertise' : ('ALLOW', "boolean", "yes")
               }
         cfg.update(MailBase.COMMON_OPTIONS)
@@ -1099,6 +1300,8 @@ class MBoxModule(DeliveryModule, MailBase):
         if (sec['SMTPServer'] is not None and
             sec['SendmailCommand'] is not None):
             raise ConfigError("Cannot specify both SMTPServer and SendmailCommand")
+        if sec['MaxConnections'] < 1:
+            raise ConfigError("MaxConnections in [Delivery/MBOX] must be at least 1")
 
         config.validateRetrySchedule("Delivery/MBOX")
 
@@ -1124,6 +1327,8 @@ class MBoxModule(DeliveryModule, MailBase):
         self.addr = config['Incoming/MMTP'].get('IP', "<Unknown IP>")
         self.maxMessageSize = _cleanMaxSize(sec['MaximumSize'],
                                             "Delivery/MBOX")
+        self.smtpWorkers = _newSMTPWorkerPool("MBOX", sec)
+        self.smtpPool = _newSMTPConnectionPool(sec)
 
         # These fields are needed by MailBase
         self.initializeHeaders(sec)
@@ -1176,7 +1381,10 @@ class MBoxModule(DeliveryModule, MailBase):
     def getExitTypes(self):
         return [ mixminion.Packet.MBOX_TYPE ]
 
-    def processMessage(self, packet): #message, tag, exitType, address):
+    def _prepareMessage(self, packet):
+        """Helper: return a (toList, fromAddr, message) tuple for the email
+           we should send for 'packet', or DELIVER_FAIL_NORETRY if we
+           shouldn't send one."""
         # Determine that message's address;
         assert packet.getExitType() == mixminion.Packet.MBOX_TYPE
         LOG.debug("Received MBOX message")
@@ -1191,9 +1399,23 @@ class MBoxModule(DeliveryModule, MailBase):
         msg = self._formatEmailMessage(address, packet)
         if not msg:
             return DELIVER_FAIL_NORETRY
+        return [address], self.returnAddress, msg
 
+    def processMessage(self, packet): #message, tag, exitType, address):
+        m = self._prepareMessage(packet)
+        if type(m) is not TupleType:
+            return m
         # Deliver the message
-        return sendSMTPMessage(self.cfgSection, [address], self.returnAddress, msg)
+        return sendSMTPMessage(self.cfgSection, m[0], m[1], m[2],
+                               self.smtpPool)
+
+    def processMessages(self, packets):
+        return sendSMTPBatch(self.cfgSection, self.smtpWorkers,
+                             _prepareAll(self._prepareMessage, packets),
+                             self.smtpPool)
+
+    def close(self):
+        _closeSMTPWorkerPool(self)
 
 #----------------------------------------------------------------------
 class SMTPModule(DeliveryModule, MailBase):
@@ -1233,6 +1455,10 @@ class DirectSMTPModule(SMTPModule):
     def getRetrySchedule(self):
         return self.retrySchedule
 
+    def getMaxConcurrency(self):
+        # Each delivery uses its own SMTP connection.
+        return None
+
     def getConfigSyntax(self):
         cfg = { 'Enabled' : ('REQUIRE', "boolean", "no"),
                 'Advertise' : ('ALLOW', "boolean", "yes"),
@@ -1241,6 +1467,7 @@ class DirectSMTPModule(SMTPModule):
                 'BlacklistFile' : ('ALLOW', "filename", None),
                 'SMTPServer' : ('ALLOW', None, None),
                 'SendmailCommand' : ('ALLOW', "command", None),
+                'MaxConnections' : ('ALLOW', "int", "4"),
                 }
         cfg.update(MailBase.COMMON_OPTIONS)
         return { "Delivery/SMTP" : cfg }
@@ -1261,6 +1488,8 @@ class DirectSMTPModule(SMTPModule):
         if (sec['SMTPServer'] is not None and
             sec['SendmailCommand'] is not None):
             raise ConfigError("Cannot specify both SMTPServer and SendmailCommand")
+        if sec['MaxConnections'] < 1:
+            raise ConfigError("MaxConnections in [Delivery/SMTP] must be at least 1")
 
         config.validateRetrySchedule("Delivery/SMTP")
 
@@ -1285,10 +1514,15 @@ class DirectSMTPModule(SMTPModule):
 
         self.maxMessageSize = _cleanMaxSize(sec['MaximumSize'],
                                             "Delivery/SMTP")
+        self.smtpWorkers = _newSMTPWorkerPool("SMTP", sec)
+        self.smtpPool = _newSMTPConnectionPool(sec)
 
         manager.enableModule(self)
 
-    def processMessage(self, packet):
+    def _prepareMessage(self, packet):
+        """Helper: return a (toList, fromAddr, message) tuple for the email
+           we should send for 'packet', or DELIVER_FAIL_NORETRY if we
+           shouldn't send one."""
         assert packet.getExitType() == mixminion.Packet.SMTP_TYPE
         LOG.debug("Received SMTP message")
         # parseSMTPInfo will raise a parse error if the mailbox is invalid.
@@ -1307,9 +1541,23 @@ class DirectSMTPModule(SMTPModule):
         msg = self._formatEmailMessage(address, packet)
         if not msg:
             return DELIVER_FAIL_NORETRY
+        return [address], self.returnAddress, msg
 
+    def processMessage(self, packet):
+        m = self._prepareMessage(packet)
+        if type(m) is not TupleType:
+            return m
         # Send the message.
-        return sendSMTPMessage(self.cfgSection, [address], self.returnAddress, msg)
+        return sendSMTPMessage(self.cfgSection, m[0], m[1], m[2],
+                               self.smtpPool)
+
+    def processMessages(self, packets):
+        return sendSMTPBatch(self.cfgSection, self.smtpWorkers,
+                             _prepareAll(self._prepareMessage, packets),
+                             self.smtpPool)
+
+    def close(self):
+        _closeSMTPWorkerPool(self)
 
 class MixmasterSMTPModule(SMTPModule):
     """Implements SMTP by relaying messages via Mixmaster nodes.  This
@@ -1374,6 +1622,11 @@ class MixmasterSMTPModule(SMTPModule):
     def getName(self):
         return "SMTP_MIX2"
 
+    def getMaxConcurrency(self):
+        # Mixmaster doesn't expect two copies of itself to flush its pool
+        # at once.
+        return 1
+
     def createDeliveryQueue(self, queueDir):
         # We create a temporary queue so we can hold files there for a little
         # while before passing their names to mixmaster.
@@ -1449,40 +1702,207 @@ def checkMailHeaders(headers):
 
 #----------------------------------------------------------------------
 
-def sendSMTPMessage(cfgSection, toList, fromAddr, message):
+# How long may an SMTP connection sit unused before we close it?
+SMTP_IDLE_TIMEOUT = 60
+# If an SMTP connection has been unused for this long, we make sure it's
+# still open before we send anything over it.
+SMTP_CHECK_AFTER = 10
+# How many messages do we send over a single SMTP connection before we
+# replace it?
+SMTP_MAX_MESSAGES_PER_CONNECTION = 100
+
+class SMTPConnectionPool:
+    """Keeps open connections to a single SMTP relay, so that we can send
+       many messages per session rather than opening a new connection for
+       each one.  Connections may be used from any thread, but only by one
+       thread at a time."""
+    ## Fields:
+    # server: the name of the SMTP relay.
+    # lock: a lock protecting 'idle'.
+    # idle: a list of [connection, time last used, number of messages sent]
+    #    for every open connection that nobody is using right now.
+    def __init__(self, server):
+        self.server = server
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def getConnection(self, fresh=0):
+        """Return a [connection, time last used, number of messages sent]
+           list for a connection that nobody else is using.  If 'fresh' is
+           true, or we have no idle connections, open a new connection.
+           Raises smtplib.SMTPException or socket.error on failure."""
+        while not fresh:
+            self.lock.acquire()
+            try:
+                if not self.idle:
+                    break
+                entry = self.idle.pop()
+            finally:
+                self.lock.release()
+            age = time.time() - entry[1]
+            if age > SMTP_IDLE_TIMEOUT:
+                _quitSMTP(entry[0])
+                continue
+            if age > SMTP_CHECK_AFTER:
+                try:
+                    ok = (entry[0].noop()[0] == 250)
+                except (smtplib.SMTPException, socket.error):
+                    ok = 0
+                if not ok:
+                    _quitSMTP(entry[0])
+                    continue
+            return entry
+        return [ smtplib.SMTP(self.server), time.time(), 0 ]
+
+    def releaseConnection(self, entry, ok=1):
+        """Return a connection from getConnection to the pool.  If 'ok' is
+           false, the connection is broken, and we close it instead."""
+        if not ok or entry[2] >= SMTP_MAX_MESSAGES_PER_CONNECTION:
+            _quitSMTP(entry[0])
+            return
+        entry[1] = time.time()
+        self.lock.acquire()
+        try:
+            self.idle.append(entry)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Close all idle connections."""
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = []
+        finally:
+            self.lock.release()
+        for con, _, _ in idle:
+            _quitSMTP(con)
+
+def _quitSMTP(con):
+    """Helper: politely close the SMTP connection 'con', ignoring errors."""
+    try:
+        con.quit()
+    except (smtplib.SMTPException, socket.error):
+        pass
+    con.close()
+
+def sendSMTPMessage(cfgSection, toList, fromAddr, message, pool):
     """Send a single SMTP message.  The message will be delivered to
-       toList, and seem to originate from fromAddr.  We use 'server' as an
-       MTA.
-       DOCDOC
+       toList, and seem to originate from fromAddr.  We use the
+       'SendmailCommand' from cfgSection if there is one; otherwise we
+       use its 'SMTPServer' (default: localhost) as an MTA, reusing an
+       open connection from the SMTPConnectionPool 'pool' if we have one.
+       Returns DELIVER_OK or DELIVER_FAIL_RETRY.
     """
-    # FFFF This implementation can stall badly if we don't have a fast
-    # FFFF local MTA.
-
-    # FFFF We should leave the connection open if we're going to send many
-    # FFFF messages in a row.
     if cfgSection['SendmailCommand'] is not None:
         cmd, opts = cfgSection['SendmailCommand']
         command = cmd + (" ".join(opts))
         f = os.popen(command, 'w')
         f.write(message)
         f.close()
-    else:
-        server = cfgSection.get('SMTPServer','localhost')
-        LOG.debug("Sending message via SMTP host %s to %s", server, toList)
-        con = smtplib.SMTP(server)
+        return DELIVER_OK
+
+    server = cfgSection.get('SMTPServer') or 'localhost'
+    LOG.debug("Sending message via SMTP host %s to %s", server, toList)
+    fresh = 0
+    while 1:
         try:
-            con.sendmail(fromAddr, toList, message)
-            res = DELIVER_OK
+            entry = pool.getConnection(fresh)
         except (smtplib.SMTPException, socket.error), e:
             LOG.warn("Unsuccessful SMTP connection to %s: %s",
                      server, str(e))
-            res = DELIVER_FAIL_RETRY
-
-        con.quit()
-        con.close()
+            return DELIVER_FAIL_RETRY
+        try:
+            entry[0].sendmail(fromAddr, toList, message)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                smtplib.SMTPDataError), e:
+            # The server refused this message, but the connection is fine.
+            LOG.warn("SMTP host %s refused message: %s", server, str(e))
+            pool.releaseConnection(entry)
+            return DELIVER_FAIL_RETRY
+        except (smtplib.SMTPException, socket.error), e:
+            pool.releaseConnection(entry, ok=0)
+            if entry[2] and not fresh:
+                # The server may have dropped a connection we were keeping
+                # open; try once more on a new one.
+                fresh = 1
+                continue
+            LOG.warn("Unsuccessful SMTP connection to %s: %s",
+                     server, str(e))
+            return DELIVER_FAIL_RETRY
+        entry[2] += 1
+        pool.releaseConnection(entry)
+        return DELIVER_OK
 
+def sendSMTPBatch(cfgSection, workers, messages, pool):
+    """Send a batch of SMTP messages, as sendSMTPMessage, using the threads
+       in the WorkerPool 'workers' and the connections in 'pool'.  Each
+       element of 'messages' is either a (toList, fromAddr, message) tuple,
+       or a DELIVER_* code for a message we've already given up on.
+       Returns a list of DELIVER_* codes, one for each element of
+       'messages'."""
+    results = [None] * len(messages)
+    toSend = []
+    for i in xrange(len(messages)):
+        if type(messages[i]) is TupleType:
+            toSend.append(i)
+        else:
+            results[i] = messages[i]
+
+    if len(toSend) == 1:
+        # Not worth handing a single message to another thread.
+        i = toSend[0]
+        toList, fromAddr, msg = messages[i]
+        results[i] = sendSMTPMessage(cfgSection, toList, fromAddr, msg, pool)
+        return results
+
+    futures = []
+    for i in toSend:
+        toList, fromAddr, msg = messages[i]
+        futures.append((i, workers.submit(sendSMTPMessage, cfgSection,
+                                          toList, fromAddr, msg, pool)))
+    for i, future in futures:
+        # (The worker pool has already logged any exception.)
+        if future.exception() is not None:
+            results[i] = DELIVER_FAIL_NORETRY
+        else:
+            results[i] = future.result()
+    return results
+
+def _prepareAll(prepareFn, packets):
+    """Helper: call prepareFn on every packet in 'packets', and return a
+       list of the results.  If prepareFn raises an exception, log it and
+       use DELIVER_FAIL_NORETRY instead."""
+    res = []
+    for p in packets:
+        try:
+            res.append(prepareFn(p))
+        except:
+            LOG.error_exc(sys.exc_info(), "Exception delivering message")
+            res.append(DELIVER_FAIL_NORETRY)
     return res
 
+def _newSMTPWorkerPool(name, cfgSection):
+    """Helper: return a new WorkerPool to send the SMTP messages of the
+       module called 'name', configured by cfgSection."""
+    return WorkerPool("%s delivery pool"%name,
+                      maxThreads=cfgSection.get('MaxConnections', 4),
+                      maxIdle=SMTP_IDLE_TIMEOUT, daemon=1)
+
+def _newSMTPConnectionPool(cfgSection):
+    """Helper: return a new SMTPConnectionPool for the SMTP relay named in
+       cfgSection, for the use of a single module."""
+    return SMTPConnectionPool(cfgSection.get('SMTPServer') or 'localhost')
+
+def _closeSMTPWorkerPool(module):
+    """Helper: shut down the worker pool used by 'module', and close its
+       SMTP connections.  (Other modules' connections stay open.)"""
+    if getattr(module, 'smtpWorkers', None) is not None:
+        module.smtpWorkers.shutdown(wait=1)
+        module.smtpWorkers = None
+    if getattr(module, 'smtpPool', None) is not None:
+        module.smtpPool.close()
+
 #----------------------------------------------------------------------
 
 def _wrapHeader(text):
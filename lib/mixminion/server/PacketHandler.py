@@ -16,6 +16,22 @@ from mixminion.Common import MixError, MixFatalError, isPrintingAscii
 
 __all__ = [ 'PacketHandler', 'ContentError', 'DeliveryPacket', 'RelayedPacket']
 
+# The keys that processPacket derives from each subheader's master secret,
+# in the order it unpacks them.  We derive them all in one call to
+# _minionlib, even though a dropped packet only needs the first.
+_PACKET_KEY_MODES = (
+    (Crypto.REPLAY_PREVENTION_MODE, Crypto.DIGEST_LEN),
+    (Crypto.HEADER_SECRET_MODE, 'aes'),
+    (Crypto.RANDOM_JUNK_MODE, 'aes'),
+    (Crypto.PAYLOAD_ENCRYPT_MODE, 'lioness'),
+    (Crypto.HEADER_ENCRYPT_MODE, 'lioness'),
+    (Crypto.APPLICATION_KEY_MODE, Crypto.AES_KEY_LEN) )
+
+# True iff we can decrypt packets in place in a PacketBuffer.  (Older
+# Pythons build a new string at each step instead.)
+_DECRYPT_IN_PLACE = (Packet.HAVE_PACKET_BUFFER and
+                     Crypto.lioness_decrypt_inplace is not None)
+
 class ContentError(MixError):
     """Exception raised when a packed is malformatted or unacceptable."""
     pass
@@ -105,9 +121,14 @@ class PacketHandler:
            packets, and exit packets are all processed faster than
            forwarded packets.  You must prevent timing attacks elsewhere."""
 
-        # Break into headers and payload
-        pkt = Packet.parsePacket(msg)
-        header1 = Packet.parseHeader(pkt.header1)
+        # Break into headers and payload.  If we can, copy the packet into
+        # a buffer that we can decrypt in place.
+        if _DECRYPT_IN_PLACE:
+            pkt = Packet.PacketBuffer(msg)
+            header1 = Packet.parseHeader(pkt.getHeader1())
+        else:
+            pkt = Packet.parsePacket(msg)
+            header1 = Packet.parseHeader(pkt.header1)
         encSubh = header1[:Packet.ENC_SUBHEADER_LEN]
         header1 = header1[Packet.ENC_SUBHEADER_LEN:]
 
@@ -146,11 +167,12 @@ class PacketHandler:
         if subh.digest != Crypto.sha1(header1):
             raise ContentError("Invalid digest")
 
-        # Get ready to generate packet keys.
-        keys = Crypto.Keyset(subh.secret)
+        # Generate the packet keys.  The AES keys come back already
+        # expanded, since we use the header key more than once.
+        (replayhash, header_sec_key, junk_key, payloadKeys, headerKeys,
+         appKey) = Crypto.Keyset(subh.secret).getKeys(_PACKET_KEY_MODES)
 
         # Replay prevention
-        replayhash = keys.get(Crypto.REPLAY_PREVENTION_MODE, Crypto.DIGEST_LEN)
         if hashlog.seenHash(replayhash):
             raise ContentError("Duplicate packet detected.")
         else:
@@ -161,13 +183,6 @@ class PacketHandler:
         if rt == Packet.DROP_TYPE:
             return None
 
-        # Prepare the key to decrypt the header in counter mode.  We'll be
-        # using this more than once.
-        header_sec_key = Crypto.aes_key(keys.get(Crypto.HEADER_SECRET_MODE))
-
-        # Prepare key to generate padding
-        junk_key = Crypto.aes_key(keys.get(Crypto.RANDOM_JUNK_MODE))
-
         # Pad the rest of header 1
         header1 += Crypto.prng(junk_key,
                                Packet.OAEP_OVERHEAD + Packet.MIN_SUBHEADER_LEN
@@ -197,16 +212,70 @@ class PacketHandler:
 
         assert len(header1) == Packet.HEADER_LEN
 
+        if _DECRYPT_IN_PLACE:
+            return self._finishInPlace(pkt, subh, header1, payloadKeys,
+                                       headerKeys, appKey)
+        else:
+            return self._finishWithCopies(pkt, subh, header1, payloadKeys,
+                                          headerKeys, appKey)
+
+    def _finishInPlace(self, pkt, subh, header1, payloadKeys, headerKeys,
+                       appKey):
+        """Helper: finish processing the PacketBuffer 'pkt', given its
+           parsed subheader, the new contents of its first header, and its
+           keys.  Return as for processPacket."""
+        rt = subh.routingtype
+
+        # Decrypt the payload.
+        Crypto.lioness_decrypt_inplace(pkt.payload, payloadKeys)
+
+        # If we're an exit node, there's no need to process the headers
+        # further.
+        if rt >= Packet.MIN_EXIT_TYPE:
+            return DeliveryPacket(rt, subh.getExitAddress(0), appKey,
+                                  pkt.getPayload())
+
+        # If we're not an exit node, make sure that what we recognize our
+        # routing type.
+        if rt not in (Packet.SWAP_FWD_IPV4_TYPE, Packet.FWD_IPV4_TYPE,
+                      Packet.SWAP_FWD_HOST_TYPE, Packet.FWD_HOST_TYPE):
+            raise ContentError("Unrecognized Mixminion routing type")
+
+        # Decrypt header 2.
+        Crypto.lioness_decrypt_inplace(pkt.header2, headerKeys)
+        pkt.setHeader1(header1)
+
+        # If we're the swap node, (1) decrypt the payload with a hash of
+        # header2... (2) decrypt header2 with a hash of the payload...
+        # (3) and swap the headers.
+        if Packet.typeIsSwap(rt):
+            hkey = Crypto.lioness_keys_from_header(pkt.getHeader2Buffer())
+            Crypto.lioness_decrypt_inplace(pkt.payload, hkey)
+
+            hkey = Crypto.lioness_keys_from_payload(pkt.getPayloadBuffer())
+            Crypto.lioness_decrypt_inplace(pkt.header2, hkey)
+
+            pkt.swapHeaders()
+
+        # Build the address object for the next hop
+        address = Packet.parseRelayInfoByType(rt, subh.routinginfo)
+
+        # The buffer now holds the packet for the next hop.
+        return RelayedPacket(address, pkt.pack())
+
+    def _finishWithCopies(self, pkt, subh, header1, payloadKeys, headerKeys,
+                          appKey):
+        """Helper: as _finishInPlace, but for a Packet object.  We use this
+           on Pythons too old for PacketBuffer."""
+        rt = subh.routingtype
+
         # Decrypt the payload.
-        payload = Crypto.lioness_decrypt(pkt.payload,
-                              keys.getLionessKeys(Crypto.PAYLOAD_ENCRYPT_MODE))
+        payload = Crypto.lioness_decrypt(pkt.payload, payloadKeys)
 
         # If we're an exit node, there's no need to process the headers
         # further.
         if rt >= Packet.MIN_EXIT_TYPE:
-            return DeliveryPacket(rt, subh.getExitAddress(0),
-                                  keys.get(Crypto.APPLICATION_KEY_MODE),
-                                  payload)
+            return DeliveryPacket(rt, subh.getExitAddress(0), appKey, payload)
 
         # If we're not an exit node, make sure that what we recognize our
         # routing type.
@@ -215,8 +284,7 @@ class PacketHandler:
             raise ContentError("Unrecognized Mixminion routing type")
 
         # Decrypt header 2.
-        header2 = Crypto.lioness_decrypt(pkt.header2,
-                           keys.getLionessKeys(Crypto.HEADER_ENCRYPT_MODE))
+        header2 = Crypto.lioness_decrypt(pkt.header2, headerKeys)
 
         # If we're the swap node, (1) decrypt the payload with a hash of
         # header2... (2) decrypt header2 with a hash of the payload...
@@ -104,6 +104,31 @@ class ServerConfig(mixminion.Config._ConfigFile):
 
         self.validateRetrySchedule("Outgoing/MMTP")
 
+        if self['Server'].get('LogRateLimit', 0) < 0:
+            raise ConfigError("LogRateLimit must not be negative.")
+        for k in ('MaxBandwidthIn', 'MaxBandwidthOut',
+                  'MaxBandwidthPerPeer'):
+            bw = self['Server'].get(k)
+            if bw is not None and bw < 4096:
+                raise ConfigError("%s must be at least 4KB."%k)
+        if self['Server'].get('DeliveryThreads', 1) < 1:
+            raise ConfigError("DeliveryThreads must be at least 1.")
+        if self['Server'].get('IncomingRingSlots', 0) < 0:
+            raise ConfigError("IncomingRingSlots must not be negative.")
+        dt = self['Server'].get('DeliveryTimeout')
+        if dt is not None and dt.getSeconds() < 1:
+            raise ConfigError("DeliveryTimeout must be at least 1 second.")
+
+        maxPending = self['Incoming/MMTP'].get('MaxPendingPackets')
+        resumePending = self['Incoming/MMTP'].get('ResumePendingPackets')
+        if maxPending is not None and maxPending < 0:
+            raise ConfigError("MaxPendingPackets must not be negative.")
+        if resumePending is not None:
+            if not maxPending:
+                raise ConfigError("ResumePendingPackets requires MaxPendingPackets.")
+            if not 0 <= resumePending < maxPending:
+                raise ConfigError("ResumePendingPackets must be less than MaxPendingPackets.")
+
         self.moduleManager.validate(self, lines, contents)
 
     def __loadModules(self, section, sectionEntries):
@@ -300,6 +325,15 @@ def _parseMixRule(s):
         raise ConfigError("Unrecognized mix algorithm %s"%s)
     return v
 
+def _parseOverloadPolicy(s):
+    """Validation function.  Converts a config value to a policy for
+       incoming packets when we're overloaded (one of 'stall' or
+       'reject').  Raises ConfigError on failure."""
+    p = s.strip().lower()
+    if p not in ('stall', 'reject'):
+        raise ConfigError("OverloadPolicy must be 'Stall' or 'Reject'")
+    return p
+
 def _parseFraction(frac):
     """Validation function.  Converts a percentage or a number into a
        number between 0 and 1."""
@@ -331,6 +365,8 @@ SERVER_SYNTAX =  {
 
                      'LogLevel' : ('ALLOW', "severity", "WARN"),
                      'EchoMessages' : ('ALLOW', "boolean", "no"),
+                     'AsyncLog' : ('ALLOW', "boolean", "yes"),
+                     'LogRateLimit' : ('ALLOW', "int", "100"),
                      'Daemon' : ('ALLOW', "boolean", "no"),
                      'LogStats' : ('ALLOW', "boolean", 'yes'),
                      'StatsInterval' : ('ALLOW', "interval",
@@ -354,8 +390,14 @@ SERVER_SYNTAX =  {
                      'MixPoolRate' : ('ALLOW', "fraction", "60%"),
                      'MixPoolMinSize' : ('ALLOW', "int", "5"),
 		     'Timeout' : ('ALLOW', "interval", "5 min"),
+                     'DeliveryThreads' : ('ALLOW', "int", "2"),
+                     'DeliveryTimeout' : ('ALLOW', "interval", "10 min"),
+                     'IncomingRingSlots' : ('ALLOW', "int", "256"),
                      'MaxBandwidth' : ('ALLOW', "size", None),
                      'MaxBandwidthSpike' : ('ALLOW', "size", None),
+                     'MaxBandwidthIn' : ('ALLOW', "size", None),
+                     'MaxBandwidthOut' : ('ALLOW', "size", None),
+                     'MaxBandwidthPerPeer' : ('ALLOW', "size", None),
                      },
         #DOCDOC
         'Pinging' : { 'Enabled' : ('ALLOW', 'boolean', 'yes'),
@@ -384,6 +426,10 @@ SERVER_SYNTAX =  {
                           'ListenIP' : ('ALLOW', "IP", None),
                           'ListenPort' : ('ALLOW', "int", None),
                           'ListenIP6' : ('ALLOW', "IP6", None),
+                          'MaxPendingPackets' : ('ALLOW', "int", "1000"),
+                          'ResumePendingPackets' : ('ALLOW', "int", None),
+                          'OverloadPolicy' : ('ALLOW', "overloadPolicy",
+                                              "stall"),
   		          'Allow' : ('ALLOW*', "addressSet_allow", None),
                           'Deny' : ('ALLOW*', "addressSet_deny", None)
 			 },
@@ -391,6 +437,8 @@ SERVER_SYNTAX =  {
                             'Retry' : ('ALLOW', "intervalList",
                               "every 1 hour for 1 day, 7 hours for 5 days"),
                            'MaxConnections' : ('ALLOW', 'int', '16'),
+                           'AsyncDNS' : ('ALLOW', 'boolean', 'yes'),
+                           'Nameserver' : ('ALLOW*', 'IP', None),
                            'Allow' : ('ALLOW*', "addressSet_allow", None),
                            'Deny' : ('ALLOW*', "addressSet_deny", None) },
         # FFFF Missing: Queue-Size / Queue config options
@@ -399,5 +447,6 @@ SERVER_SYNTAX =  {
 
 CODING_FNS = mixminion.Config._ConfigFile.CODING_FNS.copy()
 CODING_FNS.update({'mixRule':(_parseMixRule,str),
+                   'overloadPolicy':(_parseOverloadPolicy,str),
                    'fraction':(_parseFraction,
                                lambda r: "%.2f%%"%(100.*r))})
@@ -150,19 +150,30 @@ class IncomingQueue(mixminion.Filestore.StringStore):
     """A Queue to accept packets from incoming MMTP connections,
        and hold them until they can be processed.  As packets arrive, and
        are stored to disk, we notify a MessageQueue so that another thread
-       can read them."""
+       can read them.
+
+       Packets go into a memory-mapped RingStore when it has room, and
+       into files in the queue directory otherwise."""
     ## Fields:
     # packetHandler -- an instance of PacketHandler.
     # mixPool -- an instance of MixPool
     # processingThread -- an instance of ProcessingThread
     # pingLog -- an instance of pingLog, or None
-    def __init__(self, location, packetHandler):
+    # ring -- an instance of RingStore, or None if we only use files.
+    def __init__(self, location, packetHandler, ringSlots=0):
         """Create an IncomingQueue that stores its packets in <location>
-           and processes them through <packetHandler>."""
+           and processes them through <packetHandler>.  If <ringSlots> is
+           positive, keep up to that many packets in a ring file."""
         mixminion.Filestore.StringStore.__init__(self, location, create=1)
         self.packetHandler = packetHandler
         self.mixPool = None
         self.pingLog = None
+        if ringSlots > 0:
+            self.ring = mixminion.Filestore.RingStore(
+                os.path.join(location, "ring"), mixminion.Packet.PACKET_LEN,
+                ringSlots)
+        else:
+            self.ring = None
 
     def connectQueues(self, mixPool, processingThread):
         """Sets the target mix queue"""
@@ -171,7 +182,18 @@ class IncomingQueue(mixminion.Filestore.StringStore):
         for h in self.getAllMessages():
             assert h is not None
             self.processingThread.addJob(
-                lambda self=self, h=h: self.__deliverPacket(h))
+                lambda self=self, h=h: self.__deliverPacket(self, h))
+        if self.ring is not None:
+            for h in self.ring.getAllMessages():
+                self.processingThread.addJob(
+                    lambda self=self, h=h: self.__deliverPacket(self.ring, h))
+
+    def count(self, recount=0):
+        """Return the number of packets waiting in this queue."""
+        n = mixminion.Filestore.StringStore.count(self, recount)
+        if self.ring is not None:
+            n += self.ring.count()
+        return n
 
     def setPingLog(self, pingLog):
         """Configure this queue to inform 'pingLog' about received
@@ -181,28 +203,44 @@ class IncomingQueue(mixminion.Filestore.StringStore):
 
     def queuePacket(self, pkt):
         """Add a packet for delivery"""
-        h = mixminion.Filestore.StringStore.queueMessage(self, pkt)
+        store = self.ring
+        if store is not None:
+            h = store.queueMessage(pkt)
+        if store is None or h is None:
+            store = self
+            h = mixminion.Filestore.StringStore.queueMessage(self, pkt)
         LOG.trace("Inserting packet IN:%s into incoming queue", h)
         assert h is not None
         self.processingThread.addJob(
-            lambda self=self, h=h: self.__deliverPacket(h))
+            lambda self=self, store=store, h=h: self.__deliverPacket(store, h))
 
     def queueMessage(self, m):
         # Never call this directly.
         assert 0
 
-    def __deliverPacket(self, handle):
-        """Process a single packet with a given handle, and insert it into
-           the Mix pool.  This function is called from within the processing
-           thread."""
+    def cleanQueue(self, secureDeleteFn=None):
+        mixminion.Filestore.StringStore.cleanQueue(self, secureDeleteFn)
+        if self.ring is not None:
+            self.ring.sync()
+
+    def close(self):
+        """Release the ring file, if any."""
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+    def __deliverPacket(self, store, handle):
+        """Process a single packet with a given handle in 'store' (either
+           this queue or its ring), and insert it into the Mix pool.  This
+           function is called from within the processing thread."""
         ph = self.packetHandler
-        packet = self.messageContents(handle)
+        packet = store.messageContents(handle)
         try:
             res = ph.processPacket(packet)
             if res is None:
                 # Drop padding before it gets to the mix.
                 LOG.debug("Padding packet IN:%s dropped", handle)
-                self.removeMessage(handle)
+                store.removeMessage(handle)
             else:
                 if res.isDelivery():
                     if res.getExitType() == mixminion.Packet.PING_TYPE:
@@ -212,36 +250,39 @@ class IncomingQueue(mixminion.Filestore.StringStore):
                             self.pingLog.gotPing(digest)
                         else:
                             LOG.debug("Pinging not enabled; discarding packet")
-                        self.removeMessage(handle)
+                        store.removeMessage(handle)
                         return
                     else:
                         #XXXX008 defer decoding to module; don't do it here.
                         res.decode()
 
                 self.mixPool.queueObject(res)
-                self.removeMessage(handle)
+                store.removeMessage(handle)
                 LOG.debug("Processed packet IN:%s; inserting into mix pool",
                           handle)
         except mixminion.Crypto.CryptoError, e:
             LOG.warn("Invalid PK or misencrypted header in packet IN:%s: %s",
                      handle, e)
-            self.removeMessage(handle)
+            store.removeMessage(handle)
         except mixminion.Packet.ParseError, e:
             LOG.warn("Malformed packet IN:%s dropped: %s", handle, e)
-            self.removeMessage(handle)
+            store.removeMessage(handle)
         except mixminion.server.PacketHandler.ContentError, e:
             LOG.warn("Discarding bad packet IN:%s: %s", handle, e)
-            self.removeMessage(handle)
+            store.removeMessage(handle)
         except:
             LOG.error_exc(sys.exc_info(),
                     "Unexpected error when processing IN:%s", handle)
-            self.removeMessage(handle)
+            store.removeMessage(handle)
 
 class MixPool:
     """Wraps a mixminion.server.ServerQueue.*MixPool to send packets
        to an exit queue and a delivery queue.  The files in the
        MixPool are instances of RelayedPacket or DeliveryPacket from
-       PacketHandler.
+       PacketHandler.  The metadata for a RelayedPacket is its address;
+       for anything else it is None.  This lets us hand relayed packets to
+       the outgoing queue by renaming their files, without unpickling
+       them.
 
        All methods on this class are invoked from the main thread.
     """
@@ -284,7 +325,10 @@ class MixPool:
 
     def queueObject(self, obj):
         """Insert an object into the pool."""
-        return self.queue.queueObject(obj)
+        if obj.isDelivery():
+            return self.queue.queueObject(obj)
+        else:
+            return self.queue.queueObject(obj, obj.getAddress())
 
     def count(self):
         "Return the number of packets in the pool"
@@ -307,6 +351,20 @@ class MixPool:
                   self.queue.count(), len(handles))
 
         for h in handles:
+            try:
+                address = self.queue.getMetadata(h)
+            except (KeyError, mixminion.Filestore.CorruptedFile):
+                continue
+            if address is not None:
+                try:
+                    h2 = self.outgoingQueue.moveDeliveryMessage(
+                        self.queue, h, address)
+                    LOG.debug("  (moving packet MIX:%s to MMTP server as OUT:%s)"
+                              , h, h2)
+                    continue
+                except OSError, e:
+                    LOG.warn("Couldn't move packet MIX:%s to MMTP server: %s",
+                             h, e)
             try:
                 packet = self.queue.getObject(h)
             except mixminion.Filestore.CorruptedFile:
@@ -430,7 +488,8 @@ class _MMTPServer(mixminion.server.MMTPServer.MMTPAsyncServer):
 class CleaningThread(threading.Thread):
     """Thread that handles file deletion.  Some methods of secure deletion
        are slow enough that they'd block the server if we did them in the
-       main thread.
+       main thread.  We gather up everything that's been scheduled since
+       our last pass, and delete it in as few batches as we can.
     """
     # Fields:
     #   mqueue: A ClearableQueue holding lists of filenames to delete,
@@ -623,7 +682,9 @@ class MixminionServer(Scheduler):
         LOG.debug("Initializing directory client")
         self.dirClient = mixminion.ClientDirectory.ClientDirectory(config)
         try:
-            self.dirClient.update()
+            self.dirClient.updateInBackground(
+                onDone=lambda err, self=self:
+                       self._directoryUpdated(err, 0, background=1))
         except UIError, e:
             LOG.warn(str(e))
             LOG.warn("   (I'll use the old directory until I have a new one.)")
@@ -643,7 +704,9 @@ class MixminionServer(Scheduler):
 
         incomingDir = os.path.join(queueDir, "incoming")
         LOG.debug("Initializing incoming queue")
-        self.incomingQueue = IncomingQueue(incomingDir, self.packetHandler)
+        self.incomingQueue = IncomingQueue(
+            incomingDir, self.packetHandler,
+            ringSlots=config['Server'].get('IncomingRingSlots', 0))
         LOG.debug("Found %d pending packets in incoming queue",
                   self.incomingQueue.count())
 
@@ -683,8 +746,22 @@ class MixminionServer(Scheduler):
 
         self.cleaningThread = CleaningThread()
         self.processingThread = ProcessingThread()
-
-        self.dnsCache = mixminion.server.DNSFarm.DNSCache()
+        maxPending = config['Incoming/MMTP'].get('MaxPendingPackets')
+        if maxPending:
+            self.processingThread.setWatermarks(maxPending,
+                  config['Incoming/MMTP'].get('ResumePendingPackets'))
+
+        resolver = None
+        if config['Outgoing/MMTP'].get('AsyncDNS', 1):
+            nameservers = (config['Outgoing/MMTP'].get('Nameserver') or
+                           mixminion.server.DNSFarm.readResolvConf())
+            if nameservers:
+                LOG.debug("Resolving hostnames with nameservers at %s",
+                          ", ".join(nameservers))
+                resolver = mixminion.server.DNSFarm.AsyncResolver(nameservers)
+            else:
+                LOG.info("No IPv4 nameservers configured; resolving hostnames in background threads.")
+        self.dnsCache = mixminion.server.DNSFarm.DNSCache(resolver=resolver)
 
         LOG.debug("Connecting queues")
         self.incomingQueue.connectQueues(mixPool=self.mixPool,
@@ -750,25 +827,49 @@ class MixminionServer(Scheduler):
             self.keyring.unlock()
 
     def updateDirectoryClient(self, reschedulePings=1):
+        """Make sure our directory is up to date, and return the time when
+           we should next check it.  If we already have a directory, the
+           new one is fetched in the background, so that neither packet
+           processing nor the main loop ever waits for the network."""
         try:
-            self.dirClient.update()
-            nextUpdate = succeedingMidnight(time.time()+30)
-            prng = mixminion.Crypto.getCommonPRNG()
-            # Randomly retrieve the directory within an hour after
-            # midnight, to avoid hosing the server.
-            nextUpdate += prng.getInt(60)*60
-        except mixminion.ClientDirectory.DirectoryDownloadError, e:
-            LOG.warn(str(e))
-            LOG.warn("    I'll try again in an hour.")
-            nextUpdate = min(succeedingMidnight(time.time()+30),
-                             time.time()+3600)
-            reschedulePings = 0
+            if self.dirClient.updateInBackground(
+                onDone=lambda err, self=self, r=reschedulePings:
+                       self._directoryUpdated(err, r, background=1)):
+                return self._getNextDirectoryUpdate()
         except UIError, e:#XXXX008 This should really be a new exception
             LOG.warn(str(e))
+            return self._directoryUpdated(e, reschedulePings)
+        return self._directoryUpdated(None, reschedulePings)
+
+    def _getNextDirectoryUpdate(self):
+        """Helper: return the time when we should next fetch a directory."""
+        nextUpdate = succeedingMidnight(time.time()+30)
+        prng = mixminion.Crypto.getCommonPRNG()
+        # Randomly retrieve the directory within an hour after
+        # midnight, to avoid hosing the server.
+        nextUpdate += prng.getInt(60)*60
+        return nextUpdate
+
+    def _directoryUpdated(self, err, reschedulePings=1, background=0):
+        """Called when an attempt to update the directory has finished.
+           'err' is None on success, and the exception that stopped us
+           otherwise.  Returns the time when we should next fetch a
+           directory.  If 'background' is true, we're being called from
+           the thread that did the update, so nobody will look at our
+           return value: schedule any retry ourselves."""
+        if err is not None:
             LOG.warn("    I'll try again in an hour.")
             nextUpdate = min(succeedingMidnight(time.time()+30),
                              time.time()+3600)
-            reschedulePings = 0
+            if background:
+                self.scheduleEvent(OneTimeEvent(
+                    nextUpdate,
+                    lambda self=self: self.updateDirectoryClient(0)))
+            return nextUpdate
+
+        nextUpdate = self._getNextDirectoryUpdate()
+
+        self.prefetchHostnames()
 
         if reschedulePings:
             if self.pingGenerator:
@@ -780,6 +881,21 @@ class MixminionServer(Scheduler):
 
         return nextUpdate
 
+    def prefetchHostnames(self):
+        """Begin resolving the hostname of every server in the directory
+           that hasn't expired, so that we don't have to wait for DNS when
+           we relay packets to them."""
+        now = time.time()
+        names = {}
+        for s in self.dirClient.getAllServers():
+            hostname = s.getHostname()
+            if hostname and not s.isExpiredAt(now):
+                names[hostname.lower()] = 1
+        n = self.dnsCache.prefetch(names.keys())
+        stats = self.dnsCache.getStats()
+        LOG.info("Prefetching DNS for %s of %s server hostnames.  So far, %d%% of %s lookups were cache hits.",
+                 n, len(names), int(stats['hitRate']*100), stats['lookups'])
+
     def run(self):
         """Run the server; don't return unless we hit an exception."""
         global GOT_HUP
@@ -804,6 +920,11 @@ class MixminionServer(Scheduler):
                 EventStats.log.getNextRotation(),
                 _rotateStats))
 
+        self.scheduleEvent(RecurringEvent(
+            now+mixminion.server.DNSFarm.REFRESH_INTERVAL,
+            self.dnsCache.refreshExpiring,
+            mixminion.server.DNSFarm.REFRESH_INTERVAL))
+
         def _tryTimeout(self=self):
             self.mmtpServer.tryTimeout()
             self.dnsCache.cleanCache()
@@ -873,9 +994,18 @@ class MixminionServer(Scheduler):
         while 1:
             now = time.time()
             nextEvent = now + SCHEDULE_INTERVAL
+            # Wake up early if an event (such as a short mix interval) is
+            # due before then.
+            firstEvent = self.firstEventTime()
+            if 0 < firstEvent < nextEvent:
+                nextEvent = firstEvent
             timeLeft = SCHEDULE_INTERVAL
             nextTick = now+TICK_INTERVAL
             while timeLeft > 0:
+                # Stop taking new packets while the processing thread is
+                # too far behind.
+                self.mmtpServer.setOverloaded(
+                    self.processingThread.isCongested())
                 # Handle pending network events
                 self.mmtpServer.process(TICK_INTERVAL)
                 # Check for signals
@@ -971,6 +1101,7 @@ class MixminionServer(Scheduler):
         self.processingThread.shutdown()
         self.moduleManager.shutdown()
         if self.databaseThread: self.databaseThread.shutdown(flush=0)
+        self.dnsCache.shutdown(wait=1)
 
         self.cleaningThread.join()
         self.processingThread.join()
@@ -978,6 +1109,7 @@ class MixminionServer(Scheduler):
         if self.databaseThread: self.databaseThread.join()
 
         self.packetHandler.close()
+        self.incomingQueue.close()
         self.moduleManager.close()
         self.outgoingQueue.close()
         if self.pingLog:
@@ -996,6 +1128,11 @@ def daemonize():
     if sys.platform == 'win32':
         raise UIError("Daemon mode is not supported on win32.")
 
+    # Stop the log's writer thread, if any: if we forked while it held the
+    # log's lock, the child would never be able to log.  (The log is
+    # reconfigured when the main loop starts.)
+    LOG.setAsync(0)
+
     # This logic is more-or-less verbatim from Stevens's _Advanced
     # Programming in the Unix Environment_:
 
@@ -172,12 +172,16 @@ class PendingMessage:
     def succeeded(self,now=None):
         """Mark this message as having been successfully deleted, removing
            it from the queue."""
+        if self.queue is None:
+            return
         self.queue.deliverySucceeded(self.handle,now=now)
         self.queue = self.message = None
 
     def failed(self, retriable=0, now=None):
         """Mark this message as has having failed delivery, either rescheduling
            it or removing it from the queue."""
+        if self.queue is None:
+            return
         self.queue.deliveryFailed(self.handle, retriable, now=now)
         self.queue = self.message = None
 
@@ -331,6 +335,26 @@ class DeliveryQueue:
 
         return handle
 
+    def moveDeliveryMessage(self, store, handle, address=None, now=None):
+        """Schedule the message 'handle' from the filestore 'store' for
+           delivery, by moving its file into this queue rather than by
+           reading and rewriting it.  The message must be a pickled object
+           of the kind this queue delivers.  Raises OSError if the file
+           can't be moved.
+        """
+        assert self.retrySchedule is not None
+        try:
+            self._lock.acquire()
+            ds = _DeliveryState(now,None,address)
+            ds.setNextAttempt(self.retrySchedule, now)
+            newHandle = store.moveMessageTo(handle, self.store, ds)
+            LOG.trace("DeliveryQueue got message %s for %s",
+                      newHandle, self.qname)
+        finally:
+            self._lock.release()
+
+        return newHandle
+
     def _inspect(self,handle):
         """Returns a (msg, inserted, lastAttempt, nextAttempt) tuple
            for a given message handle.  For testing. """
@@ -357,6 +381,14 @@ class DeliveryQueue:
     def sendReadyMessages(self, now=None):
         """Sends all messages which are not already being sent, and which
            are scheduled to be sent."""
+        self._deliverMessages(self.getReadyMessages(now))
+        self._repOK()
+
+    def getReadyMessages(self, now=None):
+        """Return a list of PendingMessage objects for all messages which
+           are not already being sent, and which are scheduled to be sent,
+           and mark them as pending.  The caller must pass them to
+           _deliverMessages."""
         assert self.retrySchedule is not None
         self._repOK()
         if now is None:
@@ -391,8 +423,7 @@ class DeliveryQueue:
         finally:
             self._lock.release()
 
-        self._deliverMessages(messages)
-        self._repOK()
+        return messages
 
     def _deliverMessages(self, msgList):
         """Abstract method; Invoked with a list of PendingMessage objects
@@ -664,7 +695,11 @@ class PerAddressDeliveryQueue(DeliveryQueue):
         self._getAddressState(address, now=now)
         return DeliveryQueue.queueDeliveryMessage(self,msg,address,now)
 
-    def sendReadyMessages(self, now=None):
+    def moveDeliveryMessage(self, store, handle, address, now=None):
+        self._getAddressState(address, now=now)
+        return DeliveryQueue.moveDeliveryMessage(self,store,handle,address,now)
+
+    def getReadyMessages(self, now=None):
         if now is None:
             now = time.time()
         self._lock.acquire()
@@ -695,7 +730,7 @@ class PerAddressDeliveryQueue(DeliveryQueue):
         finally:
             self._lock.release()
 
-            self._deliverMessages(messages)
+        return messages
 
     def cleanQueue(self, secureDeleteFn=None):
         self.sync()
@@ -785,18 +820,143 @@ class PerAddressDeliveryQueue(DeliveryQueue):
             self._lock.release()
 
 
-class TimedMixPool(mixminion.Filestore.ObjectStore):
+class TimedMixPool(mixminion.Filestore.ObjectMetadataStore):
     """A TimedMixPool holds a group of files, and returns some of them
        as requested, according to a mixing algorithm that sends a batch
-       of messages every N seconds."""
+       of messages every N seconds.
+
+       Each file may have a small metadata object, so that the caller can
+       decide what to do with a message without unpickling it.
+
+       We keep the handles of all messages in memory, so that choosing a
+       batch takes time proportional to the size of the batch rather than
+       to the size of the pool."""
     ## Fields:
     #   interval: scanning interval, in seconds.
+    #   _handles: a list of the handles of every message in the pool, in
+    #      no particular order.
+    #   _index: a map from each handle in _handles to its position there.
     def __init__(self, location, interval=600):
         """Create a TimedMixPool that sends its entire batch of messages
            every 'interval' seconds."""
-        mixminion.Filestore.ObjectStore.__init__(
+        self._handles = []
+        self._index = {}
+        mixminion.Filestore.ObjectMetadataStore.__init__(
             self, location, create=1, scrub=1)
         self.interval = interval
+        self._rebuildHandles()
+        self.loadAllMetadata(lambda h: None)
+
+    def queueObject(self, object, metadata=None):
+        """Queue an object with the metadata 'metadata', and return a
+           handle to it."""
+        return self.queueObjectAndMetadata(object, metadata)
+
+    def count(self, recount=0):
+        """Returns the number of messages in the pool."""
+        if recount:
+            self._rebuildHandles()
+        return len(self._handles)
+
+    def pickRandom(self, count=None):
+        """As BaseStore.pickRandom, but without listing the directory or
+           shuffling the whole pool."""
+        try:
+            self._lock.acquire()
+            hs = self._handles
+            index = self._index
+            size = len(hs)
+            if count is None or count > size:
+                count = size
+            # Partial Fisher-Yates: after step i, hs[:i+1] is a random
+            # ordered sample of the pool.
+            getInt = getCommonPRNG().getInt
+            for i in xrange(count):
+                j = i+getInt(size-i)
+                hs[i], hs[j] = hs[j], hs[i]
+                index[hs[i]] = i
+                index[hs[j]] = j
+            return hs[:count]
+        finally:
+            self._lock.release()
+
+    def pickEach(self, p):
+        """Return handles for a random subset of the messages in the pool,
+           in random order, choosing each message independently with
+           probability 'p'.  Takes time proportional to the number of
+           messages chosen."""
+        try:
+            self._lock.acquire()
+            hs = self._handles
+            if p <= 0 or not hs:
+                return []
+            rng = getCommonPRNG()
+            if p >= 1:
+                return rng.shuffle(hs[:])
+            # Rather than flipping a coin for every message, skip ahead
+            # by a geometrically distributed number of messages each time.
+            logq = math.log(1.0 - p)
+            picked = []
+            i = -1
+            while 1:
+                u = rng.getFloat()
+                if u == 0.0:
+                    continue
+                i += 1 + int(math.log(u) / logq)
+                if i >= len(hs):
+                    break
+                picked.append(hs[i])
+            return rng.shuffle(picked)
+        finally:
+            self._lock.release()
+
+    def _rebuildHandles(self):
+        """Helper: rebuild _handles and _index from the directory."""
+        try:
+            self._lock.acquire()
+            self._handles = mixminion.Filestore.ObjectMetadataStore.\
+                            getAllMessages(self)
+            self._index = {}
+            for i in xrange(len(self._handles)):
+                self._index[self._handles[i]] = i
+        finally:
+            self._lock.release()
+
+    def _addHandle(self, handle):
+        """Helper: add 'handle' to _handles, if it isn't there."""
+        if not self._index.has_key(handle):
+            self._index[handle] = len(self._handles)
+            self._handles.append(handle)
+
+    def _removeHandle(self, handle):
+        """Helper: remove 'handle' from _handles, if it is there, by
+           moving the last handle into its place."""
+        i = self._index.get(handle)
+        if i is None:
+            return
+        del self._index[handle]
+        last = self._handles.pop()
+        if i < len(self._handles):
+            self._handles[i] = last
+            self._index[last] = i
+
+    def _changeState(self, handle, s1, s2):
+        try:
+            self._lock.acquire()
+            mixminion.Filestore.ObjectMetadataStore._changeState(
+                self, handle, s1, s2)
+            if s1 == 'msg' or s2 == 'msg':
+                # Check the directory, in case the rename failed.
+                if self.messageExists(handle):
+                    self._addHandle(handle)
+                else:
+                    self._removeHandle(handle)
+        finally:
+            self._lock.release()
+
+    def _forgetMoved(self, handle):
+        mixminion.Filestore.ObjectMetadataStore._forgetMoved(self, handle)
+        self._removeHandle(handle)
 
     def getBatch(self):
         """Return handles for all messages that the pool is currently ready
@@ -861,22 +1021,6 @@ class CottrellMixPool(TimedMixPool):
         else:
             return []
 
-class _BinomialMixin:
-    """Mixin class.  Given a MixPool that defines a _getBatchSize function,
-       replaces the getBatch function with one that -- instead of sending N
-       messages from a pool of size P, sends each message with probability
-       N/P."""
-    def getBatch(self):
-        n = self._getBatchSize()
-        count = self.count()
-        if n == 0 or count == 0:
-            return []
-        msgProbability = n / float(count)
-        rng = getCommonPRNG()
-        return rng.shuffle([ h for h in self.getAllMessages()
-                             if rng.getFloat() < msgProbability ])
-
-
 class _BinomialMixin:
     """Mixin class.  Given a MixPool that defines a _getBatchSize function,
        replaces the getBatch function with one that -- instead of sending N
@@ -891,10 +1035,7 @@ class _BinomialMixin:
         return  n / float(count)
 
     def getBatch(self):
-        msgProbability = self._getFraction()
-        rng = getCommonPRNG()
-        return rng.shuffle([ h for h in self.getAllMessages()
-                             if rng.getFloat() < msgProbability ])
+        return self.pickEach(self._getFraction())
 
 
 class BinomialCottrellMixPool(_BinomialMixin,CottrellMixPool):
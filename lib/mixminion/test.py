@@ -12,8 +12,10 @@
 __pychecker__ = 'no-funcdoc maxlocals=100'
 
 import base64
+import binascii
 import cPickle
 import cStringIO
+import errno
 import gzip
 import operator
 import os
@@ -25,7 +27,9 @@ import sys
 import threading
 import time
 import types
+import urllib2
 from string import atoi
+from UserList import UserList
 
 # Not every post-2.0 version of Python has a working 'unittest' module, so
 # we include a copy with mixminion, as 'mixminion._unittest'.
@@ -71,6 +75,7 @@ import mixminion.directory.ServerList
 import mixminion.directory.ServerInbox
 import mixminion.directory.DirFormats
 import mixminion.directory.DirMain
+import mixminion.directory.DirCache
 import mixminion.directory.Directory
 from mixminion.Common import *
 from mixminion.Common import Log, _FileLogHandler, _ConsoleLogHandler
@@ -787,6 +792,140 @@ World!
         self.assert_(q.empty())
         self.assertRaises(mixminion.ThreadUtils.QueueEmpty, q.get_nowait)
 
+    def test_processingThreadWatermarks(self):
+        t = mixminion.ThreadUtils.ProcessingThread()
+        # No watermarks: never congested.
+        for _ in xrange(5): t.addJob(lambda: None)
+        self.failIf(t.isCongested())
+        t.mqueue.clear()
+        # Congested from the high watermark down to the low one.
+        t.setWatermarks(4, 1)
+        for _ in xrange(3): t.addJob(lambda: None)
+        self.failIf(t.isCongested())
+        t.addJob(lambda: None)
+        self.assertEquals(4, t.getQueueLength())
+        self.failUnless(t.isCongested())
+        t.mqueue.get(); t.mqueue.get()
+        self.failUnless(t.isCongested())
+        t.mqueue.get()
+        self.failIf(t.isCongested())
+        t.addJob(lambda: None)
+        self.failIf(t.isCongested())
+        # Low watermark defaults to half the high one.
+        t.setWatermarks(10)
+        self.assertEquals(5, t.lowWater)
+        t.setWatermarks(None)
+        self.assertEquals(None, t.lowWater)
+
+    def test_workerPool(self):
+        TU = mixminion.ThreadUtils
+        pool = TU.WorkerPool("test pool", maxThreads=3, maxIdle=1)
+        gate = threading.Event()
+        def wait(x, gate=gate):
+            gate.wait()
+            return x*2
+        def fail():
+            raise MixError("Oops")
+        try:
+            # Three jobs can run at once; the fourth waits.
+            futures = [ pool.submit(wait, i) for i in range(4) ]
+            self.assertEquals(3, pool.getStats()['threads'])
+            self.failIf(futures[0].done())
+            self.assertRaises(TU.FutureTimeout, futures[0].result, 0.1)
+            # Queued jobs can be cancelled; running ones can't.
+            time.sleep(0.1)
+            self.assert_(futures[3].cancel())
+            self.failIf(futures[0].cancel())
+            self.assert_(futures[3].cancelled())
+            self.assertRaises(TU.CancelledError, futures[3].result)
+            # Callbacks run in the worker, or later from a CallbackQueue.
+            seen = []
+            cbq = TU.CallbackQueue()
+            futures[0].addDoneCallback(lambda f,seen=seen:
+                                       seen.append(("w", f.result())))
+            futures[1].addDoneCallback(lambda f,seen=seen:
+                                       seen.append(("q", f.result())), cbq)
+            gate.set()
+            self.assertEquals([0, 2, 4],
+                              [ f.result(10) for f in futures[:3] ])
+            self.assertEquals([("w", 0)], seen)
+            self.assertEquals(1, cbq.run())
+            self.assertEquals([("w", 0), ("q", 2)], seen)
+            self.assertEquals(0, cbq.run())
+            # Exceptions are passed to whoever asks for the result.
+            suspendLog()
+            try:
+                f = pool.submit(fail)
+                self.assertRaises(MixError, f.result, 10)
+            finally:
+                resumeLog()
+            self.assertEquals("Oops", str(f.exception()))
+            # ... and a callback added after the fact runs at once.
+            f.addDoneCallback(lambda f,seen=seen: seen.append("late"))
+            self.assertEquals("late", seen[-1])
+            # (A worker may still be skipping over the cancelled job.)
+            for _ in xrange(100):
+                stats = pool.getStats()
+                if stats['queued'] == stats['running'] == 0:
+                    break
+                time.sleep(.05)
+            self.assertEquals(5, stats['submitted'])
+            self.assertEquals(3, stats['completed'])
+            self.assertEquals(1, stats['failed'])
+            self.assertEquals(1, stats['cancelled'])
+            self.assertEquals(0, stats['queued'])
+        finally:
+            gate.set()
+            pool.shutdown(wait=1)
+        self.assertEquals(0, pool.getStats()['threads'])
+        self.assertRaises(MixError, pool.submit, fail)
+
+        # A job submitted just after an idle worker's get() times out
+        # (but before the worker decides to exit) still gets run.
+        pool = TU.WorkerPool("test pool", maxThreads=1, maxIdle=0.1)
+        try:
+            late = []
+            class LateGet:
+                def __init__(self, pool, late):
+                    self.pool, self.late = pool, late
+                    self.get = pool.queue.get
+                def __call__(self, *args, **kwargs):
+                    try:
+                        return self.get(*args, **kwargs)
+                    except mixminion.ThreadUtils.QueueEmpty:
+                        if not self.late:
+                            self.late.append(self.pool.submit(lambda: 2))
+                        raise
+            pool.queue.get = LateGet(pool, late)
+            self.assertEquals(1, pool.submit(lambda: 1).result(10))
+            for _ in xrange(50):
+                if late: break
+                time.sleep(.05)
+            self.assertEquals(1, len(late))
+            self.assertEquals(2, late[0].result(10))
+        finally:
+            del pool.queue.get
+            pool.shutdown(wait=1)
+
+    def test_backgroundingDecorator(self):
+        TU = mixminion.ThreadUtils
+        class Obj:
+            def __init__(self): self.items = []
+            def add(self, x): self.items.append(x); return len(self.items)
+        thread = TU.ProcessingThread("test thread")
+        obj = Obj()
+        bg = TU.BackgroundingDecorator(thread, obj)
+        f1 = bg.add("a")
+        f2 = bg.add("b")
+        thread.start()
+        try:
+            self.assertEquals(2, f2.result(10))
+            self.assertEquals(1, f1.result(10))
+            self.assertEquals(["a", "b"], obj.items)
+        finally:
+            thread.shutdown()
+            thread.join()
+
     def test_rwlock(self):
         RWLock = mixminion.ThreadUtils.RWLock
         lock = RWLock()
@@ -837,6 +976,49 @@ World!
             self.assertEquals(lst, tst)
             tst.append("unterminated line")
 
+    def test_secureDelete(self):
+        shred = _ml.shred_files
+        d = mix_mktemp()
+        os.mkdir(d, 0700)
+        # We keep a hard link to each file, so that we can see what the
+        # overwrite left behind.
+        names = []
+        for i in xrange(3):
+            fn = os.path.join(d, str(i))
+            writeFile(fn, "Secret minion %s\n"%i * (i*1000))
+            if hasattr(os, 'link'):
+                os.link(fn, fn+".ln")
+            names.append(fn)
+        missing = os.path.join(d, "missing")
+        failed = shred(names+[missing], passes=1, punch=1)
+        self.assertEquals(failed, [(missing, errno.ENOENT)])
+        for fn in names:
+            self.failIf(os.path.exists(fn))
+            if hasattr(os, 'link'):
+                s = readFile(fn+".ln", 1)
+                self.assertEquals(s, "\0"*len(s))
+                self.failIf(len(s) % 512)
+        self.assertEquals(shred([]), [])
+        self.assertRaises(TypeError, shred, [3])
+        self.assertRaises(ValueError, shred, names, -1)
+
+        # A file we can't open for writing still gets removed.  (A dangling
+        # symlink fails to open no matter who we are.)
+        if hasattr(os, 'symlink'):
+            dangling = os.path.join(d, "dangling")
+            os.symlink(missing, dangling)
+            failed = shred([dangling])
+            self.assertEquals(failed, [(dangling, errno.ENOENT)])
+            self.failIf(os.path.islink(dangling))
+
+        # Now try it through secureDelete.
+        names = [ os.path.join(d, "x%s"%i) for i in xrange(10) ]
+        for fn in names:
+            writeFile(fn, "Sensitive")
+        mixminion.Common.secureDelete(names+[missing], blocking=1)
+        for fn in names:
+            self.failIf(os.path.exists(fn))
+
 #----------------------------------------------------------------------
 
 class MinionlibCryptoTests(TestCase):
@@ -923,6 +1105,29 @@ class MinionlibCryptoTests(TestCase):
         # ...or a long string.
         self.failUnlessRaises(TypeError, _ml.aes_key, "a"*17)
 
+        # If we have OpenSSL's counter mode, it must agree with ours, at
+        # every offset and on both sides of the length where we switch.
+        backend = _ml.aes_ctr_backend()
+        self.assert_(backend in ("evp", "builtin"))
+        self.failUnlessRaises(CryptoError, _ml.aes_ctr_backend, "rot13")
+        self.assertEquals(backend, _ml.aes_ctr_backend())
+        try:
+            _ml.aes_ctr_backend("evp")
+        except CryptoError:
+            pass
+        else:
+            cases = [ (n, idx) for n in (1, 255, 256, 4097)
+                      for idx in (0, 1, 15, 16, 33, 0xFFFFFFF0) ]
+            s = teststr*30
+            results = [ crypt(key2, s[:n], idx) for n, idx in cases ] + \
+                      [ crypt(key2, "", idx, n) for n, idx in cases ]
+            _ml.aes_ctr_backend("builtin")
+            self.assertEquals(results,
+                      [ crypt(key2, s[:n], idx) for n, idx in cases ] +
+                      [ crypt(key2, "", idx, n) for n, idx in cases ])
+        _ml.aes_ctr_backend(backend)
+        self.assertEquals(backend, _ml.aes_ctr_backend())
+
     def test_openssl_seed(self):
         # Just try seeding openssl a couple of times, and make sure it
         # doesn't crash.
@@ -1179,6 +1384,17 @@ class CryptoTests(TestCase):
                               pk_sign(msg, k1024)+"X",
                               pub1024)
 
+        # test batch signature checking, with and without threads.
+        items = [ (pk_sign(str(i), k1024), pub1024) for i in range(20) ]
+        items[5] = (pk_sign("5", k512), pub1024)
+        items[17] = (items[17][0]+"X", pub1024)
+        expected = map(str, range(20))
+        expected[5] = expected[17] = None
+        eq(pk_check_signatures(items, 1), expected)
+        eq(pk_check_signatures(items, 3), expected)
+        eq(pk_check_signatures(items), expected)
+        eq(pk_check_signatures([]), [])
+
         # Make sure we can still encrypt after we've encoded/decoded a
         # key.
         encoded = pk_encode_private_key(k512)
@@ -1230,6 +1446,28 @@ class CryptoTests(TestCase):
         key = (key1,key2,key3,key4)
         self.assertEquals(left+right, lioness_encrypt(plain,key))
         self.assertEquals(key, Keyset("ABCDE"*4).getLionessKeys("foo"))
+        self.assertEquals(plain, lioness_decrypt(left+right,key))
+
+        # Make sure that the C doesn't modify its input, and that it
+        # rejects bad keys and too-short strings.
+        c = plain[:]
+        enc(c, key)
+        dec(c, key)
+        self.assertEquals(c, plain)
+        self.failUnlessRaises(TypeError, enc, plain, (key1,key2,key3,"x"))
+
+        # Decrypting in place gives the same answer, even through a view.
+        b = bytearray("x"*10+enc(plain,key)+"y"*10)
+        Crypto.lioness_decrypt_inplace(memoryview(b)[10:-10], key)
+        self.assertEquals(str(b), "x"*10+plain+"y"*10)
+        self.failUnlessRaises(TypeError, Crypto.lioness_decrypt_inplace,
+                              plain, key)
+        self.failUnlessRaises(TypeError, Crypto.lioness_decrypt_inplace,
+                              bytearray("x"*10), key)
+        self.failUnlessRaises(TypeError, dec, plain, ("x",key2,key3,key4))
+        self.failUnlessRaises(TypeError, enc, plain[:20], key)
+        self.failUnlessRaises(TypeError, _ml.lioness_encrypt, plain, key[:3])
+        self.assertEquals(plain[:21], dec(enc(plain[:21], key), key))
 
         u = "Hello world"*2
         w = whiten(u)
@@ -1269,6 +1507,9 @@ class CryptoTests(TestCase):
         key = (key1,key2)
         self.assertEquals(left+right, bear_encrypt(plain,key))
         self.assertEquals(key, Keyset("ABCDE"*4).getBearKeys("foo"))
+        self.assertEquals(plain, bear_decrypt(left+right,key))
+        self.failUnlessRaises(TypeError, enc, plain, (key1,"x"))
+        self.failUnlessRaises(TypeError, dec, "x"*20, key)
 
     def test_keyset(self):
         s = sha1
@@ -1285,6 +1526,21 @@ class CryptoTests(TestCase):
             x(s("aBaz"),z19+"\x02"), x(s("aBaz"), z19+"\x03")),
            k.getLionessKeys("Baz"))
 
+        # Make sure that keyset.getKeys agrees with the other methods.
+        raw, aes, lio, bear = k.getKeys(
+            (("Foo",10), ("Bar","aes"), ("Baz","lioness"), ("Quux","bear")))
+        eq(raw, k.get("Foo",10))
+        eq(ctr_crypt("x"*100, aes), ctr_crypt("x"*100, k.get("Bar")))
+        eq(lio, k.getLionessKeys("Baz"))
+        eq(bear, k.getBearKeys("Quux"))
+        eq([], k.getKeys(()))
+        eq(Crypto.lioness_keys_from_header("H"),
+           Keyset(s("H")).getLionessKeys(Crypto.HIDE_PAYLOAD_MODE))
+        self.failUnlessRaises(TypeError, k.getKeys, (("Foo",21),))
+        self.failUnlessRaises(TypeError, k.getKeys, (("Foo",0),))
+        self.failUnlessRaises(TypeError, k.getKeys, (("Foo","rot13"),))
+        self.failUnlessRaises(TypeError, k.getKeys, ("Foo",))
+
     def test_aesprng(self):
         # Make sure that AESCounterPRNG is really repeatable.
         key ="aaab"*4
@@ -1443,6 +1699,19 @@ class PacketTests(TestCase):
         self.failUnlessRaises(ParseError, parsePacket, m[:-1])
         self.failUnlessRaises(ParseError, parsePacket, m+"x")
 
+        # Same for a PacketBuffer, which we can also modify in place.
+        pb = PacketBuffer(m)
+        self.assertEquals(pb.pack(), m)
+        self.assertEquals(pb.getHeader1(), m[:2048])
+        self.assertEquals(str(pb.getHeader2Buffer()), m[2048:4096])
+        self.assertEquals(pb.getPayload(), m[4096:])
+        self.assertEquals(str(pb.getPayloadBuffer()), m[4096:])
+        pb.swapHeaders()
+        self.assertEquals(pb.pack(), m[2048:4096]+m[:2048]+m[4096:])
+        pb.setHeader1("Z"*2048)
+        self.assertEquals(pb.pack(), "Z"*2048+m[:2048]+m[4096:])
+        self.failUnlessRaises(ParseError, PacketBuffer, m[:-1])
+
     def test_ipv4info(self):
         # Check the IPV4Info structure used to hold the addresses for the
         # FWD and SWAP_FWD routing types.
@@ -2726,6 +2995,35 @@ class PacketHandlerTests(TestCase):
                                 longemail],
                                p)
 
+        # Pythons too old for PacketBuffer build a new string at each
+        # step, and must get the same answers.
+        PH = mixminion.server.PacketHandler
+        hlog2 = HashLog(mix_mktemp(".db"), "Z"*20)
+        m = bfm(BuildMessage.encodeMessage("\n"+p,0)[0],
+                SMTP_TYPE, "nobody@invalid",
+                [self.server1, self.server2], [self.server3])
+        sps2 = [ PacketHandler([pk], [hlog2])
+                 for pk in (self.pk1, self.pk2, self.pk3) ]
+        try:
+            for sp, sp2 in zip([self.sp1, self.sp2, self.sp3], sps2):
+                res = sp.processPacket(m)
+                replaceAttribute(PH, '_DECRYPT_IN_PLACE', 0)
+                try:
+                    res2 = sp2.processPacket(m)
+                finally:
+                    undoReplacedAttributes()
+                self.assertEquals(res.isDelivery(), res2.isDelivery())
+                if res.isDelivery():
+                    self.assertEquals(res.payload, res2.payload)
+                    self.assertEquals(res.getApplicationKey(),
+                                      res2.getApplicationKey())
+                else:
+                    self.assertEquals(res.getPacket(), res2.getPacket())
+                    m = res.getPacket()
+            self.assert_(res.isDelivery())
+        finally:
+            hlog2.close()
+
     def test_deliverypacket(self):
         # Test out DeliveryPacket.*: with a plaintext ascii packet.
         bfm = BuildMessage.buildForwardPacket
@@ -3152,6 +3450,91 @@ class FilestoreTests(FStoreTestBase):
         self.assert_(not os.path.exists(os.path.join(d_d, "rmvm_"+h2)))
         self.assert_(not os.path.exists(os.path.join(d_d, "rmv_"+h2)))
 
+        # Move a message to another store, replacing its metadata.
+        d_d2 = mix_mktemp("q_md2")
+        queue2 = Store(d_d2, create=1)
+        self.assertEquals(queue.count(), 2)
+        h4 = queue.moveMessageTo(h1, queue2, [7,8])
+        self.assertEquals(queue.count(), 1)
+        self.assertEquals(queue.getAllMessages(), [h3])
+        self.assertEquals(queue._metadata_cache, { h3: h3 })
+        self.assert_(os.path.exists(os.path.join(d_d, "rmvm_"+h1)))
+        self.assertEquals(queue2.getAllMessages(), [h4])
+        self.assertEquals(queue2.count(), 1)
+        self.assertEquals(queue2.messageContents(h4), "abc")
+        self.assertEquals(Store(d_d2).getMetadata(h4), [7,8])
+        # A failed move leaves the message where it was.
+        self.failUnlessRaises(OSError, queue.moveMessageTo, h1, queue2)
+        self.assertEquals(queue2.count(), 1)
+        self.assertEquals(len(os.listdir(d_d2)), 3) # msg, meta, rmv.
+
+    def testRingStore(self):
+        Ring = mixminion.Filestore.RingStore
+        d = mix_mktemp("ring")
+        os.mkdir(d, 0700)
+        fn = os.path.join(d, "ring")
+
+        ring = Ring(fn, 10, 3)
+        self.assertEquals(ring.count(), 0)
+        if not ON_WINDOWS:
+            self.assertEquals(0600, os.stat(fn)[stat.ST_MODE] & 0777)
+        h1 = ring.queueMessage("aaaaaaaaaa")
+        h2 = ring.queueMessage("bbbbbbbbbb")
+        h3 = ring.queueMessage("cccccccccc")
+        self.assertEquals(ring.count(), 3)
+        self.assertEquals(len({h1:1,h2:1,h3:1}), 3)
+        # When the ring is full, we say so; bad lengths are refused.
+        self.assertEquals(ring.queueMessage("dddddddddd"), None)
+        self.failUnlessRaises(MixError, ring.queueMessage, "x")
+        self.assertEquals(str(ring.messageContents(h2)), "bbbbbbbbbb")
+        ring.removeMessage(h2)
+        self.assertEquals(ring.count(), 2)
+        h4 = ring.queueMessage("dddddddddd")
+        self.assertEquals(h4, h2)
+        ring.removeMessage(h1)
+        # Removing a slot twice doesn't free it twice.
+        try:
+            suspendLog()
+            ring.removeMessage(h1)
+        finally:
+            s = resumeLog()
+        self.assert_(stringContains(s, "Tried to remove empty slot"))
+        self.assertEquals(ring.count(), 2)
+        ring.sync()
+
+        # A reopened ring (for instance, after a crash) holds exactly the
+        # packets we hadn't removed.
+        ring = Ring(fn, 10, 3)
+        self.assertEquals(ring.count(), 2)
+        hs = ring.getAllMessages()
+        hs.sort()
+        self.assertEquals(hs, [h2, h3])
+        self.assertEquals(str(ring.messageContents(h4)), "dddddddddd")
+        self.assertEquals(str(ring.messageContents(h3)), "cccccccccc")
+        # Removed slots are zeroed on disk.
+        self.assertEquals(readFile(fn, 1).find("aaaaaaaaaa"), -1)
+
+        # We don't resize a ring that holds packets...
+        ring.close()
+        try:
+            suspendLog()
+            ring = Ring(fn, 10, 5)
+        finally:
+            s = resumeLog()
+        self.assert_(stringContains(s, "Not resizing nonempty ring file"))
+        self.assertEquals((ring.slotLen, ring.nSlots), (10, 3))
+        ring.removeMessage(h3)
+        ring.removeMessage(h4)
+        ring.close()
+        # ...but we do resize an empty one.
+        ring = Ring(fn, 20, 5)
+        self.assertEquals((ring.slotLen, ring.nSlots), (20, 5))
+        self.assertEquals(ring.count(), 0)
+        ring.close()
+
+        writeFile(fn, "Not a ring file at all")
+        self.failUnlessRaises(MixFatalError, Ring, fn, 10, 3)
+
     def testDBWrappers(self):
         d_parent = mix_mktemp("db")
         loc = os.path.join(d_parent, "db0")
@@ -3615,7 +3998,31 @@ class QueueTests(FStoreTestBase):
         self.assert_(messageLens[0] <= 30)
         self.assert_(messageLens[-1] >= 30)
 
+        # The in-memory list of handles tracks the directory as messages
+        # come and go.
+        allHandles = bcmq.getAllMessages()
+        self.assertUnorderedEq(bcmq.pickRandom(), allHandles)
+        for h in bcmq.pickRandom(40):
+            bcmq.removeMessage(h)
+        self.assertEquals(60, bcmq.count())
+        self.assertUnorderedEq(bcmq.pickRandom(), bcmq.getAllMessages())
+        b = bcmq.pickRandom(10)
+        self.assertEquals(10, len(b))
+        self.assertEquals(10, len(dict([(h,1) for h in b])))
+        self.assertEquals(60, bcmq.count(recount=1))
+        # pickEach chooses a subset of the pool, without repeats.
+        self.assertEquals([], bcmq.pickEach(0))
+        self.assertUnorderedEq(bcmq.pickEach(1), bcmq.getAllMessages())
+        b = bcmq.pickEach(.5)
+        self.assertEquals(len(b), len(dict([(h,1) for h in b])))
+        for h in b:
+            self.assert_(h in allHandles)
+        # (Fails less than once in 2**30 tests.)
+        self.assert_(3 <= len(b) <= 57)
+
         bcmq.removeAll(self.unlink)
+        self.assertEquals(0, bcmq.count())
+        self.assertEquals([], bcmq.pickRandom())
         bcmq.cleanQueue(self.unlink)
 
 #---------------------------------------------------------------------
@@ -3669,6 +4076,74 @@ class LogTests(TestCase):
         self.assertEquals(readFile(t).count("\n") , 1)
         self.assertEquals(readFile(t1).count("\n"), 3)
 
+    def testAsyncLogging(self):
+        log = Log("TRACE")
+        log.handlers = []
+        buf = cStringIO.StringIO()
+        log.addHandler(_ConsoleLogHandler(buf))
+        log.setAsync(1)
+        try:
+            # Queued messages don't show up until the writer gets to them...
+            log.info("Hello %s", "world")
+            log.debug("Second")
+            log.flush()
+            lines = buf.getvalue().split("\n")
+            self.assertEquals(3, len(lines))
+            self.assertEndsWith(lines[0], "[INFO] Hello world")
+            self.assertEndsWith(lines[1], "[DEBUG] Second")
+            # ...unless they're errors.
+            buf.truncate(0)
+            log.error("Oops")
+            self.assertEndsWith(buf.getvalue(), "[ERROR] Oops\n")
+            # The writer thread flushes on its own.
+            buf.truncate(0)
+            log.info("Later")
+            time.sleep(mixminion.Common.LOG_FLUSH_INTERVAL*5)
+            self.assertEndsWith(buf.getvalue(), "[INFO] Later\n")
+            # Leaving async mode writes whatever is still queued, even a
+            # message that was being queued at the same moment.
+            buf.truncate(0)
+            log.info("Queued")
+            class RacyQueue(UserList):
+                def append(self, item, log=log):
+                    log.setAsync(0)
+                    self.data.append(item)
+            log._queue = RacyQueue(log._queue)
+            log.info("Racing")
+            self.assertEquals(None, log._queue)
+            lines = buf.getvalue().split("\n")
+            self.assertEquals(3, len(lines))
+            self.assertEndsWith(lines[0], "[INFO] Queued")
+            self.assertEndsWith(lines[1], "[INFO] Racing")
+        finally:
+            log.close()
+        self.failIf(log._writer)
+
+        # Messages we ignore are never formatted.
+        buf.truncate(0)
+        log.setMinSeverity("INFO")
+        log.debug("%s %s", "too few arguments for this format")
+        self.assertEquals(buf.getvalue(), "")
+
+        # Rate-limiting.
+        log.setMinSeverity("TRACE")
+        log.rateLimit = 3
+        fmt = "Packet %s"
+        # Make sure we don't cross into a new second halfway through.
+        while time.time() % 1 > 0.5:
+            time.sleep(0.05)
+        for i in xrange(10):
+            log.debug(fmt, i)
+        log.info("Info %s", 1)
+        # Pretend a second has passed.
+        log._rateState[fmt][0] -= 1
+        log.debug(fmt, 10)
+        lines = [ l[26:] for l in buf.getvalue().split("\n") ]
+        self.assertEquals(lines, ["[DEBUG] Packet 0", "[DEBUG] Packet 1",
+                  "[DEBUG] Packet 2", "[INFO] Info 1",
+                  "[DEBUG] (Suppressed 7 more messages like 'Packet %s')",
+                  "[DEBUG] Packet 10", ""])
+
     def testLogStream(self):
         stream = mixminion.Common.LogStream("STREAM", "WARN")
         suspendLog()
@@ -4033,6 +4508,82 @@ class MMTPTests(TestCase):
     def testRejected(self):
         self.doTest(self._testRejected)
 
+    def testPausedReading(self):
+        self.doTest(self._testPausedReading)
+
+    def testTLSByteCounts(self):
+        self.doTest(self._testTLSByteCounts)
+
+    def _testTLSByteCounts(self):
+        # A real TLSConnection must report the bytes it moves, or the
+        # bandwidth limits never see any traffic.
+        server, listener, packetsIn, keyid = _getMMTPServer()
+        self.listener = listener
+        self.server = server
+        packets = ["helloxxx"*4096, "helloyyy"*4096]
+
+        server.process(0.1)
+        routing = IPV4Info("127.0.0.1", TEST_PORT, keyid)
+        t = threading.Thread(None, mixminion.MMTPClient.sendPackets,
+                             args=(routing, packets))
+        t.start()
+        con = None
+        while con is None:
+            server.process(0.1)
+            for c in server.connections.values():
+                if isinstance(c, mixminion.server.MMTPServer.
+                              MMTPServerConnection):
+                    con = c
+        used = []
+        def process(r, w, x, cap, con=con, used=used,
+                    orig=con.process):
+            res = orig(r, w, x, cap)
+            used.append(res[3])
+            return res
+        con.process = process
+        while t.isAlive() or len(packetsIn) < 2:
+            server.process(0.1)
+        t.join()
+        self.assertEquals(packets, packetsIn)
+        self.assert_(used)
+        self.failIf([ n for n in used if n < 0 ])
+        self.assert_(reduce(operator.add, used) >= len(packets[0])*2)
+
+    def _testPausedReading(self):
+        server, listener, packetsIn, keyid = _getMMTPServer()
+        self.listener = listener
+        self.server = server
+        packets = ["helloxxx"*4096, "helloyyy"*4096]
+
+        server.process(0.1)
+        routing = IPV4Info("127.0.0.1", TEST_PORT, keyid)
+        t = threading.Thread(None, mixminion.MMTPClient.sendPackets,
+                             args=(routing, packets))
+        t.start()
+        # Pause the server side of the connection as soon as it exists.
+        con = None
+        while con is None:
+            server.process(0.1)
+            for c in server.connections.values():
+                if isinstance(c, mixminion.server.MMTPServer.
+                              MMTPServerConnection):
+                    con = c
+        con.pauseReading()
+        server.register(con)
+        # We finish negotiating, but don't read any packets.
+        for _ in xrange(15):
+            server.process(0.1)
+        self.assertEquals([], packetsIn)
+        self.failUnless(con._stalled)
+        self.failIf(con.isReading())
+        # Once we resume, the packets arrive.
+        con.resumeReading()
+        server.register(con)
+        while t.isAlive():
+            server.process(0.1)
+        t.join()
+        self.assertEquals(packets, packetsIn)
+
     def _testBlockingTransmission(self):
         server, listener, packetsIn, keyid = _getMMTPServer()
         self.listener = listener
@@ -4166,6 +4717,10 @@ class MMTPTests(TestCase):
         self.assertEquals(2, server.nJunkPackets)
         self.assert_(deliv[0]._succeeded)
         self.assert_(deliv[1]._succeeded)
+        # We negotiated a window of unacknowledged packets.
+        self.assertEquals(clientcon.protocol, "0.4")
+        self.assertEquals(clientcon.window, 64)
+        self.assertEquals(c[0].window, 64)
 
         # Again, with bad keyid.
         deliv = [FakeDeliverable(p) for p in packets]
@@ -4318,6 +4873,230 @@ class MMTPTests(TestCase):
         self.assertEquals(deliv[0]._retriable, 1)
         self.assertEquals(deliv[1]._retriable, 1)
 
+    def testProtocolWindow(self):
+        MC = mixminion.MMTPClient
+        self.assertEquals(MC.formatProtocol("0.3"), "0.3")
+        self.assertEquals(MC.formatProtocol("0.4", 64), "0.4;window=64")
+        self.assertEquals(MC.parseProtocol("0.3"), ("0.3", None))
+        self.assertEquals(MC.parseProtocol("0.4;window=64"), ("0.4", 64))
+        self.assertEquals(MC.parseProtocol("0.4;x=y;window=9"), ("0.4", 9))
+        self.assertEquals(MC.parseProtocol("0.4;window=0"), ("0.4", None))
+        self.assertEquals(MC.parseProtocol("0.4;window=-3"), ("0.4", None))
+        self.assertEquals(MC.parseProtocol("0.4;window=1e9"), ("0.4", None))
+
+        # A server that only speaks 0.3 still works with our clients, at
+        # the old window.
+        MS = mixminion.server.MMTPServer.MMTPServerConnection
+        oldVersions = MS.PROTOCOL_VERSIONS
+        MS.PROTOCOL_VERSIONS = ['0.3']
+        try:
+            self.doTest(self._testOldProtocol)
+        finally:
+            MS.PROTOCOL_VERSIONS = oldVersions
+
+    def _testOldProtocol(self):
+        server, listener, packetsIn, keyid = _getMMTPServer()
+        self.listener = listener
+        self.server = server
+        packets = [ "helloxxx"*4096, "helloyyy"*4096 ]
+        deliv = [ FakeDeliverable(p) for p in packets ]
+        async = mixminion.server.MMTPServer.AsyncServer()
+        clientcon = mixminion.server.MMTPServer.MMTPClientConnection(
+            socket.AF_INET, "127.0.0.1", TEST_PORT, keyid)
+        for d in deliv:
+            clientcon.addPacket(d)
+        async.register(clientcon)
+        def clientThread(clientcon=clientcon, async=async):
+            while clientcon.sock is not None:
+                async.process(2)
+        t = threading.Thread(None, clientThread)
+        t.start()
+        while t.isAlive():
+            server.process(0.1)
+        t.join()
+        self.assertEquals(packetsIn, packets)
+        self.assertEquals(clientcon.protocol, "0.3")
+        self.assertEquals(clientcon.window, 6)
+
+    def testCoalescedWrites(self):
+        class FakeTLS:
+            def __init__(self):
+                self.written = []
+                self.nBytes = 0
+                self.limit = None
+                self.block = 0
+                self.tried = []
+            def get_num_bytes_raw(self):
+                return self.nBytes
+            def write(self, s):
+                self.tried.append(len(s))
+                if self.block:
+                    self.block -= 1
+                    raise _ml.TLSWantWrite()
+                s = str(s)
+                if self.limit is not None:
+                    s = s[:self.limit]
+                self.written.append(s)
+                self.nBytes += len(s)
+                return len(s)
+        tls = FakeTLS()
+        con = mixminion.TLSConnection.TLSConnection(tls, None, "fake")
+        con.onWrite = lambda n: None
+        con.doneWriting = lambda: None
+        # Small strings are gathered into a single write; large ones are
+        # written without being copied together first.
+        acks = [ "RECEIVED\r\n", "X"*20 ] * 3
+        big = "Y"*40000
+        con.beginWriting(acks)
+        con.beginWriting(["", big, "Z"*20])
+        self.assertEquals(con.outbuflen, 90+40020)
+        wr, ww, isopen, n = con.process(0, 1, 0, None)
+        self.assertEquals(n, 90+40020)
+        self.assertEquals(len(tls.written), 3)
+        self.assertEquals(tls.written[0], "".join(acks)+"Y"*(16384-90))
+        self.assertEquals(len(tls.written[1]), 40000-(16384-90))
+        self.assertEquals("".join(tls.written), "".join(acks)+big+"Z"*20)
+        self.assertEquals((con.outbuf, con.outbuflen, ww), ([], 0, 0))
+
+        # Partial and blocked writes pick up where they left off, and retry
+        # with the same length.
+        tls.written = []
+        tls.tried = []
+        tls.limit = 1000
+        tls.block = 1
+        con.beginWriting(["a"*3000, "b"*10, "c"*20000])
+        wr, ww, isopen, n = con.process(0, 1, 0, None)
+        self.assertEquals((n, ww), (0, 1))
+        wr, ww, isopen, n = con.process(0, 1, 0, 2500)
+        self.assertEquals(n, 2500)
+        self.assertEquals(tls.written, ["a"*1000, "a"*1000, "a"*500])
+        self.assertEquals(tls.tried, [16384, 16384, 1500, 500])
+        tls.limit = None
+        wr, ww, isopen, n = con.process(0, 1, 0, None)
+        self.assertEquals(len(tls.written), 5)
+        self.assertEquals(tls.written[3], "a"*500+"b"*10+"c"*(16384-510))
+        self.assertEquals(con.outbuflen, 0)
+
+    def testOutboundScheduler(self):
+        sched = mixminion.server.MMTPServer.OutboundScheduler(quantum=3)
+        self.assertEquals(sched.next(), None)
+        A = (socket.AF_INET, "10.0.0.1", 48099, "K"*20)
+        B = (socket.AF_INET, "10.0.0.2", 48099, "L"*20)
+        C = (socket.AF_INET, "10.0.0.2", 48100, "L"*20)
+        sched.add(*(A+(["a1","a2"], "A")))
+        sched.add(*(B+(["b1"], "B")))
+        # Packets for a destination that's already waiting join its batch.
+        sched.add(*(A+(["a3","a4","a5"], "A")))
+        sched.add(*(C+(["c1"], "C")))
+        self.assertEquals(len(sched), 3)
+        self.assertEquals(sched.getPacketCount(), 7)
+        # A has waited longest, but only gets 'quantum' packets before
+        # the others get a turn.
+        self.assertEquals(sched.next(), A+(["a1","a2","a3"], "A"))
+        self.assertEquals(sched.next(), B+(["b1"], "B"))
+        sched.add(*(B+(["b2"], "B")))
+        self.assertEquals(sched.next(), C+(["c1"], "C"))
+        self.assertEquals(sched.next(), A+(["a4","a5"], "A"))
+        self.assertEquals(sched.next(), B+(["b2"], "B"))
+        self.assertEquals(sched.next(), None)
+        self.assertEquals(len(sched), 0)
+        self.assertEquals(sched.getPacketCount(), 0)
+
+        # Lots of destinations come out in order, and the list of turns
+        # doesn't grow without bound.
+        sched = mixminion.server.MMTPServer.OutboundScheduler()
+        for i in xrange(1000):
+            sched.add(socket.AF_INET, "10.0.%d.%d"%(floorDiv(i,256),i%256),
+                      48099, "K"*20, [i], str(i))
+            if i % 3 == 2:
+                self.assertEquals(sched.next()[4], [floorDiv(i,3)*2])
+                self.assertEquals(sched.next()[4], [floorDiv(i,3)*2+1])
+        self.assert_(len(sched.order) - sched.head == len(sched) == 334)
+        self.assert_(len(sched.order) < 1000)
+
+        # A destination that keeps getting packets takes its turns in
+        # order, and the packets it has sent don't pile up.
+        sched = mixminion.server.MMTPServer.OutboundScheduler(quantum=2)
+        sched.add(*(A+(range(10), "A")))
+        for i in xrange(0, 1000, 2):
+            self.assertEquals(sched.next()[4], [i, i+1])
+            sched.add(*(A+([i+10, i+11], "A")))
+            self.assertEquals(sched.getPacketCount(), 10)
+            self.assert_(len(sched.queues[A[1:]][4]) <= 20)
+        self.assertEquals(len(sched), 1)
+
+    def testBandwidthShaping(self):
+        MS = mixminion.server.MMTPServer
+        # Buckets refill by elapsed time, up to their burst size.
+        b = MS.TokenBucket(1000, 4000, now=100)
+        self.assertEquals(b.getAvailable(), 4000)
+        b.spend(4500)
+        self.assertEquals(b.getAvailable(), 0)
+        self.assertFloatEq(b.getDelay(), 0.501)
+        b.refill(100.25)
+        self.assertFloatEq(b.tokens, -250)
+        b.refill(99)
+        self.assertFloatEq(b.tokens, -250)
+        b.refill(200)
+        self.assertEquals(b.getAvailable(), 4000)
+
+        class FakeCon:
+            def __init__(self, classes): self.classes = classes
+            def getTrafficClasses(self): return self.classes
+        server = MS.AsyncServer()
+        server.connections[10] = FakeCon((MS.TRAFFIC_PACKET,
+                                          MS.TRAFFIC_CONTROL))
+        server.connections[11] = FakeCon((MS.TRAFFIC_CONTROL,
+                                          MS.TRAFFIC_PADDING))
+        server.connections[12] = FakeCon((MS.TRAFFIC_CONTROL,
+                                          MS.TRAFFIC_PACKET))
+        # Without limits, everybody gets everything.
+        self.assertEquals(server._getAllowedInterest(11, 1, 1), (1, 1))
+        server.setBandwidthLimits(inbound=10000, outbound=10000,
+                                  perPeer=20000)
+        self.assert_(server._shaping)
+        server._beginShaping()
+        self.assertEquals(server._getCap(10, server.connections[10], 1, 0, 2),
+                          25000)
+        self.assertEquals(server._getCap(12, server.connections[12], 1, 1, 2),
+                          MS.CONTROL_ALLOWANCE+25000)
+
+        # Once the inbound bucket is spent, we stop reading packets, but
+        # keep writing acks.
+        server._spend(10, 1, 0, 100000)
+        self.assertEquals(server.peerBuckets[10].getAvailable(), 0)
+        self.assertEquals(server.inBucket.getAvailable(), 0)
+        self.assertEquals(server._getAllowedInterest(10, 1, 1), (0, 1))
+        self.assert_(server._wakeDelay > 0)
+        self.assertEquals(server._getShapedTimeout(0.001),0.001)
+        self.assertFloatEq(server._getShapedTimeout(100),server._wakeDelay)
+        # ...and we still read acks on other connections.
+        self.assertEquals(server._getAllowedInterest(12, 1, 1), (1, 1))
+
+        # Padding waits until the buckets are half full; packets go out as
+        # soon as there's anything in the bucket.
+        server.outBucket.tokens = 100
+        self.assertEquals(server._getAllowedInterest(11, 1, 1), (1, 0))
+        self.assertEquals(server._getAllowedInterest(12, 1, 1), (1, 1))
+        # Even when the bucket holds less than a byte apiece, every
+        # connection we poll gets to move something.
+        server.outBucket.tokens = 3
+        self.assertEquals(server._getAllowedInterest(12, 0, 1), (0, 1))
+        self.assertEquals(server._getCap(12, server.connections[12], 0, 1, 5),
+                          1)
+        server.outBucket.tokens = 40000
+        self.assertEquals(server._getAllowedInterest(11, 1, 1), (1, 1))
+        # We never hold back a connection that's waiting to connect.
+        server.outBucket.tokens = -1000
+        self.assertEquals(server._getAllowedInterest(12, 0, 2), (0, 2))
+
+        # Closing a connection forgets its bucket.
+        server._forgetPeer(10)
+        self.failIf(server.peerBuckets.has_key(10))
+        server.setBandwidthLimits()
+        server.setBandwidth(None)
+        self.failIf(server._shaping)
+
 #----------------------------------------------------------------------
 # Config files
 
@@ -4477,6 +5256,51 @@ IntRS=5
         failsR("\n[Sec1]\nFoo: Bar\n\n")
         failsR("")
         failsR("\n")
+        failsR("[Sec1]\n: Bar\n")
+        failsR("[Sec1]\n#Foo: Bar\n")
+        failsR("[Sec1\nFoo: Bar\n")
+        failsR("Foo: Bar\n[Sec1]\n")
+
+    def testParserCaches(self):
+        import mixminion.Config as C
+
+        # The restricted tokenizer strips space around keys and values,
+        # and handles a missing final newline.
+        s = "[Sec1]\n  Foo :  Bar  baz \n[Sec3]\nIntRS:9\nIntAM: 1\nIntAM:2"
+        f = TestConfigFile(string=s, restrict=1)
+        self.assertEquals(f['Sec1']['Foo'], "Bar  baz")
+        self.assertEquals(f['Sec3']['IntRS'], 9)
+        self.assertEquals(f['Sec3']['IntAM'], [1,2])
+        self.assertEquals(f['Sec3']['IntAMD'], [5,2])
+
+        # Compiled sections are shared among instances of a class...
+        cached = C._compiledSyntaxCache[TestConfigFile]
+        self.assert_(cached[0] is TestConfigFile._syntax)
+        self.assertEquals(cached[2]['Sec3'][0]['IntRS'], ('REQUIRE',_parseInt))
+        f = TestConfigFile(string=s, restrict=1)
+        self.assert_(C._compiledSyntaxCache[TestConfigFile] is cached)
+
+        # ...but never for a syntax that belongs to a single instance.
+        class EditedConfigFile(TestConfigFile):
+            def __init__(self, string):
+                self._syntax = TestConfigFile._syntax.copy()
+                self._syntax['Sec4'] = { 'Foo' : ('ALLOW', "int", None) }
+                TestConfigFile.__init__(self, None, string)
+        f = EditedConfigFile("[Sec1]\nFoo 1\n[Sec4]\nFoo 7\n")
+        self.assertEquals(f['Sec4']['Foo'], 7)
+        self.failIf(C._compiledSyntaxCache.has_key(EditedConfigFile))
+
+        # Expensive parsers are memoized by their input.
+        pk = getRSAKey(0,1024)
+        enc = formatBase64(pk.encode_key(1))
+        parsePK = C._ConfigFile.CODING_FNS['publicKey'][0]
+        k1 = parsePK(enc)
+        self.assert_(parsePK(enc) is k1)
+        self.assertEquals(k1.encode_key(1), pk.encode_key(1))
+        self.failUnlessRaises(ConfigError, parsePK, "xyzzy")
+        self.failUnlessRaises(ConfigError, parsePK, "xyzzy")
+        parseDate = C._ConfigFile.CODING_FNS['date'][0]
+        self.assertEquals(parseDate("2003-01-05"), C._parseDate("2003-01-05"))
 
     def testValidationFns(self):
         import mixminion.Config as C
@@ -4602,6 +5426,9 @@ IntRS=5
         self.assertEquals(SC._parseMixRule("binomialCottrell"),
                           "BinomialCottrellMixPool")
         self.assertEquals(SC._parseMixRule("TIMED"), "TimedMixPool")
+        # Overload policies
+        self.assertEquals(SC._parseOverloadPolicy(" Stall"), "stall")
+        self.assertEquals(SC._parseOverloadPolicy("REJECT"), "reject")
 
 
         ##
@@ -4707,6 +5534,8 @@ IntRS=5
         # Mix algorithms
         fails(SC._parseMixRule, "")
         fails(SC._parseMixRule, "nonesuch")
+        # Overload policies
+        fails(SC._parseOverloadPolicy, "drop")
 
 #----------------------------------------------------------------------
 # Server descriptors
@@ -4844,9 +5673,9 @@ class ServerInfoTests(TestCase):
 
         eq(info['Incoming/MMTP']['Version'], "0.1")
         eq(info['Incoming/MMTP']['Port'], 48099)
-        eq(info['Incoming/MMTP']['Protocols'], ["0.3"])
+        eq(info['Incoming/MMTP']['Protocols'], ["0.3", "0.4"])
         eq(info['Outgoing/MMTP']['Version'], "0.1")
-        eq(info['Outgoing/MMTP']['Protocols'], ["0.3"])
+        eq(info['Outgoing/MMTP']['Protocols'], ["0.3", "0.4"])
         eq(info['Incoming/MMTP']['Allow'], [("192.168.0.16", "255.255.255.255",
                                             1,1024),
                                            ("0.0.0.0", "0.0.0.0",
@@ -4942,8 +5771,8 @@ class ServerInfoTests(TestCase):
 
         self.assertUnorderedEq(info.getCaps(), ["frag", "relay", "mbox"])
 
-        self.assertEquals(info.getIncomingMMTPProtocols(), ["0.3"])
-        self.assertEquals(info.getOutgoingMMTPProtocols(), ["0.3"])
+        self.assertEquals(info.getIncomingMMTPProtocols(), ["0.3", "0.4"])
+        self.assertEquals(info.getOutgoingMMTPProtocols(), ["0.3", "0.4"])
 
         # Now check whether we still validate the same after some corruption
         self.assertStartsWith(inf, "[Server]\n")
@@ -5035,6 +5864,20 @@ IP: 192.168.0.99
         # But make sure we don't check the sig on assumeValid
         mixminion.ServerInfo.ServerInfo(None, badSig, assumeValid=1)
 
+        # Deferred signature checks catch the bad signature too.
+        checks = []
+        good = mixminion.ServerInfo.ServerInfo(None, inf,
+                                               _signatureChecks=checks)
+        bad = mixminion.ServerInfo.ServerInfo(None, badSig,
+                                              _signatureChecks=checks)
+        self.assertEquals(len(checks), 2)
+        self.failIf(good.isValidated() or bad.isValidated())
+        self.assertEquals(
+            mixminion.ServerInfo.checkServerInfoSignatures(checks),
+            [(bad, "Signed digest is incorrect")])
+        self.assert_(good.isValidated())
+        self.failIf(bad.isValidated())
+
         # Now with a bad digest
         badSig = inf.replace("a@b.c", "---")
         self.failUnlessRaises(ConfigError,
@@ -5355,6 +6198,40 @@ class DirectoryServerTests(TestCase):
             id0, voters, va,
             [ ("voter1",s_vote1), ("voter2",s_vote2), ("voter3",s_vote3) ],
             vd1)
+        voted1 = SI.SignedDirectory(string=s_voted1)
+        self.assertEquals(voted1['Directory-Info']['Status'], "consensus")
+        self.assertEquals(voted1['Directory-Info']['Recommended-Servers'],
+                          [ "alice", "bob", "fred", "lisa", "lola" ])
+        self.assertEquals(voted1['Recommended-Software']['MixminionClient'],
+                          [ "0.0.8", "0.0.8.1", "0.0.9.1" ])
+        self.assertEquals(voted1['Recommended-Software']['MixminionServer'],
+                          [ "0.0.8", "0.0.8.1" ])
+        self.assert_(DF.serverListIsSorted(voted1.getAllServers()))
+        # Malformed and duplicate votes don't change the result.
+        suspendLog()
+        try:
+            s_voted2 = DF.generateConsensusDirectory(
+                id0, voters, va,
+                [ ("voter1",s_vote1), ("junk", "Not a directory"),
+                  ("voter2",s_vote2), ("voter3",s_vote3),
+                  ("again",s_vote2) ])
+        finally:
+            s = resumeLog()
+        self.assert_(stringContains(s, "Rejecting malformed vote"))
+        self.assert_(stringContains(s, "ignoring one from again"))
+        self.assertEquals(s_voted1[s_voted1.index("[Directory-Info]"):],
+                          s_voted2[s_voted2.index("[Directory-Info]"):])
+
+        # Sorting and counting helpers.
+        self.assertEquals(DF.commonElements([[1,2,2,3],[2,3,4],[4,2]], 2),
+                          [2,3,4])
+        self.assert_(DF._listIsSorted([1,2,2,3]))
+        self.assert_(not DF._listIsSorted([1,3,2]))
+        servers = voted1.getAllServers()[:]
+        servers.reverse()
+        self.assert_(not DF.serverListIsSorted(servers))
+        self.assertEquals([ id(x) for x in DF.sortServerList(servers) ],
+                          [ id(x) for x in voted1.getAllServers() ])
 
     def testVoteFile(self):
         VF = mixminion.directory.Directory.VoteFile
@@ -5407,6 +6284,82 @@ class DirectoryServerTests(TestCase):
                              "#abstain Terrence %(fp5)s\n"
                              "#abstain carla %(fp5)s\n")%locals())
 
+    def testArtifactCache(self):
+        eq = self.assertEquals
+        DC = mixminion.directory.DirCache
+        d = mix_mktemp()
+        cache = DC.DirectoryArtifactCache(d)
+
+        # Nothing published yet.
+        eq(None, cache.getCurrentDigest())
+        eq(404, cache.respond("Directory.gz")[0])
+
+        # Publish a directory: raw, gzipped, and a pointer.
+        dig1 = DC.publishDirectory("Directory one\n", d)
+        eq(dig1, binascii.b2a_hex(Crypto.sha1("Directory one\n")))
+        eq(readFile(os.path.join(d, dig1)), "Directory one\n")
+        eq(readFile(os.path.join(d, "current")), dig1+"\n")
+        eq(gzip.GzipFile(os.path.join(d, dig1+".gz")).read(),
+           "Directory one\n")
+        eq(dig1, cache.getCurrentDigest())
+        tag1 = '"%s"'%dig1
+
+        status, headers, body = cache.respond("Directory")
+        eq(status, 200)
+        eq(body, "Directory one\n")
+        headers = dict(headers)
+        eq(headers["ETag"], tag1)
+        eq(headers["Content-Length"], str(len(body)))
+        eq(headers["Cache-Control"], "no-cache")
+        status, headers, body = cache.respond("Directory.gz")
+        eq(status, 200)
+        eq(body, readFile(os.path.join(d, dig1+".gz"), 1))
+        eq(dict(headers)["Content-Type"], "application/x-gzip")
+        # Conditional requests.
+        eq(cache.respond("Directory.gz", tag1)[:3:2], (304, ""))
+        eq(cache.respond("Directory.gz", 'W/"x", %s'%tag1)[0], 304)
+        eq(cache.respond("Directory.gz", '"x"')[0], 200)
+        # By digest.
+        status, headers, body = cache.respond(dig1)
+        eq((status, body), (200, "Directory one\n"))
+        self.assert_(dict(headers)["Cache-Control"].startswith("public"))
+        eq(cache.respond("0"*40)[0], 404)
+
+        # Republishing the same directory changes nothing.
+        eq(dig1, DC.publishDirectory("Directory one\n", d))
+        # A new directory replaces it; old ones get pruned.
+        dig2 = DC.publishDirectory("Directory two\n", d)
+        eq(dig2, cache.getCurrentDigest())
+        eq(cache.respond("Directory", tag1)[0], 200)
+        eq(cache.respond("Directory", '"%s"'%dig2)[0], 304)
+        eq(cache.respond(dig1)[2], "Directory one\n")
+        DC.publishDirectory("Directory three\n", d, keep=1)
+        eq(len(os.listdir(d)), 3)
+        eq(cache.respond(dig1)[0], 404)
+
+        # Now try it over HTTP, through urllib2.
+        server = DC.serveDirectory(d, ("127.0.0.1", TEST_PORT), serve=0)
+        try:
+            t = threading.Thread(target=server.handle_request)
+            t.start()
+            url = "http://127.0.0.1:%s/Directory"%TEST_PORT
+            f = urllib2.urlopen(url)
+            eq(f.read(), "Directory three\n")
+            tag = f.info().get("ETag")
+            f.close()
+            t.join()
+            t = threading.Thread(target=server.handle_request)
+            t.start()
+            req = urllib2.Request(url, headers={"If-None-Match": tag})
+            try:
+                urllib2.urlopen(req)
+                self.fail("Expected 304")
+            except urllib2.HTTPError, e:
+                eq(e.code, 304)
+            t.join()
+        finally:
+            server.server_close()
+
 #----------------------------------------------------------------------
 # EventStats
 class EventStatsTests(TestCase):
@@ -5733,6 +6686,105 @@ Foo: 100
         # FFFF Add tests for catching exceptions from buggy modules
         manager.close()
 
+    def testConcurrentDelivery(self):
+        FDP = FakeDeliveryPacket
+        mod_dir = mix_mktemp()
+        home_dir = mix_mktemp()
+        os.mkdir(mod_dir, 0700)
+        writeFile(os.path.join(mod_dir, "ExampleMod2.py"),
+                  EXAMPLE_MODULE_TEXT)
+        cfg_test = (SERVER_CONFIG_SHORT%home_dir) + """
+ModulePath = %s
+Module ExampleMod2.TestModule
+DeliveryThreads: 2
+DeliveryTimeout: 1 minute
+[Example]
+Foo: 99
+""" % mod_dir
+        try:
+            suspendLog()
+            conf = mixminion.server.ServerConfig.ServerConfig(string=cfg_test)
+        finally:
+            resumeLog()
+        manager = conf.getModuleManager()
+        manager.configure(conf)
+        self.assertEquals(manager.deliveryThreads, 2)
+        self.assertEquals(manager.deliveryTimeout, 60)
+        exampleMod = manager.nameToModule["TestModule"]
+        queue = manager.queues["TestModule"]
+
+        # By default, a module delivers one batch at a time.
+        self.assertEquals(exampleMod.getMaxConcurrency(), 1)
+        exampleMod.getMaxConcurrency = lambda: None
+
+        # Make the module hang until we say otherwise.
+        release = threading.Event()
+        origProcess = exampleMod.processMessage
+        def processMessage(packet, release=release, orig=origProcess):
+            release.wait()
+            return orig(packet)
+        exampleMod.processMessage = processMessage
+
+        # Pretend we have a delivery thread, so that the manager uses its
+        # worker pools.
+        class FakeThread:
+            def __init__(self): self.n = 0
+            def beginSending(self): self.n += 1
+        manager.thread = FakeThread()
+
+        t = "ZZZZ"*5
+        for _ in xrange(4):
+            manager.queueDecodedMessage(FDP('plain',1234,'good',"Hi",t))
+        # The module gets two batches, both of which hang; we don't wait
+        # for them.
+        manager._sendReadyMessages()
+        self.assertEquals(len(manager.inFlight), 2)
+        self.assertEquals([ len(b[3]) for b in manager.inFlight ], [2, 2])
+        # Both threads are busy, so the module doesn't get any more work.
+        manager.queueDecodedMessage(FDP('plain',1234,'good',"Hi",t))
+        manager._sendReadyMessages()
+        self.assertEquals(len(manager.inFlight), 2)
+        self.assertEquals(queue.count(), 5)
+
+        # Once the batches time out, they stop counting against the
+        # module's limit, but their messages stay pending.
+        batches = manager.inFlight[:]
+        try:
+            suspendLog()
+            manager._checkTimeouts(time.time()+61)
+        finally:
+            s = resumeLog()
+        self.assert_(stringContains(s, "no longer waiting for them"))
+        for b in batches:
+            self.assert_(b[4])
+            for m in b[3]:
+                self.assert_(queue.store.getMetadata(m.handle).isPending())
+        # So the module gets the fifth message, in a thread of its own...
+        manager._sendReadyMessages()
+        self.assertEquals(len(manager.inFlight), 3)
+        self.assertEquals(manager.pools["TestModule"].maxThreads, 4)
+        # ...but even after their retry time has passed, the stuck messages
+        # aren't handed out again.
+        self.assertEquals(queue.getReadyMessages(time.time()+3600), [])
+        time.sleep(.15)
+        manager._sendReadyMessages()
+        self.assertEquals(len(manager.inFlight), 3)
+
+        # When they finally finish, their messages are removed, each
+        # delivered exactly once.
+        release.set()
+        for _ in xrange(100):
+            if not manager.inFlight: break
+            time.sleep(.05)
+        self.assertEquals(manager.inFlight, [])
+        self.assertEquals(queue.count(), 0)
+        self.assertEquals(len(exampleMod.processedMessages), 5)
+        self.assert_(manager.thread.n >= 3)
+        manager._sendReadyMessages()
+        self.assertEquals(manager.inFlight, [])
+        self.assertEquals(len(exampleMod.processedMessages), 5)
+        manager.close()
+
     def testDecoding(self):
         'test decoding and test encapsulation.'
         eme = mixminion.server.Modules._escapeMessageForEmail
@@ -6169,6 +7221,94 @@ Free to hide no more.
             undoReplacedAttributes()
             clearReplacedFunctionCallLog()
 
+    def testSMTPConnectionPool(self):
+        Modules = mixminion.server.Modules
+        import smtplib
+        opened = []
+        class FakeSMTP:
+            def __init__(self, server):
+                self.server = server
+                self.sent = []
+                self.dead = 0
+                opened.append(self)
+            def sendmail(self, fromAddr, toList, msg):
+                if self.dead:
+                    raise smtplib.SMTPServerDisconnected("Gone")
+                if "refuse" in toList:
+                    raise smtplib.SMTPRecipientsRefused({})
+                self.sent.append((fromAddr, toList, msg))
+            def noop(self):
+                return (250, "OK")
+            def quit(self): pass
+            def close(self): pass
+        replaceAttribute(Modules.smtplib, 'SMTP', FakeSMTP)
+        workers = mixminion.ThreadUtils.WorkerPool("test", maxThreads=2)
+        cfg = { 'SendmailCommand' : None, 'SMTPServer' : 'relay' }
+        relayPool = Modules.SMTPConnectionPool('relay')
+        suspendLog()
+        try:
+            # Messages go over a single connection, one after another.
+            def send(cfg, toList, fromAddr, msg, relayPool=relayPool):
+                return mixminion.server.Modules.sendSMTPMessage(
+                    cfg, toList, fromAddr, msg, relayPool)
+            self.assertEquals(Modules.DELIVER_OK, send(cfg, ["a"], "me", "1"))
+            self.assertEquals(Modules.DELIVER_OK, send(cfg, ["b"], "me", "2"))
+            self.assertEquals(1, len(opened))
+            self.assertEquals([("me",["a"],"1"), ("me",["b"],"2")],
+                              opened[0].sent)
+            # A refused message doesn't cost us the connection...
+            self.assertEquals(Modules.DELIVER_FAIL_RETRY,
+                              send(cfg, ["refuse"], "me", "3"))
+            # ...but if the server drops a connection we kept open, we
+            # reconnect and try again.
+            opened[0].dead = 1
+            self.assertEquals(Modules.DELIVER_OK, send(cfg, ["c"], "me", "4"))
+            self.assertEquals(2, len(opened))
+            self.assertEquals([("me",["c"],"4")], opened[1].sent)
+
+            # Now a batch, over a pool of its own: every message is sent
+            # on its own, spread over at most two connections.
+            del opened[:]
+            pool = Modules.SMTPConnectionPool('relay')
+            msgs = [ (["x%s"%i], "me", "msg %s"%i) for i in xrange(20) ]
+            msgs.append((["y"], "me", "msg 0"))
+            msgs.append(Modules.DELIVER_FAIL_NORETRY)
+            msgs.append((["refuse"], "me", "bad"))
+            res = Modules.sendSMTPBatch(cfg, workers, msgs, pool)
+            self.assertEquals(res, [Modules.DELIVER_OK]*21 +
+                              [Modules.DELIVER_FAIL_NORETRY,
+                               Modules.DELIVER_FAIL_RETRY])
+            self.assert_(1 <= len(opened) <= 2)
+            sent = []
+            for con in opened:
+                sent.extend(con.sent)
+            sent.sort()
+            self.assertEquals(21, len(sent))
+            self.assertEquals([("me", ["x0"], "msg 0"), ("me", ["y"], "msg 0")],
+                              [ m for m in sent if m[2] == "msg 0" ])
+            # The first pool's connection was left alone.
+            self.assertEquals(1, len(relayPool.idle))
+
+            # Closing a module shuts down its own pool, but not anybody
+            # else's.
+            class FakeModule:
+                pass
+            module = FakeModule()
+            module.smtpWorkers = mixminion.ThreadUtils.WorkerPool("test2",
+                                                                  maxThreads=1)
+            module.smtpPool = pool
+            self.assert_(pool.idle)
+            Modules._closeSMTPWorkerPool(module)
+            self.assertEquals([], pool.idle)
+            self.assertEquals(None, module.smtpWorkers)
+            self.assertEquals(1, len(relayPool.idle))
+        finally:
+            s = resumeLog()
+            workers.shutdown(wait=1)
+            relayPool.close()
+            undoReplacedAttributes()
+        self.assertEquals(2, s.count("SMTP host relay refused message"))
+
     def testDirectoryDump(self):
         """Check out the DirectoryStoreModule that we use for testing on
            machines with unreliable/nonexistent SMTP."""
@@ -6549,6 +7689,259 @@ class DNSFarmTests(TestCase):
             undoReplacedAttributes()
             mixminion.NetUtils._PROTOCOL_SUPPORT = None
 
+    def testDNSPrefetch(self):
+        import mixminion.server.DNSFarm
+        DF = mixminion.server.DNSFarm
+        # A pool that runs its jobs only when we tell it to.
+        class FakePool:
+            def __init__(self): self.jobs = []
+            def submit(self, fn, *args): self.jobs.append((fn, args))
+            def run(self):
+                jobs, self.jobs = self.jobs, []
+                for fn, args in jobs: fn(*args)
+                return len(jobs)
+            def shutdown(self, flush=1, wait=0): pass
+        pool = FakePool()
+        cache = DF.DNSCache(pool=pool)
+        results = []
+        def callback(name, val, results=results):
+            results.append((name, val[1]))
+        try:
+            overrideDNS({'foo' : '10.0.0.1', 'bar' : '10.0.0.2'})
+            # Static IPs aren't looked up; names we're already looking up
+            # aren't looked up twice.
+            cache.lookup('bar', callback)
+            self.assertEquals(cache.prefetch(['foo', 'bar', '10.0.0.9']), 1)
+            self.assertEquals(pool.run(), 2)
+            self.assertEquals(results, [('bar', '10.0.0.2')])
+            self.assertEquals(cache.prefetchNames, {'foo':1, 'bar':1})
+            # Now lookups for prefetched names don't wait.
+            cache.lookup('foo', callback)
+            self.assertEquals(results[-1], ('foo', '10.0.0.1'))
+            self.assertEquals(cache.prefetch(['foo']), 0)
+
+            # Nothing is about to expire, so there's nothing to refresh.
+            now = time.time()
+            self.assertEquals(cache.refreshExpiring(now), 0)
+            # When foo is about to expire, we look it up again, but keep
+            # answering with the old answer until the new one arrives.
+            old = cache.cache['foo']
+            self.assertEquals(cache.refreshExpiring(
+                old[2]+DF.MAX_ENTRY_TTL-DF.REFRESH_INTERVAL), 1)
+            self.assertEquals(cache.refreshing, {'foo':1})
+            cache.lookup('foo', callback)
+            self.assertEquals(len(results), 3)
+            self.assertEquals(cache.refreshExpiring(
+                old[2]+DF.MAX_ENTRY_TTL-DF.REFRESH_INTERVAL), 0)
+            self.assertEquals(pool.run(), 1)
+            self.assertEquals(cache.refreshing, {})
+            self.assert_(cache.cache['foo'] is not old)
+            # bar isn't prefetched any more, so we don't refresh it.
+            self.assertEquals(cache.refreshExpiring(
+                now+DF.MAX_ENTRY_TTL+1), 1)
+            self.assertEquals(cache.refreshing.keys(), ['foo'])
+
+            stats = cache.getStats()
+            self.assertEquals(stats['lookups'], 3)
+            self.assertEquals(stats['hits'], 2)
+            self.assertEquals(stats['misses'], 1)
+            self.assertEquals(stats['prefetched'], 1)
+            self.assertEquals(stats['refreshed'], 2)
+            self.assertEquals(stats['size'], 2)
+            self.assertFloatEq(stats['hitRate'], 2/3.0)
+
+            # Hostnames are case-insensitive.
+            self.assertEquals(cache.prefetch(['FOO', 'Bar']), 0)
+            self.assertEquals(cache.prefetchNames, {'foo':1, 'bar':1})
+            cache.lookup('Foo', callback)
+            self.assertEquals(results[-1], ('foo', '10.0.0.1'))
+            self.assertEquals(cache.getNonblocking('fOO'), cache.cache['foo'])
+            self.assertEquals(cache.getStats()['hits'], 3)
+
+            # If a refresh fails, we keep the old answer until it expires.
+            overrideDNS({'bar' : '10.0.0.2'})
+            old = cache.cache['foo']
+            try:
+                suspendLog()
+                self.assertEquals(pool.run(), 1)
+            finally:
+                resumeLog()
+            self.assertEquals(cache.refreshing, {})
+            self.assert_(cache.cache['foo'] is old)
+            cache.cache['foo'] = old[:2] + (old[2]-DF.MAX_ENTRY_TTL-1,)
+            self.assertEquals(cache.refreshExpiring(), 1)
+            self.assertEquals(pool.run(), 1)
+            self.assertEquals(cache.cache['foo'][0], 'NOENT')
+        finally:
+            undoReplacedAttributes()
+            cache.shutdown()
+
+    def testAsyncResolver(self):
+        import mixminion.server.DNSFarm
+        DF = mixminion.server.DNSFarm
+        # A nameserver that answers from a table: map from (name, type) to
+        # (rcode, list of (type, ttl, rdata), SOA (ttl, minimum) or None).
+        class StubDNSServer(mixminion.server.MMTPServer.Connection):
+            def __init__(self, table):
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.sock.bind(("127.0.0.1", 0))
+                self.sock.setblocking(0)
+                self.table = table
+                self.queries = []
+                self.ports = {}
+                self.drop = {}
+            def fileno(self): return self.sock.fileno()
+            def getStatus(self): return 1,0,1
+            def process(self, r, w, x, cap):
+                try:
+                    msg, addr = self.sock.recvfrom(4096)
+                except socket.error:
+                    return 1,0,1,0
+                qid = struct.unpack("!H", msg[:2])[0]
+                name, off = DF._readName(msg, 12)
+                qtype = struct.unpack("!H", msg[off:off+2])[0]
+                self.queries.append((name, qtype))
+                self.ports[addr[1]] = 1
+                if self.drop.get(name):
+                    self.drop[name] -= 1
+                    return 1,0,1,0
+                rcode, answers, soa = self.table.get((name, qtype), (0,[],None))
+                out = [ struct.pack("!HHHHHH", qid, 0x8180|rcode, 1,
+                                    len(answers), soa and 1 or 0, 0),
+                        msg[12:off+4] ]
+                for tp, ttl, rdata in answers:
+                    out.append(struct.pack("!HHHIH", 0xC00C, tp, 1, ttl,
+                                           len(rdata)) + rdata)
+                if soa:
+                    out.append(struct.pack("!HHHIH", 0xC00C, 6, 1, soa[0], 22)
+                               + "\0\0" + struct.pack("!IIIII", 1, 2, 3, 4,
+                                                       soa[1]))
+                self.sock.sendto("".join(out), addr)
+                return 1,0,1,0
+
+        ip6 = "\x00\x18\x0f\xff" + "\x00"*10 + "\x04\x01"
+        stub = StubDNSServer({
+            ('foo.example', 1) : (0, [(1, 300, "\x0a\x00\x00\x01")], None),
+            ('short.example', 1) : (0, [(1, 5, "\x0a\x00\x00\x02")], None),
+            ('gone.example', 1) : (3, [], (900, 600)),
+            ('six.example', 28) : (0, [(28, 3600, ip6)], None),
+            ('slow.example', 1) : (0, [(1, 100, "\x0a\x00\x00\x03")], None),
+            })
+        stub.drop = { 'slow.example' : 1, 'black.hole' : 99 }
+        hostsFile = mix_mktemp()
+        writeFile(hostsFile, "# comment\n127.0.0.1 localhost MyHost\n")
+        resolver = DF.AsyncResolver([stub.sock.getsockname()], hostsFile)
+        cache = DF.DNSCache(resolver=resolver)
+        self.assertEquals(cache.pool, None)
+        server = mixminion.server.MMTPServer.AsyncServer()
+        server.register(stub)
+        resolver.connectServer(server)
+        self.assertEquals(len(server.connections), DF.RESOLVER_SOCKETS+1)
+        results = {}
+        def callback(name, val, results=results):
+            results[name] = val
+        def runUntil(fn, server=server, resolver=resolver):
+            for _ in xrange(100):
+                if fn(): return
+                server.process(0.05)
+                resolver.poll()
+        try:
+            mixminion.NetUtils._PROTOCOL_SUPPORT = (1,1)
+            for name in ('foo.example', 'short.example', 'gone.example',
+                         'six.example', 'slow.example', 'myhost',
+                         'black.hole'):
+                cache.lookup(name, callback)
+            # We never send a query for a name in the hosts file.
+            self.failIf(('myhost', 1) in stub.queries)
+            runUntil(lambda r=results: len(r) >= 5)
+            self.assertEquals(results['foo.example'][:2],
+                              (socket.AF_INET, '10.0.0.1'))
+            self.assertEquals(cache.ttls['foo.example'], 300)
+            # TTLs that are too short get rounded up.
+            self.assertEquals(cache.ttls['short.example'], DF.MIN_ENTRY_TTL)
+            # Negative answers are cached for the SOA's minimum TTL.
+            self.assertEquals(results['gone.example'][:2],
+                              ('NOENT', 'No such host'))
+            self.assertEquals(cache.ttls['gone.example'], 600)
+            # No IPv4 address, so we asked for IPv6.
+            self.assertEquals(results['six.example'][:2],
+                              (mixminion.NetUtils.AF_INET6,
+                               '18:fff:0:0:0:0:0:401'))
+            self.assertEquals(results['myhost'][:2],
+                              (socket.AF_INET, '127.0.0.1'))
+
+            # The first query for slow.example got lost; retry it.
+            self.failIf(results.has_key('slow.example'))
+            resolver.poll(time.time()+DF.RESOLVER_TIMEOUT+1)
+            runUntil(lambda r=results: r.has_key('slow.example'))
+            self.assertEquals(results['slow.example'][:2],
+                              (socket.AF_INET, '10.0.0.3'))
+            self.assertEquals(stub.queries.count(('slow.example',1)), 2)
+
+            # Eventually, we give up on black.hole.
+            for i in xrange(DF.RESOLVER_TRIES):
+                self.failIf(results.has_key('black.hole'))
+                runUntil(lambda s=stub, i=i:
+                         s.queries.count(('black.hole',1)) > i)
+                resolver.poll(time.time()+(i+1)*(DF.RESOLVER_TIMEOUT+1))
+            self.assertEquals(results['black.hole'][0], "NOENT")
+            self.assertEquals(cache.ttls['black.hole'], DF.FAILURE_TTL)
+
+            # Cached answers are used until they expire.
+            cache.lookup('foo.example', callback)
+            self.assertEquals(stub.queries.count(('foo.example',1)), 1)
+            v = cache.cache['foo.example']
+            cache.cache['foo.example'] = v[:2] + (v[2]-301,)
+            del results['foo.example']
+            cache.lookup('foo.example', callback)
+            runUntil(lambda r=results: r.has_key('foo.example'))
+            self.assertEquals(stub.queries.count(('foo.example',1)), 2)
+            cache.cleanCache(time.time()+DF.MIN_ENTRY_TTL+1)
+            self.assertEquals(cache.getNonblocking('short.example'), None)
+            self.failIf(cache.ttls.has_key('short.example'))
+            self.assertEquals(cache.getNonblocking('foo.example'),
+                              results['foo.example'])
+
+            # Each socket moves to a new port once it has sent its share of
+            # queries, and we close the old one once it's done.
+            names = [ "n%s.example"%i for i in
+                      xrange(DF.RESOLVER_SOCKETS*DF.RESOLVER_SOCKET_QUERIES) ]
+            mixminion.NetUtils._PROTOCOL_SUPPORT = (1,0)
+            for name in names:
+                cache.lookup(name, callback)
+            self.assert_(resolver.retired)
+            runUntil(lambda r=results, n=names: r.has_key(n[-1]) and
+                     len([ 1 for x in n if r.has_key(x) ]) == len(n))
+            resolver.poll()
+            self.assertEquals(resolver.retired, [])
+            self.assertEquals(resolver.unregistered, [])
+            self.assertEquals(len(resolver.socks), DF.RESOLVER_SOCKETS)
+            self.assertEquals(len(server.connections), DF.RESOLVER_SOCKETS+1)
+            for sock in resolver.socks:
+                self.assert_(server.connections[sock.fileno()] is sock)
+            self.assert_(len(stub.ports) > DF.RESOLVER_SOCKETS)
+            # An answer that arrives on the wrong socket is ignored.
+            cache.lookup('foo2.example', callback)
+            qid, q = resolver.queries.items()[0]
+            other = [ sock for sock in resolver.socks if sock is not q.sock ][0]
+            answer = (struct.pack("!HHHHHH", qid, 0x8180, 1, 1, 0, 0) +
+                      DF._encodeName('foo2.example') + struct.pack("!HH",1,1) +
+                      struct.pack("!HHHIH", 0xC00C, 1, 1, 300, 4) + "\x01"*4)
+            resolver._handleResponse(answer, stub.sock.getsockname(),
+                                     time.time(), other)
+            self.assert_(resolver.queries.has_key(qid))
+            resolver._handleResponse(answer, stub.sock.getsockname(),
+                                     time.time(), q.sock)
+            self.failIf(resolver.queries.has_key(qid))
+
+            # Malformed answers.
+            self.assertRaises(DF.DNSError, DF._parseResponse, "X"*5)
+            self.assertRaises(DF.DNSError, DF._encodeName, "a.."+"b"*70)
+        finally:
+            mixminion.NetUtils._PROTOCOL_SUPPORT = None
+            cache.shutdown()
+            stub.sock.close()
+
 #----------------------------------------------------------------------
 
 class ServerMainTests(TestCase):
@@ -6582,6 +7975,103 @@ class ServerMainTests(TestCase):
         s.processEvents(tm+5)
         self.assertEquals(["c", "d", "b", "c" ], lst)
 
+    def testLoadTestHarness(self):
+        import mixminion.loadtest as LT
+        # The harness's server configuration must be one we accept.
+        home = mix_mktemp()
+        cfg = mixminion.server.ServerConfig.ServerConfig(
+            string=LT.getServerConfigString(home, "LoadTest0", 3,
+                               "http://127.0.0.1:48304/Directory", 48300))
+        self.assertEquals(cfg['Server']['Nickname'], "LoadTest0")
+        self.assertEquals(cfg['Server']['MixInterval'].getSeconds(), 3)
+        self.assertEquals(cfg['Incoming/MMTP']['Port'], 48300)
+
+        # Metrics from a run.
+        net = LT.LocalMixnet(mix_mktemp(), nServers=2)
+        net.sent = { 0 : 100.0, 1 : 100.5, 2 : 101.0, 3 : 101.5 }
+        net.arrivals = { 0 : 101.0, 1 : 103.5, 2 : 103.0 }
+        net.nAcked = 4
+        res = net._summarize(100.0, 2.0, [(10.0,None)], [(12.0,None)])
+        self.assertEquals(res['PacketsSent'], 4)
+        self.assertEquals(res['PacketsReceived'], 3)
+        self.assertEquals(res['PacketsLost'], 1)
+        self.assertFloatEq(res['OfferedRate'], 2.0)
+        self.assertFloatEq(res['Throughput'], 3/3.5)
+        self.assertFloatEq(res['LatencyP50'], 2.0)
+        self.assertFloatEq(res['LatencyMax'], 3.0)
+        self.assertFloatEq(res['HopLatencyP50'], 2.0/3)
+        self.assertFloatEq(res['CPUPerPacket'], 2.0/3)
+        self.assert_(not res.has_key('DiskBytesPerPacket'))
+        out = LT.formatResults(res)
+        self.assert_(stringContains(out, "PacketsLost: 1\n"))
+        self.assert_(stringContains(out, "DiskBytesPerPacket: unknown\n"))
+
+        # Success and failure.
+        self.assertEquals(LT.checkResults(res, 25), None)
+        self.assert_(LT.checkResults(res, 10).startswith("Lost 25.0%"))
+        net.arrivals = {}
+        res = net._summarize(100.0, 2.0, [(None,None)], [(None,None)])
+        self.assertEquals(LT.checkResults(res, 100),
+                          "No packets were delivered.")
+        self.assertEquals(LT.checkResults({'PacketsSent' : 0}),
+                          "No packets were sent.")
+
+    def testIncomingQueue(self):
+        IncomingQueue = mixminion.server.ServerMain.IncomingQueue
+        PACKET_LEN = mixminion.Packet.PACKET_LEN
+        class FakeRelayedPacket:
+            def __init__(self, pkt): self.pkt = pkt
+            def isDelivery(self): return 0
+        class FakePacketHandler:
+            def processPacket(self, pkt):
+                return FakeRelayedPacket(str(pkt))
+        class FakeMixPool:
+            def __init__(self): self.objects = []
+            def queueObject(self, obj): self.objects.append(obj.pkt)
+        class FakeThread:
+            def __init__(self): self.jobs = []
+            def addJob(self, job): self.jobs.append(job)
+            def run(self):
+                jobs, self.jobs = self.jobs, []
+                for job in jobs: job()
+                return len(jobs)
+        d = mix_mktemp()
+        pkts = [ chr(ord("A")+i)*PACKET_LEN for i in xrange(4) ]
+
+        # Packets go into the ring until it's full, then into files.
+        queue = IncomingQueue(d, FakePacketHandler(), ringSlots=2)
+        pool, thread = FakeMixPool(), FakeThread()
+        queue.connectQueues(pool, thread)
+        for p in pkts[:3]:
+            queue.queuePacket(p)
+        self.assertEquals(queue.ring.count(), 2)
+        self.assertEquals(mixminion.Filestore.StringStore.count(queue), 1)
+        self.assertEquals(queue.count(), 3)
+        # Processing a packet moves it to the mix pool and frees its slot.
+        thread.jobs[0]()
+        self.assertEquals(pool.objects, [pkts[0]])
+        self.assertEquals(queue.ring.count(), 1)
+        self.assertEquals(queue.count(), 2)
+        queue.close()
+
+        # When we restart, the packets we hadn't processed are queued
+        # again, from both the ring and the files.
+        queue = IncomingQueue(d, FakePacketHandler(), ringSlots=2)
+        pool, thread = FakeMixPool(), FakeThread()
+        self.assertEquals(queue.count(), 2)
+        queue.connectQueues(pool, thread)
+        self.assertEquals(thread.run(), 2)
+        pool.objects.sort()
+        self.assertEquals(pool.objects, pkts[1:3])
+        self.assertEquals(queue.count(), 0)
+        # Now the ring has room again.
+        queue.queuePacket(pkts[3])
+        self.assertEquals(queue.ring.count(), 1)
+        self.assertEquals(thread.run(), 1)
+        self.assertEquals(pool.objects[-1], pkts[3])
+        self.assertEquals(queue.count(), 0)
+        queue.close()
+
     def testMixPool(self):
         ServerConfig = mixminion.server.ServerConfig.ServerConfig
         MixPool = mixminion.server.ServerMain.MixPool
@@ -6620,7 +8110,39 @@ class ServerMainTests(TestCase):
         self.assertEquals(pool.queue.minSend, 1)
         self.assertFloatEq(pool.queue.sendRate, .4)
 
-        # FFFF test other mix pool behavior
+        # Relayed packets move to the outgoing queue without being
+        # unpickled; delivery packets go to the modules.
+        class FakeManager:
+            def __init__(self): self.packets = []
+            def queueDecodedMessage(self, p):
+                self.packets.append(p)
+                return "MOD"
+        pool = MixPool(configTimed, mixDir)
+        outgoing = mixminion.server.ServerMain.OutgoingQueue(
+            mix_mktemp(), "Z"*20)
+        manager = FakeManager()
+        pool.connectQueues(outgoing, manager)
+        addr = IPV4Info("1.2.3.4", 48099, "Z"*20)
+        pkt = "X"*(1<<15)
+        pool.queueObject(RelayedPacket(addr, pkt))
+        pool.queueObject(DeliveryPacket(0x1000, "addr", "K"*16, "P"*28*1024))
+        unpickled = []
+        getObject = pool.queue.getObject
+        def getObjectAndRecord(h, getObject=getObject, unpickled=unpickled):
+            o = getObject(h)
+            unpickled.append(o)
+            return o
+        pool.queue.getObject = getObjectAndRecord
+        pool.mix()
+        self.assertEquals(pool.count(), 0)
+        self.assertEquals(len(unpickled), 1)
+        self.assert_(unpickled[0].isDelivery())
+        self.assertEquals(manager.packets, unpickled)
+        self.assertEquals(outgoing.count(), 1)
+        h = outgoing.getAllMessages()[0]
+        self.assertEquals(outgoing.store.getMetadata(h).address, addr)
+        self.assertEquals(outgoing.store.getObject(h).getPacket(), pkt)
+        outgoing.close()
 
 #----------------------------------------------------------------------
 
@@ -7490,6 +9012,77 @@ class ClientDirectoryTests(TestCase):
             "  [1970-01-02 to 1970-01-03]", "    A:a1", "    B:b1",
             "  [1970-01-03 to 1970-01-04]", "    A:a2", "    B:b2" ])
 
+    def testBackgroundUpdate(self):
+        eq = self.assertEquals
+        dirname = mix_mktemp()
+        config = mixminion.Config.ClientConfig(
+            string="[User]\nUserDir: %s\n"%dirname)
+        cd = mixminion.ClientDirectory.ClientDirectory(config)
+        calls = []
+        release = threading.Event()
+        finished = []
+        def fakeUpdate(force=0, now=None, calls=calls, release=release):
+            calls.append(threading.currentThread())
+            release.wait(10)
+            if force == 2:
+                raise MixError("Couldn't connect")
+        cd.update = fakeUpdate
+
+        # With no directory, we update in the caller's thread.
+        release.set()
+        eq(0, cd._hasDirectory())
+        eq(0, cd.updateInBackground(onDone=finished.append))
+        eq(calls, [threading.currentThread()])
+        eq(finished, [])
+
+        # With a directory, we return at once, keep serving the old one,
+        # and only start one updating thread at a time.
+        del calls[:]
+        release.clear()
+        cd._hasDirectory = lambda: 1
+        oldServers = cd.getAllServers()
+        eq(1, cd.updateInBackground(onDone=finished.append))
+        eq(1, cd.isUpdating())
+        eq(1, cd.updateInBackground(onDone=finished.append))
+        eq(oldServers, cd.getAllServers())
+        t = cd._refreshThread
+        release.set()
+        t.join(10)
+        eq(1, len(calls))
+        self.assert_(calls[0] is t)
+        eq(finished, [None])
+        eq(0, cd.isUpdating())
+
+        # Failures get passed to onDone, and don't escape the thread.
+        del finished[:]
+        suspendLog()
+        try:
+            eq(1, cd.updateInBackground(force=2, onDone=finished.append))
+            t = cd._refreshThread
+            if t is not None:
+                t.join(10)
+        finally:
+            s = resumeLog()
+        eq(1, len(finished))
+        self.assert_(isinstance(finished[0], MixError))
+        self.assert_(stringContains(s, "Couldn't connect"))
+        eq(0, cd.isUpdating())
+
+    def testServerURL(self):
+        # ServerURL overrides the default directory URL.
+        DBDS = mixminion.ClientDirectory.DirectoryBackedDescriptorSource
+        dirname = mix_mktemp()
+        config = mixminion.Config.ClientConfig(
+            string="[User]\nUserDir: %s\n"%dirname)
+        cd = mixminion.ClientDirectory.ClientDirectory(config)
+        base = [ b for b in cd.store.bases if isinstance(b, DBDS) ][0]
+        self.assertEquals(base.url, None)
+        config = mixminion.Config.ClientConfig(string=
+            "[User]\nUserDir: %s\n[DirectoryServers]\n"
+            "ServerURL: http://127.0.0.1:8080/Directory\n"%dirname)
+        cd.configure(config)
+        self.assertEquals(base.url, "http://127.0.0.1:8080/Directory")
+
     def writeDescriptorsToDisk(self):
         edesc = getExampleServerDescriptors()
         d = mix_mktemp()
@@ -497,7 +497,8 @@ if sys.platform != 'win32':
 
 extmodule = Extension(
     "mixminion._minionlib",
-    ["src/crypt.c", "src/aes_ctr.c", "src/main.c", "src/tls.c", "src/fec.c" ],
+    ["src/crypt.c", "src/aes_ctr.c", "src/main.c", "src/tls.c", "src/fec.c",
+     "src/shred.c" ],
     include_dirs=INCLUDE_DIRS,
     extra_objects=STATIC_LIBS,
     extra_compile_args=EXTRA_CFLAGS + OPENSSL_CFLAGS,
@@ -24,10 +24,26 @@ the README file for further instructions."
 #define INLINE inline
 #endif
 
-/* We provide our own implementation of counter mode; see aes_ctr.c
+/* An AES key, as returned by aes_key(): the expanded key for our own
+ * counter mode implementation, and the raw key for OpenSSL's EVP one.
+ */
+typedef struct mm_AES_KEY {
+        AES_KEY key;
+        unsigned char raw[16];
+} mm_AES_KEY;
+
+/* We provide our own implementation of counter mode; see aes_ctr.c.
+ * mm_aes_ctr_crypt uses OpenSSL's EVP implementation instead, when it's
+ * available and the input is long enough to be worth it.
  */
 void mm_aes_counter128(const char *in, char *out, unsigned int len,
                        AES_KEY *key, unsigned long count);
+void mm_aes_ctr_crypt(const char *in, char *out, unsigned int len,
+                      mm_AES_KEY *key, unsigned long count);
+int mm_aes_ctr_set_key(mm_AES_KEY *key, const unsigned char *raw);
+void mm_aes_ctr_init(void);
+const char *mm_aes_ctr_get_backend(void);
+int mm_aes_ctr_set_backend(const char *name);
 
 /* Propagate an error from OpenSSL.  If 'crypto', it's a cryptography
  * error.  Else, it's a TLS error.
@@ -64,8 +80,17 @@ FUNC_DOC(mm_sha1);
 FUNC_DOC(mm_sha1);
 FUNC_DOC(mm_aes_key);
 FUNC_DOC(mm_aes_ctr128_crypt);
+FUNC_DOC(mm_aes_ctr_backend);
+FUNC_DOC(mm_derive_keys);
 FUNC_DOC(mm_aes128_block_crypt);
 FUNC_DOC(mm_strxor);
+FUNC_DOC(mm_lioness_encrypt);
+FUNC_DOC(mm_lioness_decrypt);
+#if PY_VERSION_HEX >= 0x02060000
+FUNC_DOC(mm_lioness_decrypt_inplace);
+#endif
+FUNC_DOC(mm_bear_encrypt);
+FUNC_DOC(mm_bear_decrypt);
 FUNC_DOC(mm_openssl_seed);
 #ifdef MS_WINDOWS
 FUNC_DOC(mm_win32_openssl_seed);
@@ -85,6 +110,9 @@ FUNC_DOC(mm_generate_cert);
 extern PyObject *mm_CryptoError;
 extern char mm_CryptoError__doc__[];
 
+/* From shred.c */
+FUNC_DOC(mm_shred_files);
+
 /* From fec.c */
 FUNC_DOC(mm_FEC_generate);
 extern PyTypeObject mm_FEC_Type;
@@ -11,14 +11,24 @@
  *
  * Disclosure: I have seen and played with the OpenSSL implementation for
  *   a while before I decided to abandon it.
+ *
+ * Newer OpenSSLs have an EVP counter mode that does a) right, and that
+ * uses hardware AES (and pipelining) where it can; that's a lot faster
+ * than calling AES_encrypt once per block.  So when the EVP version is
+ * present and agrees with ours, we use it for everything but short
+ * inputs, and handle b) by discarding the start of the first block.
  */
 
 #include "_minionlib.h"
 
 #ifndef TRUNCATED_OPENSSL_INCLUDES
 #include <openssl/aes.h>
+#include <openssl/err.h>
+#include <openssl/evp.h>
 #else
 #include <aes.h>
+#include <err.h>
+#include <evp.h>
 #endif
 #include <string.h>
 #include <stdio.h>
@@ -101,6 +111,139 @@ mm_aes_counter128(const char *in, char *out, unsigned int len, AES_KEY *key,
         }
 }
 
+/* ======================================================================
+   EVP backend. */
+
+#if OPENSSL_VERSION_NUMBER >= 0x10001000L
+#define MM_HAVE_EVP_CTR
+#endif
+
+/* Inputs shorter than this many bytes aren't worth setting up an EVP
+ * context for; we use mm_aes_counter128 on them instead. */
+#define MM_EVP_MIN_LEN 256
+
+/* True iff we should use EVP for long inputs. */
+static int mm_use_evp = 0;
+
+#ifdef MM_HAVE_EVP_CTR
+/* Like mm_aes_counter128, but using OpenSSL's EVP counter mode with the
+ * raw 16-byte key 'raw'.  Returns 0 on success.  On failure, returns -1
+ * without touching 'out'. */
+static int
+mm_aes_counter128_evp(const char *in, char *out, unsigned int len,
+                      const unsigned char *raw, unsigned long count)
+{
+        unsigned char iv[16];
+        unsigned char skip[16];
+        EVP_CIPHER_CTX *ctx;
+        int outl, r = -1;
+        u32 block = (u32)(count >> 4);
+
+        memset(iv, 0, 12);
+        iv[12] = (u8)((block>>24) & 0xff);
+        iv[13] = (u8)((block>>16) & 0xff);
+        iv[14] = (u8)((block>>8) & 0xff);
+        iv[15] = (u8)(block & 0xff);
+        memset(skip, 0, sizeof(skip));
+
+        if (!(ctx = EVP_CIPHER_CTX_new()))
+                goto done;
+        if (EVP_EncryptInit_ex(ctx, EVP_aes_128_ctr(), NULL, raw, iv) != 1)
+                goto done;
+        /* Throw away the part of the first block that comes before
+         * 'count'. */
+        if ((count & 0x0f) &&
+            EVP_EncryptUpdate(ctx, skip, &outl, skip, count & 0x0f) != 1)
+                goto done;
+        if (EVP_EncryptUpdate(ctx, (unsigned char*)out, &outl,
+                              (const unsigned char*)in, len) != 1)
+                goto done;
+        r = 0;
+ done:
+        if (ctx)
+                EVP_CIPHER_CTX_free(ctx);
+        memset(skip, 0, sizeof(skip));
+        if (r)
+                ERR_clear_error();
+        return r;
+}
+#endif
+
+/* Set 'key' to hold the 16-byte AES key 'raw'.  Returns 0 on success. */
+int
+mm_aes_ctr_set_key(mm_AES_KEY *key, const unsigned char *raw)
+{
+        memcpy(key->raw, raw, 16);
+        return AES_set_encrypt_key(raw, 128, &key->key);
+}
+
+/* Encrypt 'len' bytes from 'in' into 'out' in counter mode, starting
+ * with byte 'count' of the key stream.  'in' and 'out' may be the same.
+ * Uses whichever backend is selected.  Doesn't touch Python objects, so
+ * it's safe to call without the GIL. */
+void
+mm_aes_ctr_crypt(const char *in, char *out, unsigned int len,
+                 mm_AES_KEY *key, unsigned long count)
+{
+#ifdef MM_HAVE_EVP_CTR
+        if (mm_use_evp && len >= MM_EVP_MIN_LEN &&
+            !mm_aes_counter128_evp(in, out, len, key->raw, count))
+                return;
+#endif
+        mm_aes_counter128(in, out, len, &key->key, count);
+}
+
+/* Choose our backend: use EVP if it's there and gives the same answers
+ * as mm_aes_counter128, including when we start in the middle of a block
+ * and when the counter carries past 32 bits. */
+void
+mm_aes_ctr_init(void)
+{
+#ifdef MM_HAVE_EVP_CTR
+        static const unsigned char raw[16] = "minion-ctr-test";
+        unsigned long starts[] = { 0, 7, (unsigned long)-1 };
+        char in[MM_EVP_MIN_LEN+37], out1[sizeof(in)], out2[sizeof(in)];
+        mm_AES_KEY key;
+        unsigned int i;
+
+        mm_use_evp = 0;
+        if (mm_aes_ctr_set_key(&key, raw))
+                return;
+        for (i = 0; i < sizeof(in); ++i)
+                in[i] = (char)i;
+        for (i = 0; i < sizeof(starts)/sizeof(starts[0]); ++i) {
+                mm_aes_counter128(in, out1, sizeof(in), &key.key, starts[i]);
+                if (mm_aes_counter128_evp(in, out2, sizeof(in), key.raw,
+                                          starts[i]) ||
+                    memcmp(out1, out2, sizeof(in)))
+                        return;
+        }
+        mm_use_evp = 1;
+#endif
+}
+
+/* Return the name of the current backend: "evp" or "builtin". */
+const char *
+mm_aes_ctr_get_backend(void)
+{
+        return mm_use_evp ? "evp" : "builtin";
+}
+
+/* Select a backend by name.  Returns 0 on success, -1 if the backend is
+ * unknown or unavailable. */
+int
+mm_aes_ctr_set_backend(const char *name)
+{
+        if (!strcmp(name, "builtin")) {
+                mm_use_evp = 0;
+                return 0;
+        } else if (!strcmp(name, "evp")) {
+                mm_aes_ctr_init();
+                return mm_use_evp ? 0 : -1;
+        }
+        return -1;
+}
+
 /*
   Local Variables:
   mode:c
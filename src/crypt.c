@@ -108,7 +108,7 @@ static void
 aes_destruct(void *obj, void *desc)
 {
         assert(desc==aes_descriptor);
-        memset(obj, 0, sizeof(AES_KEY));
+        memset(obj, 0, sizeof(mm_AES_KEY));
         free(obj);
 }
 
@@ -117,7 +117,8 @@ static int
 aes_arg_convert(PyObject *obj, void *adr)
 {
         if (PyCObject_Check(obj) && PyCObject_GetDesc(obj) == aes_descriptor) {
-                *((AES_KEY**) adr) = (AES_KEY*) PyCObject_AsVoidPtr(obj);
+                *((mm_AES_KEY**) adr) =
+                        (mm_AES_KEY*) PyCObject_AsVoidPtr(obj);
                 return 1;
         } else {
                 TYPE_ERR("Expected an AES key as an argument.");
@@ -141,7 +142,7 @@ mm_aes_key(PyObject *self, PyObject *args, PyObject *kwdict)
         char *key;
         int keylen;
         int r;
-        AES_KEY *aes_key = NULL;
+        mm_AES_KEY *aes_key = NULL;
         PyObject *result;
 
         if (!PyArg_ParseTupleAndKeywords(args, kwdict, "s#:aes_key", kwlist,
@@ -152,11 +153,11 @@ mm_aes_key(PyObject *self, PyObject *args, PyObject *kwdict)
                 return NULL;
         }
 
-        if (!(aes_key = malloc(sizeof(AES_KEY)))) {
+        if (!(aes_key = malloc(sizeof(mm_AES_KEY)))) {
                 PyErr_NoMemory(); goto err;
         }
         Py_BEGIN_ALLOW_THREADS
-        r = AES_set_encrypt_key((unsigned char*)key, keylen*8, aes_key);
+        r = mm_aes_ctr_set_key(aes_key, (unsigned char*)key);
         Py_END_ALLOW_THREADS
         if (r) {
                 mm_SSL_ERR(1);
@@ -169,7 +170,7 @@ mm_aes_key(PyObject *self, PyObject *args, PyObject *kwdict)
 
  err:
         if (aes_key) {
-                memset(aes_key, 0, sizeof(AES_KEY));
+                memset(aes_key, 0, sizeof(mm_AES_KEY));
                 free(aes_key);
         }
         return NULL;
@@ -194,7 +195,7 @@ mm_aes_ctr128_crypt(PyObject *self, PyObject *args, PyObject *kwdict)
         char *input;
         int inputlen, prng=0;
         long idx=0;
-        AES_KEY *aes_key = NULL;
+        mm_AES_KEY *aes_key = NULL;
 
         PyObject *output;
 
@@ -221,14 +222,150 @@ mm_aes_ctr128_crypt(PyObject *self, PyObject *args, PyObject *kwdict)
         }
 
         Py_BEGIN_ALLOW_THREADS
-        mm_aes_counter128(input, PyString_AS_STRING(output), inputlen,
-                          aes_key, idx);
+        mm_aes_ctr_crypt(input, PyString_AS_STRING(output), inputlen,
+                         aes_key, idx);
         Py_END_ALLOW_THREADS
 
         if (prng) free(input);
         return output;
 }
 
+const char mm_derive_keys__doc__[] =
+  "derive_keys(master, modes) -> list\n\n"
+  "Derives several keys from the master secret 'master'.  'modes' is a\n"
+  "sequence of (mode, kind) tuples.  For each one, we compute\n"
+  "SHA1(master+mode), and return:\n"
+  "   if kind is an integer n: the first n bytes of the digest.\n"
+  "   if kind is 'aes': aes_key() of the first 16 bytes of the digest.\n"
+  "   if kind is 'lioness': a tuple of 4 LIONESS keys: the digest, and\n"
+  "       the digest with its last byte xored with 1, 2, and 3.\n"
+  "   if kind is 'bear': a tuple of the first 2 LIONESS keys.\n";
+
+PyObject*
+mm_derive_keys(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        static char *kwlist[] = { "master", "modes", NULL };
+        unsigned char *master, *mode;
+        int masterlen, modelen, nModes, i, j, n;
+        unsigned char digest[SHA_DIGEST_LENGTH];
+        SHA_CTX ctx;
+        PyObject *modes, *item, *kind, *key, *result = NULL;
+        mm_AES_KEY *aes_key;
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict, "s#O:derive_keys",
+                                         kwlist, &master, &masterlen, &modes))
+                return NULL;
+        if (!(modes = PySequence_Fast(modes,
+                                      "derive_keys expects a sequence")))
+                return NULL;
+        nModes = PySequence_Fast_GET_SIZE(modes);
+        if (!(result = PyList_New(nModes)))
+                goto err;
+
+        for (i = 0; i < nModes; ++i) {
+                item = PySequence_Fast_GET_ITEM(modes, i);
+                if (!PyTuple_Check(item)) {
+                        TYPE_ERR("Expected a sequence of (mode, kind) tuples");
+                        goto err;
+                }
+                if (!PyArg_ParseTuple(item, "s#O:derive_keys", &mode,
+                                      &modelen, &kind))
+                        goto err;
+                SHA1_Init(&ctx);
+                SHA1_Update(&ctx, master, masterlen);
+                SHA1_Update(&ctx, mode, modelen);
+                SHA1_Final(digest, &ctx);
+
+                if (PyInt_Check(kind)) {
+                        n = (int) PyInt_AS_LONG(kind);
+                        if (n <= 0 || n > SHA_DIGEST_LENGTH) {
+                                TYPE_ERR("Key length out of range");
+                                goto err;
+                        }
+                        key = PyString_FromStringAndSize((char*)digest, n);
+                } else if (!PyString_Check(kind)) {
+                        TYPE_ERR("Expected an integer or a string");
+                        goto err;
+                } else if (!strcmp(PyString_AS_STRING(kind), "aes")) {
+                        if (!(aes_key = malloc(sizeof(mm_AES_KEY)))) {
+                                PyErr_NoMemory(); goto err;
+                        }
+                        if (mm_aes_ctr_set_key(aes_key, digest)) {
+                                memset(aes_key, 0, sizeof(mm_AES_KEY));
+                                free(aes_key);
+                                mm_SSL_ERR(1);
+                                goto err;
+                        }
+                        if (!(key = WRAP_AES(aes_key))) {
+                                memset(aes_key, 0, sizeof(mm_AES_KEY));
+                                free(aes_key);
+                                PyErr_NoMemory();
+                        }
+                } else if (!strcmp(PyString_AS_STRING(kind), "lioness") ||
+                           !strcmp(PyString_AS_STRING(kind), "bear")) {
+                        n = PyString_AS_STRING(kind)[0] == 'l' ? 4 : 2;
+                        if ((key = PyTuple_New(n))) {
+                                for (j = 0; j < n; ++j) {
+                                        PyObject *k;
+                                        if (!(k = PyString_FromStringAndSize(
+                                                 (char*)digest,
+                                                 SHA_DIGEST_LENGTH))) {
+                                                Py_DECREF(key);
+                                                key = NULL;
+                                                break;
+                                        }
+                                        PyString_AS_USTRING(k)[
+                                                SHA_DIGEST_LENGTH-1] ^= j;
+                                        PyTuple_SET_ITEM(key, j, k);
+                                }
+                        }
+                } else {
+                        TYPE_ERR("Unrecognized kind of key");
+                        goto err;
+                }
+                if (!key)
+                        goto err;
+                PyList_SET_ITEM(result, i, key);
+        }
+        memset(&ctx, 0, sizeof(ctx));
+        memset(digest, 0, sizeof(digest));
+        Py_DECREF(modes);
+        return result;
+
+ err:
+        memset(&ctx, 0, sizeof(ctx));
+        memset(digest, 0, sizeof(digest));
+        Py_DECREF(modes);
+        Py_XDECREF(result);
+        return NULL;
+}
+
+const char mm_aes_ctr_backend__doc__[] =
+  "aes_ctr_backend(name=None) -> str\n\n"
+  "Returns the name of the counter mode implementation that\n"
+  "aes_ctr128_crypt uses for long strings: 'evp' for OpenSSL's, or\n"
+  "'builtin' for our own.  If name is provided, switch to that\n"
+  "implementation first; raises CryptoError if it isn't available.\n";
+
+PyObject*
+mm_aes_ctr_backend(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        static char *kwlist[] = { "name", NULL };
+        char *name = NULL;
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict,
+                                         "|z:aes_ctr_backend", kwlist,
+                                         &name))
+                return NULL;
+
+        if (name && mm_aes_ctr_set_backend(name)) {
+                PyErr_SetString(mm_CryptoError,
+                                "Counter mode implementation not available");
+                return NULL;
+        }
+        return PyString_FromString(mm_aes_ctr_get_backend());
+}
+
 const char mm_aes128_block_crypt__doc__[] =
 "aes128_block_crypt(key, block, encrypt=0) -> result\n\n"
 "For testing only.  Encrypt or decrypt a single RSA block.\n";
@@ -241,7 +378,7 @@ mm_aes128_block_crypt(PyObject *self, PyObject *args, PyObject *kwdict)
         long inputlen;
         int encrypt=0;
         PyObject *result;
-        AES_KEY *aes_key = NULL;
+        mm_AES_KEY *aes_key = NULL;
 
         if (!PyArg_ParseTupleAndKeywords(args, kwdict,
                                          "O&s#|i:aes128_block_crypt", kwlist,
@@ -260,9 +397,11 @@ mm_aes128_block_crypt(PyObject *self, PyObject *args, PyObject *kwdict)
                 return NULL;
         }
         if (encrypt) {
-                AES_encrypt(input, PyString_AS_USTRING(result), aes_key);
+                AES_encrypt(input, PyString_AS_USTRING(result),
+                            &aes_key->key);
         } else {
-                AES_decrypt(input, PyString_AS_USTRING(result), aes_key);
+                AES_decrypt(input, PyString_AS_USTRING(result),
+                            &aes_key->key);
         }
 
         return result;
@@ -306,6 +445,249 @@ mm_strxor(PyObject *self, PyObject *args, PyObject *kwdict)
         return output;
 }
 
+/* One round of LIONESS or BEAR.  We treat the input as a 20-byte left
+ * half L and a right half R.  A hash round sets L ^= SHA1(K|R|K).  A
+ * stream round encrypts R in counter mode, keyed with the first 16 bytes
+ * of SHA1(K|L|K) -- or of SHA1(L), if the round has no key.
+ */
+typedef struct sprp_round {
+        int stream; /* Is this a stream round?  (Else, a hash round.) */
+        int key;    /* Index of the key for this round, or -1 for none. */
+} sprp_round;
+
+static const sprp_round lioness_encrypt_rounds[] =
+        { {1, 0}, {0, 1}, {1, 2}, {0, 3} };
+static const sprp_round lioness_decrypt_rounds[] =
+        { {0, 3}, {1, 2}, {0, 1}, {1, 0} };
+static const sprp_round bear_encrypt_rounds[] =
+        { {0, 0}, {1, -1}, {0, 1} };
+static const sprp_round bear_decrypt_rounds[] =
+        { {0, 1}, {1, -1}, {0, 0} };
+
+/* Helper: run the 'nRounds' rounds in 'rounds' in place over the 'len'
+ * bytes at 'buf', using the 'nKeys' keys in 'keys' (with lengths in
+ * 'keylens').  We release the GIL while we work.  Return 0 on success; on
+ * failure, set a Python exception and return -1.
+ */
+static int
+sprp_crypt_inplace(unsigned char *buf, int len,
+                   const unsigned char **keys, const int *keylens, int nKeys,
+                   const sprp_round *rounds, int nRounds)
+{
+        unsigned char *left, *right;
+        const unsigned char *key;
+        unsigned char digest[SHA_DIGEST_LENGTH];
+        SHA_CTX ctx;
+        mm_AES_KEY aes_key;
+        int i, j, rightlen, r = 0;
+
+        for (i = 0; i < nKeys; ++i) {
+                if (keylens[i] != SHA_DIGEST_LENGTH) {
+                        TYPE_ERR("Keys must be 20 bytes long");
+                        return -1;
+                }
+        }
+        if (len <= SHA_DIGEST_LENGTH) {
+                TYPE_ERR("String must be longer than 20 bytes");
+                return -1;
+        }
+        left = buf;
+        right = left + SHA_DIGEST_LENGTH;
+        rightlen = len - SHA_DIGEST_LENGTH;
+
+        Py_BEGIN_ALLOW_THREADS
+        for (i = 0; i < nRounds; ++i) {
+                key = rounds[i].key < 0 ? NULL : keys[rounds[i].key];
+                SHA1_Init(&ctx);
+                if (key) SHA1_Update(&ctx, key, SHA_DIGEST_LENGTH);
+                if (rounds[i].stream)
+                        SHA1_Update(&ctx, left, SHA_DIGEST_LENGTH);
+                else
+                        SHA1_Update(&ctx, right, rightlen);
+                if (key) SHA1_Update(&ctx, key, SHA_DIGEST_LENGTH);
+                SHA1_Final(digest, &ctx);
+                if (rounds[i].stream) {
+                        if ((r = mm_aes_ctr_set_key(&aes_key, digest)))
+                                break;
+                        mm_aes_ctr_crypt((char*)right, (char*)right,
+                                         rightlen, &aes_key, 0);
+                } else {
+                        for (j = 0; j < SHA_DIGEST_LENGTH; ++j)
+                                left[j] ^= digest[j];
+                }
+        }
+        memset(&ctx, 0, sizeof(ctx));
+        memset(&aes_key, 0, sizeof(aes_key));
+        memset(digest, 0, sizeof(digest));
+        Py_END_ALLOW_THREADS
+
+        if (r) {
+                mm_SSL_ERR(1);
+                return -1;
+        }
+        return 0;
+}
+
+/* Helper: return a new string holding the result of running 'rounds'
+ * over the 'inputlen' bytes at 'input'.  We copy the input once, and do
+ * every round in place on the copy.
+ */
+static PyObject*
+mm_sprp_crypt(const unsigned char *input, int inputlen,
+              const unsigned char **keys, const int *keylens, int nKeys,
+              const sprp_round *rounds, int nRounds)
+{
+        PyObject *output;
+
+        if (!(output = PyString_FromStringAndSize((char*)input, inputlen))) {
+                PyErr_NoMemory();
+                return NULL;
+        }
+        if (sprp_crypt_inplace(PyString_AS_USTRING(output), inputlen,
+                               keys, keylens, nKeys, rounds, nRounds)) {
+                Py_DECREF(output);
+                return NULL;
+        }
+        return output;
+}
+
+const char mm_lioness_encrypt__doc__[] =
+  "lioness_encrypt(string, (key1, key2, key3, key4)) -> str\n\n"
+  "Encrypts a string with the LIONESS super-pseudorandom permutation.\n"
+  "All four keys must be 20 bytes long, and the string must be longer\n"
+  "than 20 bytes.\n";
+
+PyObject*
+mm_lioness_encrypt(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        static char *kwlist[] = { "string", "keys", NULL };
+        const unsigned char *input, *keys[4];
+        int inputlen, keylens[4];
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict,
+                                         "s#(s#s#s#s#):lioness_encrypt",
+                                         kwlist, &input, &inputlen,
+                                         &keys[0], &keylens[0],
+                                         &keys[1], &keylens[1],
+                                         &keys[2], &keylens[2],
+                                         &keys[3], &keylens[3]))
+                return NULL;
+
+        return mm_sprp_crypt(input, inputlen, keys, keylens, 4,
+                             lioness_encrypt_rounds, 4);
+}
+
+const char mm_lioness_decrypt__doc__[] =
+  "lioness_decrypt(string, (key1, key2, key3, key4)) -> str\n\n"
+  "Decrypts a string encrypted with lioness_encrypt.\n";
+
+PyObject*
+mm_lioness_decrypt(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        static char *kwlist[] = { "string", "keys", NULL };
+        const unsigned char *input, *keys[4];
+        int inputlen, keylens[4];
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict,
+                                         "s#(s#s#s#s#):lioness_decrypt",
+                                         kwlist, &input, &inputlen,
+                                         &keys[0], &keylens[0],
+                                         &keys[1], &keylens[1],
+                                         &keys[2], &keylens[2],
+                                         &keys[3], &keylens[3]))
+                return NULL;
+
+        return mm_sprp_crypt(input, inputlen, keys, keylens, 4,
+                             lioness_decrypt_rounds, 4);
+}
+
+/* The 'w*' format and Py_buffer only exist in Python 2.6 and later; on
+ * older Pythons, we don't provide lioness_decrypt_inplace at all, and
+ * callers fall back to lioness_decrypt.
+ */
+#if PY_VERSION_HEX >= 0x02060000
+const char mm_lioness_decrypt_inplace__doc__[] =
+  "lioness_decrypt_inplace(buffer, (key1, key2, key3, key4)) -> None\n\n"
+  "As lioness_decrypt, but decrypts the contents of the writable buffer\n"
+  "'buffer' (such as a bytearray or memoryview) in place.\n";
+
+PyObject*
+mm_lioness_decrypt_inplace(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        static char *kwlist[] = { "buffer", "keys", NULL };
+        Py_buffer buf;
+        const unsigned char *keys[4];
+        int keylens[4], r;
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict,
+                                         "w*(s#s#s#s#):lioness_decrypt_inplace",
+                                         kwlist, &buf,
+                                         &keys[0], &keylens[0],
+                                         &keys[1], &keylens[1],
+                                         &keys[2], &keylens[2],
+                                         &keys[3], &keylens[3]))
+                return NULL;
+
+        if (buf.len > INT_MAX) {
+                PyBuffer_Release(&buf);
+                TYPE_ERR("String too long");
+                return NULL;
+        }
+        r = sprp_crypt_inplace(buf.buf, (int)buf.len, keys, keylens, 4,
+                               lioness_decrypt_rounds, 4);
+        PyBuffer_Release(&buf);
+        if (r)
+                return NULL;
+        Py_INCREF(Py_None);
+        return Py_None;
+}
+#endif
+
+const char mm_bear_encrypt__doc__[] =
+  "bear_encrypt(string, (key1, key2)) -> str\n\n"
+  "Encrypts a string with the BEAR pseudorandom permutation.  Both keys\n"
+  "must be 20 bytes long, and the string must be longer than 20 bytes.\n";
+
+PyObject*
+mm_bear_encrypt(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        static char *kwlist[] = { "string", "keys", NULL };
+        const unsigned char *input, *keys[2];
+        int inputlen, keylens[2];
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict,
+                                         "s#(s#s#):bear_encrypt",
+                                         kwlist, &input, &inputlen,
+                                         &keys[0], &keylens[0],
+                                         &keys[1], &keylens[1]))
+                return NULL;
+
+        return mm_sprp_crypt(input, inputlen, keys, keylens, 2,
+                             bear_encrypt_rounds, 3);
+}
+
+const char mm_bear_decrypt__doc__[] =
+  "bear_decrypt(string, (key1, key2)) -> str\n\n"
+  "Decrypts a string encrypted with bear_encrypt.\n";
+
+PyObject*
+mm_bear_decrypt(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        static char *kwlist[] = { "string", "keys", NULL };
+        const unsigned char *input, *keys[2];
+        int inputlen, keylens[2];
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict,
+                                         "s#(s#s#):bear_decrypt",
+                                         kwlist, &input, &inputlen,
+                                         &keys[0], &keylens[0],
+                                         &keys[1], &keylens[1]))
+                return NULL;
+
+        return mm_sprp_crypt(input, inputlen, keys, keylens, 2,
+                             bear_decrypt_rounds, 3);
+}
+
 const char mm_openssl_seed__doc__[]=
   "openssl_seed(str)\n\n"
   "Seeds OpenSSL\'s internal random number generator with a provided source\n"
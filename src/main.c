@@ -54,8 +54,17 @@ static struct PyMethodDef _mixcryptlib_functions[] = {
         ENTRY(sha1),
         ENTRY(aes_key),
         ENTRY(aes_ctr128_crypt),
+        ENTRY(aes_ctr_backend),
+        ENTRY(derive_keys),
         ENTRY(aes128_block_crypt),
         ENTRY(strxor),
+        ENTRY(lioness_encrypt),
+        ENTRY(lioness_decrypt),
+#if PY_VERSION_HEX >= 0x02060000
+        ENTRY(lioness_decrypt_inplace),
+#endif
+        ENTRY(bear_encrypt),
+        ENTRY(bear_decrypt),
         ENTRY(openssl_seed),
         ENTRY(openssl_rand),
 #ifdef MS_WINDOWS
@@ -74,6 +83,8 @@ static struct PyMethodDef _mixcryptlib_functions[] = {
         ENTRY(TLSContext_new),
 
         ENTRY(FEC_generate),
+
+        ENTRY(shred_files),
         { NULL, NULL }
 };
 
@@ -115,6 +126,60 @@ exc(PyObject *module_dict, PyObject **exception, char *longName,
         return 0;
 }
 
+#if defined(WITH_THREAD) && OPENSSL_VERSION_NUMBER < 0x10100000L
+#include "pythread.h"
+
+/* OpenSSL before 1.1.0 is only threadsafe if the application gives it
+ * locks to use.  Since our RSA, AES, and TLS operations release the
+ * interpreter lock, we need to install them ourselves.  (If something
+ * else, such as Python's own _ssl module, has already done so, we leave
+ * its callbacks alone.)
+ */
+static PyThread_type_lock *mm_openssl_locks = NULL;
+
+static void
+mm_openssl_locking_cb(int mode, int n, const char *file, int line)
+{
+        if (mode & CRYPTO_LOCK)
+                PyThread_acquire_lock(mm_openssl_locks[n], WAIT_LOCK);
+        else
+                PyThread_release_lock(mm_openssl_locks[n]);
+}
+
+static unsigned long
+mm_openssl_id_cb(void)
+{
+        return (unsigned long) PyThread_get_thread_ident();
+}
+
+/* Install OpenSSL's locking and thread-id callbacks, unless somebody has
+ * installed some already.  Return 0 on success, and -1 (with a Python
+ * exception set) on failure. */
+static int
+mm_openssl_threads_init(void)
+{
+        int i, n;
+        if (CRYPTO_get_locking_callback() != NULL)
+                return 0;
+        n = CRYPTO_num_locks();
+        mm_openssl_locks = malloc(n * sizeof(PyThread_type_lock));
+        if (!mm_openssl_locks) {
+                PyErr_NoMemory();
+                return -1;
+        }
+        for (i = 0; i < n; ++i) {
+                if (!(mm_openssl_locks[i] = PyThread_allocate_lock())) {
+                        PyErr_NoMemory();
+                        return -1;
+                }
+        }
+        if (CRYPTO_get_id_callback() == NULL)
+                CRYPTO_set_id_callback(mm_openssl_id_cb);
+        CRYPTO_set_locking_callback(mm_openssl_locking_cb);
+        return 0;
+}
+#endif
+
 /* Required by Python: magic method to tell the Python runtime about our
  * new module and its contents.  Also initializes OpenSSL as needed.
  */
@@ -133,6 +198,11 @@ init_minionlib(void)
         ERR_load_RSA_strings();
 
         OpenSSL_add_all_algorithms();
+        mm_aes_ctr_init();
+#if defined(WITH_THREAD) && OPENSSL_VERSION_NUMBER < 0x10100000L
+        if (mm_openssl_threads_init() < 0)
+                return;
+#endif
 
         if (exc(d, &mm_CryptoError, "mixminion._minionlib.CryptoError",
                 "CryptoError", mm_CryptoError__doc__))
@@ -0,0 +1,238 @@
+/* Copyright 2002-2011 Nick Mathewson.  See LICENSE for licensing information*/
+#include <Python.h>
+
+#include <sys/types.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <errno.h>
+#include <string.h>
+#include <stdlib.h>
+#ifdef MS_WINDOWS
+#include <io.h>
+#else
+#include <unistd.h>
+#endif
+
+#ifndef TRUNCATED_OPENSSL_INCLUDES
+#include <openssl/rand.h>
+#else
+#include <rand.h>
+#endif
+
+#include "_minionlib.h"
+
+/* Overwriting files in-process, so that we don't need to fork and exec
+ * a 'shred' command for every batch of packets we delete.
+ */
+
+#ifndef O_BINARY
+#define O_BINARY 0
+#endif
+
+/* How much do we write at a time? */
+#define SHRED_BUFLEN 65536
+/* Block size to assume when the filesystem won't tell us. */
+#define SHRED_DFLT_BLKSIZE 8192
+
+/* Helper: write 'len' bytes from 'buf' to 'fd' at offset 'off'.  Return 0
+ * on success, -1 on failure. */
+static int
+shred_pwrite(int fd, const unsigned char *buf, size_t len, off_t off)
+{
+        ssize_t r;
+#ifdef MS_WINDOWS
+        if (lseek(fd, off, SEEK_SET) < 0)
+                return -1;
+#endif
+        while (len) {
+#ifdef MS_WINDOWS
+                r = write(fd, buf, len);
+#else
+                r = pwrite(fd, buf, len, off);
+#endif
+                if (r < 0) {
+                        if (errno == EINTR) continue;
+                        return -1;
+                }
+                buf += r; off += r; len -= r;
+        }
+        return 0;
+}
+
+/* Helper: flush the data (but not necessarily the metadata) of 'fd' to
+ * disk. */
+static int
+shred_sync(int fd)
+{
+#if defined(MS_WINDOWS)
+        return _commit(fd);
+#elif defined(HAVE_FDATASYNC)
+        return fdatasync(fd);
+#else
+        return fsync(fd);
+#endif
+}
+
+/* Helper: give the blocks in the first 'len' bytes of 'fd' back to the
+ * filesystem, if we know how. */
+static void
+shred_punch(int fd, off_t len)
+{
+#if defined(FALLOC_FL_PUNCH_HOLE) && defined(FALLOC_FL_KEEP_SIZE)
+        fallocate(fd, FALLOC_FL_PUNCH_HOLE|FALLOC_FL_KEEP_SIZE, 0, len);
+#else
+        (void)fd; (void)len;
+#endif
+}
+
+/* State for a single file we're deleting. */
+typedef struct shred_file {
+        const char *name;
+        int fd;
+        off_t len;  /* Size of the file, rounded up to a whole block. */
+        int err;    /* 0, or the errno of the first failure. */
+} shred_file;
+
+const char mm_shred_files__doc__[] =
+  "shred_files(fnames, passes=0, punch=0) -> list\n\n"
+  "Overwrites and unlinks every file in the list 'fnames'.  Each file\n"
+  "is overwritten 'passes' times with random bytes, and then once with\n"
+  "zeros, rounded up to a whole filesystem block.  We write every file\n"
+  "in the batch before syncing any of them, so that the disk sees a\n"
+  "few large flushes rather than many small ones.  If 'punch' is true\n"
+  "and the platform supports it, we release each file's blocks before\n"
+  "unlinking it.\n\n"
+  "Returns a list of (filename, errno) for each file we couldn't\n"
+  "overwrite or remove.\n";
+
+PyObject*
+mm_shred_files(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        static char *kwlist[] = { "fnames", "passes", "punch", NULL };
+        PyObject *fnames, *seq, *item, *result = NULL;
+        int passes = 0, punch = 0;
+        int n, i, pass;
+        shred_file *files = NULL;
+        unsigned char *buf = NULL;
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict, "O|ii:shred_files",
+                                         kwlist, &fnames, &passes, &punch))
+                return NULL;
+        if (passes < 0) {
+                PyErr_SetString(PyExc_ValueError, "passes must be >= 0");
+                return NULL;
+        }
+        if (!(seq = PySequence_Fast(fnames, "fnames must be a sequence")))
+                return NULL;
+
+        n = PySequence_Fast_GET_SIZE(seq);
+        files = malloc(sizeof(shred_file)*(n ? n : 1));
+        buf = malloc(SHRED_BUFLEN);
+        if (!files || !buf) {
+                PyErr_NoMemory(); goto done;
+        }
+        for (i = 0; i < n; ++i) {
+                item = PySequence_Fast_GET_ITEM(seq, i);
+                if (!PyString_Check(item)) {
+                        PyErr_SetString(PyExc_TypeError,
+                                        "fnames must contain strings");
+                        goto done;
+                }
+                files[i].name = PyString_AS_STRING(item);
+                files[i].fd = -1;
+                files[i].len = 0;
+                files[i].err = 0;
+        }
+
+        Py_BEGIN_ALLOW_THREADS
+        for (i = 0; i < n; ++i) {
+                struct stat st;
+                off_t blk;
+                files[i].fd = open(files[i].name, O_WRONLY|O_BINARY);
+                if (files[i].fd < 0 || fstat(files[i].fd, &st) < 0) {
+                        files[i].err = errno;
+                        continue;
+                }
+#ifdef MS_WINDOWS
+                blk = SHRED_DFLT_BLKSIZE;
+#else
+                blk = st.st_blksize > 0 ? st.st_blksize : SHRED_DFLT_BLKSIZE;
+#endif
+                files[i].len = ((st.st_size + blk - 1) / blk) * blk;
+        }
+
+        /* 'passes' random passes, then one pass of zeros. */
+        for (pass = 0; pass <= passes; ++pass) {
+                int zero = (pass == passes);
+                if (zero)
+                        memset(buf, 0, SHRED_BUFLEN);
+                for (i = 0; i < n; ++i) {
+                        off_t off;
+                        size_t len;
+                        if (files[i].fd < 0 || files[i].err)
+                                continue;
+                        for (off = 0; off < files[i].len; off += len) {
+                                len = SHRED_BUFLEN;
+                                if (files[i].len - off < (off_t)len)
+                                        len = (size_t)(files[i].len - off);
+                                if (!zero && !RAND_bytes(buf, (int)len)) {
+                                        files[i].err = EIO;
+                                        break;
+                                }
+                                if (shred_pwrite(files[i].fd, buf, len, off)) {
+                                        files[i].err = errno;
+                                        break;
+                                }
+                        }
+                }
+                for (i = 0; i < n; ++i) {
+                        if (files[i].fd >= 0 && !files[i].err &&
+                            shred_sync(files[i].fd))
+                                files[i].err = errno;
+                }
+        }
+
+        for (i = 0; i < n; ++i) {
+                if (files[i].fd >= 0) {
+                        if (punch && !files[i].err)
+                                shred_punch(files[i].fd, files[i].len);
+                        close(files[i].fd);
+                }
+                /* Even if we couldn't open or overwrite the file, we still
+                 * remove it: leaving it in place would be worse. */
+                if (unlink(files[i].name) < 0 && !files[i].err)
+                        files[i].err = errno;
+        }
+        Py_END_ALLOW_THREADS
+
+        if (!(result = PyList_New(0)))
+                goto done;
+        for (i = 0; i < n; ++i) {
+                if (files[i].err) {
+                        item = Py_BuildValue("(Oi)",
+                                             PySequence_Fast_GET_ITEM(seq, i),
+                                             files[i].err);
+                        if (!item || PyList_Append(result, item) < 0) {
+                                Py_XDECREF(item);
+                                Py_DECREF(result);
+                                result = NULL;
+                                goto done;
+                        }
+                        Py_DECREF(item);
+                }
+        }
+
+ done:
+        Py_DECREF(seq);
+        if (files) free(files);
+        if (buf) free(buf);
+        return result;
+}
+
+/*
+  Local Variables:
+  mode:c
+  indent-tabs-mode:nil
+  c-basic-offset:8
+  End:
+*/